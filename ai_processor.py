@@ -2,29 +2,62 @@
 OpenAI Function Calling Integration for USSD Natural Language Processing
 Processes natural language inputs and converts them to USSD actions
 """
-import openai
 import json
 import logging
+from dataclasses import dataclass
 from typing import Dict, Any, Optional, Tuple
-from config import Config
+from config import Config, validate_config
+from circuit_breaker import dependencies
+from tracing import instrument_openai
+from metrics import AI_REQUESTS
+from phone_numbers import normalize_or_original
+from exchange_rate import kes_to_sats, sats_to_kes, sats_to_kes_text, rate_pair_text
+from rule_engine import rules
 import re
 
 logger = logging.getLogger(__name__)
 
+@dataclass(slots=True)
+class SessionContext:
+    """
+    Operation an AI conversation is in the middle of, and what it waits for.
+
+    Args:
+        operation: 'topup_mpesa', 'withdraw_mpesa', 'buy_airtime' or 'send_bitcoin'
+        awaiting: Next expected input ('amount', 'confirmation', 'phone_number', ...)
+        kes_amount: Amount entered in KES
+        amount: Amount in sats (top-up equivalent or sats needed for a withdrawal)
+    """
+    operation: str
+    awaiting: Optional[str] = None
+    kes_amount: Optional[int] = None
+    amount: Optional[int] = None
+
+    def data(self) -> Dict[str, int]:
+        """Inputs collected so far"""
+        data = {}
+        if self.kes_amount is not None:
+            data['kes_amount'] = self.kes_amount
+        if self.amount is not None:
+            data['sats'] = self.amount
+        return data
+
 class USSDNaturalLanguageProcessor:
     """Process natural language USSD inputs using OpenAI function calling"""
     
     def __init__(self):
-        self.client = openai.OpenAI(api_key=Config.OPENAI_API_KEY)
+        self._client = None
         self.model = Config.OPENAI_MODEL
         
         # Session-based conversation history storage
         # Format: {session_id: [{"role": "user", "content": "..."}, {"role": "assistant", "content": "..."}]}
         self.conversation_history = {}
-        self.session_context = {}  # Store current operation context per session
-        
-        # Define available USSD functions
-        self.ussd_functions = [
+        self.session_context: Dict[str, SessionContext] = {}  # Current operation per session
+    
+    @property
+    def ussd_functions(self):
+        """Available USSD functions (built per request so the airtime limits follow the rules)"""
+        return [
             {
                 "type": "function",
                 "function": {
@@ -182,7 +215,8 @@ class USSDNaturalLanguageProcessor:
                             },
                             "amount": {
                                 "type": "number",
-                                "description": "Amount in KES for airtime purchase (minimum 10 KES, maximum 1000 KES)"
+                                "description": (f"Amount in KES for airtime purchase (minimum {rules.limit('MinimumAirtime')} KES, "
+                                                f"maximum {rules.limit('MaximumAirtime')} KES)")
                             }
                         },
                         "required": ["amount"]
@@ -191,6 +225,15 @@ class USSDNaturalLanguageProcessor:
             }
         ]
     
+    @property
+    def client(self):
+        """OpenAI client, created on first use to keep it out of import time"""
+        if self._client is None:
+            import openai
+            validate_config()
+            self._client = instrument_openai(openai.OpenAI(api_key=Config.OPENAI_API_KEY))
+        return self._client
+    
     def add_to_conversation_history(self, session_id: str, role: str, content: str):
         """Add message to conversation history for a session"""
         if session_id not in self.conversation_history:
@@ -209,13 +252,13 @@ class USSDNaturalLanguageProcessor:
         """Get conversation history for a session"""
         return self.conversation_history.get(session_id, [])
     
-    def set_session_context(self, session_id: str, context: Dict[str, Any]):
+    def set_session_context(self, session_id: str, context: SessionContext):
         """Set context for a session (current operation, expected input, etc.)"""
         self.session_context[session_id] = context
     
-    def get_session_context(self, session_id: str) -> Dict[str, Any]:
+    def get_session_context(self, session_id: str) -> Optional[SessionContext]:
         """Get context for a session"""
-        return self.session_context.get(session_id, {})
+        return self.session_context.get(session_id)
     
     def clear_session_context(self, session_id: str):
         """Clear context for a session"""
@@ -237,17 +280,17 @@ class USSDNaturalLanguageProcessor:
             
             # Get conversation history and session context
             conversation_history = self.get_conversation_history(session_id) if session_id else []
-            session_context = self.get_session_context(session_id) if session_id else {}
+            session_context = self.get_session_context(session_id) if session_id else None
             
             # Build context-aware system message
             system_message = f"""You are a Bitcoin Lightning Network USSD wallet assistant for Kenya.
             User phone: {phone_number}
-            Current balance: {current_balance} sats (≈{current_balance/150:.2f} KES)
+            Current balance: {current_balance} sats (≈{sats_to_kes_text(current_balance, session_id)} KES)
             
             CONVERSATION CONTEXT:
-            {f"Current operation: {session_context.get('operation', 'None')}" if session_context else ""}
-            {f"Awaiting: {session_context.get('awaiting', 'None')}" if session_context else ""}
-            {f"Partial data: {session_context.get('data', {})}" if session_context else ""}
+            {f"Current operation: {session_context.operation}" if session_context else ""}
+            {f"Awaiting: {session_context.awaiting}" if session_context else ""}
+            {f"Partial data: {session_context.data()}" if session_context else ""}
             
             Parse user requests and call appropriate functions. Handle various ways users might express their intent:
             
@@ -271,7 +314,7 @@ class USSDNaturalLanguageProcessor:
             - Bob: +254787654321  
             - Charlie: +254798765432
             
-            Exchange rate: 150 KES = 1000 sats
+            Exchange rate: {rate_pair_text(session_id)}
             
             IMPORTANT: Use conversation history to understand follow-up responses.
             If user previously asked to "top up" and now provides "500", treat as "topup 500 KES".
@@ -324,11 +367,10 @@ class USSDNaturalLanguageProcessor:
     
     def convert_amount(self, amount: float, from_currency: str, to_currency: str) -> int:
         """Convert between KES and satoshis"""
-        # Exchange rate: 150 KES = 1000 sats
         if from_currency.lower() in ["kes", "shillings"] and to_currency.lower() in ["sats", "satoshis"]:
-            return int(amount * (1000 / 150))
+            return kes_to_sats(amount)
         elif from_currency.lower() in ["sats", "satoshis"] and to_currency.lower() in ["kes", "shillings"]:
-            return int(amount * (150 / 1000))
+            return sats_to_kes(amount)
         else:
             return int(amount)
     
@@ -344,11 +386,8 @@ class USSDNaturalLanguageProcessor:
         if recipient_lower in name_to_phone:
             return name_to_phone[recipient_lower]
         
-        # If it looks like a phone number, return as is
-        if recipient.startswith('+254') or recipient.startswith('254') or recipient.startswith('0'):
-            return recipient
-        
-        return recipient
+        # Phone numbers come back in E.164; anything else is returned unchanged
+        return normalize_or_original(recipient)
     
     def generate_natural_response(self, action_result: str, context: Dict[str, Any]) -> str:
         """Generate natural language response for action results"""
@@ -410,14 +449,16 @@ class AIEnhancedUSSDHandler:
             
             # Check if this is a follow-up response to a previous AI request
             session_context = self.ai_processor.get_session_context(session_id)
-            if session_context and session_context.get('awaiting'):
+            if session_context and session_context.awaiting:
                 # Extract just the latest input part for context-based responses
                 input_parts = user_input.split('*')
                 latest_input = input_parts[-1] if input_parts else user_input
                 logger.info(f"Processing context-based follow-up: '{latest_input}' in context: {session_context}")
+                AI_REQUESTS.inc('session_context')
                 return self._handle_context_based_response(session_id, phone_number, latest_input, session_context)
             
             # Process with AI including session context
+            AI_REQUESTS.inc('openai')
             action_type, action_params = self.ai_processor.process_natural_language(
                 user_input, phone_number, current_balance, session_id
             )
@@ -477,18 +518,17 @@ class AIEnhancedUSSDHandler:
         user_lower = user_input.lower()
         return any(keyword in user_lower for keyword in informational_keywords)
     
-    def _handle_informational_request_with_context(self, session_id: str, phone_number: str, user_input: str, context: Dict) -> str:
+    def _handle_informational_request_with_context(self, session_id: str, phone_number: str, user_input: str, context: SessionContext) -> str:
         """Handle informational requests while preserving operation context"""
         try:
-            operation = context.get('operation')
-            awaiting = context.get('awaiting')
-            data = context.get('data', {})
+            operation = context.operation
+            awaiting = context.awaiting
             
             # Handle specific informational requests
             user_lower = user_input.lower()
             
             if any(word in user_lower for word in ['exchange', 'rate', 'how much']):
-                info_response = "CON Current Exchange Rate:\\n150 KES = 1,000 sats\\n\\n"
+                info_response = f"CON Current Exchange Rate:\\n{rate_pair_text(session_id)}\\n\\n"
                 
                 if operation == 'topup_mpesa' and awaiting == 'amount':
                     info_response += "You were entering Lightning purchase amount.\\nEnter amount in KES:"
@@ -517,7 +557,10 @@ class AIEnhancedUSSDHandler:
                     return "CON No pending operation to continue.\\n\\n0. Main menu"
             
             elif 'help' in user_lower:
-                help_response = "CON Lightning Network Help:\\n• 150 KES = 1,000 sats\\n• Min Lightning purchase: 10 KES (66 sats)\\n• Min withdrawal: 100 KES\\n\\n"
+                minimum_topup = rules.limit('MinimumTopUp')
+                help_response = (f"CON Lightning Network Help:\\n• {rate_pair_text(session_id)}\\n"
+                                 f"• Min Lightning purchase: {minimum_topup} KES ({kes_to_sats(minimum_topup, session_id)} sats)\\n"
+                                 f"• Min withdrawal: {rules.limit('MinimumWithdrawal')} KES\\n\\n")
                 
                 if operation and awaiting:
                     help_response += f"Currently: {operation.replace('_', ' ')} - {awaiting}\\n\\n"
@@ -538,12 +581,11 @@ class AIEnhancedUSSDHandler:
             logger.error(f"Error handling informational request: {e}")
             return "CON Type 'continue' to resume or '0' for main menu."
     
-    def _handle_context_based_response(self, session_id: str, phone_number: str, user_input: str, context: Dict) -> str:
+    def _handle_context_based_response(self, session_id: str, phone_number: str, user_input: str, context: SessionContext) -> str:
         """Handle follow-up responses based on session context"""
         try:
-            operation = context.get('operation')
-            awaiting = context.get('awaiting')
-            data = context.get('data', {})
+            operation = context.operation
+            awaiting = context.awaiting
             
             logger.info(f"Handling context-based response: operation={operation}, awaiting={awaiting}, input={user_input}")
             
@@ -556,17 +598,14 @@ class AIEnhancedUSSDHandler:
                     # User provided amount
                     try:
                         kes_amount = int(user_input.strip())
-                        if kes_amount < 10:
-                            return "CON Minimum Lightning Network purchase is 10 KES (66 sats).\nEnter amount in KES:"
+                        minimum_error = rules.check('MinimumTopUp', kes_amount=kes_amount)
+                        if minimum_error:
+                            return f"CON {minimum_error}.\nEnter amount in KES:"
                         
-                        sats_equivalent = int(kes_amount * (1000 / 150))
+                        sats_equivalent = kes_to_sats(kes_amount, session_id)
                         
                         # Update context to await confirmation
-                        self.ai_processor.set_session_context(session_id, {
-                            'operation': 'topup_mpesa',
-                            'awaiting': 'confirmation',
-                            'data': {'kes_amount': kes_amount, 'sats_equivalent': sats_equivalent}
-                        })
+                        self.ai_processor.set_session_context(session_id, SessionContext('topup_mpesa', 'confirmation', kes_amount=kes_amount, amount=sats_equivalent))
                         
                         return f"CON Top up {kes_amount} KES ({sats_equivalent:,} sats)?\n\n1. Yes, send M-Pesa request\n2. Cancel"
                     except ValueError:
@@ -575,9 +614,10 @@ class AIEnhancedUSSDHandler:
                 elif awaiting == 'confirmation':
                     # User confirmed the top-up amount
                     if user_input.strip().lower() in ['1', 'yes', 'y', 'confirm']:
-                        kes_amount = data.get('kes_amount')
+                        kes_amount = context.kes_amount
                         # Execute STK push directly (no code needed)
-                        success, message, transaction_data = self.original_handler.topup_via_mpesa(phone_number, kes_amount)
+                        success, message, transaction_data = self.original_handler.topup_via_mpesa(phone_number, kes_amount,
+                                                                                                      session_id=session_id)
                         
                         # Clear context
                         self.ai_processor.clear_session_context(session_id)
@@ -587,8 +627,8 @@ class AIEnhancedUSSDHandler:
                         self.ai_processor.clear_session_context(session_id)
                         return "END M-Pesa top-up cancelled."
                     else:
-                        kes_amount = data.get('kes_amount')
-                        sats_equivalent = data.get('sats_equivalent')
+                        kes_amount = context.kes_amount
+                        sats_equivalent = context.amount
                         return f"CON Top up {kes_amount} KES ({sats_equivalent:,} sats)?\n\n1. Yes, send M-Pesa request\n2. Cancel"
             
             elif operation == 'withdraw_mpesa':
@@ -596,10 +636,11 @@ class AIEnhancedUSSDHandler:
                     # User provided amount
                     try:
                         kes_amount = int(user_input.strip())
-                        if kes_amount < 100:
-                            return "CON Minimum withdrawal is 100 KES.\nEnter amount in KES:"
+                        minimum_error = rules.check('MinimumWithdrawal', kes_amount=kes_amount)
+                        if minimum_error:
+                            return f"CON {minimum_error}.\nEnter amount in KES:"
                         
-                        sats_needed = int(kes_amount * (1000 / 150))
+                        sats_needed = kes_to_sats(kes_amount, session_id)
                         
                         # Check balance
                         balance = self.original_handler.get_user_balance(phone_number)
@@ -607,11 +648,7 @@ class AIEnhancedUSSDHandler:
                             return f"CON Insufficient balance. You have {balance:,} sats, need {sats_needed:,} sats.\nEnter amount in KES:"
                         
                         # Update context to await phone number
-                        self.ai_processor.set_session_context(session_id, {
-                            'operation': 'withdraw_mpesa',
-                            'awaiting': 'phone_number',
-                            'data': {'kes_amount': kes_amount, 'sats_needed': sats_needed}
-                        })
+                        self.ai_processor.set_session_context(session_id, SessionContext('withdraw_mpesa', 'phone_number', kes_amount=kes_amount, amount=sats_needed))
                         
                         return f"CON Withdraw {kes_amount} KES ({sats_needed:,} sats)\nEnter M-Pesa phone number:"
                     except ValueError:
@@ -625,9 +662,10 @@ class AIEnhancedUSSDHandler:
                     if not self.original_handler.validate_phone_number(normalized_phone):
                         return "CON Invalid phone number format.\nEnter M-Pesa phone number:"
                     
-                    kes_amount = data.get('kes_amount')
+                    kes_amount = context.kes_amount
                     # Execute withdrawal
-                    success, message, _ = self.original_handler.withdraw_to_mpesa(phone_number, kes_amount, normalized_phone)
+                    success, message, _ = self.original_handler.withdraw_to_mpesa(phone_number, kes_amount, normalized_phone,
+                                                                                   session_id=session_id)
                     
                     # Clear context
                     self.ai_processor.clear_session_context(session_id)
@@ -639,38 +677,29 @@ class AIEnhancedUSSDHandler:
                     # User provided amount
                     try:
                         kes_amount = int(user_input.strip())
-                        if kes_amount < 10:
-                            return "CON Minimum airtime purchase is 10 KES.\nEnter amount in KES:"
-                        if kes_amount > 1000:
-                            return "CON Maximum airtime purchase is 1,000 KES.\nEnter amount in KES:"
+                        limit_error = rules.first_violation(('MinimumAirtime', 'MaximumAirtime'), kes_amount=kes_amount)
+                        if limit_error:
+                            return f"CON {limit_error}.\nEnter amount in KES:"
                         
                         # Ask if they want to buy for themselves or another number
-                        self.ai_processor.set_session_context(session_id, {
-                            'operation': 'buy_airtime',
-                            'awaiting': 'phone_confirmation',
-                            'data': {'kes_amount': kes_amount}
-                        })
+                        self.ai_processor.set_session_context(session_id, SessionContext('buy_airtime', 'phone_confirmation', kes_amount=kes_amount))
                         return f"CON Buy {kes_amount} KES airtime\n\n1. For my number ({phone_number})\n2. For another number"
                     except ValueError:
                         return "CON Invalid amount. Enter amount in KES:"
                 
                 elif awaiting == 'phone_confirmation':
                     # User chose 1 or 2
-                    kes_amount = data.get('kes_amount')
+                    kes_amount = context.kes_amount
                     if user_input.strip() == '1':
                         # Buy for own number
                         success, message, airtime_data = self.original_handler.buy_airtime(
-                            phone_number, phone_number, kes_amount
+                            phone_number, phone_number, kes_amount, session_id=session_id
                         )
                         self.ai_processor.clear_session_context(session_id)
                         return f"END {message}"
                     elif user_input.strip() == '2':
                         # Ask for another number
-                        self.ai_processor.set_session_context(session_id, {
-                            'operation': 'buy_airtime',
-                            'awaiting': 'phone_number',
-                            'data': {'kes_amount': kes_amount}
-                        })
+                        self.ai_processor.set_session_context(session_id, SessionContext('buy_airtime', 'phone_number', kes_amount=kes_amount))
                         return "CON Enter phone number for airtime:"
                     else:
                         return f"CON Buy {kes_amount} KES airtime\n\n1. For my number ({phone_number})\n2. For another number"
@@ -683,10 +712,10 @@ class AIEnhancedUSSDHandler:
                     if not self.original_handler.validate_phone_number(normalized_phone):
                         return "CON Invalid phone number format.\nEnter phone number for airtime:"
                     
-                    kes_amount = data.get('kes_amount')
+                    kes_amount = context.kes_amount
                     # Execute airtime purchase
                     success, message, airtime_data = self.original_handler.buy_airtime(
-                        phone_number, normalized_phone, kes_amount
+                        phone_number, normalized_phone, kes_amount, session_id=session_id
                     )
                     
                     # Clear context
@@ -720,12 +749,11 @@ class AIEnhancedUSSDHandler:
             else:
                 amount_sats = int(amount)
             
-            # Validate amount (Lightning Network can handle small amounts)
-            if amount_sats < 10:
-                return "CON Minimum send amount is 10 sats (≈0.015 KES)\nEnter amount in sats:"
-            
-            if amount_sats > 1000000:
-                return "CON Maximum send amount is 1,000,000 sats (≈6,667 KES)\nEnter amount in sats:"
+            # Validate amount against the MinimumAmount and MaximumAmount rules
+            valid_amount, amount_error = self.original_handler.validate_amount(amount_sats)
+            if not valid_amount:
+                limit = rules.limit('MinimumAmount' if amount_sats < rules.limit('MinimumAmount') else 'MaximumAmount')
+                return f"CON {amount_error} (≈{sats_to_kes_text(limit, session_id)} KES)\nEnter amount in sats:"
             
             # Check balance
             balance = self.original_handler.get_user_balance(phone_number)
@@ -755,10 +783,10 @@ class AIEnhancedUSSDHandler:
         """Handle AI balance check request"""
         try:
             balance = self.original_handler.get_user_balance(phone_number)
-            balance_kes = balance * 150 / 1000
+            balance_kes = sats_to_kes_text(balance)
             
             natural_response = self.ai_processor.generate_natural_response(
-                f"Your balance is {balance:,} sats (≈{balance_kes:.2f} KES)",
+                f"Your balance is {balance:,} sats (≈{balance_kes} KES)",
                 {"sats": balance, "kes": balance_kes}
             )
             return f"END {natural_response}"
@@ -774,32 +802,21 @@ class AIEnhancedUSSDHandler:
             if 'amount' in params and params['amount']:
                 kes_amount = int(params['amount'])
                 
-                if kes_amount < 10:
+                minimum_error = rules.check('MinimumTopUp', kes_amount=kes_amount)
+                if minimum_error:
                     # Set context for amount collection
-                    self.ai_processor.set_session_context(session_id, {
-                        'operation': 'topup_mpesa',
-                        'awaiting': 'amount',
-                        'data': {}
-                    })
-                    return "CON Minimum Lightning purchase is 10 KES (66 sats).\nEnter amount in KES:"
+                    self.ai_processor.set_session_context(session_id, SessionContext('topup_mpesa', 'amount'))
+                    return f"CON {minimum_error}.\nEnter amount in KES:"
                 
-                sats_equivalent = int(kes_amount * (1000 / 150))
+                sats_equivalent = kes_to_sats(kes_amount, session_id)
                 
                 # Set context for confirmation
-                self.ai_processor.set_session_context(session_id, {
-                    'operation': 'topup_mpesa',
-                    'awaiting': 'confirmation',
-                    'data': {'kes_amount': kes_amount, 'sats_equivalent': sats_equivalent}
-                })
+                self.ai_processor.set_session_context(session_id, SessionContext('topup_mpesa', 'confirmation', kes_amount=kes_amount, amount=sats_equivalent))
                 
                 return f"CON Top up {kes_amount} KES ({sats_equivalent:,} sats)?\n\n1. Yes, send M-Pesa request\n2. Cancel"
             else:
                 # Ask for amount first
-                self.ai_processor.set_session_context(session_id, {
-                    'operation': 'topup_mpesa',
-                    'awaiting': 'amount',
-                    'data': {}
-                })
+                self.ai_processor.set_session_context(session_id, SessionContext('topup_mpesa', 'amount'))
                 return "CON Top Up via M-Pesa\nEnter amount in KES:"
             
         except Exception as e:
@@ -816,45 +833,30 @@ class AIEnhancedUSSDHandler:
                 
                 if currency.lower() in ['kes', 'shillings']:
                     kes_amount = int(amount)
-                    sats_needed = int(kes_amount * (1000 / 150))
+                    sats_needed = kes_to_sats(kes_amount, session_id)
                 else:
                     sats_needed = int(amount)
-                    kes_amount = int(sats_needed * 150 / 1000)
+                    kes_amount = sats_to_kes(sats_needed, session_id)
                 
-                if kes_amount < 100:
+                minimum_error = rules.check('MinimumWithdrawal', kes_amount=kes_amount)
+                if minimum_error:
                     # Set context for amount collection
-                    self.ai_processor.set_session_context(session_id, {
-                        'operation': 'withdraw_mpesa',
-                        'awaiting': 'amount',
-                        'data': {}
-                    })
-                    return "CON Minimum withdrawal is 100 KES.\nEnter amount in KES:"
+                    self.ai_processor.set_session_context(session_id, SessionContext('withdraw_mpesa', 'amount'))
+                    return f"CON {minimum_error}.\nEnter amount in KES:"
                 
                 # Check balance
                 balance = self.original_handler.get_user_balance(phone_number)
                 if balance < sats_needed:
-                    self.ai_processor.set_session_context(session_id, {
-                        'operation': 'withdraw_mpesa',
-                        'awaiting': 'amount',
-                        'data': {}
-                    })
+                    self.ai_processor.set_session_context(session_id, SessionContext('withdraw_mpesa', 'amount'))
                     return f"CON Insufficient balance. You have {balance:,} sats, need {sats_needed:,} sats.\nEnter amount in KES:"
                 
                 # Set context for phone number collection
-                self.ai_processor.set_session_context(session_id, {
-                    'operation': 'withdraw_mpesa',
-                    'awaiting': 'phone_number',
-                    'data': {'kes_amount': kes_amount, 'sats_needed': sats_needed}
-                })
+                self.ai_processor.set_session_context(session_id, SessionContext('withdraw_mpesa', 'phone_number', kes_amount=kes_amount, amount=sats_needed))
                 
                 return f"CON Withdraw {kes_amount} KES ({sats_needed:,} sats)\nEnter M-Pesa phone number:"
             else:
                 # Ask for amount first
-                self.ai_processor.set_session_context(session_id, {
-                    'operation': 'withdraw_mpesa',
-                    'awaiting': 'amount',
-                    'data': {}
-                })
+                self.ai_processor.set_session_context(session_id, SessionContext('withdraw_mpesa', 'amount'))
                 return "CON Withdraw to M-Pesa\nEnter amount in KES:"
                 
         except Exception as e:
@@ -937,56 +939,33 @@ class AIEnhancedUSSDHandler:
             # Check if we have the required amount
             if 'amount' not in params or not params['amount']:
                 # Set context for amount collection
-                self.ai_processor.set_session_context(session_id, {
-                    'operation': 'buy_airtime',
-                    'awaiting': 'amount',
-                    'data': {}
-                })
-                return "CON Buy Airtime\nEnter amount in KES (10-1000):"
+                self.ai_processor.set_session_context(session_id, SessionContext('buy_airtime', 'amount'))
+                return f"CON Buy Airtime\nEnter amount in KES ({rules.limit('MinimumAirtime')}-{rules.limit('MaximumAirtime')}):"
             
             kes_amount = int(params['amount'])
             
-            if kes_amount < 10:
-                self.ai_processor.set_session_context(session_id, {
-                    'operation': 'buy_airtime',
-                    'awaiting': 'amount',
-                    'data': {}
-                })
-                return "CON Minimum airtime purchase is 10 KES.\nEnter amount in KES:"
-            
-            if kes_amount > 1000:
-                self.ai_processor.set_session_context(session_id, {
-                    'operation': 'buy_airtime',
-                    'awaiting': 'amount',
-                    'data': {}
-                })
-                return "CON Maximum airtime purchase is 1,000 KES.\nEnter amount in KES:"
+            limit_error = rules.first_violation(('MinimumAirtime', 'MaximumAirtime'), kes_amount=kes_amount)
+            if limit_error:
+                self.ai_processor.set_session_context(session_id, SessionContext('buy_airtime', 'amount'))
+                return f"CON {limit_error}.\nEnter amount in KES:"
             
             # Check if phone number is provided, otherwise ask for it
             airtime_phone = params.get('phone_number', phone_number)
             
             if not airtime_phone or airtime_phone == phone_number:
                 # Ask if they want to buy for themselves or another number
-                self.ai_processor.set_session_context(session_id, {
-                    'operation': 'buy_airtime',
-                    'awaiting': 'phone_confirmation',
-                    'data': {'kes_amount': kes_amount}
-                })
+                self.ai_processor.set_session_context(session_id, SessionContext('buy_airtime', 'phone_confirmation', kes_amount=kes_amount))
                 return f"CON Buy {kes_amount} KES airtime\n\n1. For my number ({phone_number})\n2. For another number"
             
             # Validate the phone number
             normalized_phone = self.original_handler.normalize_phone_number(airtime_phone)
             if not self.original_handler.validate_phone_number(normalized_phone):
-                self.ai_processor.set_session_context(session_id, {
-                    'operation': 'buy_airtime',
-                    'awaiting': 'phone_number',
-                    'data': {'kes_amount': kes_amount}
-                })
+                self.ai_processor.set_session_context(session_id, SessionContext('buy_airtime', 'phone_number', kes_amount=kes_amount))
                 return "CON Invalid phone number.\nEnter phone number for airtime:"
             
             # Execute airtime purchase
             success, message, airtime_data = self.original_handler.buy_airtime(
-                phone_number, normalized_phone, kes_amount
+                phone_number, normalized_phone, kes_amount, session_id=session_id
             )
             
             # Clear context
@@ -1005,7 +984,18 @@ class AIEnhancedUSSDHandler:
         except Exception as e:
             logger.error(f"AI airtime purchase error: {e}")
             self.ai_processor.clear_session_context(session_id)
-            return "CON Buy Airtime\nEnter amount in KES (10-1000):"
+            return f"CON Buy Airtime\nEnter amount in KES ({rules.limit('MinimumAirtime')}-{rules.limit('MaximumAirtime')}):"
 
 # Global AI processor instance
-ai_processor = USSDNaturalLanguageProcessor()
\ No newline at end of file
+ai_processor = USSDNaturalLanguageProcessor()
+
+def _openai_health() -> Optional[bool]:
+    """Background health probe; skipped until the client exists so it is not built just to be checked"""
+    client = ai_processor._client
+    if client is None:
+        return None
+    # Listing models is authenticated but uses no tokens
+    client.with_options(timeout=Config.DEPENDENCY_HEALTH_TIMEOUT).models.list()
+    return True
+
+dependencies.register('openai', health_check=_openai_health)
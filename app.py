@@ -3,14 +3,26 @@ Flask USSD Application for Bitcoin Lightning Network
 Integrates with Africa's Talking USSD API and MeTTa reasoning
 Unified version with all features
 """
-from flask import Flask, request, jsonify, render_template_string, send_file
+from flask import Flask, request, jsonify, render_template_string
 import logging
-from handlers import USSDHandlers
+from handlers import ussd_handlers
 from ai_processor import AIEnhancedUSSDHandler
 from lightning import lightning_api
+from session_store import session_store, USSDSession
+from tracing import traced, current_span, SPAN_KIND_SERVER
+from exchange_rate import kes_to_sats, rate_summary_text, release_quote, StaleRateError
+from ussd_screens import screens, render_for, MORE_OPTION
+from single_flight import ussd_flight, phone_locks, EXECUTED
+from static_assets import static_assets
+from circuit_breaker import dependencies, CircuitOpenError
+from metta_queries import PENDING_MPESA
+from balance_reconciler import balance_reconciler
+from rule_engine import rules
+import metrics
 import re
 from dotenv import load_dotenv
 import os
+import threading
 import time
 
 # Load environment variables
@@ -36,44 +48,43 @@ sys.stderr.flush()
 
 app = Flask(__name__)
 
-# Initialize handlers
-ussd_handlers = USSDHandlers()
+# Initialize handlers (MeTTa, database and OpenAI are created lazily on first use)
 ai_enhanced_handler = AIEnhancedUSSDHandler(ussd_handlers)
 
-# Session storage (in production, use Redis or database)
-user_sessions = {}
+RATE_UNAVAILABLE_RESPONSE = "END Exchange rate unavailable.\nPlease try again later."
 
-class USSDSession:
-    def __init__(self, session_id: str, phone_number: str):
-        self.session_id = session_id
-        self.phone_number = phone_number
-        self.state = "main_menu"
-        self.data = {}
-    
-    def set_state(self, state: str):
-        self.state = state
-    
-    def set_data(self, key: str, value):
-        self.data[key] = value
-    
-    def get_data(self, key: str, default=None):
-        return self.data.get(key, default)
+# Session storage: in-memory with write-behind persistence to ussd_sessions
+user_sessions = session_store
+
+def unavailable_response(session: USSDSession, *dependency_names: str):
+    """END screen if a dependency the next step calls has an open circuit, else None"""
+    down = dependencies.unavailable(*dependency_names)
+    if not down:
+        return None
+    logger.warning(f"Failing fast for {session.phone_number}: {', '.join(down)} unavailable")
+    clear_session(session.session_id)
+    return render_for(session, 'service_unavailable')
+
+def airtime_limits() -> dict:
+    """Slots for the airtime range screens, read from the MinimumAirtime and MaximumAirtime rules"""
+    return {'minimum': rules.limit('MinimumAirtime'), 'maximum': rules.limit('MaximumAirtime')}
 
 def get_or_create_session(session_id: str, phone_number: str) -> USSDSession:
     """Get existing session or create new one"""
-    if session_id not in user_sessions:
-        user_sessions[session_id] = USSDSession(session_id, phone_number)
-    return user_sessions[session_id]
+    return session_store.get_or_create(session_id, phone_number)
 
 def clear_session(session_id: str):
     """Clear session data"""
-    if session_id in user_sessions:
-        del user_sessions[session_id]
+    session_store.end(session_id)
+    release_quote(session_id)
 
 @app.route('/ussd', methods=['POST'])
+@traced('POST /ussd', kind=SPAN_KIND_SERVER)
 def ussd():
     """Main USSD endpoint for Africa's Talking"""
     request_id = f"req_{int(time.time())}_{hash(request.remote_addr) % 10000}"
+    hop_start = time.perf_counter()
+    state_before = "unknown"
     
     try:
         # Log complete request details
@@ -105,29 +116,18 @@ def ussd():
         
         # Get or create session
         session = get_or_create_session(session_id, phone_number)
-        
-        # Initialize user balance for your number
-        if phone_number == "+254715586044":
-            current_balance = ussd_handlers.get_user_balance(phone_number)
-            if current_balance == 0:
-                lightning_api.set_balance(phone_number, 0)
-                ussd_handlers.update_balance(phone_number, 0)
-        
-        # Parse text input (split by *)
-        text_parts = text.split("*") if text else [""]
-        logger.info(f"Text parts: {text_parts}")
-        logger.info(f"Session state: {session.state}")
-        
-        # Route based on session state and input
-        logger.info(f"[{request_id}] Routing request - Text empty: {text == ''}")
-        
-        if text == "":
-            # First interaction - show main menu
-            logger.info(f"[{request_id}] Showing main menu")
-            response = handle_main_menu(session)
+        state_before = session.state
+        current_span().set_attribute('ussd.state', session.state)
+        current_span().set_attribute('ussd.hop', len(text.split("*")) if text else 0)
+        
+        # Gateway retries of this hop share the first execution's response
+        response, outcome = ussd_flight.do((session_id, text), lambda: route_hop(session, text, request_id))
+        current_span().set_attribute('ussd.response', response[:3])
+        if outcome == EXECUTED:
+            metrics.record_hop(state_before, session.state, response, time.perf_counter() - hop_start)
         else:
-            logger.info(f"[{request_id}] Processing user input with text_parts: {text_parts}")
-            response = handle_user_input(session, text_parts)
+            current_span().set_attribute('ussd.coalesced', outcome)
+            metrics.COALESCED_HOPS.inc(outcome)
         
         logger.info(f"[{request_id}] USSD Response: {response}")
         logger.info(f"[{request_id}] Response Length: {len(response)}")
@@ -140,7 +140,40 @@ def ussd():
         logger.error(f"[{request_id}] USSD EXCEPTION: {str(e)}")
         logger.error(f"[{request_id}] FULL TRACEBACK: {error_details}")
         logger.error(f"[{request_id}] ===== REQUEST FAILED =====")
-        return "END Internal error. Please try again."
+        response = "END Internal error. Please try again."
+        metrics.record_hop(state_before, "main_menu", response, time.perf_counter() - hop_start)
+        return response
+
+def route_hop(session: USSDSession, text: str, request_id: str) -> str:
+    """Compute the response for one USSD hop and queue the session for persistence"""
+    # Parse text input (split by *)
+    text_parts = text.split("*") if text else [""]
+    logger.info(f"Text parts: {text_parts}")
+    logger.info(f"Session state: {session.state}")
+    
+    # Route based on session state and input
+    logger.info(f"[{request_id}] Routing request - Text empty: {text == ''}")
+    
+    if text_parts[-1] == MORE_OPTION and screens.has_more(session.session_id):
+        # "98. More" on a paginated screen
+        response = screens.next_page(session.session_id)
+        if response.startswith("END"):
+            clear_session(session.session_id)
+    elif text == "":
+        # First interaction - show main menu
+        logger.info(f"[{request_id}] Showing main menu")
+        session.language = ussd_handlers.get_user_language(session.phone_number)
+        response = handle_main_menu(session)
+    else:
+        logger.info(f"[{request_id}] Processing user input with text_parts: {text_parts}")
+        response = handle_user_input(session, text_parts)
+    
+    # Split screens over the gateway's character budget instead of letting it truncate them
+    response = screens.respond(session.session_id, response)
+    
+    # Persist the hop's state changes in the next batched flush
+    session_store.mark_dirty(session)
+    return response
 
 @app.route('/webhook/intersend', methods=['POST'])
 def intersend_webhook():
@@ -167,6 +200,16 @@ def intersend_webhook():
         logger.error(f"WEBHOOK ERROR: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/webhook/sms_delivery', methods=['POST'])
+def sms_delivery_webhook():
+    """Africa's Talking SMS delivery reports (id, status, phoneNumber, failureReason)"""
+    from sms_queue import sms_queue
+    message_id = request.values.get('id', '')
+    delivery_status = request.values.get('status', '')
+    known = sms_queue.record_delivery(message_id, delivery_status, request.values.get('failureReason', ''))
+    logger.info(f"SMS delivery report {message_id}: {delivery_status}{'' if known else ' (unknown message)'}")
+    return jsonify({"status": "ok"})
+
 @app.route('/mock_payment/<invoice_id>', methods=['POST'])
 def mock_payment_completion(invoice_id):
     """Mock payment completion for testing"""
@@ -176,13 +219,14 @@ def mock_payment_completion(invoice_id):
         # For testing, let's try to add mock balance directly  
         # Try both formats to ensure compatibility
         phone_formats = ["+254715586044", "254715586044", "0715586044"]
-        sats_to_add = 66  # Add 66 sats (equivalent to 10 KES)
+        sats_to_add = kes_to_sats(10)  # Equivalent of 10 KES
         
         results = []
         for phone_number in phone_formats:
-            current_balance = ussd_handlers.get_user_balance(phone_number)
-            new_balance = current_balance + sats_to_add
-            ussd_handlers.update_balance(phone_number, new_balance)
+            with phone_locks.hold(phone_number):
+                current_balance = ussd_handlers.get_user_balance(phone_number)
+                new_balance = current_balance + sats_to_add
+                ussd_handlers.update_balance(phone_number, new_balance)
             
             logger.info(f"MOCK: Updated balance for {phone_number}: {current_balance} -> {new_balance} sats")
             results.append({
@@ -273,20 +317,8 @@ def check_pending_payments():
         
         # Try to find pending payments in MeTTa
         try:
-            query = '!(match &self (PendingMpesa $phone $invoice $kes $sats $timestamp) (list $phone $invoice $kes $sats $timestamp))'
-            result = ussd_handlers.metta.run(query)
-            logger.info(f"MANUAL CHECK: MeTTa query result: {result}")
-            
-            for pending_match in result:
-                pending_str = str(pending_match)
-                logger.info(f"MANUAL CHECK: Processing pending match: {pending_str}")
-                
-                # Try to parse the pending transaction
-                if '(list' in pending_str and '$' not in pending_str:
-                    # Extract phone and invoice details
-                    import re
-                    # Simple parsing for now - in production use proper parsing
-                    pending_payments.append(pending_str)
+            pending_payments = ussd_handlers.queries.query(PENDING_MPESA)
+            logger.info(f"MANUAL CHECK: {len(pending_payments)} pending M-Pesa top-ups in MeTTa")
                     
         except Exception as metta_error:
             logger.error(f"MANUAL CHECK: MeTTa query error: {metta_error}")
@@ -317,24 +349,15 @@ def check_pending_payments():
 def handle_main_menu(session: USSDSession) -> str:
     """Handle main menu display"""
     balance = ussd_handlers.get_user_balance(session.phone_number)
-    
-    return (f"CON Welcome to Bitcoin Lightning!\n"
-           f"₿ Balance: {balance:,} sats\n\n"
-           f"Bitcoin Lightning\n"
-           f"1. Send BTC\n"
-           f"2. Receive BTC\n"
-           f"3. Send Invoice\n"
-           f"4. Buy BTC (M-Pesa)\n"
-           f"5. Withdraw M-Pesa\n"
-           f"6. Buy Airtime\n"
-           f"0. Exit")
+    return render_for(session, 'main_menu', balance=balance)
 
 def handle_user_input(session: USSDSession, text_parts: list) -> str:
     """Handle user input based on current state"""
     try:
         # First check if we should use AI for natural language processing (except for simple menu states)
         full_text = "*".join(text_parts)
-        if session.state == "main_menu" and ai_enhanced_handler.should_use_ai(full_text, session.session_id):
+        if (session.state == "main_menu" and not dependencies.unavailable('openai')
+                and ai_enhanced_handler.should_use_ai(full_text, session.session_id)):
             logger.info(f"Using AI for natural language input: '{full_text}'")
             return ai_enhanced_handler.process_with_ai(full_text, session.phone_number, session.session_id)
         
@@ -408,17 +431,21 @@ def handle_user_input(session: USSDSession, text_parts: list) -> str:
             session.set_state("main_menu")
             return handle_main_menu(session)
             
+    except CircuitOpenError as e:
+        logger.warning(f"Input handling failed fast: {e}")
+        clear_session(session.session_id)
+        return render_for(session, 'service_unavailable')
     except Exception as e:
         logger.error(f"Input handling error: {e}")
         clear_session(session.session_id)
-        return "END Error processing request. Please try again."
+        return render_for(session, 'processing_error')
 
 def handle_main_menu_selection(session: USSDSession, selection: str, text_parts: list) -> str:
     """Handle main menu selection"""
     
     # First check if we should use AI for natural language processing
     full_text = "*".join(text_parts) if len(text_parts) > 1 else selection
-    if ai_enhanced_handler.should_use_ai(full_text, session.session_id):
+    if not dependencies.unavailable('openai') and ai_enhanced_handler.should_use_ai(full_text, session.session_id):
         logger.info(f"Using AI for natural language input: '{full_text}'")
         return ai_enhanced_handler.process_with_ai(full_text, session.phone_number, session.session_id)
     
@@ -430,44 +457,38 @@ def handle_main_menu_selection(session: USSDSession, selection: str, text_parts:
     
     # Handle special commands
     if selection.lower() in ['rates?', 'rates']:
-        return "END Current rate: 1 KES ≈ 6.67 sats\n150 KES = 1,000 sats"
+        return render_for(session, 'rates', rate=rate_summary_text(session.session_id))
     elif selection.lower() in ['help']:
-        return ("END USSD Commands:\n"
-               "• Send: '1*phone*amount'\n"
-               "• Buy BTC: '4*amount_kes'\n"
-               "• Rates: 'rates?'\n"
-               "• Help: 'help'")
+        return render_for(session, 'help')
     
     if selection == "1":
         # Send BTC
         session.set_state("send_btc_phone")
-        return "CON Send BTC\nEnter recipient phone number:"
+        return render_for(session, 'send_btc_phone')
     elif selection == "2":
         # Receive BTC
         session.set_state("receive_btc_amount")
-        return "CON Receive BTC\nEnter amount in sats:"
+        return render_for(session, 'receive_btc_amount')
     elif selection == "3":
         # Send Invoice
         session.set_state("send_invoice_phone")
-        return "CON Send Invoice\nEnter recipient phone number:"
+        return render_for(session, 'send_invoice_phone')
     elif selection == "4":
         # Buy BTC via M-Pesa STK Push
         session.set_state("topup_amount")
-        return ("CON Buy BTC with M-Pesa\n"
-               "Enter KES amount (Min: 10 KES):\n\n"
-               "(Ask 'rates?' or say 'back')")
+        return render_for(session, 'topup_amount', minimum=rules.limit('MinimumTopUp'))
     elif selection == "5":
         # Withdraw to M-Pesa
         session.set_state("withdraw_amount")
-        return "CON Withdraw to M-Pesa\nEnter amount in KES:"
+        return render_for(session, 'withdraw_amount')
     elif selection == "6":
         # Buy Airtime
         session.set_state("airtime_amount")
-        return "CON Buy Airtime\nEnter amount in KES (10-1000):"
+        return render_for(session, 'airtime_amount', **airtime_limits())
     elif selection == "0":
         # Exit
         clear_session(session.session_id)
-        return "END Thank you for using Bitcoin Lightning!"
+        return render_for(session, 'exit')
     else:
         # Invalid selection
         return handle_main_menu(session)
@@ -481,27 +502,32 @@ def handle_send_btc_phone(session: USSDSession, phone_input: str) -> str:
     normalized_phone = ussd_handlers.normalize_phone_number(phone_input)
     
     if not ussd_handlers.validate_phone_number(normalized_phone):
-        return "CON Invalid phone number format.\nEnter recipient phone number:"
+        return render_for(session, 'invalid_phone')
     
-    session.set_data("recipient_phone", normalized_phone)
+    session.recipient = normalized_phone
     session.set_state("send_btc_amount")
-    return f"CON Send BTC to {normalized_phone}\nEnter amount in sats:"
+    return render_for(session, 'send_btc_amount', phone=normalized_phone)
 
 def handle_send_btc_amount(session: USSDSession, amount_input: str) -> str:
     """Handle amount input for sending BTC"""
     try:
         if amount_input.lower() == 'back':
             session.set_state("send_btc_phone")
-            return "CON Send BTC\nEnter recipient phone number:"
+            return render_for(session, 'send_btc_phone')
             
         amount = int(amount_input)
-        recipient_phone = session.get_data("recipient_phone")
+        recipient_phone = session.recipient
         
         # Validate amount
         valid, error_msg = ussd_handlers.validate_amount(amount)
         if not valid:
             return f"CON {error_msg}\nEnter amount in sats:"
         
+        # Fail fast while a dependency is down instead of waiting out its timeout
+        unavailable = unavailable_response(session, 'database')
+        if unavailable:
+            return unavailable
+        
         # Execute payment
         success, message, payment_data = ussd_handlers.send_btc(session.phone_number, recipient_phone, amount)
         
@@ -513,7 +539,7 @@ def handle_send_btc_amount(session: USSDSession, amount_input: str) -> str:
             return f"END Payment failed: {message}"
             
     except ValueError:
-        return "CON Invalid amount. Enter amount in sats:"
+        return render_for(session, 'invalid_amount_sats')
 
 def handle_receive_btc_amount(session: USSDSession, amount_input: str) -> str:
     """Handle amount input for receiving BTC"""
@@ -529,6 +555,11 @@ def handle_receive_btc_amount(session: USSDSession, amount_input: str) -> str:
         if not valid:
             return f"CON {error_msg}\nEnter amount in sats:"
         
+        # Fail fast while a dependency is down instead of waiting out its timeout
+        unavailable = unavailable_response(session, 'lightning', 'database')
+        if unavailable:
+            return unavailable
+        
         # Generate invoice
         success, message, invoice_data = ussd_handlers.receive_btc(session.phone_number, amount)
         
@@ -540,7 +571,7 @@ def handle_receive_btc_amount(session: USSDSession, amount_input: str) -> str:
             return f"END Invoice creation failed: {message}"
             
     except ValueError:
-        return "CON Invalid amount. Enter amount in sats:"
+        return render_for(session, 'invalid_amount_sats')
 
 def handle_send_invoice_phone(session: USSDSession, phone_input: str) -> str:
     """Handle phone number input for sending invoice"""
@@ -551,27 +582,32 @@ def handle_send_invoice_phone(session: USSDSession, phone_input: str) -> str:
     normalized_phone = ussd_handlers.normalize_phone_number(phone_input)
     
     if not ussd_handlers.validate_phone_number(normalized_phone):
-        return "CON Invalid phone number format.\nEnter recipient phone number:"
+        return render_for(session, 'invalid_phone')
     
-    session.set_data("invoice_recipient", normalized_phone)
+    session.recipient = normalized_phone
     session.set_state("send_invoice_amount")
-    return f"CON Send invoice to {normalized_phone}\nEnter amount in sats:"
+    return render_for(session, 'send_invoice_amount', phone=normalized_phone)
 
 def handle_send_invoice_amount(session: USSDSession, amount_input: str) -> str:
     """Handle amount input for sending invoice"""
     try:
         if amount_input.lower() == 'back':
             session.set_state("send_invoice_phone")
-            return "CON Send Invoice\nEnter recipient phone number:"
+            return render_for(session, 'send_invoice_phone')
             
         amount = int(amount_input)
-        recipient_phone = session.get_data("invoice_recipient")
+        recipient_phone = session.recipient
         
         # Validate amount
         valid, error_msg = ussd_handlers.validate_amount(amount)
         if not valid:
             return f"CON {error_msg}\nEnter amount in sats:"
         
+        # Fail fast while a dependency is down instead of waiting out its timeout
+        unavailable = unavailable_response(session, 'lightning', 'database')
+        if unavailable:
+            return unavailable
+        
         # Send invoice
         success, message, invoice_data = ussd_handlers.send_invoice(session.phone_number, recipient_phone, amount)
         
@@ -583,7 +619,7 @@ def handle_send_invoice_amount(session: USSDSession, amount_input: str) -> str:
             return f"END Invoice sending failed: {message}"
             
     except ValueError:
-        return "CON Invalid amount. Enter amount in sats:"
+        return render_for(session, 'invalid_amount_sats')
 
 def handle_topup_amount(session: USSDSession, amount_input: str) -> str:
     """Handle amount input for M-Pesa top-up with STK Push"""
@@ -592,7 +628,7 @@ def handle_topup_amount(session: USSDSession, amount_input: str) -> str:
             session.set_state("main_menu")
             return handle_main_menu(session)
         elif amount_input.lower() in ['rates?', 'rates']:
-            return "END Current rate: 1 KES ≈ 6.67 sats\n150 KES = 1,000 sats"
+            return render_for(session, 'rates', rate=rate_summary_text(session.session_id))
             
         logger.info(f"TOPUP AMOUNT - Raw input: '{amount_input}'")
         logger.info(f"TOPUP AMOUNT - Input bytes: {repr(amount_input)}")
@@ -604,19 +640,20 @@ def handle_topup_amount(session: USSDSession, amount_input: str) -> str:
         
         if not cleaned_input:
             logger.warning(f"TOPUP AMOUNT - No digits found in input: '{amount_input}'")
-            return ("CON Invalid amount. Please enter a valid number.\n"
-                   "Enter KES amount (Min: 10 KES):\n\n"
-                   "(Ask 'rates?' or say 'back')")
+            return render_for(session, 'topup_invalid_amount', minimum=rules.limit('MinimumTopUp'))
         
         kes_amount = int(cleaned_input)
         logger.info(f"TOPUP AMOUNT - Parsed KES amount: {kes_amount}")
         
-        if kes_amount < 10:
-            return ("CON Minimum top-up is 10 KES.\n"
-                   "Enter KES amount (Min: 10 KES):\n\n"
-                   "(Ask 'rates?' or say 'back')")
+        if rules.check('MinimumTopUp', kes_amount=kes_amount):
+            return render_for(session, 'topup_minimum', minimum=rules.limit('MinimumTopUp'))
+        
+        # Fail fast while a dependency is down instead of waiting out its timeout
+        unavailable = unavailable_response(session, 'intersend')
+        if unavailable:
+            return unavailable
         
-        sats_equivalent = int(kes_amount * (1000 / 150))
+        sats_equivalent = kes_to_sats(kes_amount, session.session_id)
         
         # Directly initiate M-Pesa STK Push with timeout handling
         logger.info(f"TOPUP AMOUNT - Initiating M-Pesa STK Push for {session.phone_number}, amount: {kes_amount} KES ({sats_equivalent} sats)")
@@ -632,12 +669,17 @@ def handle_topup_amount(session: USSDSession, amount_input: str) -> str:
             logger.info(f"TOPUP AMOUNT - Phone: {session.phone_number}")
             logger.info(f"TOPUP AMOUNT - Amount: {kes_amount} KES ({sats_equivalent} sats)")
             
-            signal.signal(signal.SIGALRM, timeout_handler)
-            signal.alarm(15)
+            # SIGALRM can only be armed from the main thread, not under threaded servers
+            use_alarm = threading.current_thread() is threading.main_thread()
+            if use_alarm:
+                signal.signal(signal.SIGALRM, timeout_handler)
+                signal.alarm(15)
             
-            success, message, topup_data = ussd_handlers.topup_via_mpesa(session.phone_number, kes_amount)
+            success, message, topup_data = ussd_handlers.topup_via_mpesa(session.phone_number, kes_amount,
+                                                                          session_id=session.session_id)
             
-            signal.alarm(0)  # Cancel the alarm
+            if use_alarm:
+                signal.alarm(0)  # Cancel the alarm
             
             logger.info(f"TOPUP AMOUNT - STK Push result: success={success}")
             logger.info(f"TOPUP AMOUNT - Message: '{message}'")
@@ -661,11 +703,12 @@ def handle_topup_amount(session: USSDSession, amount_input: str) -> str:
         else:
             return f"END {message}"
         
+    except StaleRateError as e:
+        logger.error(f"TOPUP AMOUNT - {e}")
+        return RATE_UNAVAILABLE_RESPONSE
     except ValueError as e:
         logger.error(f"TOPUP AMOUNT - ValueError: {e}")
-        return ("CON Invalid amount. Please enter a valid number.\n"
-               "Enter KES amount (Min: 10 KES):\n\n"
-               "(Ask 'rates?' or say 'back')")
+        return render_for(session, 'topup_invalid_amount', minimum=rules.limit('MinimumTopUp'))
 
 def handle_withdraw_amount(session: USSDSession, amount_input: str) -> str:
     """Handle amount input for M-Pesa withdrawal"""
@@ -676,37 +719,46 @@ def handle_withdraw_amount(session: USSDSession, amount_input: str) -> str:
             
         kes_amount = int(amount_input)
         
-        if kes_amount < 100:
-            return "CON Minimum withdrawal is 100 KES.\nEnter amount in KES:"
+        if rules.check('MinimumWithdrawal', kes_amount=kes_amount):
+            return render_for(session, 'withdraw_minimum', minimum=rules.limit('MinimumWithdrawal'))
         
-        sats_equivalent = int(kes_amount * (1000 / 150))
+        sats_equivalent = kes_to_sats(kes_amount, session.session_id)
         current_balance = ussd_handlers.get_user_balance(session.phone_number)
         
         if current_balance < sats_equivalent:
-            return f"CON Insufficient balance.\nNeed {sats_equivalent} sats, have {current_balance} sats.\nEnter amount in KES:"
+            return render_for(session, 'withdraw_insufficient', sats=sats_equivalent, balance=current_balance)
         
-        session.set_data("withdraw_kes", kes_amount)
+        session.kes_amount = kes_amount
         session.set_state("withdraw_phone")
         
-        return f"CON Withdraw {kes_amount} KES ({sats_equivalent} sats)\nEnter M-Pesa phone number:"
+        return render_for(session, 'withdraw_phone', kes=kes_amount, sats=sats_equivalent)
         
+    except StaleRateError as e:
+        logger.error(f"WITHDRAW AMOUNT - {e}")
+        return RATE_UNAVAILABLE_RESPONSE
     except ValueError:
-        return "CON Invalid amount. Enter amount in KES:"
+        return render_for(session, 'invalid_amount_kes')
 
 def handle_withdraw_phone(session: USSDSession, phone_input: str) -> str:
     """Handle phone number input for M-Pesa withdrawal"""
     if phone_input.lower() == 'back':
         session.set_state("withdraw_amount")
-        return "CON Withdraw to M-Pesa\nEnter amount in KES:"
+        return render_for(session, 'withdraw_amount')
         
     normalized_phone = ussd_handlers.normalize_phone_number(phone_input)
-    kes_amount = session.get_data("withdraw_kes")
+    kes_amount = session.kes_amount
     
     if not ussd_handlers.validate_phone_number(normalized_phone):
-        return "CON Invalid phone number format.\nEnter M-Pesa phone number:"
+        return render_for(session, 'invalid_mpesa_phone')
+    
+    # Fail fast while a dependency is down instead of waiting out its timeout
+    unavailable = unavailable_response(session, 'database')
+    if unavailable:
+        return unavailable
     
     # Execute withdrawal
-    success, message, withdraw_data = ussd_handlers.withdraw_to_mpesa(session.phone_number, kes_amount, normalized_phone)
+    success, message, withdraw_data = ussd_handlers.withdraw_to_mpesa(session.phone_number, kes_amount, normalized_phone,
+                                                                     session_id=session.session_id)
     
     clear_session(session.session_id)
     
@@ -724,42 +776,48 @@ def handle_airtime_amount(session: USSDSession, amount_input: str) -> str:
             
         kes_amount = int(amount_input)
         
-        if kes_amount < 10:
-            return "CON Minimum airtime purchase is 10 KES.\nEnter amount in KES:"
+        if rules.check('MinimumAirtime', kes_amount=kes_amount):
+            return render_for(session, 'airtime_minimum', minimum=rules.limit('MinimumAirtime'))
         
-        if kes_amount > 1000:
-            return "CON Maximum airtime purchase is 1,000 KES.\nEnter amount in KES:"
+        if rules.check('MaximumAirtime', kes_amount=kes_amount):
+            return render_for(session, 'airtime_maximum', maximum=rules.limit('MaximumAirtime'))
         
-        session.set_data("airtime_kes", kes_amount)
+        session.kes_amount = kes_amount
         session.set_state("airtime_phone")
         
-        return f"CON Buy {kes_amount} KES airtime\n\n1. For my number ({session.phone_number})\n2. For another number"
+        return render_for(session, 'airtime_recipient', kes=kes_amount, phone=session.phone_number)
         
     except ValueError:
-        return "CON Invalid amount. Enter amount in KES:"
+        return render_for(session, 'invalid_amount_kes')
 
 def handle_airtime_phone(session: USSDSession, phone_input: str) -> str:
     """Handle phone number selection for airtime purchase"""
-    kes_amount = session.get_data("airtime_kes")
+    kes_amount = session.kes_amount
     
     if phone_input.lower() == 'back':
         session.set_state("airtime_amount")
-        return "CON Buy Airtime\nEnter amount in KES (10-1000):"
+        return render_for(session, 'airtime_amount', **airtime_limits())
     
     if phone_input == "1":
         # Buy airtime for own number
         airtime_phone = session.phone_number
     elif phone_input == "2":
-        return "CON Enter phone number for airtime:"
+        return render_for(session, 'airtime_phone')
     else:
         # User entered a phone number directly
         airtime_phone = ussd_handlers.normalize_phone_number(phone_input)
         
         if not ussd_handlers.validate_phone_number(airtime_phone):
-            return "CON Invalid phone number format.\nEnter phone number for airtime:"
+            return render_for(session, 'invalid_airtime_phone')
+    
+    # Fail fast while a dependency is down instead of waiting out its timeout
+    unavailable = unavailable_response(session, 'database')
+    if unavailable:
+        return unavailable
     
     # Execute airtime purchase
-    success, message, airtime_data = ussd_handlers.buy_airtime(session.phone_number, airtime_phone, kes_amount)
+    success, message, airtime_data = ussd_handlers.buy_airtime(session.phone_number, airtime_phone, kes_amount,
+                                                                session_id=session.session_id)
     
     clear_session(session.session_id)
     
@@ -774,9 +832,38 @@ def status():
     return jsonify({
         "status": "running",
         "service": "Bitcoin Lightning USSD",
-        "active_sessions": len(user_sessions)
+        "active_sessions": len(user_sessions),
+        "dependencies": dependencies.snapshot(),
+        "balance_reconciler": balance_reconciler.status()
     })
 
+@app.route('/ready', methods=['GET'])
+def ready():
+    """Readiness for load balancers: cached BTCPay probes when BTCPay is the Lightning backend"""
+    if lightning_api.api_type != 'btcpay':
+        return jsonify({"ready": True, "checks": {}})
+    from btcpay_health_check import readiness
+    body, status_code = readiness.status()
+    return jsonify(body), status_code
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Prometheus metrics: hops, flows, responses, dependency latency, sessions and DB pool"""
+    return app.response_class(metrics.render_metrics(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/metrics/db', methods=['GET'])
+def db_metrics():
+    """Database pool usage, checkout waits and slow-query log"""
+    from database import get_pool_metrics
+    top = request.args.get('top', 20, type=int)
+    return jsonify(get_pool_metrics(top))
+
+@app.route('/metrics/metta', methods=['GET'])
+def metta_metrics():
+    """Lock contention and write batching per MeTTa space (empty until the knowledge base is loaded)"""
+    queries = ussd_handlers._queries
+    return jsonify(queries.stats() if queries is not None else {})
+
 @app.route('/test', methods=['GET'])
 def test():
     """Test endpoint for debugging"""
@@ -794,9 +881,7 @@ def test():
 def landing_page():
     """Serve the landing page"""
     try:
-        with open('/var/www/btc.emmanuelhaggai.com/index.html', 'r', encoding='utf-8') as f:
-            content = f.read()
-            return content, 200, {'Content-Type': 'text/html; charset=utf-8'}
+        return static_assets.respond('index.html', request.headers)
     except FileNotFoundError:
         return "Landing page not found", 404
 
@@ -804,7 +889,7 @@ def landing_page():
 def serve_css():
     """Serve CSS file"""
     try:
-        return send_file('/var/www/btc.emmanuelhaggai.com/styles.css', mimetype='text/css')
+        return static_assets.respond('styles.css', request.headers, request.args.get('v'))
     except FileNotFoundError:
         return "CSS not found", 404
 
@@ -812,7 +897,7 @@ def serve_css():
 def serve_js():
     """Serve JavaScript file"""
     try:
-        return send_file('/var/www/btc.emmanuelhaggai.com/script.js', mimetype='application/javascript')
+        return static_assets.respond('script.js', request.headers, request.args.get('v'))
     except FileNotFoundError:
         return "JS not found", 404
 
@@ -820,13 +905,5 @@ if __name__ == '__main__':
     logger.info("Starting Bitcoin Lightning USSD service...")
     print("STARTUP: Bitcoin Lightning USSD service starting...")
     
-    # Initialize balance for your number
-    your_phone = "+254715586044"
-    lightning_api.set_balance(your_phone, 0)
-    ussd_handlers.update_balance(your_phone, 0)
-    
-    logger.info("Live user balance initialized")
-    print("STARTUP: Live user balance initialized")
-    
     # Run Flask app
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -0,0 +1,72 @@
+"""
+Application context for lazily constructed shared resources
+Keeps the database engine, MeTTa space and OpenAI client out of import time
+"""
+import logging
+import threading
+from typing import Any, Callable, Dict
+
+logger = logging.getLogger(__name__)
+
+class AppContext:
+    """
+    Registry of process-wide resources built on first use.
+
+    Modules register a factory at import time (cheap) and the resource is
+    only constructed the first time something asks for it, so CLI tools and
+    workers that never touch the database or OpenAI never pay for them.
+
+    Usage:
+        context.register('db_manager', DatabaseManager)
+        db = context.get('db_manager')
+    """
+
+    def __init__(self):
+        self._factories: Dict[str, Callable[[], Any]] = {}
+        self._resources: Dict[str, Any] = {}
+        self._lock = threading.RLock()
+
+    def register(self, name: str, factory: Callable[[], Any]):
+        """Register a factory for a named resource"""
+        with self._lock:
+            self._factories[name] = factory
+
+    def get(self, name: str) -> Any:
+        """Get a resource, constructing it on first access"""
+        resource = self._resources.get(name)
+        if resource is not None:
+            return resource
+
+        with self._lock:
+            # Another thread may have built it while we waited for the lock
+            if name in self._resources:
+                return self._resources[name]
+
+            factory = self._factories.get(name)
+            if factory is None:
+                raise KeyError(f"No factory registered for resource: {name}")
+
+            logger.info(f"Initializing {name}")
+            resource = factory()
+            self._resources[name] = resource
+            return resource
+
+    def is_initialized(self, name: str) -> bool:
+        """Check whether a resource has been constructed"""
+        return name in self._resources
+
+    def override(self, name: str, resource: Any):
+        """Install a prebuilt resource (benchmarks, alternative backends)"""
+        with self._lock:
+            self._resources[name] = resource
+
+    def reset(self, name: str = None):
+        """Drop constructed resources so they are rebuilt on next access"""
+        with self._lock:
+            if name is None:
+                self._resources.clear()
+            else:
+                self._resources.pop(name, None)
+
+# Global application context
+context = AppContext()
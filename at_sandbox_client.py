@@ -5,21 +5,31 @@ Real integration with AT Sandbox for USSD testing
 import requests
 import json
 from config import Config
+from tracing import TracedHTTP
 import logging
-from typing import Dict, Any
+from typing import Dict, Any, List
 
 logger = logging.getLogger(__name__)
 
 class AfricasTalkingSandboxClient:
     """Client for Africa's Talking Sandbox API"""
     
+    API_URLS = {
+        'sandbox': "https://api.sandbox.africastalking.com/version1",
+        'production': "https://api.africastalking.com/version1",
+    }
+    
     def __init__(self):
         self.username = Config.AFRICASTALKING_USERNAME
         self.api_key = Config.AFRICASTALKING_API_KEY
         self.environment = Config.AFRICASTALKING_ENVIRONMENT or 'sandbox'
         
-        # Sandbox URLs
-        self.base_url = "https://api.sandbox.africastalking.com/version1"
+        # Sandbox or live API (AFRICASTALKING_API_URL overrides both, e.g. for a local fake)
+        self.base_url = Config.AFRICASTALKING_API_URL or self.API_URLS.get(self.environment, self.API_URLS['sandbox'])
+        
+        # One pooled session for all calls
+        session = requests.Session()
+        self.http = TracedHTTP('africastalking', session=session)
         self.headers = {
             'Accept': 'application/json',
             'Content-Type': 'application/x-www-form-urlencoded',
@@ -35,7 +45,7 @@ class AfricasTalkingSandboxClient:
                 'phoneNumber': phone_number
             }
             
-            response = requests.post(url, headers=self.headers, data=data)
+            response = self.http.post(url, headers=self.headers, data=data, timeout=30)
             result = response.json()
             
             logger.info(f"Checkout token creation: {result}")
@@ -60,7 +70,7 @@ class AfricasTalkingSandboxClient:
                 })
             }
             
-            response = requests.post(url, headers=self.headers, data=data)
+            response = self.http.post(url, headers=self.headers, data=data, timeout=30)
             result = response.json()
             
             logger.info(f"Mobile checkout initiated: {result}")
@@ -89,7 +99,7 @@ class AfricasTalkingSandboxClient:
                 }])
             }
             
-            response = requests.post(url, headers=self.headers, data=data)
+            response = self.http.post(url, headers=self.headers, data=data, timeout=30)
             result = response.json()
             
             logger.info(f"Mobile payment sent: {result}")
@@ -100,19 +110,27 @@ class AfricasTalkingSandboxClient:
             return {"status": "error", "message": str(e)}
     
     def send_sms(self, phone_number: str, message: str) -> Dict[str, Any]:
-        """Send SMS notification"""
+        """Send SMS notification synchronously (prefer sms_queue.send_sms from request handlers)"""
+        return self.send_bulk_sms([phone_number], message)
+    
+    def send_bulk_sms(self, phone_numbers: List[str], message: str) -> Dict[str, Any]:
+        """Send one message to several recipients in a single request"""
         try:
             url = f"{self.base_url}/messaging"
             data = {
                 'username': self.username,
-                'to': phone_number,
+                'to': ','.join(phone_numbers),
                 'message': message
             }
+            if Config.AFRICASTALKING_SENDER_ID:
+                data['from'] = Config.AFRICASTALKING_SENDER_ID
             
-            response = requests.post(url, headers=self.headers, data=data)
+            response = self.http.post(url, headers=self.headers, data=data, timeout=30)
+            if response.status_code >= 400:
+                return {"status": "error", "message": f"HTTP {response.status_code}"}
             result = response.json()
             
-            logger.info(f"SMS sent: {result}")
+            logger.info(f"SMS sent to {len(phone_numbers)} recipient(s): {result.get('SMSMessageData', {}).get('Message')}")
             return result
             
         except Exception as e:
@@ -125,7 +143,7 @@ class AfricasTalkingSandboxClient:
             url = f"{self.base_url}/user"
             params = {'username': self.username}
             
-            response = requests.get(url, headers=self.headers, params=params)
+            response = self.http.get(url, headers=self.headers, params=params, timeout=30)
             result = response.json()
             
             logger.info(f"Account balance: {result}")
@@ -0,0 +1,242 @@
+"""
+Balance reconciliation between the database and MeTTa
+Background passes that stream changed balances both ways in batches, with drift metrics
+
+The users table is the ledger of record: Lightning payments and M-Pesa top-ups
+move users.balance_sats directly. The MeTTa Balance facts that rules and the AI
+flows read are a journal projection and can fall behind. Instead of repairing
+them on every balance read, a reconciler thread in each worker runs a pass
+every interval seconds:
+
+- database -> MeTTa: users rows whose updated_at is at or after the last
+  watermark (minus an overlap window for rows committed out of order) are
+  read in batches (keyset on id) and compared with their Balance fact;
+- MeTTa -> database: accounts whose Balance fact changed since the last pass
+  (BALANCE_SET events, plus every fact present at startup) are looked up in
+  the database in batches.
+
+Conflicts are resolved the same way in both directions, so every worker reaches
+the same answer: the database balance wins and is journaled as a BALANCE_SET
+(which updates MeTTa in every worker). MeTTa never writes to the ledger; a
+Balance fact for an account the database has no row for is reset to 0, the
+balance the ledger reports for it. Only the database-backed (mock) Lightning
+backend keeps balances in the users table; with the other backends passes are
+skipped.
+
+Usage:
+    from balance_reconciler import balance_reconciler
+
+    balance_reconciler.attach(queries)     # replay the journal, start the thread
+    balance_reconciler.run_once()          # one pass now
+
+    python balance_reconciler.py once
+"""
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Set
+
+from config import Config
+from database import get_session
+from event_journal import journal, Event, Projection, BALANCE_SET
+from lightning import lightning_api
+from metrics import BALANCE_DRIFT, BALANCE_DRIFT_SATS, BALANCE_RECONCILE_ROWS
+from metta_queries import MettaQueries, BALANCE
+from models import User
+
+logger = logging.getLogger(__name__)
+
+# Repair direction (metric label value); MeTTa is never copied to the database
+DB_TO_METTA = 'db_to_metta'
+
+class BalanceReconciler(Projection):
+    """
+    Keeps MeTTa Balance facts and users.balance_sats in step.
+
+    Attached to the journal as a projection so it learns which accounts had a
+    BALANCE_SET since its last pass (in this worker or any other).
+    """
+    name = 'balance_reconciler'
+
+    def __init__(self, interval: float = None, batch_size: int = None, overlap_seconds: float = None):
+        self.interval = interval if interval is not None else Config.BALANCE_RECONCILE_INTERVAL
+        self.batch_size = batch_size if batch_size is not None else Config.BALANCE_RECONCILE_BATCH_SIZE
+        self.overlap_seconds = (overlap_seconds if overlap_seconds is not None
+                                else Config.BALANCE_RECONCILE_OVERLAP_SECONDS)
+        self.queries: Optional[MettaQueries] = None
+        self.watermark: Optional[datetime] = None
+        self._dirty: Set[str] = set()
+        self._lock = threading.Lock()
+        self._pass_lock = threading.Lock()
+        self._worker = None
+        self._worker_pid = None
+        self._stopped = threading.Event()
+        self.stats = {'passes': 0, 'rows_checked': 0, DB_TO_METTA: 0,
+                      'last_pass_at': None, 'last_pass_ms': None, 'last_error': None}
+
+    # --- projection ------------------------------------------------------
+
+    def apply(self, event: Event):
+        if event.type == BALANCE_SET:
+            with self._lock:
+                self._dirty.add(event.data['phone'])
+
+    def snapshot(self) -> Dict[str, Any]:
+        # Nothing to keep: the first pass after a restart compares every account
+        return {}
+
+    # --- lifecycle -------------------------------------------------------
+
+    def attach(self, queries: MettaQueries):
+        """Start reconciling against a knowledge base (facts present now are checked on the first pass)"""
+        first = self.queries is None
+        self.queries = queries
+        if first:
+            journal.attach(self)
+        with self._lock:
+            self._dirty.update(row['phone'] for row in queries.query(BALANCE))
+        self.ensure_running()
+
+    def ensure_running(self):
+        """Start the reconciler thread in this process (first use, or after a fork)"""
+        if self._worker_pid == os.getpid() or self.queries is None or self.interval <= 0:
+            return
+        with self._lock:
+            if self._worker_pid == os.getpid():
+                return
+            self._worker_pid = os.getpid()
+            self._worker = threading.Thread(target=self._run, name='balance-reconciler', daemon=True)
+            self._worker.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                self.stats['last_error'] = str(e)
+                logger.error(f"Balance reconciliation pass failed: {e}")
+
+    def close(self):
+        self._stopped.set()
+
+    # --- passes ----------------------------------------------------------
+
+    def run_once(self) -> Dict[str, int]:
+        """
+        Run one reconciliation pass.
+
+        Returns:
+            Accounts checked and Balance facts repaired
+        """
+        result = {'checked': 0, DB_TO_METTA: 0}
+        if self.queries is None or lightning_api.api_type != 'mock':
+            return result
+        with self._pass_lock:
+            start = time.perf_counter()
+            # Apply BALANCE_SET events other workers wrote, so their repairs are not repeated
+            journal.catch_up()
+            with self._lock:
+                dirty, self._dirty = self._dirty, set()
+            try:
+                seen = self._reconcile_changed_rows(result)
+                self._reconcile_dirty(sorted(dirty - seen), result)
+            except Exception:
+                with self._lock:
+                    self._dirty |= dirty
+                raise
+            self.stats['passes'] += 1
+            self.stats['rows_checked'] += result['checked']
+            self.stats[DB_TO_METTA] += result[DB_TO_METTA]
+            self.stats['last_pass_at'] = time.time()
+            self.stats['last_pass_ms'] = round((time.perf_counter() - start) * 1000, 1)
+            self.stats['last_error'] = None
+        if result[DB_TO_METTA]:
+            logger.info(f"Balance reconciliation: {result}")
+        return result
+
+    def _reconcile_changed_rows(self, result: Dict[str, int]) -> Set[str]:
+        """database -> MeTTa for rows changed since the watermark; returns the phones compared"""
+        since = self.watermark - timedelta(seconds=self.overlap_seconds) if self.watermark else None
+        seen = set()
+        newest = self.watermark
+        last_id = 0
+        while True:
+            # Keyset pagination on id inside the updated_at window (no equality tests on
+            # timestamps, which some databases store with less precision than Python's)
+            with get_session() as session:
+                query = session.query(User.id, User.phone_number, User.balance_sats, User.updated_at)
+                if since is not None:
+                    query = query.filter(User.updated_at >= since)
+                rows = query.filter(User.id > last_id).order_by(User.id).limit(self.batch_size).all()
+            for row in rows:
+                seen.add(row.phone_number)
+                self._compare(row.phone_number, row.balance_sats, result)
+                if newest is None or row.updated_at > newest:
+                    newest = row.updated_at
+            BALANCE_RECONCILE_ROWS.inc('database', amount=len(rows))
+            if len(rows) < self.batch_size:
+                break
+            last_id = rows[-1].id
+        self.watermark = newest
+        return seen
+
+    def _reconcile_dirty(self, phones: List[str], result: Dict[str, int]):
+        """Check accounts whose Balance fact changed against the database"""
+        for i in range(0, len(phones), self.batch_size):
+            batch = phones[i:i + self.batch_size]
+            with get_session() as session:
+                stored = dict(session.query(User.phone_number, User.balance_sats)
+                              .filter(User.phone_number.in_(batch)).all())
+            for phone in batch:
+                if phone in stored:
+                    self._compare(phone, stored[phone], result)
+                elif self._compare(phone, 0, result):
+                    # Facts never create ledger rows (atoms.metta's sample balances would mint sats)
+                    logger.warning(f"Balance fact for {phone} has no users row; reset it to 0")
+            BALANCE_RECONCILE_ROWS.inc('metta', amount=len(batch))
+
+    def _compare(self, phone: str, db_balance: int, result: Dict[str, int]) -> bool:
+        """The database wins: journal its balance if the Balance fact differs; returns whether it did"""
+        result['checked'] += 1
+        metta_balance = self.queries.value(BALANCE, 'balance', phone=phone)
+        if metta_balance == db_balance:
+            return False
+        journal.append(BALANCE_SET, {'phone': phone, 'balance': db_balance})
+        self._record_drift(DB_TO_METTA, abs(db_balance - (metta_balance or 0)), result)
+        return True
+
+    @staticmethod
+    def _record_drift(direction: str, sats: int, result: Dict[str, int]):
+        result[direction] += 1
+        BALANCE_DRIFT.inc(direction)
+        BALANCE_DRIFT_SATS.observe(sats)
+
+    def status(self) -> Dict[str, Any]:
+        """Pass counters, watermark and accounts waiting for the next pass"""
+        self.ensure_running()
+        with self._lock:
+            pending = len(self._dirty)
+        return dict(self.stats, pending=pending, enabled=self.queries is not None and lightning_api.api_type == 'mock',
+                    watermark=self.watermark.isoformat() if self.watermark else None)
+
+# Global instance
+balance_reconciler = BalanceReconciler()
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Reconcile MeTTa and database balances')
+    subcommands = parser.add_subparsers(dest='command', required=True)
+    subcommands.add_parser('once', help='Load the knowledge base and run one full pass')
+    args = parser.parse_args()
+
+    # The instance the handlers attach (this file runs as __main__, a separate module)
+    from balance_reconciler import balance_reconciler as reconciler
+    from handlers import ussd_handlers
+
+    reconciler.interval = 0  # No background thread for a one-off pass
+    ussd_handlers.queries
+    print(json.dumps(reconciler.run_once(), indent=2))
@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+"""
+Handler hot-path micro-benchmarks
+Times balance lookups, history queries, phone parsing, carrier detection, mock Lightning
+payments and USSD dispatch across knowledge-base sizes and user counts
+
+Each scenario gets a fresh in-memory database and MeTTa space seeded with `users`
+accounts and `kb_size` Transaction atoms. Timings are pyperf-style: calibrated loops,
+warmup samples, then per-iteration mean/median/stdev over several samples.
+
+Usage:
+    python benchmark_handlers.py run                                # Default matrix
+    python benchmark_handlers.py run --kb-sizes 1000000 --users 10000
+    python benchmark_handlers.py run --only balance,dispatch        # Subset of benchmarks
+    python benchmark_handlers.py run --save baseline                # Save benchmarks/baseline.json
+    python benchmark_handlers.py run --compare baseline             # Run and compare to a baseline
+    python benchmark_handlers.py compare baseline candidate         # Compare two saved runs
+    python benchmark_handlers.py list                               # Saved baselines
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from typing import Dict, Any, List, Callable
+
+BENCHMARK_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks')
+
+BenchFunc = Callable[[Dict[str, Any], int], float]
+BENCHMARKS: Dict[str, BenchFunc] = {}
+
+def benchmark(name: str):
+    """Register a benchmark: func(ctx, loops) -> elapsed seconds for `loops` iterations"""
+    def decorator(func: BenchFunc) -> BenchFunc:
+        BENCHMARKS[name] = func
+        return func
+    return decorator
+
+# ---------------------------------------------------------------------------
+# Scenario setup
+# ---------------------------------------------------------------------------
+
+def _phone(index: int) -> str:
+    return f"+2547{10000000 + index:08d}"
+
+def build_scenario(kb_size: int, users: int, seed: int = 42) -> Dict[str, Any]:
+    """
+    Build a fresh database and knowledge base for one (kb_size, users) scenario.
+
+    Args:
+        kb_size: Number of Transaction atoms added to the MeTTa space
+        users: Number of user accounts (database rows and Balance atoms)
+        seed: Random seed for generated ledger data
+
+    Returns:
+        Context dictionary shared by the benchmarks of this scenario
+    """
+    from sqlalchemy import insert
+    from database import create_database_manager, set_db_manager, init_database, get_session
+    from models import User
+    from handlers import USSDHandlers
+    from metta_queries import BALANCE, TRANSACTION
+    from lightning import LightningAPI
+    import handlers as handlers_module
+    import app as ussd_app
+    from session_store import session_store
+
+    set_db_manager(create_database_manager('benchmark'))
+    init_database()
+
+    phones = [_phone(i) for i in range(users)]
+    with get_session() as session:
+        session.execute(insert(User), [{'phone_number': p, 'balance_sats': 10 ** 12} for p in phones])
+        session.commit()
+
+    # Seed through the fact templates so atoms land in the phone's shard, as the handlers write them
+    handler = USSDHandlers()
+    queries = handler.queries
+    for phone in phones:
+        queries.add(BALANCE, phone=phone, balance=10 ** 12)
+
+    rng = random.Random(seed)
+    types = ['Send', 'Receive', 'TopUp', 'Withdraw', 'Airtime']
+    for i in range(kb_size):
+        sender, recipient = rng.choice(phones), rng.choice(phones)
+        timestamp = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(1700000000 + i))
+        queries.add(TRANSACTION, sender=sender, recipient=recipient, amount=rng.randint(1, 100000),
+                    kind=rng.choice(types), timestamp=timestamp)
+
+    # Route the app's dispatch through this scenario's handler, without session persistence
+    handlers_module.ussd_handlers = handler
+    ussd_app.ussd_handlers = handler
+    session_store.persist = False
+
+    # Mock Lightning backend with one outstanding invoice per user to scan past
+    lightning = LightningAPI("mock")
+    for i, phone in enumerate(phones):
+        lightning.mock_data["invoices"][f"open_{i}"] = {
+            "payment_request": f"lnbc_open_{i}", "payment_hash": f"hash_open_{i}",
+            "amount": 1, "memo": "", "user_id": phone, "paid": False, "expires_at": 0
+        }
+
+    return {
+        'kb_size': kb_size,
+        'users': users,
+        'phones': phones,
+        'user': phones[len(phones) // 2],
+        'handler': handler,
+        'lightning': lightning,
+        'app': ussd_app,
+        'rng': rng,
+        'invoice_counter': 0,
+    }
+
+# ---------------------------------------------------------------------------
+# Benchmarks
+# ---------------------------------------------------------------------------
+
+PHONE_INPUTS = ['0712345678', '254712345678', '+254712345678', ' 0733123456 ', '0770123456', '12345']
+
+@benchmark('balance')
+def bench_get_user_balance(ctx: Dict[str, Any], loops: int) -> float:
+    handler, user = ctx['handler'], ctx['user']
+    start = time.perf_counter()
+    for _ in range(loops):
+        handler.get_user_balance(user)
+    return time.perf_counter() - start
+
+@benchmark('history')
+def bench_get_transaction_history(ctx: Dict[str, Any], loops: int) -> float:
+    handler, user = ctx['handler'], ctx['user']
+    start = time.perf_counter()
+    for _ in range(loops):
+        handler.get_transaction_history(user, limit=5)
+    return time.perf_counter() - start
+
+@benchmark('normalize_phone')
+def bench_normalize_phone_number(ctx: Dict[str, Any], loops: int) -> float:
+    normalize = ctx['handler'].normalize_phone_number
+    start = time.perf_counter()
+    for _ in range(loops):
+        for phone in PHONE_INPUTS:
+            normalize(phone)
+    return time.perf_counter() - start
+
+@benchmark('validate_phone')
+def bench_validate_phone_number(ctx: Dict[str, Any], loops: int) -> float:
+    validate = ctx['handler'].validate_phone_number
+    start = time.perf_counter()
+    for _ in range(loops):
+        for phone in PHONE_INPUTS:
+            validate(phone)
+    return time.perf_counter() - start
+
+@benchmark('detect_carrier')
+def bench_detect_carrier(ctx: Dict[str, Any], loops: int) -> float:
+    detect = ctx['handler']._detect_carrier
+    phones = ['+254712345678', '+254733123456', '+254770123456', '+254799123456', '+255712345678']
+    start = time.perf_counter()
+    for _ in range(loops):
+        for phone in phones:
+            detect(phone)
+    return time.perf_counter() - start
+
+@benchmark('lightning_pay')
+def bench_lightning_pay_invoice(ctx: Dict[str, Any], loops: int) -> float:
+    lightning, phones, rng = ctx['lightning'], ctx['phones'], ctx['rng']
+    invoices = lightning.mock_data["invoices"]
+    requests = []
+    for _ in range(loops):
+        ctx['invoice_counter'] += 1
+        n = ctx['invoice_counter']
+        invoices[f"bench_{n}"] = {
+            "payment_request": f"lnbc_bench_{n}", "payment_hash": f"hash_bench_{n}",
+            "amount": 10, "memo": "", "user_id": rng.choice(phones), "paid": False, "expires_at": 0
+        }
+        requests.append(f"lnbc_bench_{n}")
+
+    payer = ctx['user']
+    start = time.perf_counter()
+    for payment_request in requests:
+        lightning.pay_invoice(payer, payment_request)
+    return time.perf_counter() - start
+
+@benchmark('dispatch')
+def bench_handle_user_input(ctx: Dict[str, Any], loops: int) -> float:
+    ussd_app, user = ctx['app'], ctx['user']
+    USSDSession = ussd_app.USSDSession
+    hops = [("main_menu", ["1"]), ("send_btc_phone", ["1", "0712345678"]), ("airtime_amount", ["6", "50"])]
+    start = time.perf_counter()
+    for i in range(loops):
+        for state, text_parts in hops:
+            session = USSDSession(f"bench_{i}", user)
+            session.state = state
+            ussd_app.handle_user_input(session, text_parts)
+    return time.perf_counter() - start
+
+# ---------------------------------------------------------------------------
+# Runner
+# ---------------------------------------------------------------------------
+
+def calibrate(func: BenchFunc, ctx: Dict[str, Any], min_time: float) -> int:
+    """Double the loop count until one sample takes at least min_time seconds"""
+    loops = 1
+    while loops < 10 ** 7:
+        if func(ctx, loops) >= min_time:
+            return loops
+        loops *= 2
+    return loops
+
+def run_benchmark(func: BenchFunc, ctx: Dict[str, Any], samples: int, warmups: int,
+                  min_time: float) -> Dict[str, Any]:
+    """
+    Time one benchmark in one scenario.
+
+    Returns:
+        Per-iteration timing statistics in microseconds
+    """
+    loops = calibrate(func, ctx, min_time)
+    for _ in range(warmups):
+        func(ctx, loops)
+    values = [func(ctx, loops) / loops * 1e6 for _ in range(samples)]
+    return {
+        'loops': loops,
+        'values_us': [round(value, 4) for value in values],
+        'mean_us': round(statistics.mean(values), 4),
+        'median_us': round(statistics.median(values), 4),
+        'stdev_us': round(statistics.stdev(values), 4) if len(values) > 1 else 0.0,
+        'min_us': round(min(values), 4)
+    }
+
+def run_suite(kb_sizes: List[int], user_counts: List[int], only: List[str] = None,
+              samples: int = 10, warmups: int = 2, min_time: float = 0.05) -> Dict[str, Any]:
+    """Run every selected benchmark for every (kb_size, users) scenario"""
+    selected = [name for name in BENCHMARKS if not only or name in only]
+    results = {}
+    for kb_size in kb_sizes:
+        for users in user_counts:
+            setup_start = time.perf_counter()
+            ctx = build_scenario(kb_size, users)
+            setup_s = time.perf_counter() - setup_start
+            print(f"scenario kb={kb_size} users={users} (setup {setup_s:.1f} s)", file=sys.stderr)
+            for name in selected:
+                key = f"{name}[kb={kb_size},users={users}]"
+                results[key] = run_benchmark(BENCHMARKS[name], ctx, samples, warmups, min_time)
+                print(f"  {key:<48} {format_us(results[key]['median_us'])}", file=sys.stderr)
+
+    return {
+        'metadata': {
+            'timestamp': time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'samples': samples,
+            'warmups': warmups,
+            'min_time_s': min_time
+        },
+        'benchmarks': results
+    }
+
+def format_us(value: float) -> str:
+    """Format a duration given in microseconds"""
+    if value >= 1e6:
+        return f"{value / 1e6:.2f} s"
+    if value >= 1e3:
+        return f"{value / 1e3:.2f} ms"
+    return f"{value:.2f} us"
+
+def baseline_path(name: str) -> str:
+    """Resolve a baseline name or path to a JSON file"""
+    if name.endswith('.json') or os.sep in name:
+        return name
+    return os.path.join(BENCHMARK_DIR, f"{name}.json")
+
+def save_results(results: Dict[str, Any], name: str) -> str:
+    path = baseline_path(name)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+    return path
+
+def load_results(name: str) -> Dict[str, Any]:
+    with open(baseline_path(name)) as f:
+        return json.load(f)
+
+def compare_results(base: Dict[str, Any], new: Dict[str, Any], threshold: float) -> int:
+    """
+    Print a comparison table and count significant regressions.
+
+    A change is significant when the medians differ by more than `threshold`
+    percent and by more than the combined standard deviation of both runs.
+
+    Returns:
+        Number of benchmarks that got significantly slower
+    """
+    regressions = 0
+    print(f"{'benchmark':<48}{'base':>12}{'new':>12}{'change':>10}  ")
+    print("-" * 86)
+    for key in sorted(set(base['benchmarks']) | set(new['benchmarks'])):
+        old_stats = base['benchmarks'].get(key)
+        new_stats = new['benchmarks'].get(key)
+        if old_stats is None or new_stats is None:
+            present = format_us(new_stats['median_us']) if new_stats else "-"
+            previous = format_us(old_stats['median_us']) if old_stats else "-"
+            print(f"{key:<48}{previous:>12}{present:>12}{'':>10}  (only in one run)")
+            continue
+
+        old_median, new_median = old_stats['median_us'], new_stats['median_us']
+        change = (new_median - old_median) / old_median * 100 if old_median else 0.0
+        noise = old_stats['stdev_us'] + new_stats['stdev_us']
+        verdict = ""
+        if abs(change) > threshold and abs(new_median - old_median) > noise:
+            if change > 0:
+                verdict = "SLOWER"
+                regressions += 1
+            else:
+                verdict = "faster"
+        print(f"{key:<48}{format_us(old_median):>12}{format_us(new_median):>12}{change:>+9.1f}%  {verdict}")
+
+    print()
+    print(f"{regressions} significant regression(s) at >{threshold:g}% threshold")
+    return regressions
+
+def _int_list(value: str) -> List[int]:
+    return [int(item) for item in value.split(',') if item.strip()]
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for USSD handler hot paths")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help="Run the benchmark suite")
+    run_parser.add_argument('--kb-sizes', type=_int_list, default=[0, 10000, 100000],
+                            help="Transaction atoms in the knowledge base (comma-separated)")
+    run_parser.add_argument('--users', type=_int_list, default=[100, 10000],
+                            help="User accounts (comma-separated)")
+    run_parser.add_argument('--only', help=f"Comma-separated subset of: {', '.join(BENCHMARKS)}")
+    run_parser.add_argument('--samples', type=int, default=10, help="Timed samples per benchmark")
+    run_parser.add_argument('--warmups', type=int, default=2, help="Untimed warmup samples")
+    run_parser.add_argument('--min-time', type=float, default=0.05, help="Minimum seconds per sample")
+    run_parser.add_argument('--save', help="Save results as benchmarks/<name>.json (or a path)")
+    run_parser.add_argument('--compare', help="Baseline to compare against after the run")
+    run_parser.add_argument('--threshold', type=float, default=5.0, help="Regression threshold in percent")
+    run_parser.add_argument('--json', action='store_true', help="Print results as JSON")
+
+    compare_parser = subparsers.add_parser('compare', help="Compare two saved runs")
+    compare_parser.add_argument('base', help="Baseline name or path")
+    compare_parser.add_argument('new', help="Candidate name or path")
+    compare_parser.add_argument('--threshold', type=float, default=5.0, help="Regression threshold in percent")
+
+    subparsers.add_parser('list', help="List saved baselines")
+
+    args = parser.parse_args()
+
+    if args.command == 'list':
+        if os.path.isdir(BENCHMARK_DIR):
+            for filename in sorted(os.listdir(BENCHMARK_DIR)):
+                if filename.endswith('.json'):
+                    metadata = load_results(os.path.join(BENCHMARK_DIR, filename)).get('metadata', {})
+                    print(f"{filename[:-5]:<24}{metadata.get('timestamp', '')}")
+        return
+
+    if args.command == 'compare':
+        regressions = compare_results(load_results(args.base), load_results(args.new), args.threshold)
+        sys.exit(1 if regressions else 0)
+
+    unknown = set(args.only.split(',')) - set(BENCHMARKS) if args.only else set()
+    if unknown:
+        parser.error(f"Unknown benchmarks: {', '.join(sorted(unknown))}")
+
+    # Handlers log every call; keep logging out of the measurements
+    logging.disable(logging.CRITICAL)
+
+    # Ledger events and queued SMS from the benchmarks stay out of the real journal and outbox
+    from event_journal import journal
+    from sms_queue import sms_queue
+    scratch_dir = tempfile.mkdtemp(prefix="ussd_bench_")
+    journal.directory = os.path.join(scratch_dir, 'journal')
+    sms_queue.path = os.path.join(scratch_dir, 'sms_queue.db')
+
+    results = run_suite(
+        args.kb_sizes, args.users,
+        only=args.only.split(',') if args.only else None,
+        samples=args.samples, warmups=args.warmups, min_time=args.min_time
+    )
+
+    if args.save:
+        print(f"Saved {save_results(results, args.save)}", file=sys.stderr)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    if args.compare:
+        regressions = compare_results(load_results(args.compare), results, args.threshold)
+        sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()
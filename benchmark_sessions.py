@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+USSD session memory benchmark
+Reports heap bytes per live session for the previous dict-based session and AI context
+objects and for the slotted ones in session_store and ai_processor
+
+Sessions are populated with a realistic mix of flows (menu only, send, invoice,
+withdraw, airtime), and a share of them also hold an AI conversation context.
+Memory is measured with tracemalloc as the growth of the heap while the
+sessions are alive, including the string values they reference.
+
+Usage:
+    python benchmark_sessions.py                     # 50,000 sessions
+    python benchmark_sessions.py --sessions 200000 --ai-share 0.5
+"""
+import argparse
+import gc
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Tuple
+
+from ai_processor import SessionContext
+from session_store import USSDSession
+
+class LegacyUSSDSession:
+    """The session object before slots: instance __dict__, string state, free-form data dict"""
+
+    def __init__(self, session_id: str, phone_number: str):
+        self.session_id = session_id
+        self.phone_number = phone_number
+        self.state = "main_menu"
+        self.data = {}
+        self.last_activity = time.time()
+
+    def set_state(self, state: str):
+        self.state = state
+
+    def set_data(self, key: str, value):
+        self.data[key] = value
+
+# (state, data) per flow, mirroring what the handlers store mid-flow
+FLOWS: List[Tuple[str, Dict[str, object]]] = [
+    ('main_menu', {}),
+    ('send_btc_amount', {'recipient_phone': '+254712345678'}),
+    ('send_invoice_amount', {'invoice_recipient': '+254798765432'}),
+    ('withdraw_phone', {'withdraw_kes': 500}),
+    ('airtime_phone', {'airtime_kes': 100}),
+]
+
+# Nested context dicts as the AI processor stored them, and their slotted equivalent
+AI_CONTEXTS = [
+    (lambda: {'operation': 'topup_mpesa', 'awaiting': 'confirmation',
+              'data': {'kes_amount': 1000, 'sats_equivalent': 153846}},
+     lambda: SessionContext('topup_mpesa', 'confirmation', kes_amount=1000, amount=153846)),
+    (lambda: {'operation': 'withdraw_mpesa', 'awaiting': 'phone_number',
+              'data': {'kes_amount': 500, 'sats_needed': 76923}},
+     lambda: SessionContext('withdraw_mpesa', 'phone_number', kes_amount=500, amount=76923)),
+    (lambda: {'operation': 'buy_airtime', 'awaiting': 'amount', 'data': {}},
+     lambda: SessionContext('buy_airtime', 'amount')),
+]
+
+def build(count: int, session_class, compact_context: bool, ai_share: float) -> Tuple[dict, dict]:
+    """Create `count` live sessions (and AI contexts for ai_share of them)"""
+    sessions = {}
+    contexts = {}
+    ai_every = int(1 / ai_share) if ai_share > 0 else 0
+    for i in range(count):
+        # Distinct ids and phones, like real traffic (not shared interned constants)
+        session_id = f"ATUid_{i:012d}"
+        session = session_class(session_id, f"+2547{i:08d}")
+        state, data = FLOWS[i % len(FLOWS)]
+        session.set_state(state)
+        session.set_data('language', 'en')
+        for key, value in data.items():
+            session.set_data(key, value)
+        sessions[session_id] = session
+        if ai_every and i % ai_every == 0:
+            legacy_factory, compact_factory = AI_CONTEXTS[i % len(AI_CONTEXTS)]
+            contexts[session_id] = compact_factory() if compact_context else legacy_factory()
+    return sessions, contexts
+
+def measure(count: int, factory: Callable[[], object]) -> Tuple[float, float]:
+    """
+    Heap growth for keeping the factory's result alive.
+
+    Returns:
+        (bytes per session, build seconds)
+    """
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    live = factory()
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del live
+    return (after - before) / count, elapsed
+
+def run(count: int, ai_share: float) -> Dict[str, Dict[str, float]]:
+    """Measure the legacy and compact representations"""
+    results = {}
+    for name, session_class, compact in (('legacy', LegacyUSSDSession, False), ('compact', USSDSession, True)):
+        per_session, elapsed = measure(count, lambda: build(count, session_class, compact, ai_share))
+        results[name] = {'bytes_per_session': round(per_session, 1), 'build_s': round(elapsed, 3)}
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Heap bytes per live USSD session, before and after slots')
+    parser.add_argument('--sessions', type=int, default=50000, help='Live sessions to create')
+    parser.add_argument('--ai-share', type=float, default=0.2, help='Fraction of sessions with an AI context')
+    args = parser.parse_args()
+
+    results = run(args.sessions, args.ai_share)
+    legacy = results['legacy']['bytes_per_session']
+    compact = results['compact']['bytes_per_session']
+    print(f"{args.sessions:,} sessions, {args.ai_share:.0%} with an AI context")
+    for name, result in results.items():
+        print(f"  {name:<8} {result['bytes_per_session']:>8.1f} bytes/session  (built in {result['build_s']:.2f} s)")
+    print(f"  saved    {legacy - compact:>8.1f} bytes/session ({(1 - compact / legacy):.0%}), "
+          f"{(legacy - compact) * args.sessions / 2 ** 20:.1f} MiB in total")
+
+if __name__ == "__main__":
+    main()
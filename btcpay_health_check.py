@@ -2,67 +2,141 @@
 """
 BTCPay Server Health Check and Initialization Script
 Checks if BTCPay Server is ready and performs initial setup
+
+Probes share one HTTP session and run concurrently. Read-only probes start at
+once; the test invoice (a write) waits for the store probe. A probe whose
+dependency failed is reported as skipped, so the first failure in the chain
+server -> API key -> store -> invoice is the one shown.
+
+Usage:
+    python btcpay_health_check.py            # full check, including a test invoice
+    python btcpay_health_check.py wait       # wait for the server with exponential backoff
+    python btcpay_health_check.py fake       # local fake BTCPay Server for testing
 """
 
-import requests
 import json
+import logging
+import random
+import threading
 import time
 import sys
-import os
-from typing import Dict, Any, Optional
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Any, Optional, Callable, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from circuit_breaker import dependencies, CircuitOpenError
 from config import Config
+from tracing import TracedHTTP
+
+logger = logging.getLogger(__name__)
+
+class ProbeResult:
+    """Outcome of one probe"""
+    __slots__ = ('name', 'ok', 'detail', 'elapsed_ms', 'skipped', 'data')
+    
+    def __init__(self, name: str, ok: bool, detail: str = '', elapsed_ms: float = 0.0,
+                 skipped: bool = False, data: Optional[Dict[str, Any]] = None):
+        self.name = name
+        self.ok = ok
+        self.detail = detail
+        self.elapsed_ms = elapsed_ms
+        self.skipped = skipped
+        self.data = data
+    
+    def to_dict(self) -> Dict[str, Any]:
+        status = 'skipped' if self.skipped else ('ok' if self.ok else 'failed')
+        return {'status': status, 'detail': self.detail, 'elapsed_ms': round(self.elapsed_ms, 1)}
+
+class HealthReport:
+    """Results of one health check run"""
+    
+    def __init__(self, results: Dict[str, ProbeResult], elapsed_ms: float):
+        self.results = results
+        self.elapsed_ms = elapsed_ms
+        self.checked_at = time.time()
+    
+    @property
+    def ok(self) -> bool:
+        return all(result.ok for result in self.results.values())
+    
+    def first_failure(self) -> Optional[ProbeResult]:
+        for result in self.results.values():
+            if not result.ok and not result.skipped:
+                return result
+        return None
+    
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'ready': self.ok,
+            'checked_at': time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(self.checked_at)),
+            'elapsed_ms': round(self.elapsed_ms, 1),
+            'checks': {name: result.to_dict() for name, result in self.results.items()},
+        }
 
 class BTCPayHealthCheck:
-    def __init__(self):
-        self.btcpay_url = Config.BTCPAY_URL or "http://localhost:23000"
-        self.api_key = Config.BTCPAY_API_KEY
-        self.store_id = Config.BTCPAY_STORE_ID
+    # name -> (method, dependency, writes); order is the reporting order
+    PROBES = (
+        ('server', 'check_btcpay_server', None, False),
+        ('server_info', 'get_server_info', 'server', False),
+        ('api_key', 'check_api_access', 'server', False),
+        ('store', 'check_store_access', 'api_key', False),
+        ('invoice', 'test_invoice_creation', 'store', True),
+    )
+    
+    def __init__(self, btcpay_url: str = None, api_key: str = None, store_id: str = None, timeout: float = None):
+        self.btcpay_url = (btcpay_url or Config.BTCPAY_URL or "http://localhost:23000").rstrip('/')
+        self.api_key = api_key if api_key is not None else Config.BTCPAY_API_KEY
+        self.store_id = store_id if store_id is not None else Config.BTCPAY_STORE_ID
+        self.timeout = timeout if timeout is not None else Config.BTCPAY_HEALTH_TIMEOUT
         
+        # One pooled session for all probes (and all runs)
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=len(self.PROBES))
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        self.http = TracedHTTP('btcpay', session=session)
+        self._executor = ThreadPoolExecutor(max_workers=len(self.PROBES), thread_name_prefix='btcpay-probe')
+    
+    def _headers(self) -> Dict[str, str]:
+        return {
+            "Authorization": f"token {self.api_key}",
+            "Content-Type": "application/json"
+        }
+    
     def check_btcpay_server(self) -> bool:
         """Check if BTCPay Server is accessible"""
         try:
-            response = requests.get(f"{self.btcpay_url}/health", timeout=10)
+            response = self.http.get(f"{self.btcpay_url}/health", timeout=self.timeout)
             return response.status_code == 200
-        except requests.RequestException:
+        except (requests.RequestException, CircuitOpenError):
             return False
     
     def check_api_access(self) -> bool:
         """Check if API key provides access"""
         if not self.api_key:
             return False
-            
+        
         try:
-            headers = {
-                "Authorization": f"token {self.api_key}",
-                "Content-Type": "application/json"
-            }
-            response = requests.get(f"{self.btcpay_url}/api/v1/api-keys/current", headers=headers, timeout=10)
+            response = self.http.get(f"{self.btcpay_url}/api/v1/api-keys/current", headers=self._headers(),
+                                     timeout=self.timeout)
             return response.status_code == 200
-        except requests.RequestException:
+        except (requests.RequestException, CircuitOpenError):
             return False
     
     def check_store_access(self) -> bool:
         """Check if store ID is accessible"""
-        if not self.api_key or not self.store_id:
-            return False
-            
-        try:
-            headers = {
-                "Authorization": f"token {self.api_key}",
-                "Content-Type": "application/json"
-            }
-            response = requests.get(f"{self.btcpay_url}/api/v1/stores/{self.store_id}", headers=headers, timeout=10)
-            return response.status_code == 200
-        except requests.RequestException:
-            return False
+        return self.get_store_info() is not None
     
     def get_server_info(self) -> Optional[Dict[str, Any]]:
         """Get BTCPay Server information"""
         try:
-            response = requests.get(f"{self.btcpay_url}/api/v1/server/info", timeout=10)
+            response = self.http.get(f"{self.btcpay_url}/api/v1/server/info", timeout=self.timeout)
             if response.status_code == 200:
                 return response.json()
-        except requests.RequestException:
+        except (requests.RequestException, ValueError, CircuitOpenError):
             pass
         return None
     
@@ -70,30 +144,22 @@ class BTCPayHealthCheck:
         """Get store information"""
         if not self.api_key or not self.store_id:
             return None
-            
+        
         try:
-            headers = {
-                "Authorization": f"token {self.api_key}",
-                "Content-Type": "application/json"
-            }
-            response = requests.get(f"{self.btcpay_url}/api/v1/stores/{self.store_id}", headers=headers, timeout=10)
+            response = self.http.get(f"{self.btcpay_url}/api/v1/stores/{self.store_id}", headers=self._headers(),
+                                     timeout=self.timeout)
             if response.status_code == 200:
                 return response.json()
-        except requests.RequestException:
+        except (requests.RequestException, ValueError, CircuitOpenError):
             pass
         return None
     
-    def test_invoice_creation(self) -> bool:
+    def test_invoice_creation(self) -> Optional[Dict[str, Any]]:
         """Test creating a simple invoice"""
         if not self.api_key or not self.store_id:
-            return False
-            
+            return None
+        
         try:
-            headers = {
-                "Authorization": f"token {self.api_key}",
-                "Content-Type": "application/json"
-            }
-            
             data = {
                 "amount": "0.00001",  # 1000 sats
                 "currency": "BTC",
@@ -103,35 +169,101 @@ class BTCPayHealthCheck:
                 }
             }
             
-            response = requests.post(
+            response = self.http.post(
                 f"{self.btcpay_url}/api/v1/stores/{self.store_id}/invoices",
-                headers=headers,
+                headers=self._headers(),
                 json=data,
-                timeout=10
+                timeout=self.timeout
             )
             
             if response.status_code == 200:
-                # Clean up - mark test invoice as invalid
-                invoice_data = response.json()
-                print(f"✅ Test invoice created: {invoice_data.get('id')}")
-                return True
-                
-        except requests.RequestException:
+                return response.json()
+        
+        except (requests.RequestException, ValueError, CircuitOpenError):
             pass
-        return False
+        return None
     
-    def wait_for_services(self, timeout: int = 300) -> bool:
-        """Wait for BTCPay Server and dependencies to be ready"""
+    def _run_probe(self, name: str, method: str) -> ProbeResult:
+        start = time.perf_counter()
+        try:
+            # Runs on a pool thread; probes must reach BTCPay even while its breaker is open
+            with dependencies.probing():
+                value = getattr(self, method)()
+        except Exception as e:
+            logger.error(f"BTCPay probe {name} raised: {e}")
+            value = None
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        data = value if isinstance(value, dict) else None
+        return ProbeResult(name, bool(value), elapsed_ms=elapsed_ms, data=data)
+    
+    def probe(self, include_invoice: bool = True) -> HealthReport:
+        """
+        Run all probes concurrently, honouring dependencies.
+        
+        Read-only probes start immediately; probes that write (the test invoice)
+        start only once their dependency passed. A probe whose dependency failed
+        is marked skipped.
+        
+        Args:
+            include_invoice: Also create a test invoice
+        
+        Returns:
+            HealthReport with one result per probe, in dependency order
+        """
+        start = time.perf_counter()
+        probes = [probe for probe in self.PROBES if include_invoice or probe[0] != 'invoice']
+        futures = {name: self._executor.submit(self._run_probe, name, method)
+                   for name, method, _, writes in probes if not writes}
+        
+        results: Dict[str, ProbeResult] = {}
+        for name, method, dependency, writes in probes:
+            parent = results.get(dependency) if dependency else None
+            if parent is not None and not parent.ok:
+                # Let a speculative read finish in the background; report the root cause instead
+                results[name] = ProbeResult(name, False, f"{dependency} failed", skipped=True)
+                continue
+            if writes:
+                results[name] = self._run_probe(name, method)
+            else:
+                results[name] = futures[name].result()
+        
+        for name, result in results.items():
+            if not result.ok and not result.skipped:
+                result.detail = self._failure_detail(name)
+        return HealthReport(results, (time.perf_counter() - start) * 1000)
+    
+    def _failure_detail(self, name: str) -> str:
+        if name == 'api_key' and not self.api_key:
+            return "No API key configured"
+        if name in ('store', 'invoice') and not self.store_id:
+            return "No store ID configured"
+        return {
+            'server': f"Not accessible at {self.btcpay_url}",
+            'server_info': "Server info unavailable",
+            'api_key': "API key is invalid or has insufficient permissions",
+            'store': "Store ID is invalid or inaccessible",
+            'invoice': "Failed to create test invoice",
+        }[name]
+    
+    def wait_for_services(self, timeout: int = 300, initial_delay: float = 0.5, max_delay: float = 10.0) -> bool:
+        """Wait for BTCPay Server and dependencies to be ready, retrying with exponential backoff and jitter"""
         print("⏳ Waiting for BTCPay Server to be ready...")
         
-        start_time = time.time()
-        while time.time() - start_time < timeout:
-            if self.check_btcpay_server():
+        deadline = time.monotonic() + timeout
+        delay = initial_delay
+        while True:
+            with dependencies.probing():
+                ready = self.check_btcpay_server() and self.get_server_info() is not None
+            if ready:
                 print("✅ BTCPay Server is accessible")
-                time.sleep(5)  # Give it a few more seconds
                 return True
-            print("⏳ Waiting for BTCPay Server... (will retry)")
-            time.sleep(10)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            sleep_for = min(delay * random.uniform(0.5, 1.0), remaining)
+            print(f"⏳ Waiting for BTCPay Server... (retry in {sleep_for:.1f}s)")
+            time.sleep(sleep_for)
+            delay = min(delay * 2, max_delay)
         
         print("❌ Timeout waiting for BTCPay Server")
         return False
@@ -141,55 +273,38 @@ class BTCPayHealthCheck:
         print("=" * 50)
         print("BTCPay Server Health Check")
         print("=" * 50)
-        
-        # Check server accessibility
         print(f"🔍 Checking BTCPay Server at {self.btcpay_url}")
-        if not self.check_btcpay_server():
-            print("❌ BTCPay Server is not accessible")
-            return False
-        print("✅ BTCPay Server is accessible")
-        
-        # Get server info
-        server_info = self.get_server_info()
-        if server_info:
-            print(f"📋 Server Version: {server_info.get('version', 'Unknown')}")
-        
-        # Check API access
-        print("🔑 Checking API key access")
-        if not self.check_api_access():
-            if not self.api_key:
-                print("⚠️  No API key configured")
-            else:
-                print("❌ API key is invalid or insufficient permissions")
-            print("💡 Please generate an API key in BTCPay Server with invoice permissions")
-            return False
-        print("✅ API key is valid")
         
-        # Check store access
-        print("🏪 Checking store access")
-        if not self.check_store_access():
-            if not self.store_id:
-                print("⚠️  No store ID configured")
-            else:
-                print("❌ Store ID is invalid or inaccessible")
-            print("💡 Please create a store in BTCPay Server and update BTCPAY_STORE_ID")
-            return False
-        print("✅ Store access confirmed")
+        report = self.probe(include_invoice=True)
+        results = report.results
         
-        # Get store info
-        store_info = self.get_store_info()
-        if store_info:
-            print(f"📋 Store Name: {store_info.get('name', 'Unknown')}")
-        
-        # Test invoice creation
-        print("🧾 Testing invoice creation")
-        if not self.test_invoice_creation():
-            print("❌ Failed to create test invoice")
-            return False
-        print("✅ Invoice creation test passed")
+        labels = {
+            'server': "BTCPay Server is accessible",
+            'api_key': "API key is valid",
+            'store': "Store access confirmed",
+            'invoice': "Invoice creation test passed",
+        }
+        for name, label in labels.items():
+            result = results[name]
+            if result.skipped:
+                continue
+            if not result.ok:
+                print(f"❌ {result.detail} ({result.elapsed_ms:.0f} ms)")
+                if name == 'api_key':
+                    print("💡 Please generate an API key in BTCPay Server with invoice permissions")
+                elif name == 'store':
+                    print("💡 Please create a store in BTCPay Server and update BTCPAY_STORE_ID")
+                return False
+            print(f"✅ {label} ({result.elapsed_ms:.0f} ms)")
+            if name == 'server' and results['server_info'].data:
+                print(f"📋 Server Version: {results['server_info'].data.get('version', 'Unknown')}")
+            elif name == 'store' and results['store'].data:
+                print(f"📋 Store Name: {results['store'].data.get('name', 'Unknown')}")
+            elif name == 'invoice' and results['invoice'].data:
+                print(f"✅ Test invoice created: {results['invoice'].data.get('id')}")
         
         print("=" * 50)
-        print("🎉 All health checks passed! BTCPay Server is ready.")
+        print(f"🎉 All health checks passed in {report.elapsed_ms:.0f} ms! BTCPay Server is ready.")
         print("=" * 50)
         return True
     
@@ -211,8 +326,161 @@ class BTCPayHealthCheck:
         print("6. Re-run this health check")
         print("=" * 50)
 
+class ReadinessCache:
+    """
+    Cached readiness for the /ready endpoint.
+    
+    Serves the last report for ttl seconds. After that, one caller refreshes
+    it in the background while the others keep getting the previous report,
+    so a load balancer polling /ready never waits on BTCPay or piles up probes.
+    Readiness runs the read-only probes only (no test invoice).
+    """
+    
+    def __init__(self, checker_factory: Callable[[], BTCPayHealthCheck] = BTCPayHealthCheck, ttl: float = None):
+        self.checker_factory = checker_factory
+        self.ttl = ttl if ttl is not None else Config.BTCPAY_READY_TTL_SECONDS
+        self._checker: Optional[BTCPayHealthCheck] = None
+        self._report: Optional[HealthReport] = None
+        self._refreshing = False
+        self._lock = threading.Lock()
+    
+    def _refresh(self):
+        try:
+            if self._checker is None:
+                self._checker = self.checker_factory()
+            report = self._checker.probe(include_invoice=False)
+            with self._lock:
+                self._report = report
+        except Exception as e:
+            logger.error(f"Readiness probe failed: {e}")
+        finally:
+            with self._lock:
+                self._refreshing = False
+    
+    def get(self) -> HealthReport:
+        """Latest report; only the very first call waits for a probe run"""
+        with self._lock:
+            report = self._report
+            stale = report is None or time.time() - report.checked_at >= self.ttl
+            start_refresh = stale and not self._refreshing
+            if start_refresh:
+                self._refreshing = True
+        if report is None:
+            if start_refresh:
+                self._refresh()
+            else:
+                # Another caller is running the first probe
+                while self._report is None and self._refreshing:
+                    time.sleep(0.05)
+            return self._report or HealthReport({}, 0.0)
+        if start_refresh:
+            threading.Thread(target=self._refresh, daemon=True, name='btcpay-ready').start()
+        return report
+    
+    def status(self) -> Tuple[Dict[str, Any], int]:
+        """(/ready body, HTTP status): 200 when ready, 503 otherwise"""
+        report = self.get()
+        body = report.to_dict()
+        body['ready'] = bool(report.results) and report.ok
+        return body, 200 if body['ready'] else 503
+
+# Global instance
+readiness = ReadinessCache()
+
+class FakeBTCPayServer:
+    """
+    Minimal local stand-in for the Greenfield API endpoints the probes use.
+    
+    Usage:
+        with FakeBTCPayServer(api_key='key', store_id='store', delay=0.2) as fake:
+            BTCPayHealthCheck(fake.url, 'key', 'store').probe()
+    """
+    
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, api_key: str = 'fake-api-key',
+                 store_id: str = 'fake-store', delay: float = 0.0, down: bool = False):
+        self.api_key = api_key
+        self.store_id = store_id
+        self.delay = delay
+        self.down = down
+        self.invoices = 0
+        fake = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+            
+            def _send(self, status: int, body: Dict[str, Any]):
+                payload = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+            
+            def _authorized(self) -> bool:
+                return self.headers.get('Authorization') == f"token {fake.api_key}"
+            
+            def _route(self, method: str):
+                time.sleep(fake.delay)
+                if fake.down:
+                    return self._send(503, {'error': 'starting'})
+                path = self.path.split('?', 1)[0]
+                if method == 'GET' and path == '/health':
+                    return self._send(200, {'status': 'healthy'})
+                if method == 'GET' and path == '/api/v1/server/info':
+                    return self._send(200, {'version': '1.13.0-fake', 'fullySynched': True})
+                if not self._authorized():
+                    return self._send(401, {'code': 'unauthenticated'})
+                if method == 'GET' and path == '/api/v1/api-keys/current':
+                    return self._send(200, {'apiKey': fake.api_key, 'permissions': ['btcpay.store.cancreateinvoice']})
+                store_path = f'/api/v1/stores/{fake.store_id}'
+                if method == 'GET' and path == store_path:
+                    return self._send(200, {'id': fake.store_id, 'name': 'Fake Store'})
+                if method == 'POST' and path == f'{store_path}/invoices':
+                    self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                    fake.invoices += 1
+                    return self._send(200, {'id': f'fake-invoice-{fake.invoices}', 'status': 'New'})
+                return self._send(404, {'code': 'not-found'})
+            
+            def do_GET(self):
+                self._route('GET')
+            
+            def do_POST(self):
+                self._route('POST')
+        
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://{host}:{self.server.server_address[1]}"
+        self._thread = None
+    
+    def start(self) -> 'FakeBTCPayServer':
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True, name='fake-btcpay')
+        self._thread.start()
+        return self
+    
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+    
+    def __enter__(self) -> 'FakeBTCPayServer':
+        return self.start()
+    
+    def __exit__(self, *exc):
+        self.stop()
+
 def main():
     """Main function"""
+    if len(sys.argv) > 1 and sys.argv[1] == "fake":
+        # Local fake server: BTCPAY_URL=http://127.0.0.1:23001 BTCPAY_API_KEY=fake-api-key BTCPAY_STORE_ID=fake-store
+        port = int(sys.argv[2]) if len(sys.argv) > 2 else 23001
+        fake = FakeBTCPayServer(port=port)
+        print(f"Fake BTCPay Server on {fake.url} (API key {fake.api_key}, store {fake.store_id})")
+        try:
+            fake.server.serve_forever()
+        except KeyboardInterrupt:
+            fake.stop()
+        sys.exit(0)
+    
     health_checker = BTCPayHealthCheck()
     
     if len(sys.argv) > 1 and sys.argv[1] == "wait":
@@ -232,4 +500,4 @@ def main():
     sys.exit(0)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,341 @@
+"""
+Dependency circuit breakers
+Per-dependency breakers (closed/open/half-open) with error-rate and slow-call thresholds, plus cached background health checks
+
+Outbound calls (TracedHTTP, the OpenAI client, database sessions) ask their
+dependency's breaker before calling and report the outcome after. When the
+share of failed or slow calls in the rolling window crosses a threshold, the
+breaker opens and calls fail immediately with CircuitOpenError instead of
+waiting for a timeout. After open_seconds a few trial calls are let through
+(half-open); if they succeed the breaker closes again.
+
+USSD flows check `dependencies.unavailable(...)` before starting work, so a
+user gets "unavailable, try later" in one hop while a dependency is down.
+
+Usage:
+    from circuit_breaker import dependencies, CircuitOpenError
+
+    breaker = dependencies.breaker('intersend')
+    breaker.acquire()                      # raises CircuitOpenError when open
+    ...call...
+    breaker.record(elapsed_seconds, failed)
+"""
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional
+
+from config import Config
+from metrics import CIRCUIT_OPEN, CIRCUIT_REJECTIONS, CIRCUIT_TRANSITIONS
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a dependency whose breaker is open"""
+
+    def __init__(self, dependency: str, retry_after: float):
+        super().__init__(f"{dependency} is unavailable (circuit open, retry in {retry_after:.0f}s)")
+        self.dependency = dependency
+        self.retry_after = retry_after
+
+_probing = threading.local()
+
+class CircuitBreaker:
+    """
+    Circuit breaker for one dependency.
+
+    Calls are sampled over a rolling window of window_seconds. The breaker
+    opens when at least min_calls were made and either error_rate of them
+    failed or slow_call_rate of them took longer than slow_call_ms.
+    """
+
+    def __init__(self, name: str, window_seconds: float = None, min_calls: int = None, error_rate: float = None,
+                 slow_call_ms: float = None, slow_call_rate: float = None, open_seconds: float = None,
+                 half_open_calls: int = None):
+        self.name = name
+        self.window_seconds = window_seconds if window_seconds is not None else Config.CIRCUIT_WINDOW_SECONDS
+        self.min_calls = min_calls if min_calls is not None else Config.CIRCUIT_MIN_CALLS
+        self.error_rate = error_rate if error_rate is not None else Config.CIRCUIT_ERROR_RATE
+        self.slow_call_ms = slow_call_ms if slow_call_ms is not None else Config.CIRCUIT_SLOW_CALL_MS
+        self.slow_call_rate = slow_call_rate if slow_call_rate is not None else Config.CIRCUIT_SLOW_CALL_RATE
+        self.open_seconds = open_seconds if open_seconds is not None else Config.CIRCUIT_OPEN_SECONDS
+        self.half_open_calls = half_open_calls if half_open_calls is not None else Config.CIRCUIT_HALF_OPEN_CALLS
+
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._reason = ''
+        self._calls = deque()  # (timestamp, failed, slow)
+        self._failed = 0
+        self._slow = 0
+        self._trials_in_flight = 0
+        self._trial_successes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            self._advance(time.monotonic())
+            return self._state
+
+    def _transition(self, state: str, reason: str = ''):
+        """Move to a new state (caller holds the lock)"""
+        if state == self._state:
+            return
+        previous, self._state = self._state, state
+        CIRCUIT_TRANSITIONS.inc(self.name, state)
+        if state == OPEN:
+            self._opened_at = time.monotonic()
+            self._reason = reason
+            CIRCUIT_OPEN.inc(self.name)
+            logger.warning(f"Circuit for {self.name} opened: {reason}")
+        elif previous == OPEN:
+            CIRCUIT_OPEN.dec(self.name)
+        if state == HALF_OPEN:
+            self._trials_in_flight = 0
+            self._trial_successes = 0
+            logger.info(f"Circuit for {self.name} half-open: allowing {self.half_open_calls} trial calls")
+        elif state == CLOSED:
+            self._calls.clear()
+            self._failed = self._slow = 0
+            logger.info(f"Circuit for {self.name} closed")
+
+    def _advance(self, now: float):
+        """Open -> half-open once open_seconds passed (caller holds the lock)"""
+        if self._state == OPEN and now - self._opened_at >= self.open_seconds:
+            self._transition(HALF_OPEN)
+
+    def retry_after(self) -> float:
+        with self._lock:
+            if self._state != OPEN:
+                return 0.0
+            return max(0.0, self.open_seconds - (time.monotonic() - self._opened_at))
+
+    def allows(self) -> bool:
+        """Would a call be let through right now (without reserving a trial slot)"""
+        with self._lock:
+            self._advance(time.monotonic())
+            if self._state == OPEN:
+                return False
+            if self._state == HALF_OPEN:
+                return self._trials_in_flight < self.half_open_calls
+            return True
+
+    def acquire(self):
+        """Reserve permission for one call; raises CircuitOpenError when the breaker rejects it"""
+        if getattr(_probing, 'active', False):
+            return
+        with self._lock:
+            self._advance(time.monotonic())
+            if self._state == CLOSED:
+                return
+            if self._state == HALF_OPEN and self._trials_in_flight < self.half_open_calls:
+                self._trials_in_flight += 1
+                return
+            retry_after = max(0.0, self.open_seconds - (time.monotonic() - self._opened_at))
+        CIRCUIT_REJECTIONS.inc(self.name)
+        raise CircuitOpenError(self.name, retry_after)
+
+    def record(self, elapsed: float, failed: bool):
+        """Report the outcome of a call let through by acquire()"""
+        slow = elapsed * 1000 >= self.slow_call_ms
+        now = time.monotonic()
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._trials_in_flight = max(0, self._trials_in_flight - 1)
+                if failed or slow:
+                    self._transition(OPEN, f"trial call {'failed' if failed else 'slow'}")
+                    return
+                self._trial_successes += 1
+                if self._trial_successes >= self.half_open_calls:
+                    self._transition(CLOSED)
+                return
+            if self._state == OPEN:
+                # A call that started before the breaker opened
+                return
+
+            self._calls.append((now, failed, slow))
+            self._failed += failed
+            self._slow += slow
+            cutoff = now - self.window_seconds
+            while self._calls and self._calls[0][0] < cutoff:
+                _, old_failed, old_slow = self._calls.popleft()
+                self._failed -= old_failed
+                self._slow -= old_slow
+
+            total = len(self._calls)
+            if total < self.min_calls:
+                return
+            if self._failed / total >= self.error_rate:
+                self._transition(OPEN, f"{self._failed}/{total} calls failed in {self.window_seconds:.0f}s")
+            elif self._slow / total >= self.slow_call_rate:
+                self._transition(OPEN, f"{self._slow}/{total} calls slower than {self.slow_call_ms:.0f}ms")
+
+    def trip(self, reason: str):
+        """Open the breaker now (e.g. a health check failed)"""
+        with self._lock:
+            self._transition(OPEN, reason)
+
+    def probe_succeeded(self):
+        """A health check passed: let trial traffic through without waiting out open_seconds"""
+        with self._lock:
+            if self._state == OPEN:
+                self._transition(HALF_OPEN)
+            elif self._state == HALF_OPEN:
+                # Passing checks count as trials, so an idle dependency still closes
+                self._trial_successes += 1
+                if self._trial_successes >= self.half_open_calls:
+                    self._transition(CLOSED)
+
+    @contextmanager
+    def guard(self):
+        """Time a block as one call; any exception counts as a failure"""
+        self.acquire()
+        start = time.perf_counter()
+        failed = True
+        try:
+            yield
+            failed = False
+        finally:
+            self.record(time.perf_counter() - start, failed)
+
+    def snapshot(self) -> Dict[str, object]:
+        with self._lock:
+            self._advance(time.monotonic())
+            total = len(self._calls)
+            return {
+                'state': self._state,
+                'reason': self._reason if self._state != CLOSED else '',
+                'calls': total,
+                'error_rate': round(self._failed / total, 3) if total else 0.0,
+                'slow_rate': round(self._slow / total, 3) if total else 0.0,
+            }
+
+class DependencyRegistry:
+    """
+    Breakers and cached health state for every outbound dependency.
+
+    Health checks run every health_interval seconds in a background thread
+    (started on first use, restarted after fork). A failing check trips the
+    dependency's breaker; a passing check moves an open breaker to half-open.
+    """
+
+    def __init__(self, health_interval: float = None):
+        self.health_interval = health_interval if health_interval is not None else Config.DEPENDENCY_HEALTH_INTERVAL
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._settings: Dict[str, Dict[str, float]] = {}
+        self._checks: Dict[str, Callable[[], Optional[bool]]] = {}
+        self._health: Dict[str, Dict[str, object]] = {}
+        self._lock = threading.Lock()
+        self._checker = None
+        self._checker_pid = None
+        self._stopped = threading.Event()
+
+    def register(self, name: str, health_check: Callable[[], Optional[bool]] = None, **settings):
+        """
+        Configure a dependency.
+
+        Args:
+            name: Dependency name (the TracedHTTP peer_service, 'openai' or 'database')
+            health_check: Returns True/False, or None when there is nothing to check yet
+            **settings: CircuitBreaker keyword overrides (e.g. slow_call_ms)
+        """
+        with self._lock:
+            self._settings[name] = settings
+            self._breakers.pop(name, None)
+            if health_check is not None:
+                self._checks[name] = health_check
+
+    def breaker(self, name: str) -> CircuitBreaker:
+        """The dependency's breaker, created on first use"""
+        breaker = self._breakers.get(name)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.get(name)
+                if breaker is None:
+                    breaker = self._breakers[name] = CircuitBreaker(name, **self._settings.get(name, {}))
+        return breaker
+
+    def unavailable(self, *names: str) -> List[str]:
+        """Those of names whose breaker would reject a call right now"""
+        self._ensure_checker()
+        return [name for name in names if not self.breaker(name).allows()]
+
+    @contextmanager
+    def probing(self):
+        """Calls made inside bypass open breakers (health checks must reach a down dependency)"""
+        previous = getattr(_probing, 'active', False)
+        _probing.active = True
+        try:
+            yield
+        finally:
+            _probing.active = previous
+
+    def run_check(self, name: str) -> Optional[bool]:
+        """Run one health check now and update the cached state and breaker"""
+        check = self._checks.get(name)
+        if check is None:
+            return None
+        start = time.perf_counter()
+        try:
+            with self.probing():
+                ok = check()
+            detail = ''
+        except Exception as e:
+            ok, detail = False, str(e)
+        if ok is None:
+            return None
+        self._health[name] = {
+            'ok': bool(ok),
+            'checked_at': time.time(),
+            'elapsed_ms': round((time.perf_counter() - start) * 1000, 1),
+            'detail': detail,
+        }
+        if ok:
+            self.breaker(name).probe_succeeded()
+        elif self.breaker(name).state != OPEN:
+            self.breaker(name).trip(f"health check failed{': ' + detail if detail else ''}")
+        return bool(ok)
+
+    def check(self, name: str, max_age: float = None) -> Optional[bool]:
+        """Cached health of a dependency, re-checked synchronously if older than max_age"""
+        self._ensure_checker()
+        max_age = max_age if max_age is not None else 2 * self.health_interval
+        health = self._health.get(name)
+        if health is not None and time.time() - health['checked_at'] <= max_age:
+            return health['ok']
+        return self.run_check(name)
+
+    def _ensure_checker(self):
+        if self._checker_pid == os.getpid() or not self._checks:
+            return
+        with self._lock:
+            if self._checker_pid == os.getpid():
+                return
+            # New process (first use or after a fork): the parent's thread did not come along
+            self._checker_pid = os.getpid()
+            self._checker = threading.Thread(target=self._run, name='dependency-health', daemon=True)
+            self._checker.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.health_interval):
+            for name in list(self._checks):
+                self.run_check(name)
+
+    def snapshot(self) -> Dict[str, Dict[str, object]]:
+        """Breaker and health state per dependency"""
+        self._ensure_checker()
+        names = sorted(set(self._breakers) | set(self._checks))
+        return {name: dict(self.breaker(name).snapshot(), health=self._health.get(name)) for name in names}
+
+    def close(self):
+        self._stopped.set()
+
+# Global instance
+dependencies = DependencyRegistry()
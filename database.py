@@ -1,37 +1,279 @@
 import os
-from sqlalchemy import create_engine
+import threading
+import time
+import contextvars
+import functools
+import inspect
+import itertools
+from collections import OrderedDict
+from typing import Optional
+from sqlalchemy import create_engine, event, select
+from sqlalchemy import inspect as inspect_schema
 from sqlalchemy.orm import sessionmaker, scoped_session
 from sqlalchemy.exc import SQLAlchemyError
-from contextlib import contextmanager
+from sqlalchemy.pool import StaticPool
+from contextlib import contextmanager, nullcontext
 import logging
-from models import Base
-from config import Config
+from models import Base, User, Transaction, Invoice, UssdSession
+from config import Config, validate_config
+from app_context import context
+from db_metrics import PoolInstrumentation
+import tracing
+from circuit_breaker import dependencies
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Engine profiles
+#
+# A profile turns a deployment shape into create_engine() options. Server
+# databases get a pool sized from the number of worker threads that share it,
+# so gunicorn workers with 4 threads don't each hold 50 idle MySQL connections.
+# The SQLite profile is for embedded/edge deployments and benchmarks: WAL mode
+# lets readers run alongside the writer, and writes are funnelled through one
+# writer lock so threads queue in-process instead of spinning on SQLITE_BUSY.
+ENGINE_PROFILES = {
+    'mysql': {
+        'pool_timeout': 30,
+        'pool_recycle': 3600,  # MySQL drops idle connections after wait_timeout
+        'pool_pre_ping': True,
+    },
+    'postgres': {
+        'pool_timeout': 30,
+        'pool_recycle': 1800,
+        'pool_pre_ping': True,
+    },
+    'sqlite': {
+        'pragmas': {
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',  # Safe with WAL, avoids an fsync per commit
+            'busy_timeout': 5000,
+            'foreign_keys': 'ON',
+            'cache_size': -64000,     # 64 MB page cache
+            'temp_store': 'MEMORY',
+            'mmap_size': 268435456,
+        },
+        'single_writer': True,
+    },
+}
+
+# Statements that never need the SQLite writer lock
+_SQLITE_READ_PREFIXES = ('SELECT', 'PRAGMA', 'WITH', 'EXPLAIN')
+
+
+def detect_profile(database_url: str) -> str:
+    """Pick an engine profile from the database URL scheme"""
+    scheme = database_url.split(':', 1)[0].lower()
+    if scheme.startswith('sqlite'):
+        return 'sqlite'
+    if scheme.startswith('postgres'):
+        return 'postgres'
+    return 'mysql'
+
+
+def build_engine_options(database_url: str, profile: str = None, workers: int = None) -> dict:
+    """
+    Build create_engine() keyword arguments for a profile.
+    
+    Args:
+        database_url: SQLAlchemy database URL
+        profile: Profile name from ENGINE_PROFILES (detected from the URL if omitted)
+        workers: Threads sharing this engine (defaults to Config.DB_POOL_WORKERS)
+        
+    Returns:
+        Dictionary of engine options
+    """
+    profile = profile or detect_profile(database_url)
+    if profile not in ENGINE_PROFILES:
+        raise ValueError(f"Unknown database profile: {profile}")
+    
+    workers = workers or Config.DB_POOL_WORKERS
+    options = {'echo': False}
+    
+    if profile == 'sqlite':
+        options['connect_args'] = {'check_same_thread': False}
+        if database_url in ('sqlite://', 'sqlite:///:memory:'):
+            # An in-memory database only exists inside its connection, so all
+            # threads share one connection
+            options['poolclass'] = StaticPool
+        else:
+            options['pool_size'] = workers
+            options['max_overflow'] = 0
+            options['pool_timeout'] = 30
+        return options
+    
+    options.update(ENGINE_PROFILES[profile])
+    # One connection per request thread plus headroom for background pollers
+    options['pool_size'] = workers
+    options['max_overflow'] = max(2, workers // 2)
+    return options
+
+
+def _install_sqlite_profile(engine, settings: dict):
+    """Apply SQLite pragmas and the single-writer lock to an engine"""
+    pragmas = settings.get('pragmas', {})
+    # Re-entrant so that a helper opening a nested session (a second pooled
+    # connection) on the same thread takes it again and gets SQLITE_BUSY after
+    # busy_timeout instead of deadlocking on itself
+    writer_lock = threading.RLock()
+    
+    @event.listens_for(engine, "connect")
+    def _set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+    
+    if not settings.get('single_writer'):
+        return
+    
+    # Per thread, the pooled connections (by their record's info dict) that hold
+    # one level of the lock. Not a flag in conn.info: under StaticPool every
+    # thread shares one connection record. Each connection releases only its
+    # own level, so a nested session's commit leaves the outer write holding it.
+    held = threading.local()
+    
+    def _held_connections() -> set:
+        connections = getattr(held, 'connections', None)
+        if connections is None:
+            connections = held.connections = set()
+        return connections
+    
+    @event.listens_for(engine, "before_cursor_execute")
+    def _acquire_writer(conn, cursor, statement, parameters, context, executemany):
+        connections = _held_connections()
+        if id(conn.info) in connections:
+            return
+        if statement.lstrip().upper().startswith(_SQLITE_READ_PREFIXES):
+            return
+        writer_lock.acquire()
+        connections.add(id(conn.info))
+    
+    def _release_writer(info: dict):
+        connections = _held_connections()
+        if id(info) in connections:
+            connections.discard(id(info))
+            writer_lock.release()
+    
+    # Pool reset rolls back without firing the engine rollback event
+    event.listen(engine, "checkin", lambda dbapi_connection, record: _release_writer(record.info))
+    event.listen(engine, "commit", lambda conn: _release_writer(conn.info))
+    event.listen(engine, "rollback", lambda conn: _release_writer(conn.info))
+
+
+# Read/write splitting
+#
+# Helpers annotated with @replica_read run their sessions against a read
+# replica. A replica may lag the primary, so phone numbers whose balance was
+# written within DB_REPLICA_MAX_STALENESS seconds keep reading from the
+# primary (read-your-writes); everyone else gets replica reads whose
+# staleness is bounded by replication lag. Writes to a user's invoices,
+# transactions and USSD sessions count as writes for that phone too.
+#
+# The write tracker is per process. Under gunicorn with several workers, a
+# read served by a different worker than the write can still hit a replica
+# within the window. Where a user must always see their own writes across
+# workers, run a single worker per host or leave DATABASE_REPLICA_URLS unset.
+_read_context = contextvars.ContextVar('db_read_context', default=None)
+
+
+class ReadContext:
+    """Routing annotation for the current read-only helper call"""
+    
+    __slots__ = ('phone_number',)
+    
+    def __init__(self, phone_number: Optional[str] = None):
+        self.phone_number = phone_number
+
+
+def replica_read(phone_param: str = 'phone_number'):
+    """
+    Annotate a read-only helper so its sessions may be served by a replica.
+    
+    Args:
+        phone_param: Name of the argument holding the phone number used for
+                     the read-your-writes check (absent or None means any replica)
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+        
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            phone_number = None
+            if phone_param in signature.parameters:
+                bound = signature.bind_partial(*args, **kwargs)
+                phone_number = bound.arguments.get(phone_param)
+            token = _read_context.set(ReadContext(phone_number))
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _read_context.reset(token)
+        
+        return wrapper
+    return decorator
+
+
+class WriteTracker:
+    """Remembers recent balance writes per phone number for read-your-writes routing"""
+    
+    def __init__(self, window_seconds: float, max_entries: int = 100000):
+        self.window_seconds = window_seconds
+        self.max_entries = max_entries
+        self._writes = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def record(self, phone_numbers):
+        """Record a committed write for each phone number"""
+        now = time.monotonic()
+        with self._lock:
+            for phone_number in phone_numbers:
+                self._writes.pop(phone_number, None)
+                self._writes[phone_number] = now
+            while len(self._writes) > self.max_entries:
+                self._writes.popitem(last=False)
+    
+    def token(self, phone_number: str) -> Optional[float]:
+        """Monotonic time of the last write for a phone number within the window"""
+        with self._lock:
+            written_at = self._writes.get(phone_number)
+            if written_at is None:
+                return None
+            if time.monotonic() - written_at > self.window_seconds:
+                del self._writes[phone_number]
+                return None
+            return written_at
+    
+    def replica_safe(self, phone_number: Optional[str]) -> bool:
+        """Whether a replica read for this phone number satisfies read-your-writes"""
+        return phone_number is None or self.token(phone_number) is None
+
+
+# Tables whose writes start a user's read-your-writes window
+_PHONE_TRACKED_TABLES = {model.__table__: model for model in (User, Transaction, Invoice, UssdSession)}
+
+
 class DatabaseManager:
     """
-    Database manager for handling MySQL connections and sessions.
-    Supports connection pooling and automatic session management.
+    Database manager for handling database connections and sessions.
+    Supports connection pooling, engine profiles, read replicas and
+    automatic session management.
     """
     
-    def __init__(self, database_url=None):
+    def __init__(self, database_url=None, profile=None, workers=None, replica_urls=None,
+                 **engine_overrides):
         # Use configuration manager for database URL
         if database_url is None:
             database_url = Config.DATABASE_URL
+        if replica_urls is None:
+            replica_urls = Config.DATABASE_REPLICA_URLS
         
-        # Engine configuration for production use
-        self.engine = create_engine(
-            database_url,
-            pool_size=20,          # Number of connections to keep in pool
-            max_overflow=30,       # Additional connections when pool is full
-            pool_timeout=30,       # Seconds to wait for connection
-            pool_recycle=3600,     # Recycle connections after 1 hour
-            pool_pre_ping=True,    # Verify connections before use
-            echo=False             # Set to True for SQL debugging
-        )
+        self.profile = profile or Config.DATABASE_PROFILE or detect_profile(database_url)
+        
+        # Primary engine configuration derived from the profile
+        self.engine, self.metrics = self._create_engine(database_url, workers, engine_overrides)
+        # StaticPool shares one connection between threads, so whole sessions take turns on it
+        self._session_lock = threading.RLock() if isinstance(self.engine.pool, StaticPool) else None
         
         # Session factory
         self.SessionLocal = sessionmaker(
@@ -42,6 +284,123 @@ class DatabaseManager:
         
         # Scoped session for thread safety
         self.ScopedSession = scoped_session(self.SessionLocal)
+        
+        # Read replicas, used only by helpers annotated with @replica_read
+        self.replicas = []
+        for index, replica_url in enumerate(replica_urls):
+            engine, metrics = self._create_engine(replica_url, workers, engine_overrides)
+            self.replicas.append({
+                'name': f"replica{index}",
+                'engine': engine,
+                'metrics': metrics,
+                'SessionLocal': sessionmaker(autocommit=False, autoflush=False, bind=engine)
+            })
+        self._replica_counter = itertools.count()
+        
+        self.write_tracker = WriteTracker(Config.DB_REPLICA_MAX_STALENESS)
+        if self.replicas:
+            event.listen(self.SessionLocal, 'before_flush', self._collect_written_phones)
+            event.listen(self.SessionLocal, 'do_orm_execute', self._collect_bulk_written_phones)
+            event.listen(self.SessionLocal, 'after_commit', self._record_writes)
+        
+        self._check_indexes()
+    
+    def _create_engine(self, database_url, workers, engine_overrides):
+        """Create an engine for this manager's profile with optional instrumentation"""
+        options = build_engine_options(database_url, self.profile, workers)
+        options.update(engine_overrides)
+        engine = create_engine(database_url, **options)
+        
+        if self.profile == 'sqlite':
+            _install_sqlite_profile(engine, ENGINE_PROFILES['sqlite'])
+        
+        # Pool and statement instrumentation
+        metrics = None
+        if Config.DB_METRICS_ENABLED:
+            metrics = PoolInstrumentation(engine, slow_query_ms=Config.DB_SLOW_QUERY_MS)
+        
+        return engine, metrics
+    
+    def _collect_written_phones(self, session, flush_context, instances):
+        """Remember which users' rows (balances, invoices, transactions, sessions) this session is about to write"""
+        phones = set()
+        for obj in list(session.new) + list(session.dirty):
+            if isinstance(obj, (User, UssdSession)):
+                phones.add(obj.phone_number)
+            elif isinstance(obj, (Invoice, Transaction)):
+                phones.add(self._owner_phone(session, obj))
+                if isinstance(obj, Transaction):
+                    phones.add(obj.recipient_phone)
+        phones.discard(None)
+        if phones:
+            session.info.setdefault('written_phones', set()).update(phones)
+    
+    def _collect_bulk_written_phones(self, orm_execute_state):
+        """
+        Same as _collect_written_phones for bulk statements, which never reach before_flush:
+        query(...).update(...) and session.execute(insert(Model), rows). Updates are
+        resolved to phones with a SELECT on their WHERE clause before they run.
+        """
+        if not (orm_execute_state.is_update or orm_execute_state.is_insert):
+            return
+        statement = orm_execute_state.statement
+        model = _PHONE_TRACKED_TABLES.get(statement.table)
+        if model is None:
+            return
+        session = orm_execute_state.session
+        phones = set()
+        if orm_execute_state.is_insert:
+            rows = orm_execute_state.parameters or []
+            rows = [rows] if isinstance(rows, dict) else rows
+            if model in (User, UssdSession):
+                phones.update(row.get('phone_number') for row in rows)
+            else:
+                user_ids = {row.get('user_id') for row in rows} - {None}
+                if user_ids:
+                    phones.update(session.execute(select(User.phone_number).where(User.id.in_(user_ids))).scalars())
+                phones.update(row.get('recipient_phone') for row in rows)
+        else:
+            where = statement.whereclause
+            if model in (User, UssdSession):
+                query = select(model.phone_number)
+            else:
+                query = select(User.phone_number).join(model, model.user_id == User.id)
+            phones.update(session.execute(query.where(where) if where is not None else query).scalars())
+            if model is Transaction:
+                query = select(Transaction.recipient_phone)
+                phones.update(session.execute(query.where(where) if where is not None else query).scalars())
+        phones.discard(None)
+        if phones:
+            session.info.setdefault('written_phones', set()).update(phones)
+    
+    @staticmethod
+    def _owner_phone(session, obj) -> Optional[str]:
+        """Phone number of the user an Invoice or Transaction row belongs to"""
+        user = obj.__dict__.get('user')
+        if user is not None:
+            return user.phone_number
+        if obj.user_id is None:
+            return None
+        owners = session.info.setdefault('owner_phones', {})
+        if obj.user_id not in owners:
+            with session.no_autoflush:
+                owners[obj.user_id] = session.query(User.phone_number).filter(User.id == obj.user_id).scalar()
+        return owners[obj.user_id]
+    
+    def _record_writes(self, session):
+        """Start the read-your-writes window for users written by a committed session"""
+        phones = session.info.pop('written_phones', None)
+        if phones:
+            self.write_tracker.record(phones)
+    
+    def _choose_replica(self):
+        """Pick a replica for the current read context, or None for the primary"""
+        read_context = _read_context.get()
+        if read_context is None or not self.replicas:
+            return None
+        if not self.write_tracker.replica_safe(read_context.phone_number):
+            return None
+        return self.replicas[next(self._replica_counter) % len(self.replicas)]
     
     def create_tables(self):
         """Create all database tables"""
@@ -51,6 +410,35 @@ class DatabaseManager:
         except SQLAlchemyError as e:
             logger.error(f"Error creating tables: {e}")
             raise
+        # create_all skips tables that already exist, including indexes added to them later
+        for index in self._missing_indexes():
+            try:
+                index.create(bind=self.engine, checkfirst=True)
+                logger.info(f"Created index {index.name} on {index.table.name}")
+            except SQLAlchemyError as e:
+                logger.error(f"Error creating index {index.name} on {index.table.name} "
+                             f"(duplicate rows block unique indexes): {e}")
+    
+    def _missing_indexes(self):
+        """Indexes declared on the models but absent from tables that already exist"""
+        inspector = inspect_schema(self.engine)
+        missing = []
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {index['name'] for index in inspector.get_indexes(table.name)}
+            missing.extend(index for index in table.indexes if index.name not in existing)
+        return missing
+    
+    def _check_indexes(self):
+        """Log an error for each missing index; idx_transactions_mpesa_id is what keeps top-up credits idempotent"""
+        try:
+            missing = self._missing_indexes()
+        except SQLAlchemyError as e:
+            logger.warning(f"Could not inspect database indexes: {e}")
+            return
+        for index in missing:
+            logger.error(f"Index {index.name} is missing on {index.table.name}; run init_database() to create it")
     
     def drop_tables(self):
         """Drop all database tables - USE WITH CAUTION"""
@@ -71,16 +459,51 @@ class DatabaseManager:
             with db_manager.get_session() as session:
                 user = session.query(User).filter_by(phone_number=phone).first()
         """
-        session = self.SessionLocal()
-        try:
+        with self._session_lock or nullcontext(), self._open_session() as session:
             yield session
-            session.commit()
-        except Exception as e:
-            session.rollback()
-            logger.error(f"Database session error: {e}")
-            raise
-        finally:
-            session.close()
+    
+    @contextmanager
+    def _open_session(self):
+        breaker = dependencies.breaker('database')
+        breaker.acquire()
+        start = time.perf_counter()
+        failed = False
+        with tracing.span('db.session') as active:
+            replica = self._choose_replica()
+            if replica is not None:
+                session = replica['SessionLocal']()
+                try:
+                    self._checkout(session, replica['metrics'])
+                except SQLAlchemyError as e:
+                    # A replica being down should cost latency, not availability
+                    logger.warning(f"{replica['name']} unavailable, reading from primary: {e}")
+                    session.close()
+                    replica = None
+            
+            if replica is None:
+                session = self.SessionLocal()
+            active.set_attribute('db.target', replica['name'] if replica else 'primary')
+            
+            try:
+                if replica is None:
+                    self._checkout(session, self.metrics)
+                yield session
+                session.commit()
+            except Exception as e:
+                # Only database errors count against the circuit, not the caller's own exceptions
+                failed = isinstance(e, SQLAlchemyError)
+                session.rollback()
+                logger.error(f"Database session error: {e}")
+                raise
+            finally:
+                session.close()
+                breaker.record(time.perf_counter() - start, failed)
+    
+    def _checkout(self, session, metrics):
+        """Check out the session's connection up front so pool waits are measured"""
+        if metrics:
+            with metrics.time_checkout():
+                session.connection()
     
     def get_scoped_session(self):
         """Get thread-safe scoped session"""
@@ -90,6 +513,18 @@ class DatabaseManager:
         """Remove scoped session"""
         self.ScopedSession.remove()
     
+    def get_pool_metrics(self, top: int = 20):
+        """Snapshot of pool usage, checkout waits and statement latencies"""
+        if not self.metrics:
+            return {'enabled': False}
+        snapshot = {'enabled': True, **self.metrics.snapshot(top)}
+        if self.replicas:
+            snapshot['replicas'] = {
+                replica['name']: replica['metrics'].snapshot(top)
+                for replica in self.replicas if replica['metrics']
+            }
+        return snapshot
+    
     def health_check(self):
         """Check database connectivity"""
         try:
@@ -101,9 +536,34 @@ class DatabaseManager:
             logger.error(f"Database health check failed: {e}")
             return False
 
+def _build_default_manager() -> 'DatabaseManager':
+    """Build the global database manager from configuration"""
+    validate_config()
+    return DatabaseManager()
+
+context.register('db_manager', _build_default_manager)
+
+def get_db_manager() -> DatabaseManager:
+    """Get the global database manager, creating the engine on first use"""
+    return context.get('db_manager')
+
+def set_db_manager(manager: DatabaseManager):
+    """Replace the global database manager (e.g. with a SQLite profile)"""
+    context.override('db_manager', manager)
+
+class _LazyDatabaseManager:
+    """Proxy that defers building the global DatabaseManager until it is used"""
+    
+    def __getattr__(self, name):
+        return getattr(get_db_manager(), name)
+    
+    def __repr__(self):
+        state = "initialized" if context.is_initialized('db_manager') else "not initialized"
+        return f"<LazyDatabaseManager ({state})>"
+
 # Global database manager instance
-# Initialize with your actual database URL
-db_manager = DatabaseManager()
+# The engine and pool are only created when a session is first requested
+db_manager = _LazyDatabaseManager()
 
 # Convenience functions for backward compatibility
 def get_session():
@@ -114,10 +574,26 @@ def init_database():
     """Initialize database tables"""
     db_manager.create_tables()
 
-def check_database_health():
-    """Check if database is accessible"""
+def _database_health() -> Optional[bool]:
+    """Background health probe; skipped until the engine exists so it is not built just to be checked"""
+    if not context.is_initialized('db_manager'):
+        return None
     return db_manager.health_check()
 
+# Session time includes the caller's work, so only errors and health checks open this circuit
+dependencies.register('database', health_check=_database_health, slow_call_ms=float('inf'))
+
+def check_database_health():
+    """Check if database is accessible (the background health result while it is fresh)"""
+    healthy = dependencies.check('database')
+    return db_manager.health_check() if healthy is None else healthy
+
+def get_pool_metrics(top: int = 20):
+    """Get pool and slow-query metrics without forcing the engine to be built"""
+    if not context.is_initialized('db_manager'):
+        return {'enabled': Config.DB_METRICS_ENABLED, 'initialized': False}
+    return db_manager.get_pool_metrics(top)
+
 # Database configuration examples for different environments
 DATABASE_CONFIGS = {
     'development': {
@@ -136,22 +612,25 @@ DATABASE_CONFIGS = {
         'max_overflow': 30,
         'pool_timeout': 30,
         'pool_recycle': 3600
+    },
+    'embedded': {
+        'url': 'sqlite:///ussd_lightning.db',
+        'profile': 'sqlite'
+    },
+    'benchmark': {
+        'url': 'sqlite://',
+        'profile': 'sqlite'
     }
 }
 
-def create_database_manager(environment='development'):
+def create_database_manager(environment='development', workers=None):
     """Create database manager for specific environment"""
-    config = DATABASE_CONFIGS.get(environment, DATABASE_CONFIGS['development'])
+    # Copy so the shared config dict is never mutated between calls
+    config = dict(DATABASE_CONFIGS.get(environment, DATABASE_CONFIGS['development']))
     url = config.pop('url')
+    profile = config.pop('profile', None)
     
-    engine = create_engine(url, **config, pool_pre_ping=True, echo=False)
-    
-    manager = DatabaseManager.__new__(DatabaseManager)
-    manager.engine = engine
-    manager.SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-    manager.ScopedSession = scoped_session(manager.SessionLocal)
-    
-    return manager
+    return DatabaseManager(url, profile=profile, workers=workers, **config)
 
 if __name__ == "__main__":
     # Example usage and testing
@@ -0,0 +1,254 @@
+"""
+Connection pool instrumentation and slow-query tracing for DatabaseManager
+Records checkout waits, pool usage and per-statement latency via SQLAlchemy events
+"""
+import logging
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Dict, Any, List
+
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+
+logger = logging.getLogger(__name__)
+slow_query_logger = logging.getLogger('db.slow_query')
+
+# Histogram bucket upper bounds in milliseconds
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, float('inf'))
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+_IN_LIST = re.compile(r"\bIN\s*\((?:\s*(?:\?|%\(\w+\)s|%s|:\w+)\s*,?)+\)", re.IGNORECASE)
+_WHITESPACE = re.compile(r"\s+")
+
+@lru_cache(maxsize=2048)
+def normalize_sql(statement: str) -> str:
+    """
+    Normalize a SQL statement into a metrics key.
+
+    Literals become '?' and IN-lists collapse to 'IN (...)' so that batch
+    queries with different list lengths share one histogram.
+    """
+    normalized = _STRING_LITERAL.sub('?', statement)
+    normalized = _NUMBER_LITERAL.sub('?', normalized)
+    normalized = _IN_LIST.sub('IN (...)', normalized)
+    return _WHITESPACE.sub(' ', normalized).strip()
+
+class LatencyHistogram:
+    """Fixed-bucket latency histogram (not thread-safe; callers hold a lock)"""
+
+    __slots__ = ('buckets', 'count', 'total_ms', 'max_ms')
+
+    def __init__(self):
+        self.buckets = [0] * len(LATENCY_BUCKETS_MS)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, elapsed_ms: float):
+        """Record one observation"""
+        for index, bound in enumerate(LATENCY_BUCKETS_MS):
+            if elapsed_ms <= bound:
+                self.buckets[index] += 1
+                break
+        self.count += 1
+        self.total_ms += elapsed_ms
+        if elapsed_ms > self.max_ms:
+            self.max_ms = elapsed_ms
+
+    def percentile(self, fraction: float) -> float:
+        """Approximate a percentile as the upper bound of its bucket"""
+        if not self.count:
+            return 0.0
+        target = fraction * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.buckets):
+            seen += bucket_count
+            if seen >= target:
+                bound = LATENCY_BUCKETS_MS[index]
+                return self.max_ms if bound == float('inf') else min(bound, self.max_ms)
+        return self.max_ms
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Serialize histogram for the snapshot API"""
+        return {
+            'count': self.count,
+            'avg_ms': round(self.total_ms / self.count, 3) if self.count else 0.0,
+            'max_ms': round(self.max_ms, 3),
+            'p50_ms': self.percentile(0.50),
+            'p95_ms': self.percentile(0.95),
+            'p99_ms': self.percentile(0.99),
+            'buckets': {
+                ('+Inf' if bound == float('inf') else str(bound)): count
+                for bound, count in zip(LATENCY_BUCKETS_MS, self.buckets)
+            }
+        }
+
+class PoolInstrumentation:
+    """
+    SQLAlchemy event hooks that record pool and statement metrics for an engine.
+
+    Usage:
+        metrics = PoolInstrumentation(engine, slow_query_ms=200)
+        snapshot = metrics.snapshot()
+    """
+
+    OTHER_STATEMENTS = '<other>'
+
+    def __init__(self, engine, slow_query_ms: float = 200, max_statements: int = 500,
+                 slow_query_log_size: int = 100):
+        self.engine = engine
+        self.slow_query_ms = slow_query_ms
+        self.max_statements = max_statements
+
+        self._lock = threading.Lock()
+        self._checkout_wait = LatencyHistogram()
+        self._statements: Dict[str, LatencyHistogram] = {}
+        self._slow_queries = deque(maxlen=slow_query_log_size)
+        self._checkouts = 0
+        self._pool_timeouts = 0
+        self._connections_opened = 0
+        self._in_use = 0
+        self._peak_in_use = 0
+
+        self._attach()
+
+    def _attach(self):
+        """Register engine and pool event listeners"""
+        event.listen(self.engine, 'connect', self._on_connect)
+        event.listen(self.engine, 'checkout', self._on_checkout)
+        event.listen(self.engine, 'checkin', self._on_checkin)
+        event.listen(self.engine, 'before_cursor_execute', self._before_execute)
+        event.listen(self.engine, 'after_cursor_execute', self._after_execute)
+        event.listen(self.engine, 'handle_error', self._on_error)
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        with self._lock:
+            self._connections_opened += 1
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        with self._lock:
+            self._checkouts += 1
+            self._in_use += 1
+            if self._in_use > self._peak_in_use:
+                self._peak_in_use = self._in_use
+
+    def _on_checkin(self, dbapi_connection, connection_record):
+        with self._lock:
+            self._in_use = max(0, self._in_use - 1)
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start_times', []).append(time.perf_counter())
+        if context is not None:
+            context._query_timed = True
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        start_times = conn.info.get('query_start_times')
+        if not start_times:
+            return
+        elapsed_ms = (time.perf_counter() - start_times.pop()) * 1000
+        key = normalize_sql(statement)
+
+        with self._lock:
+            histogram = self._statements.get(key)
+            if histogram is None:
+                if len(self._statements) >= self.max_statements:
+                    key = self.OTHER_STATEMENTS
+                histogram = self._statements.setdefault(key, LatencyHistogram())
+            histogram.observe(elapsed_ms)
+
+            if elapsed_ms >= self.slow_query_ms:
+                self._slow_queries.append({
+                    'statement': key,
+                    'elapsed_ms': round(elapsed_ms, 3),
+                    'executemany': executemany,
+                    'timestamp': time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+                })
+
+        if elapsed_ms >= self.slow_query_ms:
+            slow_query_logger.warning(f"Slow query ({elapsed_ms:.1f} ms): {key}")
+
+    def _on_error(self, exception_context):
+        """A failed statement never reaches after_cursor_execute: drop its start time"""
+        conn, context = exception_context.connection, exception_context.execution_context
+        if conn is None or not getattr(context, '_query_timed', False):
+            return
+        start_times = conn.info.get('query_start_times')
+        if start_times:
+            start_times.pop()
+
+    @contextmanager
+    def time_checkout(self):
+        """Time a connection checkout, counting pool exhaustion timeouts"""
+        start = time.perf_counter()
+        try:
+            yield
+        except PoolTimeoutError:
+            with self._lock:
+                self._pool_timeouts += 1
+            logger.error("Database pool exhausted: timed out waiting for a connection")
+            raise
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        with self._lock:
+            self._checkout_wait.observe(elapsed_ms)
+
+    def _pool_state(self) -> Dict[str, Any]:
+        """Read live pool counters where the pool class supports them"""
+        pool = self.engine.pool
+        state = {'pool_class': type(pool).__name__}
+        for name in ('size', 'checkedin', 'checkedout', 'overflow'):
+            reader = getattr(pool, name, None)
+            if callable(reader):
+                try:
+                    state[name] = reader()
+                except Exception:
+                    pass
+        return state
+
+    def slow_queries(self) -> List[Dict[str, Any]]:
+        """Recent statements slower than the threshold, newest last"""
+        with self._lock:
+            return list(self._slow_queries)
+
+    def snapshot(self, top: int = 20) -> Dict[str, Any]:
+        """
+        Programmatic snapshot of pool and statement metrics.
+
+        Args:
+            top: Number of statements to include, ordered by total time
+
+        Returns:
+            Dictionary of pool, checkout and statement metrics
+        """
+        with self._lock:
+            statements = sorted(
+                self._statements.items(), key=lambda item: item[1].total_ms, reverse=True
+            )[:top]
+            return {
+                'pool': {
+                    **self._pool_state(),
+                    'in_use': self._in_use,
+                    'peak_in_use': self._peak_in_use,
+                    'checkouts': self._checkouts,
+                    'connections_opened': self._connections_opened,
+                    'timeouts': self._pool_timeouts,
+                },
+                'checkout_wait': self._checkout_wait.to_dict(),
+                'slow_query_threshold_ms': self.slow_query_ms,
+                'slow_queries': list(self._slow_queries),
+                'statements': {key: histogram.to_dict() for key, histogram in statements}
+            }
+
+    def reset(self):
+        """Clear accumulated statement and checkout metrics"""
+        with self._lock:
+            self._checkout_wait = LatencyHistogram()
+            self._statements.clear()
+            self._slow_queries.clear()
+            self._checkouts = 0
+            self._pool_timeouts = 0
+            self._peak_in_use = self._in_use
@@ -0,0 +1,512 @@
+"""
+Append-only event journal
+Durable, CRC-framed segment files that every ledger state change is written to before it is applied
+
+Events are framed as [length:u32][crc32:u32][json payload] and appended to
+segment files named after their first sequence number. Appends from all
+worker processes are serialized with an flock on the journal directory, and
+each append first reads any events other workers wrote, so every process
+applies the same events in the same order. fsync is batched: a background
+thread syncs every fsync_interval and durable appends wait for it (group
+commit).
+
+Projections (MeTTa facts, in-memory indexes) are rebuilt from the journal:
+each restores its latest snapshot and replays the events after it.
+
+Usage:
+    from event_journal import journal, TRANSACTION_RECORDED
+
+    journal.attach(projection)                       # restore + replay
+    journal.append(TRANSACTION_RECORDED, {...})      # write, fsync, apply
+    journal.catch_up()                               # apply other workers' events
+"""
+import fcntl
+import json
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# Event types
+TRANSACTION_RECORDED = 'transaction_recorded'
+INVOICE_CREATED = 'invoice_created'
+MPESA_PENDING = 'mpesa_pending'
+MPESA_SETTLED = 'mpesa_settled'
+MPESA_FAILED = 'mpesa_failed'
+BALANCE_SET = 'balance_set'
+
+FRAME_HEADER = struct.Struct('>II')  # payload length, CRC32 of payload
+SEGMENT_PREFIX = 'segment-'
+SEGMENT_SUFFIX = '.log'
+
+class JournalCorruptError(Exception):
+    """Raised when a complete frame fails its CRC check"""
+
+class Event:
+    __slots__ = ('seq', 'ts', 'type', 'data')
+
+    def __init__(self, seq: int, ts: float, type: str, data: Dict[str, Any]):
+        self.seq = seq
+        self.ts = ts
+        self.type = type
+        self.data = data
+
+    def __repr__(self) -> str:
+        return f"Event({self.seq}, {self.type}, {self.data})"
+
+    def encode(self) -> bytes:
+        payload = json.dumps({'seq': self.seq, 'ts': self.ts, 'type': self.type, 'data': self.data},
+                             separators=(',', ':')).encode()
+        return FRAME_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+    @classmethod
+    def decode(cls, payload: bytes) -> 'Event':
+        record = json.loads(payload)
+        return cls(record['seq'], record['ts'], record['type'], record['data'])
+
+def read_frames(data: bytes, offset: int = 0) -> Iterator[Tuple[Event, int]]:
+    """
+    Yield (event, end offset) for each complete frame in data.
+
+    Stops quietly at an incomplete frame (a write in progress or a torn tail).
+
+    Raises:
+        JournalCorruptError: If a complete frame fails its CRC check
+    """
+    while offset + FRAME_HEADER.size <= len(data):
+        length, crc = FRAME_HEADER.unpack_from(data, offset)
+        start = offset + FRAME_HEADER.size
+        end = start + length
+        if end > len(data):
+            return
+        payload = data[start:end]
+        if zlib.crc32(payload) != crc:
+            raise JournalCorruptError(f"CRC mismatch at offset {offset}")
+        yield Event.decode(payload), end
+        offset = end
+
+class Projection:
+    """
+    A view rebuilt from the journal.
+
+    Subclasses implement apply(); snapshot() returns JSON-serializable state
+    (or None if the projection is cheap enough to always replay) and
+    restore() loads it back.
+    """
+    name = 'projection'
+
+    def apply(self, event: Event):
+        raise NotImplementedError
+
+    def snapshot(self) -> Optional[Dict[str, Any]]:
+        return None
+
+    def restore(self, state: Dict[str, Any]):
+        pass
+
+class EventJournal:
+    """
+    Segmented append-only log with group-commit fsync, cross-process
+    ordering, replay and per-projection snapshots.
+    """
+
+    def __init__(self, directory: str = None, segment_bytes: int = None, fsync_interval: float = None,
+                 snapshot_every: int = None, keep_snapshots: int = 2):
+        self.directory = directory or Config.JOURNAL_DIR
+        self.segment_bytes = segment_bytes or Config.JOURNAL_SEGMENT_BYTES
+        self.fsync_interval = fsync_interval if fsync_interval is not None else Config.JOURNAL_FSYNC_INTERVAL_MS / 1000
+        self.snapshot_every = snapshot_every if snapshot_every is not None else Config.JOURNAL_SNAPSHOT_EVERY
+        self.keep_snapshots = keep_snapshots
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        """Fresh per-process state (also run in forked workers, which must not share fds or threads)"""
+        self._lock = threading.RLock()
+        self._opened = False
+        self._lock_fd = None
+        self._write_fds: Dict[int, int] = {}  # segment first seq -> fd
+        self._dirty: set = set()
+        self._segment = None  # first seq of the segment the cursor is in
+        self._offset = 0
+        self.last_seq = 0
+        self._projections: List[Projection] = []
+        self._since_snapshot = 0
+        self._written_seq = 0
+        self._synced_seq = 0
+        self._sync_cond = threading.Condition()
+        self._syncer = None
+        self.stats = {'appends': 0, 'fsyncs': 0, 'applied_remote': 0, 'snapshots': 0}
+
+    # --- files ---------------------------------------------------------
+
+    @property
+    def snapshot_dir(self) -> str:
+        return os.path.join(self.directory, 'snapshots')
+
+    def _segment_path(self, first_seq: int) -> str:
+        return os.path.join(self.directory, f"{SEGMENT_PREFIX}{first_seq:016d}{SEGMENT_SUFFIX}")
+
+    def segments(self) -> List[int]:
+        """First sequence numbers of all segments, oldest first"""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted(int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]) for name in names
+                      if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX))
+
+    def _read_segment(self, first_seq: int, offset: int = 0) -> bytes:
+        with open(self._segment_path(first_seq), 'rb') as f:
+            f.seek(offset)
+            return f.read()
+
+    @contextmanager
+    def _file_lock(self):
+        """Exclusive lock shared by every process appending to this directory"""
+        fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def _ensure_open(self):
+        if self._opened:
+            return
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        self._lock_fd = os.open(os.path.join(self.directory, 'journal.lock'), os.O_RDWR | os.O_CREAT, 0o644)
+        with self._file_lock():
+            self._recover_tail()
+        self._opened = True
+
+    def _recover_tail(self):
+        """Position the cursor at the end of the log, truncating a torn final frame"""
+        segments = self.segments()
+        if not segments:
+            self._segment, self._offset, self.last_seq = None, 0, 0
+            return
+
+        last = segments[-1]
+        data = self._read_segment(last)
+        offset, last_seq = 0, last - 1
+        try:
+            for event, end in read_frames(data):
+                offset, last_seq = end, event.seq
+        except JournalCorruptError as e:
+            logger.error(f"Journal segment {last}: {e}; truncating the damaged tail")
+
+        if offset < len(data):
+            logger.warning(f"Journal segment {last}: dropping {len(data) - offset} bytes of incomplete tail")
+            with open(self._segment_path(last), 'r+b') as f:
+                f.truncate(offset)
+                os.fsync(f.fileno())
+
+        self._segment, self._offset, self.last_seq = last, offset, last_seq
+        self._written_seq = self._synced_seq = last_seq
+
+    # --- reading ---------------------------------------------------------
+
+    def read(self, after_seq: int = 0) -> Iterator[Event]:
+        """Yield all events with seq > after_seq, oldest first"""
+        segments = self.segments()
+        for index, first_seq in enumerate(segments):
+            next_first = segments[index + 1] if index + 1 < len(segments) else None
+            if next_first is not None and next_first <= after_seq + 1:
+                continue
+            for event, _ in read_frames(self._read_segment(first_seq)):
+                if event.seq > after_seq:
+                    yield event
+
+    def _catch_up_locked(self) -> int:
+        """Apply events written by other processes since our cursor (caller holds self._lock)"""
+        applied = 0
+        while True:
+            if self._segment is None:
+                segments = self.segments()
+                if not segments:
+                    break
+                self._segment, self._offset = segments[0], 0
+
+            data = self._read_segment(self._segment, self._offset)
+            consumed = 0
+            for event, end in read_frames(data):
+                consumed = end
+                if event.seq > self.last_seq:
+                    self.last_seq = event.seq
+                    self._apply(event)
+                    applied += 1
+            self._offset += consumed
+            if consumed < len(data):
+                break  # Another worker is mid-write
+
+            # Move on once this segment is exhausted and a newer one exists
+            newer = [seq for seq in self.segments() if seq > self._segment]
+            if not newer:
+                break
+            self._segment, self._offset = newer[0], 0
+
+        if applied:
+            self.stats['applied_remote'] += applied
+            with self._sync_cond:
+                self._written_seq = max(self._written_seq, self.last_seq)
+                self._synced_seq = max(self._synced_seq, self.last_seq)
+        return applied
+
+    def catch_up(self) -> int:
+        """Apply any events other workers appended; returns how many were applied"""
+        with self._lock:
+            self._ensure_open()
+            return self._catch_up_locked()
+
+    # --- writing ---------------------------------------------------------
+
+    def append(self, event_type: str, data: Dict[str, Any], durable: bool = True,
+               precondition: Callable[[], bool] = None) -> Optional[Event]:
+        """
+        Append an event and apply it to attached projections.
+
+        Args:
+            event_type: One of the event type constants
+            data: JSON-serializable event data
+            durable: Wait until the event is fsynced before returning
+            precondition: Checked after catching up with other workers and before
+                writing; if it returns False nothing is written (check-and-append
+                is atomic across processes)
+
+        Returns:
+            The written Event, or None if the precondition failed
+        """
+        with self._lock:
+            self._ensure_open()
+            with self._file_lock():
+                self._catch_up_locked()
+                if precondition is not None and not precondition():
+                    return None
+
+                event = Event(self.last_seq + 1, time.time(), event_type, data)
+                frame = event.encode()
+                if self._segment is None or (self._offset and self._offset + len(frame) > self.segment_bytes):
+                    self._segment, self._offset = event.seq, 0
+                fd = self._write_fd(self._segment)
+                os.write(fd, frame)
+                self._dirty.add(self._segment)
+                self._offset += len(frame)
+                self.last_seq = event.seq
+                self._written_seq = event.seq
+
+            self.stats['appends'] += 1
+            self._apply(event)
+            self._since_snapshot += 1
+            if self.snapshot_every and self._since_snapshot >= self.snapshot_every:
+                self._since_snapshot = 0
+                self.snapshot()
+
+        if durable:
+            self._wait_synced(event.seq)
+        return event
+
+    def _write_fd(self, first_seq: int) -> int:
+        fd = self._write_fds.get(first_seq)
+        if fd is None:
+            fd = os.open(self._segment_path(first_seq), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            self._write_fds[first_seq] = fd
+        return fd
+
+    def _wait_synced(self, seq: int):
+        self._ensure_syncer()
+        with self._sync_cond:
+            self._sync_cond.notify_all()
+            while self._synced_seq < seq:
+                self._sync_cond.wait()
+
+    def _ensure_syncer(self):
+        if self._syncer is None:
+            with self._lock:
+                if self._syncer is None:
+                    self._syncer = threading.Thread(target=self._run_syncer, name='journal-fsync', daemon=True)
+                    self._syncer.start()
+
+    def _run_syncer(self):
+        while True:
+            with self._sync_cond:
+                while self._written_seq <= self._synced_seq:
+                    self._sync_cond.wait()
+            # Let concurrent appends join this batch
+            time.sleep(self.fsync_interval)
+            self.sync()
+
+    def sync(self):
+        """fsync every segment written since the last sync"""
+        with self._lock:
+            target = self._written_seq
+            dirty, self._dirty = self._dirty, set()
+            fds = [(seq, self._write_fds[seq]) for seq in dirty if seq in self._write_fds]
+        for seq, fd in fds:
+            os.fsync(fd)
+        with self._lock:
+            # Close handles of segments we have rolled past
+            for seq in [seq for seq in self._write_fds if seq != self._segment and seq not in self._dirty]:
+                os.close(self._write_fds.pop(seq))
+        self.stats['fsyncs'] += 1
+        with self._sync_cond:
+            self._synced_seq = max(self._synced_seq, target)
+            self._sync_cond.notify_all()
+
+    # --- projections and snapshots -------------------------------------------
+
+    def _apply(self, event: Event):
+        for projection in self._projections:
+            try:
+                projection.apply(event)
+            except Exception as e:
+                logger.error(f"Projection {projection.name} failed on event {event.seq} ({event.type}): {e}")
+
+    def attach(self, projection: Projection) -> int:
+        """
+        Restore a projection from its latest snapshot, replay the rest of the
+        journal into it and keep it updated from then on.
+
+        Returns:
+            Number of events replayed
+        """
+        with self._lock:
+            self._ensure_open()
+            with self._file_lock():
+                self._catch_up_locked()
+                after_seq = 0
+                snapshot = self._latest_snapshot(projection.name)
+                if snapshot is not None:
+                    after_seq, state = snapshot
+                    projection.restore(state)
+
+                replayed = 0
+                for event in self.read(after_seq):
+                    if event.seq > self.last_seq:
+                        break
+                    projection.apply(event)
+                    replayed += 1
+            self._projections.append(projection)
+        logger.info(f"Journal: {projection.name} restored at seq {after_seq}, replayed {replayed} events")
+        return replayed
+
+    def _snapshot_files(self, name: str) -> List[Tuple[int, str]]:
+        prefix = f"{name}-"
+        try:
+            names = os.listdir(self.snapshot_dir)
+        except FileNotFoundError:
+            return []
+        return sorted((int(entry[len(prefix):-len('.json')]), os.path.join(self.snapshot_dir, entry))
+                      for entry in names if entry.startswith(prefix) and entry.endswith('.json'))
+
+    def _latest_snapshot(self, name: str) -> Optional[Tuple[int, Dict[str, Any]]]:
+        for seq, path in reversed(self._snapshot_files(name)):
+            if seq > self.last_seq:
+                continue  # Snapshot ahead of the log (log restored from backup): unusable
+            try:
+                with open(path) as f:
+                    return seq, json.load(f)['state']
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning(f"Journal: ignoring unreadable snapshot {path}: {e}")
+        return None
+
+    def snapshot(self) -> int:
+        """Write a snapshot of every snapshot-able projection at the current seq"""
+        with self._lock:
+            seq = self.last_seq
+            states = [(p.name, p.snapshot()) for p in self._projections]
+        written = 0
+        for name, state in states:
+            if state is None:
+                continue
+            path = os.path.join(self.snapshot_dir, f"{name}-{seq:016d}.json")
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump({'seq': seq, 'state': state}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+            for _, old_path in self._snapshot_files(name)[:-self.keep_snapshots]:
+                os.remove(old_path)
+            written += 1
+        self.stats['snapshots'] += written
+        return written
+
+    def compact(self) -> int:
+        """
+        Delete segments fully covered by every projection's latest snapshot.
+
+        Returns:
+            Number of segments removed
+        """
+        with self._lock:
+            self._ensure_open()
+            names = {entry.rsplit('-', 1)[0] for entry in os.listdir(self.snapshot_dir) if entry.endswith('.json')}
+            if not names:
+                return 0
+            covered = min(self._snapshot_files(name)[-1][0] for name in names)
+            with self._file_lock():
+                segments = self.segments()
+                removed = 0
+                for first_seq, next_first in zip(segments, segments[1:]):
+                    if next_first - 1 > covered or first_seq == self._segment:
+                        break
+                    fd = self._write_fds.pop(first_seq, None)
+                    if fd is not None:
+                        os.close(fd)
+                    os.remove(self._segment_path(first_seq))
+                    removed += 1
+        return removed
+
+    def close(self):
+        if self._opened and self._written_seq > self._synced_seq:
+            self.sync()
+
+# Global instance
+journal = EventJournal()
+
+def verify(directory: str = None) -> Tuple[int, int]:
+    """Check every frame of a journal; returns (segments, events)"""
+    target = EventJournal(directory) if directory else journal
+    events = 0
+    segments = target.segments()
+    expected = None
+    for event in target.read():
+        if expected is not None and event.seq != expected:
+            raise JournalCorruptError(f"Sequence gap: expected {expected}, found {event.seq}")
+        expected = event.seq + 1
+        events += 1
+    return len(segments), events
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Inspect and maintain the event journal")
+    parser.add_argument('--dir', default=None, help='Journal directory (default: JOURNAL_DIR)')
+    subcommands = parser.add_subparsers(dest='command')
+    subcommands.add_parser('verify', help='Check CRCs and sequence continuity')
+    tail_parser = subcommands.add_parser('tail', help='Print the last events')
+    tail_parser.add_argument('-n', type=int, default=20)
+    subcommands.add_parser('compact', help='Delete segments covered by snapshots')
+    args = parser.parse_args()
+
+    target = EventJournal(args.dir) if args.dir else journal
+    if args.command == 'verify':
+        segment_count, event_count = verify(args.dir)
+        print(f"OK: {event_count} events in {segment_count} segments")
+    elif args.command == 'tail':
+        events = list(target.read())[-args.n:]
+        for event in events:
+            print(f"{event.seq:>8}  {time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(event.ts))}  "
+                  f"{event.type:22} {json.dumps(event.data)}")
+    elif args.command == 'compact':
+        print(f"Removed {target.compact()} segments")
+    else:
+        parser.print_help()
@@ -0,0 +1,359 @@
+"""
+KES/sats exchange rate service
+Integer fixed-point conversions against a background-refreshed rate cache, with per-session quote locking
+
+A rate is kept as an exact ratio (kes_units KES = sats_units sats), so every
+conversion is integer arithmetic on the cached rate: no floats, no network
+calls, and the same answer in every module.
+
+Usage:
+    from exchange_rate import kes_to_sats, sats_to_kes
+
+    kes_to_sats(150)                         # 1000
+    kes_to_sats(150, session_id="ATUid_1")   # uses (and locks) the session's quote
+"""
+import json
+import logging
+import os
+import threading
+import time
+from fractions import Fraction
+from math import gcd
+from typing import Callable, Dict, List, Tuple
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+SATS_PER_BTC = 100_000_000
+MSAT_PER_SAT = 1000
+
+def _exact(amount):
+    """Amounts as int, or an exact Fraction for decimals (floats never enter the arithmetic)"""
+    if isinstance(amount, int):
+        return amount
+    value = Fraction(str(amount))
+    return value.numerator if value.denominator == 1 else value
+
+class StaleRateError(Exception):
+    """Raised when the cached rate is older than the allowed staleness"""
+
+class Rate:
+    """
+    An exact KES/sats ratio: kes_units KES = sats_units sats.
+
+    Conversions round down, matching the old int(kes * (1000 / 150)) behaviour
+    for every whole-KES amount.
+    """
+    __slots__ = ('kes_units', 'sats_units', 'source', 'fetched_at')
+
+    def __init__(self, kes_units: int, sats_units: int, source: str = 'static', fetched_at: float = None):
+        if kes_units <= 0 or sats_units <= 0:
+            raise ValueError(f"Exchange rate must be positive, got {kes_units} KES = {sats_units} sats")
+        self.kes_units = kes_units
+        self.sats_units = sats_units
+        self.source = source
+        self.fetched_at = fetched_at if fetched_at is not None else time.time()
+
+    @classmethod
+    def from_ratio(cls, kes, sats, source: str = 'static', fetched_at: float = None) -> 'Rate':
+        """Build a rate from 'kes KES = sats sats', where either side may be a decimal"""
+        if isinstance(kes, int) and isinstance(sats, int):
+            return cls(kes, sats, source, fetched_at)
+        ratio = Fraction(str(sats)) / Fraction(str(kes))
+        return cls(ratio.denominator, ratio.numerator, source, fetched_at)
+
+    @classmethod
+    def from_btc_price(cls, btc_kes, source: str = 'static', fetched_at: float = None) -> 'Rate':
+        """Build a rate from a KES price for one bitcoin"""
+        return cls.from_ratio(btc_kes, SATS_PER_BTC, source, fetched_at)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Rate) and self.sats_units * other.kes_units == other.sats_units * self.kes_units
+
+    def __hash__(self) -> int:
+        divisor = gcd(self.kes_units, self.sats_units)
+        return hash((self.kes_units // divisor, self.sats_units // divisor))
+
+    def __repr__(self) -> str:
+        return f"Rate({self.kes_units} KES = {self.sats_units} sats, source={self.source})"
+
+    def age(self, now: float = None) -> float:
+        return (now if now is not None else time.time()) - self.fetched_at
+
+    def kes_to_msat(self, kes_amount: int) -> int:
+        """KES → millisatoshis (floor)"""
+        return int(_exact(kes_amount) * self.sats_units * MSAT_PER_SAT // self.kes_units)
+
+    def kes_to_sats(self, kes_amount: int) -> int:
+        """KES → satoshis (floor)"""
+        return int(_exact(kes_amount) * self.sats_units // self.kes_units)
+
+    def sats_to_kes_cents(self, sats_amount: int) -> int:
+        """Satoshis → KES cents (floor)"""
+        return int(_exact(sats_amount) * self.kes_units * 100 // self.sats_units)
+
+    def sats_to_kes(self, sats_amount: int) -> int:
+        """Satoshis → whole KES (floor)"""
+        return int(_exact(sats_amount) * self.kes_units // self.sats_units)
+
+    def sats_per_kes_text(self) -> str:
+        """Sats per 1 KES rounded to two decimals, e.g. '6.67'"""
+        hundredths = (2 * self.sats_units * 100 + self.kes_units) // (2 * self.kes_units)
+        return f"{hundredths // 100}.{hundredths % 100:02d}"
+
+    def pair(self) -> Tuple[int, int]:
+        """A readable 'X KES = Y sats' pair (the configured ratio, or per 1,000 KES for market prices)"""
+        if self.kes_units <= 1000:
+            return self.kes_units, self.sats_units
+        return 1000, self.kes_to_sats(1000)
+
+def format_kes_cents(cents: int) -> str:
+    """Format KES cents as '1,234.56'"""
+    return f"{cents // 100:,}.{cents % 100:02d}"
+
+class StaticRateSource:
+    """Fixed rate from configuration"""
+    name = 'static'
+
+    def __init__(self, kes_units: int = None, sats_units: int = None):
+        self.kes_units = kes_units if kes_units is not None else Config.EXCHANGE_RATE_KES
+        self.sats_units = sats_units if sats_units is not None else Config.EXCHANGE_RATE_SATS
+
+    def fetch(self) -> Rate:
+        return Rate(self.kes_units, self.sats_units, self.name)
+
+def parse_rate_payload(payload: Dict, source: str) -> Rate:
+    """
+    Parse a rate document.
+
+    Accepts {"kes": 150, "sats": 1000} or {"btc_kes": 9000000}.
+    """
+    if 'btc_kes' in payload:
+        return Rate.from_btc_price(payload['btc_kes'], source)
+    if 'kes' in payload and 'sats' in payload:
+        return Rate.from_ratio(payload['kes'], payload['sats'], source)
+    raise ValueError(f"Unrecognised rate payload: {payload}")
+
+class FileRateSource:
+    """Rate from a JSON file, re-read only when its mtime changes"""
+    name = 'file'
+
+    def __init__(self, path: str = None):
+        self.path = path or Config.EXCHANGE_RATE_FILE
+        self._mtime = None
+        self._rate = None
+
+    def fetch(self) -> Rate:
+        mtime = os.path.getmtime(self.path)
+        if mtime != self._mtime:
+            with open(self.path) as f:
+                self._rate = parse_rate_payload(json.load(f), self.name)
+            self._mtime = mtime
+            return self._rate
+        # Unchanged file: the rate is still current as of now
+        return Rate(self._rate.kes_units, self._rate.sats_units, self.name)
+
+class HttpRateSource:
+    """Rate from a JSON HTTP endpoint (only ever called from the refresh thread)"""
+    name = 'http'
+
+    def __init__(self, url: str = None, timeout: float = 2.0):
+        self.url = url or Config.EXCHANGE_RATE_URL
+        self.timeout = timeout
+
+    def fetch(self) -> Rate:
+        from tracing import TracedHTTP
+        response = TracedHTTP('exchange_rate').get(self.url, timeout=self.timeout)
+        response.raise_for_status()
+        return parse_rate_payload(response.json(), self.name)
+
+def source_from_config():
+    """Build the rate source selected by EXCHANGE_RATE_SOURCE"""
+    kind = Config.EXCHANGE_RATE_SOURCE
+    if kind == 'file':
+        return FileRateSource()
+    if kind == 'http':
+        return HttpRateSource()
+    if kind != 'static':
+        logger.warning(f"Unknown EXCHANGE_RATE_SOURCE '{kind}', using static rate")
+    return StaticRateSource()
+
+class ExchangeRateService:
+    """
+    Cached exchange rate with background refresh and per-session quotes.
+
+    Readers only ever see the cached Rate; a daemon thread calls the source
+    every refresh_interval seconds and swaps it in. The configured static rate
+    is the bootstrap value, so it goes stale like any other rate if the feed
+    never answers. Once a rate is older than max_staleness, conversions raise
+    StaleRateError instead of pricing with an old number.
+
+    A session's first conversion locks the rate it saw for quote_ttl seconds,
+    so the amount shown on the confirmation screen is the amount charged.
+    """
+
+    def __init__(self, source=None, refresh_interval: float = None, max_staleness: float = None,
+                 quote_ttl: float = None):
+        self.source = source if source is not None else source_from_config()
+        self.refresh_interval = refresh_interval if refresh_interval is not None else Config.EXCHANGE_RATE_REFRESH_SECONDS
+        self.max_staleness = max_staleness if max_staleness is not None else Config.EXCHANGE_RATE_MAX_STALENESS_SECONDS
+        self.quote_ttl = quote_ttl if quote_ttl is not None else Config.EXCHANGE_RATE_QUOTE_TTL_SECONDS
+
+        self._rate = StaticRateSource().fetch()
+        self._quotes: Dict[str, Tuple[Rate, float]] = {}
+        self._listeners: List[Callable[[Rate], None]] = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._refresher = None
+
+        self.stats = {'refreshes': 0, 'refresh_errors': 0, 'rate_changes': 0}
+
+        # Local sources are cheap enough to read before the first conversion
+        if not isinstance(self.source, HttpRateSource):
+            self.refresh()
+
+    def refresh(self) -> bool:
+        """Fetch from the source and swap in the new rate"""
+        try:
+            rate = self.source.fetch()
+        except Exception as e:
+            self.stats['refresh_errors'] += 1
+            logger.warning(f"Exchange rate refresh from {self.source.name} failed: {e}")
+            return False
+
+        previous, self._rate = self._rate, rate
+        self.stats['refreshes'] += 1
+        if rate != previous:
+            self.stats['rate_changes'] += 1
+            logger.info(f"Exchange rate updated: {rate.kes_units} KES = {rate.sats_units} sats ({rate.source})")
+            for listener in list(self._listeners):
+                try:
+                    listener(rate)
+                except Exception as e:
+                    logger.error(f"Exchange rate listener failed: {e}")
+        return True
+
+    def _ensure_refresher(self):
+        if self._refresher is None and not isinstance(self.source, StaticRateSource):
+            with self._lock:
+                if self._refresher is None:
+                    self._refresher = threading.Thread(target=self._run, name='exchange-rate-refresh', daemon=True)
+                    self._refresher.start()
+
+    def _run(self):
+        while True:
+            self.refresh()
+            if self._stopped.wait(self.refresh_interval):
+                return
+
+    def current(self) -> Rate:
+        """The cached rate (raises StaleRateError past max_staleness)"""
+        self._ensure_refresher()
+        rate = self._rate
+        if not isinstance(self.source, StaticRateSource) and rate.age() > self.max_staleness:
+            raise StaleRateError(f"Exchange rate is {rate.age():.0f}s old (max {self.max_staleness:.0f}s)")
+        return rate
+
+    def quote(self, session_id: str = None) -> Rate:
+        """Rate for a session: its locked quote if still valid, otherwise the current rate (now locked)"""
+        if not session_id:
+            return self.current()
+
+        now = time.time()
+        entry = self._quotes.get(session_id)
+        if entry is not None and entry[1] > now:
+            return entry[0]
+
+        rate = self.current()
+        with self._lock:
+            self._quotes[session_id] = (rate, now + self.quote_ttl)
+            if len(self._quotes) > 1024:
+                self._quotes = {sid: q for sid, q in self._quotes.items() if q[1] > now}
+        return rate
+
+    def release_quote(self, session_id: str):
+        """Drop a session's locked quote"""
+        with self._lock:
+            self._quotes.pop(session_id, None)
+
+    def add_listener(self, listener: Callable[[Rate], None]):
+        """Call listener(rate) whenever the rate changes"""
+        self._listeners.append(listener)
+
+    def close(self):
+        self._stopped.set()
+
+# Global instance
+rate_service = ExchangeRateService()
+
+def kes_to_sats(kes_amount: int, session_id: str = None) -> int:
+    """KES → sats at the session's quoted rate (or the current rate)"""
+    return rate_service.quote(session_id).kes_to_sats(kes_amount)
+
+def kes_to_msat(kes_amount: int, session_id: str = None) -> int:
+    """KES → millisatoshis at the session's quoted rate (or the current rate)"""
+    return rate_service.quote(session_id).kes_to_msat(kes_amount)
+
+def sats_to_kes(sats_amount: int, session_id: str = None) -> int:
+    """Sats → whole KES at the session's quoted rate (or the current rate)"""
+    return rate_service.quote(session_id).sats_to_kes(sats_amount)
+
+def sats_to_kes_text(sats_amount: int, session_id: str = None) -> str:
+    """Sats as a KES amount with cents, e.g. '12.34'"""
+    return format_kes_cents(rate_service.quote(session_id).sats_to_kes_cents(sats_amount))
+
+def rate_pair_text(session_id: str = None) -> str:
+    """e.g. '150 KES = 1,000 sats'"""
+    kes, sats = rate_service.quote(session_id).pair()
+    return f"{kes:,} KES = {sats:,} sats"
+
+def rate_summary_text(session_id: str = None) -> str:
+    """Two-line rate summary for USSD screens"""
+    rate = rate_service.quote(session_id)
+    return f"1 KES ≈ {rate.sats_per_kes_text()} sats\n{rate_pair_text(session_id)}"
+
+def release_quote(session_id: str):
+    rate_service.release_quote(session_id)
+
+def serve(port: int, btc_kes: float):
+    """Local HTTP stand-in for a rate feed, for development and load tests"""
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+    class RateHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = json.dumps({'btc_kes': btc_kes, 'timestamp': int(time.time())}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    print(f"Serving BTC/KES {btc_kes} on http://127.0.0.1:{port}/")
+    HTTPServer(('127.0.0.1', port), RateHandler).serve_forever()
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="KES/sats exchange rate tools")
+    subcommands = parser.add_subparsers(dest='command')
+
+    serve_parser = subcommands.add_parser('serve', help='Run a local HTTP rate feed')
+    serve_parser.add_argument('--port', type=int, default=8765)
+    serve_parser.add_argument('--btc-kes', type=float, default=15_000_000)
+
+    convert_parser = subcommands.add_parser('convert', help='Convert KES to sats at the configured rate')
+    convert_parser.add_argument('kes', type=int)
+
+    args = parser.parse_args()
+    if args.command == 'serve':
+        serve(args.port, args.btc_kes)
+    elif args.command == 'convert':
+        rate = rate_service.current()
+        print(f"{args.kes} KES = {rate.kes_to_sats(args.kes)} sats "
+              f"({rate.kes_to_msat(args.kes)} msat) at {rate_pair_text()} [{rate.source}]")
+    else:
+        parser.print_help()
@@ -4,9 +4,21 @@ Integrates MeTTa reasoning with Lightning operations
 """
 import logging
 from typing import Dict, Any, Tuple, Optional
-from hyperon import MeTTa
 from lightning import lightning_api
 from intersend_helpers import initiate_mpesa_stk_push, check_mpesa_status, get_payment_summary
+from tracing import instrument_metta
+import phone_numbers
+from metrics import PENDING_TOPUPS
+from exchange_rate import rate_service, kes_to_sats
+from ussd_screens import render
+from single_flight import phone_locks
+from sms_queue import send_sms
+from event_journal import (journal, TRANSACTION_RECORDED, INVOICE_CREATED, MPESA_PENDING, MPESA_SETTLED,
+                           MPESA_FAILED, BALANCE_SET)
+from ledger_projections import MettaProjection, PendingTopupsProjection
+from metta_queries import MettaQueries, TRANSACTION, PREFERENCE_LANGUAGE, EXCHANGE_RATE
+from balance_reconciler import balance_reconciler
+from rule_engine import rules
 import time
 import re
 import threading
@@ -16,12 +28,56 @@ logger = logging.getLogger(__name__)
 
 class USSDHandlers:
     def __init__(self, metta_file: str = "atoms.metta"):
-        self.metta = MeTTa()
-        self.load_knowledge_base(metta_file)
+        self.metta_file = metta_file
+        self._metta = None
+        self._queries = None
+        self._metta_lock = threading.Lock()
+        self._pending_topups = None
         self.sessions = {}  # Store session data
+    
+    @property
+    def metta(self):
+        """MeTTa interpreter with the knowledge base loaded, built on first use"""
+        if self._metta is None:
+            with self._metta_lock:
+                if self._metta is None:
+                    from hyperon import MeTTa
+                    metta = MeTTa()
+                    self.load_knowledge_base(self.metta_file, metta)
+                    metta = instrument_metta(metta)
+                    self._queries = MettaQueries(metta)
+                    # Per-user facts from the knowledge base file go to their shards
+                    self._queries.adopt_shared_facts()
+                    # Ledger facts are a projection of the event journal
+                    journal.attach(MettaProjection(self._queries))
+                    # Balances are kept in step with the database in the background
+                    balance_reconciler.attach(self._queries)
+                    self._metta = metta
+                    self._sync_exchange_rate(rate_service.current())
+                    rate_service.add_listener(self._sync_exchange_rate)
+        return self._metta
+    
+    @property
+    def queries(self) -> MettaQueries:
+        """Typed fact queries against the knowledge base space"""
+        if self._queries is None:
+            self.metta
+        return self._queries
+    
+    @property
+    def pending_topups(self) -> PendingTopupsProjection:
+        """M-Pesa top-ups awaiting payment, rebuilt from the event journal on first use"""
+        if self._pending_topups is None:
+            with self._metta_lock:
+                if self._pending_topups is None:
+                    pending_topups = PendingTopupsProjection()
+                    journal.attach(pending_topups)
+                    self._pending_topups = pending_topups
+        return self._pending_topups
         
-    def load_knowledge_base(self, metta_file: str):
+    def load_knowledge_base(self, metta_file: str, metta=None):
         """Load MeTTa knowledge base from file"""
+        metta = metta or self.metta
         try:
             with open(metta_file, 'r') as f:
                 content = f.read()
@@ -30,7 +86,7 @@ class USSDHandlers:
                     line = line.strip()
                     if line and not line.startswith(';'):
                         try:
-                            result = self.metta.run(line)
+                            result = metta.run(line)
                             logger.debug(f"Loaded: {line}")
                         except Exception as e:
                             logger.warning(f"Error loading line '{line}': {e}")
@@ -38,73 +94,46 @@ class USSDHandlers:
             logger.error(f"MeTTa file {metta_file} not found")
         except Exception as e:
             logger.error(f"Error loading knowledge base: {e}")
-    
-    def get_user_balance(self, phone_number: str) -> int:
-        """Get user balance from MeTTa and sync with Lightning API"""
-        # Query MeTTa for balance
-        query = f'!(match &self (Balance "{phone_number}" $b) $b)'
+
+    def _sync_exchange_rate(self, rate):
+        """Keep the MeTTa ExchangeRate atom equal to the rate service's current rate"""
         try:
-            result = self.metta.run(query)
-            if result and len(result) > 0:
-                metta_balance = int(str(result[0]).strip('[]'))
-                # Sync with Lightning API balance
-                lightning_balance = lightning_api.get_balance(phone_number)
-                if lightning_balance != metta_balance:
-                    self.update_balance(phone_number, lightning_balance)
-                return lightning_balance
+            # One locked swap, so concurrent syncs cannot leave two rates or none
+            self._queries.replace(EXCHANGE_RATE, {}, kes_units=rate.kes_units, sats_units=rate.sats_units)
         except Exception as e:
-            logger.error(f"Error getting balance for {phone_number}: {e}")
-        
-        # Fallback to Lightning API
+            logger.error(f"Error syncing exchange rate atom: {e}")
+
+    def get_user_balance(self, phone_number: str) -> int:
+        """Get user balance from the Lightning API (MeTTa Balance facts are synced by balance_reconciler)"""
         return lightning_api.get_balance(phone_number)
     
     def update_balance(self, phone_number: str, new_balance: int):
-        """Update balance in both MeTTa and Lightning API"""
-        try:
-            # Remove old balance
-            remove_query = f'!(remove-atom &self (Balance "{phone_number}" $b))'
-            self.metta.run(remove_query)
-            
-            # Add new balance
-            add_query = f'!(add-atom &self (Balance "{phone_number}" {new_balance}))'
-            self.metta.run(add_query)
-            
-            # Update Lightning API
-            lightning_api.set_balance(phone_number, new_balance)
-            
-            logger.info(f"Updated balance for {phone_number}: {new_balance} sats")
-        except Exception as e:
-            logger.error(f"Error updating balance: {e}")
+        """
+        Update balance in the Lightning API, then in MeTTa.
+        
+        Raises:
+            Exception: If the Lightning API write fails (nothing is journaled)
+        """
+        lightning_api.set_balance(phone_number, new_balance)
+        
+        # Journal only a stored balance; the MeTTa Balance fact is projected from the event
+        journal.append(BALANCE_SET, {'phone': phone_number, 'balance': new_balance})
+        
+        logger.info(f"Updated balance for {phone_number}: {new_balance} sats")
     
     def validate_phone_number(self, phone_number: str) -> bool:
-        """Validate phone number format"""
-        if not phone_number.startswith('+254'):
-            if phone_number.startswith('254'):
-                phone_number = '+' + phone_number
-            elif phone_number.startswith('0') and len(phone_number) == 10:
-                phone_number = '+254' + phone_number[1:]
-            else:
-                return False
-        return len(phone_number) == 13 and phone_number[1:].isdigit()
+        """Validate phone number format (numbering plan, then the ValidPhoneNumber rule)"""
+        normalized = phone_numbers.normalize(phone_number)
+        return normalized is not None and rules.check('ValidPhoneNumber', phone=normalized) is None
     
     def normalize_phone_number(self, phone_number: str) -> str:
-        """Normalize phone number to international format"""
-        phone_number = phone_number.strip()
-        if phone_number.startswith('0') and len(phone_number) == 10:
-            return '+254' + phone_number[1:]
-        elif phone_number.startswith('254') and len(phone_number) == 12:
-            return '+' + phone_number
-        elif phone_number.startswith('+254'):
-            return phone_number
-        return phone_number
+        """Normalize phone number to international (E.164) format"""
+        return phone_numbers.normalize_or_original(phone_number)
     
     def validate_amount(self, amount: int) -> Tuple[bool, str]:
-        """Validate transaction amount - flexible for Lightning Network micro-transactions"""
-        if amount < 1:
-            return False, "Minimum amount is 1 sat"
-        if amount > 1000000:
-            return False, "Maximum amount is 1,000,000 sats"
-        return True, ""
+        """Validate transaction amount against the MinimumAmount and MaximumAmount rules"""
+        error = rules.first_violation(('MinimumAmount', 'MaximumAmount'), amount=amount)
+        return error is None, error or ""
     
     def send_btc(self, from_phone: str, to_phone: str, amount: int) -> Tuple[bool, str, Dict[str, Any]]:
         """Send Bitcoin Lightning payment"""
@@ -123,36 +152,94 @@ class USSDHandlers:
             if not valid_amount:
                 return False, amount_error, {}
             
-            # Check sender balance
-            sender_balance = self.get_user_balance(from_phone)
-            if sender_balance < amount:
-                return False, f"Insufficient balance. Current: {sender_balance} sats", {}
-            
-            # Create invoice for recipient
-            success, invoice_data = lightning_api.create_invoice(to_phone, amount, f"USSD payment from {from_phone}")
-            if not success:
-                return False, "Failed to create payment invoice", {}
-            
-            # Pay the invoice
-            success, payment_result = lightning_api.pay_invoice(from_phone, invoice_data["payment_request"])
-            if not success:
-                return False, payment_result.get("error", "Payment failed"), {}
-            
-            # Record transaction in MeTTa
-            timestamp = time.strftime("%Y-%m-%dT%H:%M:%SZ")
-            transaction_atom = f'!(add-atom &self (Transaction "{from_phone}" "{to_phone}" {amount} Lightning "{timestamp}"))'
-            self.metta.run(transaction_atom)
-            
-            # Update balances
-            self.update_balance(from_phone, sender_balance - amount)
-            self.update_balance(to_phone, self.get_user_balance(to_phone) + amount)
-            
+            # Balance check and debit must not interleave with another payment from or to these numbers
+            with phone_locks.hold(from_phone, to_phone):
+                # Check sender balance
+                sender_balance = self.get_user_balance(from_phone)
+                insufficient = rules.check('InsufficientFunds', user=from_phone, amount=amount,
+                                           Balance={from_phone: sender_balance}.get)
+                if insufficient:
+                    return False, f"{insufficient}. Current: {sender_balance} sats", {}
+            
+                # Create invoice for recipient
+                success, invoice_data = lightning_api.create_invoice(to_phone, amount, f"USSD payment from {from_phone}")
+                if not success:
+                    return False, "Failed to create payment invoice", {}
+            
+                # Pay the invoice
+                success, payment_result = lightning_api.pay_invoice(from_phone, invoice_data["payment_request"])
+                if not success:
+                    return False, payment_result.get("error", "Payment failed"), {}
+            
+                # Record transaction
+                self._record_transaction(from_phone, to_phone, amount, "Lightning")
+            
+                # Update balances
+                self.update_balance(from_phone, sender_balance - amount)
+                self.update_balance(to_phone, self.get_user_balance(to_phone) + amount)
+            
+            send_sms(to_phone, f"You received {amount} sats from {from_phone} via Lightning.", kind='payment')
             return True, f"Sent {amount} sats to {to_phone}. New balance: {sender_balance - amount} sats", payment_result
             
         except Exception as e:
             logger.error(f"Error in send_btc: {e}")
             return False, "Internal error during payment", {}
     
+    def _record_transaction(self, from_party: str, to_party: str, amount: int, kind: str):
+        """Journal a completed transaction (projected into MeTTa Transaction facts)"""
+        journal.append(TRANSACTION_RECORDED, {
+            'from': from_party,
+            'to': to_party,
+            'amount': amount,
+            'kind': kind,
+            'timestamp': time.strftime("%Y-%m-%dT%H:%M:%SZ")
+        })
+    
+    def _settle_topup(self, invoice_id: str, outcome: str, mpesa_reference: str = None) -> Optional[Dict[str, Any]]:
+        """
+        Close a pending M-Pesa top-up with an MPESA_SETTLED or MPESA_FAILED event.
+        
+        Returns:
+            The pending top-up if this call closed it, None if it was already closed
+        """
+        pending_topups = self.pending_topups
+        journal.catch_up()
+        pending = pending_topups.get(invoice_id)
+        if pending is None:
+            return None
+        event = journal.append(outcome, dict(pending, mpesa_reference=mpesa_reference,
+                                             settled_at=time.strftime("%Y-%m-%dT%H:%M:%SZ")),
+                               precondition=lambda: invoice_id in pending_topups)
+        return pending if event is not None else None
+    
+    def _credit_topup(self, invoice_id: str, mpesa_reference: str = None) -> Optional[Tuple[Dict[str, Any], int]]:
+        """
+        Credit a completed M-Pesa top-up, then close it with MPESA_SETTLED.
+        
+        The credit is keyed on the invoice id in the database, so the webhook, the
+        poller and other workers can all complete the same payment, and a crash
+        between crediting and settling is repaired by the next attempt, without
+        crediting twice.
+        
+        Returns:
+            (pending top-up, new balance) if this call credited it, None if it was already credited or closed
+        
+        Raises:
+            Exception: If the credit could not be stored (the top-up stays pending)
+        """
+        pending_topups = self.pending_topups
+        journal.catch_up()
+        pending = pending_topups.get(invoice_id)
+        if pending is None:
+            return None
+        phone_number = pending['phone']
+        with phone_locks.hold(phone_number):
+            new_balance = lightning_api.credit_topup(phone_number, pending['sats_amount'], invoice_id)
+            if new_balance is not None:
+                journal.append(BALANCE_SET, {'phone': phone_number, 'balance': new_balance})
+        self._settle_topup(invoice_id, MPESA_SETTLED, mpesa_reference)
+        return (pending, new_balance) if new_balance is not None else None
+    
     def receive_btc(self, phone_number: str, amount: int, memo: str = "") -> Tuple[bool, str, Dict[str, Any]]:
         """Generate Lightning invoice for receiving Bitcoin"""
         try:
@@ -169,10 +256,13 @@ class USSDHandlers:
             success, invoice_data = lightning_api.create_invoice(phone_number, amount, memo or "USSD Bitcoin payment")
             
             if success:
-                # Store invoice reference in MeTTa
-                timestamp = time.strftime("%Y-%m-%dT%H:%M:%SZ")
-                invoice_atom = f'!(add-atom &self (Invoice "{phone_number}" "{invoice_data["invoice_id"]}" {amount} "{timestamp}"))'
-                self.metta.run(invoice_atom)
+                # Store invoice reference
+                journal.append(INVOICE_CREATED, {
+                    'phone': phone_number,
+                    'invoice_id': invoice_data["invoice_id"],
+                    'amount': amount,
+                    'timestamp': time.strftime("%Y-%m-%dT%H:%M:%SZ")
+                })
                 
                 # Create short invoice code for USSD display
                 short_code = invoice_data["invoice_id"][-8:]  # Last 8 chars
@@ -198,8 +288,10 @@ class USSDHandlers:
             success, message, invoice_data = self.receive_btc(from_phone, amount, memo)
             
             if success:
-                # In a real implementation, this would send SMS
+                # Queued: the sender thread delivers it without holding up the USSD hop
                 logger.info(f"Sending invoice to {to_phone}: {invoice_data['payment_request']}")
+                send_sms(to_phone, f"{from_phone} requests {amount} sats{': ' + memo if memo else ''}.\n"
+                                   f"Pay this Lightning invoice:\n{invoice_data['payment_request']}", kind='invoice')
                 return True, f"Invoice sent to {to_phone}\nAmount: {amount} sats", invoice_data
             else:
                 return False, message, {}
@@ -208,7 +300,8 @@ class USSDHandlers:
             logger.error(f"Error in send_invoice: {e}")
             return False, "Internal error sending invoice", {}
     
-    def topup_via_mpesa(self, phone_number: str, kes_amount: int, mpesa_code: str = None) -> Tuple[bool, str, Dict[str, Any]]:
+    def topup_via_mpesa(self, phone_number: str, kes_amount: int, mpesa_code: str = None,
+                        session_id: str = None) -> Tuple[bool, str, Dict[str, Any]]:
         """M-Pesa to Lightning top-up with real STK Push integration"""
         logger.info(f"MPESA_TOPUP - Starting topup for {phone_number}, amount: {kes_amount} KES")
         try:
@@ -218,11 +311,11 @@ class USSDHandlers:
             if not self.validate_phone_number(phone_number):
                 return False, "Invalid phone number", {}
             
-            if kes_amount < 10:
-                return False, "Minimum Lightning Network purchase is 10 KES (66 sats)", {}
+            minimum_error = rules.check('MinimumTopUp', kes_amount=kes_amount)
+            if minimum_error:
+                return False, minimum_error, {}
             
-            # Convert KES to sats (150 KES = 1000 sats)
-            sats_amount = int(kes_amount * (1000 / 150))
+            sats_amount = kes_to_sats(kes_amount, session_id)
             
             # Use Intersend M-Pesa STK Push
             reference = f"BTC_TOPUP_{int(time.time())}"
@@ -250,9 +343,13 @@ class USSDHandlers:
                 return False, "Payment initiation failed", {}
             
             # Store pending transaction
-            timestamp = time.strftime("%Y-%m-%dT%H:%M:%SZ")
-            pending_atom = f'!(add-atom &self (PendingMpesa "{phone_number}" "{invoice_id}" {kes_amount} {sats_amount} "{timestamp}"))'
-            self.metta.run(pending_atom)
+            journal.append(MPESA_PENDING, {
+                'phone': phone_number,
+                'invoice_id': invoice_id,
+                'kes_amount': kes_amount,
+                'sats_amount': sats_amount,
+                'timestamp': time.strftime("%Y-%m-%dT%H:%M:%SZ")
+            })
             
             # Start background polling to check payment completion
             self._start_payment_polling(invoice_id, phone_number, kes_amount, sats_amount)
@@ -283,41 +380,28 @@ class USSDHandlers:
             payment_summary = get_payment_summary(status_response)
             
             if payment_summary['status'] == 'COMPLETE':
-                # Find pending transaction
-                query = f'!(match &self (PendingMpesa $phone $invoice $kes $sats $timestamp) (list $phone $invoice $kes $sats $timestamp))'
-                result = self.metta.run(query)
-                
-                for pending in result:
-                    parts = str(pending).strip('[]').split()
-                    if len(parts) >= 2 and parts[1].strip('"') == invoice_id:
-                        phone_number = parts[0].strip('"')
-                        kes_amount = int(parts[2])
-                        sats_amount = int(parts[3])
-                        
-                        # Update balance
-                        current_balance = self.get_user_balance(phone_number)
-                        new_balance = current_balance + sats_amount
-                        self.update_balance(phone_number, new_balance)
-                        
-                        # Record completed transaction
-                        timestamp = time.strftime("%Y-%m-%dT%H:%M:%SZ")
-                        transaction_atom = f'!(add-atom &self (Transaction "M-Pesa" "{phone_number}" {sats_amount} TopUp "{timestamp}"))'
-                        self.metta.run(transaction_atom)
-                        
-                        # Remove pending transaction
-                        remove_pending = f'!(remove-atom &self (PendingMpesa "{phone_number}" "{invoice_id}" {kes_amount} {sats_amount} $timestamp))'
-                        self.metta.run(remove_pending)
-                        
-                        return True, f"Payment confirmed! {sats_amount} sats added to your balance.\nM-Pesa Ref: {payment_summary.get('mpesa_reference', 'N/A')}\nNew balance: {new_balance} sats", {
-                            "kes_amount": kes_amount,
-                            "sats_amount": sats_amount,
-                            "new_balance": new_balance,
-                            "mpesa_reference": payment_summary.get('mpesa_reference')
-                        }
+                # Credit and settle the pending transaction (exactly once across webhook, poller and workers)
+                credited = self._credit_topup(invoice_id, payment_summary.get('mpesa_reference'))
+                if credited is not None:
+                    pending, new_balance = credited
+                    phone_number = pending['phone']
+                    kes_amount = pending['kes_amount']
+                    sats_amount = pending['sats_amount']
+                    
+                    send_sms(phone_number, f"M-Pesa top-up confirmed: {sats_amount} sats added. "
+                                           f"New balance: {new_balance} sats.", kind='topup')
+                    
+                    return True, f"Payment confirmed! {sats_amount} sats added to your balance.\nM-Pesa Ref: {payment_summary.get('mpesa_reference', 'N/A')}\nNew balance: {new_balance} sats", {
+                        "kes_amount": kes_amount,
+                        "sats_amount": sats_amount,
+                        "new_balance": new_balance,
+                        "mpesa_reference": payment_summary.get('mpesa_reference')
+                    }
                 
                 return False, "Payment completed but no matching pending transaction found", {}
                 
             elif payment_summary['status'] in ['FAILED', 'CANCELLED']:
+                self._settle_topup(invoice_id, MPESA_FAILED)
                 return False, f"Payment failed: {payment_summary.get('failed_reason', 'Unknown error')}", {}
             else:
                 return False, f"Payment still {payment_summary['status'].lower()}. Please wait and try again.", {}
@@ -326,7 +410,8 @@ class USSDHandlers:
             logger.error(f"Error completing M-Pesa topup: {e}")
             return False, "Error verifying payment", {}
     
-    def withdraw_to_mpesa(self, phone_number: str, kes_amount: int, mpesa_number: str) -> Tuple[bool, str, Dict[str, Any]]:
+    def withdraw_to_mpesa(self, phone_number: str, kes_amount: int, mpesa_number: str,
+                          session_id: str = None) -> Tuple[bool, str, Dict[str, Any]]:
         """Simulate Lightning to M-Pesa withdrawal"""
         try:
             phone_number = self.normalize_phone_number(phone_number)
@@ -335,25 +420,25 @@ class USSDHandlers:
             if not self.validate_phone_number(phone_number):
                 return False, "Invalid phone number", {}
             
-            if kes_amount < 100:
-                return False, "Minimum withdrawal is 100 KES", {}
+            minimum_error = rules.check('MinimumWithdrawal', kes_amount=kes_amount)
+            if minimum_error:
+                return False, minimum_error, {}
             
-            # Convert KES to sats
-            sats_amount = int(kes_amount * (1000 / 150))
+            sats_amount = kes_to_sats(kes_amount, session_id)
             
-            # Check balance
-            current_balance = self.get_user_balance(phone_number)
-            if current_balance < sats_amount:
-                return False, f"Insufficient balance. Need {sats_amount} sats ({kes_amount} KES)", {}
+            # Balance check and debit must not interleave with another payment from this number
+            with phone_locks.hold(phone_number):
+                # Check balance
+                current_balance = self.get_user_balance(phone_number)
+                if current_balance < sats_amount:
+                    return False, f"Insufficient balance. Need {sats_amount} sats ({kes_amount} KES)", {}
             
-            # Update balance
-            new_balance = current_balance - sats_amount
-            self.update_balance(phone_number, new_balance)
+                # Update balance
+                new_balance = current_balance - sats_amount
+                self.update_balance(phone_number, new_balance)
             
-            # Record transaction
-            timestamp = time.strftime("%Y-%m-%dT%H:%M:%SZ")
-            transaction_atom = f'!(add-atom &self (Transaction "{phone_number}" "M-Pesa" {sats_amount} Withdraw "{timestamp}"))'
-            self.metta.run(transaction_atom)
+                # Record transaction
+                self._record_transaction(phone_number, "M-Pesa", sats_amount, "Withdraw")
             
             # Simulate M-Pesa payout
             logger.info(f"Simulated M-Pesa payout: {kes_amount} KES to {mpesa_number}")
@@ -373,21 +458,19 @@ class USSDHandlers:
         """Get recent transaction history"""
         try:
             phone_number = self.normalize_phone_number(phone_number)
-            query = f'!(match &self (Transaction $from $to $amount $type $timestamp) (list $from $to $amount $type $timestamp))'
-            result = self.metta.run(query)
-            
-            transactions = []
-            for tx in result:
-                tx_str = str(tx).strip('[]')
-                parts = tx_str.split()
-                if len(parts) >= 5 and (parts[0].strip('"') == phone_number or parts[1].strip('"') == phone_number):
-                    transactions.append({
-                        'from': parts[0].strip('"'),
-                        'to': parts[1].strip('"'),
-                        'amount': int(parts[2]),
-                        'type': parts[3],
-                        'timestamp': parts[4].strip('"')
-                    })
+            queries = self.queries
+            journal.catch_up()  # Transactions recorded by other workers
+            # Sent and received, each matched with the phone bound (a self-transfer matches both)
+            rows = queries.query(TRANSACTION, sender=phone_number)
+            rows += [row for row in queries.query(TRANSACTION, recipient=phone_number) if row['sender'] != phone_number]
+            
+            transactions = [{
+                'from': row['sender'],
+                'to': row['recipient'],
+                'amount': row['amount'],
+                'type': row['kind'],
+                'timestamp': row['timestamp']
+            } for row in rows]
             
             return sorted(transactions, key=lambda x: x['timestamp'], reverse=True)[:limit]
             
@@ -395,7 +478,8 @@ class USSDHandlers:
             logger.error(f"Error getting transaction history: {e}")
             return []
     
-    def buy_airtime(self, phone_number: str, airtime_phone: str, kes_amount: int) -> Tuple[bool, str, Dict[str, Any]]:
+    def buy_airtime(self, phone_number: str, airtime_phone: str, kes_amount: int,
+                    session_id: str = None) -> Tuple[bool, str, Dict[str, Any]]:
         """Buy airtime using Bitcoin for Kenyan mobile networks"""
         try:
             phone_number = self.normalize_phone_number(phone_number)
@@ -407,37 +491,35 @@ class USSDHandlers:
             if not self.validate_phone_number(airtime_phone):
                 return False, "Invalid airtime recipient phone number", {}
             
-            if kes_amount < 10:
-                return False, "Minimum airtime purchase is 10 KES", {}
-                
-            if kes_amount > 1000:
-                return False, "Maximum airtime purchase is 1,000 KES", {}
+            limit_error = rules.first_violation(('MinimumAirtime', 'MaximumAirtime'), kes_amount=kes_amount)
+            if limit_error:
+                return False, limit_error, {}
             
             # Convert KES to sats for balance check
-            sats_needed = int(kes_amount * (1000 / 150))
+            sats_needed = kes_to_sats(kes_amount, session_id)
             
-            # Check sender balance
-            sender_balance = self.get_user_balance(phone_number)
-            if sender_balance < sats_needed:
-                return False, f"Insufficient balance. Need {sats_needed} sats ({kes_amount} KES), have {sender_balance} sats", {}
+            # Balance check and debit must not interleave with another payment from this number
+            with phone_locks.hold(phone_number):
+                # Check sender balance
+                sender_balance = self.get_user_balance(phone_number)
+                if sender_balance < sats_needed:
+                    return False, f"Insufficient balance. Need {sats_needed} sats ({kes_amount} KES), have {sender_balance} sats", {}
             
-            # Detect mobile network carrier
-            carrier = self._detect_carrier(airtime_phone)
+                # Detect mobile network carrier
+                carrier = self._detect_carrier(airtime_phone)
             
-            # Simulate airtime purchase (in reality, integrate with carrier APIs)
-            success = self._process_airtime_purchase(airtime_phone, kes_amount, carrier)
+                # Simulate airtime purchase (in reality, integrate with carrier APIs)
+                success = self._process_airtime_purchase(airtime_phone, kes_amount, carrier)
             
-            if not success:
-                return False, "Airtime purchase failed. Please try again.", {}
+                if not success:
+                    return False, "Airtime purchase failed. Please try again.", {}
             
-            # Deduct balance
-            new_balance = sender_balance - sats_needed
-            self.update_balance(phone_number, new_balance)
+                # Deduct balance
+                new_balance = sender_balance - sats_needed
+                self.update_balance(phone_number, new_balance)
             
-            # Record transaction
-            timestamp = time.strftime("%Y-%m-%dT%H:%M:%SZ")
-            transaction_atom = f'!(add-atom &self (Transaction "{phone_number}" "Airtime-{carrier}" {sats_needed} Airtime "{timestamp}"))'
-            self.metta.run(transaction_atom)
+                # Record transaction
+                self._record_transaction(phone_number, f"Airtime-{carrier}", sats_needed, "Airtime")
             
             if phone_number == airtime_phone:
                 message = f"Airtime purchased successfully!\n{kes_amount} KES airtime for {carrier}\nNew balance: {new_balance} sats"
@@ -458,30 +540,7 @@ class USSDHandlers:
     
     def _detect_carrier(self, phone_number: str) -> str:
         """Detect mobile network carrier from phone number"""
-        # Kenyan mobile network prefixes
-        if phone_number.startswith("+254"):
-            prefix = phone_number[4:7]
-            
-            # Safaricom prefixes
-            safaricom_prefixes = ['701', '702', '703', '704', '705', '706', '707', '708', '709', 
-                                '710', '711', '712', '713', '714', '715', '716', '717', '718', '719',
-                                '720', '721', '722', '723', '724', '725', '726', '727', '728', '729']
-            
-            # Airtel prefixes  
-            airtel_prefixes = ['730', '731', '732', '733', '734', '735', '736', '737', '738', '739',
-                             '750', '751', '752', '753', '754', '755', '756']
-            
-            # Telkom prefixes
-            telkom_prefixes = ['770', '771', '772', '773', '774', '775', '776', '777']
-            
-            if prefix in safaricom_prefixes:
-                return "Safaricom"
-            elif prefix in airtel_prefixes:
-                return "Airtel"
-            elif prefix in telkom_prefixes:
-                return "Telkom"
-        
-        return "Unknown Carrier"
+        return phone_numbers.detect_carrier(phone_number)
     
     def _process_airtime_purchase(self, phone_number: str, amount: int, carrier: str) -> bool:
         """Simulate airtime purchase processing"""
@@ -495,28 +554,17 @@ class USSDHandlers:
         # Simulate success (in reality, this would depend on API response)
         return True
     
+    def get_user_language(self, phone_number: str) -> Optional[str]:
+        """Preferred screen language from the user's MeTTa Preference atom, if any"""
+        try:
+            return self.queries.value(PREFERENCE_LANGUAGE, 'language', phone=phone_number)
+        except Exception as e:
+            logger.error(f"Error getting language for {phone_number}: {e}")
+        return None
+    
     def get_menu_text(self, language: str = "en") -> str:
         """Get localized main menu text"""
-        if language == "sw":
-            return ("Bitcoin Lightning\n"
-                   "1. Tuma BTC\n"
-                   "2. Pokea BTC\n"
-                   "3. Tuma Ankara\n"
-                   "4. Nunua BTC (M-Pesa)\n"
-                   "5. Toa M-Pesa\n"
-                   "6. Nunua Airtime\n"
-                   "7. Historia\n"
-                   "0. Ondoka")
-        else:
-            return ("Bitcoin Lightning\n"
-                   "1. Send BTC\n"
-                   "2. Receive BTC\n"
-                   "3. Send Invoice\n"
-                   "4. Buy BTC (M-Pesa)\n"
-                   "5. Withdraw M-Pesa\n"
-                   "6. Buy Airtime\n"
-                   "7. History\n"
-                   "0. Exit")
+        return render('menu', language)
     
     def _start_payment_polling(self, invoice_id: str, phone_number: str, kes_amount: int, sats_amount: int):
         """Start background polling to check payment completion"""
@@ -553,34 +601,25 @@ class USSDHandlers:
                     if status == 'COMPLETE':
                         logger.info(f"POLLING: Payment completed! Updating balance for {phone_number}")
                         
-                        # Update balance directly through Lightning API (bypassing MeTTa issues)
-                        from lightning import lightning_api
-                        current_balance = lightning_api.get_balance(phone_number)
-                        lightning_api._update_db_balance(phone_number, sats_amount)
-                        new_balance = lightning_api.get_balance(phone_number)
+                        # The webhook may have credited it already; the credit is applied once per invoice
+                        credited = self._credit_topup(invoice_id)
+                        if credited is None:
+                            logger.info(f"POLLING: Top-up {invoice_id} already settled")
+                            break
                         
-                        # Record completed transaction in MeTTa (optional)
-                        try:
-                            timestamp = time.strftime("%Y-%m-%dT%H:%M:%SZ")
-                            transaction_atom = f'!(add-atom &self (Transaction "M-Pesa" "{phone_number}" {sats_amount} TopUp "{timestamp}"))'
-                            self.metta.run(transaction_atom)
-                            
-                            # Remove pending transaction
-                            remove_pending = f'!(remove-atom &self (PendingMpesa "{phone_number}" "{invoice_id}" {kes_amount} {sats_amount} $timestamp))'
-                            self.metta.run(remove_pending)
-                        except Exception as metta_error:
-                            logger.warning(f"POLLING: MeTTa operation failed (balance still updated): {metta_error}")
+                        new_balance = credited[1]
+                        send_sms(phone_number, f"M-Pesa top-up confirmed: {sats_amount} sats added. "
+                                               f"New balance: {new_balance} sats.", kind='topup')
                         
-                        logger.info(f"POLLING: Balance updated from {current_balance} to {new_balance} sats")
+                        logger.info(f"POLLING: Balance updated to {new_balance} sats")
                         break
                     
                     elif status in ['FAILED', 'CANCELLED', 'EXPIRED'] or failed_reason or failed_code:
                         # Payment failed - stop polling
                         logger.info(f"POLLING: Payment failed/cancelled (Status: {status}, Reason: '{failed_reason}', Code: '{failed_code}'). Stopping polling.")
                         
-                        # Remove pending transaction for failed payments
-                        remove_pending = f'!(remove-atom &self (PendingMpesa "{phone_number}" "{invoice_id}" {kes_amount} {sats_amount} $timestamp))'
-                        self.metta.run(remove_pending)
+                        # Close the pending top-up for failed payments
+                        self._settle_topup(invoice_id, MPESA_FAILED)
                         break
                     
                     elif status in ['PENDING', 'PROCESSING']:
@@ -599,10 +638,19 @@ class USSDHandlers:
             
             logger.info(f"POLLING: Finished polling for invoice {invoice_id}")
         
+        def poll_and_track():
+            try:
+                poll_payment()
+            finally:
+                PENDING_TOPUPS.dec()
+        
         # Start polling in background thread
-        polling_thread = threading.Thread(target=poll_payment, daemon=True)
+        PENDING_TOPUPS.inc()
+        polling_thread = threading.Thread(target=poll_and_track, daemon=True)
         polling_thread.start()
         logger.info(f"POLLING: Started background polling thread for invoice {invoice_id}")
 
-# Initialize handlers instance
-ussd_handlers = USSDHandlers()
\ No newline at end of file
+# Initialize handlers instance (the MeTTa space is loaded on first use)
+ussd_handlers = USSDHandlers()
+# (Balance $user) in the InsufficientFunds rule
+rules.register('Balance', ussd_handlers.get_user_balance)
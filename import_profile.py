@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Import-time profiling report
+Measures how long each application module takes to import in a fresh interpreter
+
+Usage:
+    python import_profile.py                    # Profile the default module set
+    python import_profile.py app lightning      # Profile specific modules
+    python import_profile.py --top 20 --json    # Machine-readable output
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from typing import Dict, Any, List
+
+DEFAULT_MODULES = [
+    'config',
+    'database',
+    'user_helpers',
+    'transaction_helpers',
+    'lightning',
+    'handlers',
+    'ai_processor',
+    'app',
+    'bitcoin_purchase_summary',
+]
+
+def profile_module(module: str, top: int = 10) -> Dict[str, Any]:
+    """
+    Import a module in a fresh interpreter with -X importtime.
+
+    Args:
+        module: Module name to import
+        top: Number of slowest imports to report
+
+    Returns:
+        Dictionary with wall time, total import time and slowest imports
+    """
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True,
+        text=True,
+        cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+    wall_ms = (time.perf_counter() - start) * 1000
+
+    imports = []
+    for line in result.stderr.splitlines():
+        # Format: "import time:   self [us] |   cumulative | imported package"
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        try:
+            _, timing = line.split(':', 1)
+            self_us, cumulative_us, name = timing.split('|', 2)
+            imports.append({
+                'module': name.strip(),
+                'depth': (len(name) - len(name.lstrip())) // 2,
+                'self_ms': int(self_us) / 1000,
+                'cumulative_ms': int(cumulative_us) / 1000
+            })
+        except ValueError:
+            continue
+
+    root = next((imp for imp in imports if imp['module'] == module), None)
+    slowest = sorted(imports, key=lambda imp: imp['self_ms'], reverse=True)[:top]
+
+    error = None
+    if result.returncode != 0:
+        error = result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "import failed"
+
+    return {
+        'module': module,
+        'ok': result.returncode == 0,
+        'error': error,
+        'wall_ms': round(wall_ms, 1),
+        'import_ms': round(root['cumulative_ms'], 1) if root else None,
+        'modules_loaded': len(imports),
+        'slowest': slowest
+    }
+
+def print_report(reports: List[Dict[str, Any]], top: int):
+    """Print a human-readable import profile report"""
+    print("=" * 60)
+    print("Import-time profile")
+    print("=" * 60)
+    print(f"{'module':<28}{'import ms':>12}{'wall ms':>10}{'loaded':>10}")
+    print("-" * 60)
+    for report in reports:
+        import_ms = f"{report['import_ms']:.1f}" if report['import_ms'] is not None else "-"
+        print(f"{report['module']:<28}{import_ms:>12}{report['wall_ms']:>10.1f}{report['modules_loaded']:>10}")
+        if not report['ok']:
+            print(f"    ✗ {report['error']}")
+
+    for report in reports:
+        if not report['slowest']:
+            continue
+        print()
+        print(f"Slowest imports under {report['module']} (self time):")
+        for imp in report['slowest'][:top]:
+            print(f"  {imp['self_ms']:8.1f} ms  {imp['module']}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Profile application import time")
+    parser.add_argument('modules', nargs='*', default=DEFAULT_MODULES, help="Modules to import")
+    parser.add_argument('--top', type=int, default=10, help="Slowest imports to list per module")
+    parser.add_argument('--json', action='store_true', help="Print JSON instead of a table")
+    args = parser.parse_args()
+
+    reports = [profile_module(module, args.top) for module in args.modules]
+
+    if args.json:
+        print(json.dumps(reports, indent=2))
+    else:
+        print_report(reports, args.top)
+
+if __name__ == "__main__":
+    main()
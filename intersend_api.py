@@ -8,8 +8,15 @@ import os
 from typing import Dict, Any, Optional
 import logging
 
+from circuit_breaker import dependencies
+from config import Config
+from tracing import TracedHTTP
+
 logger = logging.getLogger(__name__)
 
+# Outbound calls to Intersend, traced per request
+http = TracedHTTP('intersend')
+
 class IntersendAPIError(Exception):
     """Custom exception for Intersend API errors"""
     pass
@@ -47,9 +54,9 @@ class IntersendClient:
         
         try:
             if method.upper() == 'POST':
-                response = requests.post(url, json=data, headers=headers)
+                response = http.post(url, json=data, headers=headers)
             else:
-                response = requests.get(url, headers=headers)
+                response = http.get(url, headers=headers)
                 
             response.raise_for_status()
             return response.json()
@@ -195,4 +202,14 @@ def create_intersend_client() -> IntersendClient:
         token=os.getenv('INTERSEND_SECRET_KEY'),
         publishable_key=os.getenv('INTERSEND_PUBLISHABLE_KEY'),
         test=os.getenv('INTERSEND_TEST_MODE', 'true').lower() == 'true'
-    )
\ No newline at end of file
+    )
+
+def _intersend_health() -> Optional[bool]:
+    """Background health probe; skipped until Intersend keys are configured"""
+    if not os.getenv('INTERSEND_SECRET_KEY') or not os.getenv('INTERSEND_PUBLISHABLE_KEY'):
+        return None
+    # There is no health endpoint: any answer below 500 from the API host means it is reachable
+    response = http.get(create_intersend_client().base_url, timeout=Config.DEPENDENCY_HEALTH_TIMEOUT)
+    return response.status_code < 500
+
+dependencies.register('intersend', health_check=_intersend_health)
@@ -5,6 +5,7 @@ Provides high-level payment operations for the USSD application
 import logging
 from typing import Dict, Any, Optional, Tuple
 from intersend_api import create_intersend_client, IntersendAPIError
+from phone_numbers import to_msisdn
 import threading
 import time
 
@@ -160,19 +161,7 @@ class IntersendPaymentHandler:
         Returns:
             Formatted phone number
         """
-        # Remove any spaces, dashes, or special characters
-        cleaned = ''.join(filter(str.isdigit, phone_number))
-        
-        # Handle different input formats
-        if cleaned.startswith('254'):
-            return cleaned
-        elif cleaned.startswith('0'):
-            return '254' + cleaned[1:]
-        elif len(cleaned) == 9:
-            return '254' + cleaned
-        else:
-            # Return as-is and let API handle validation
-            return cleaned
+        return to_msisdn(phone_number)
 
 
 def create_payment_handler() -> IntersendPaymentHandler:
@@ -1,12 +1,13 @@
 from sqlalchemy.orm import Session
 from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy import insert
 from models import Invoice, User, Transaction, InvoiceStatus, TransactionStatus, TransactionType
-from database import db_manager
+from database import db_manager, replica_read
 from user_helpers import UserManager
 from transaction_helpers import TransactionManager
 import logging
 from datetime import datetime, timedelta
-from typing import Optional, List
+from typing import Optional, List, Dict, Any
 import hashlib
 import secrets
 
@@ -186,6 +187,151 @@ class InvoiceManager:
             logger.error(f"Error marking invoice as paid: {e}")
             return False
     
+    @staticmethod
+    def mark_invoices_paid(payment_hashes: List[str],
+                           paid_amounts: Dict[str, int] = None) -> Dict[str, Dict[str, Any]]:
+        """
+        Mark a batch of invoices as paid and credit their users in one commit.
+        
+        Invoices are locked before users, each in ascending ID order, matching
+        the lock order of mark_invoice_paid so batches and single settlements
+        cannot deadlock.
+        
+        Args:
+            payment_hashes: Lightning payment hashes to settle
+            paid_amounts: Optional mapping of payment hash to amount actually paid
+            
+        Returns:
+            Mapping of payment hash to outcome dict with success, error and amount_sats
+        """
+        paid_amounts = paid_amounts or {}
+        outcomes = {
+            payment_hash: {'success': False, 'error': "Invoice not found", 'amount_sats': None}
+            for payment_hash in payment_hashes
+        }
+        if not outcomes:
+            return outcomes
+        
+        try:
+            with db_manager.get_session() as session:
+                invoices = session.query(Invoice).filter(
+                    Invoice.payment_hash.in_(sorted(outcomes))
+                ).order_by(Invoice.id).with_for_update().all()
+                
+                user_ids = sorted({invoice.user_id for invoice in invoices})
+                users = {
+                    user.id: user for user in session.query(User).filter(
+                        User.id.in_(user_ids)
+                    ).order_by(User.id).with_for_update().all()
+                } if user_ids else {}
+                
+                paid_at = datetime.now()
+                settled = []
+                receive_rows = []
+                
+                for invoice in invoices:
+                    outcome = outcomes[invoice.payment_hash]
+                    outcome['amount_sats'] = invoice.amount_sats
+                    
+                    if invoice.status != InvoiceStatus.PENDING.value:
+                        outcome['error'] = f"Invoice already processed: {invoice.status}"
+                        continue
+                    
+                    paid_amount = paid_amounts.get(invoice.payment_hash)
+                    if paid_amount and paid_amount != invoice.amount_sats:
+                        outcome['error'] = f"Payment amount mismatch: {paid_amount} != {invoice.amount_sats}"
+                        continue
+                    
+                    user = users.get(invoice.user_id)
+                    if not user:
+                        outcome['error'] = "User not found"
+                        continue
+                    
+                    invoice.status = InvoiceStatus.PAID.value
+                    invoice.paid_at = paid_at
+                    user.balance_sats += invoice.amount_sats
+                    
+                    receive_rows.append({
+                        'user_id': user.id,
+                        'transaction_type': TransactionType.RECEIVE.value,
+                        'amount_sats': invoice.amount_sats,
+                        'status': TransactionStatus.COMPLETED.value,
+                        'invoice_string': invoice.invoice_string,
+                        'lightning_payment_hash': invoice.payment_hash,
+                        'description': f"Invoice payment received: {invoice.description}"
+                    })
+                    settled.append(invoice.payment_hash)
+                    outcome['success'] = True
+                    outcome['error'] = None
+                
+                if settled:
+                    # Complete the related invoice transactions with one IN-list update
+                    session.query(Transaction).filter(
+                        Transaction.lightning_payment_hash.in_(settled),
+                        Transaction.transaction_type == TransactionType.INVOICE.value
+                    ).update({'status': TransactionStatus.COMPLETED.value}, synchronize_session=False)
+                    
+                    session.execute(insert(Transaction), receive_rows)
+                
+                session.commit()
+            
+            logger.info(f"Settled {len(settled)}/{len(outcomes)} invoices in batch")
+            
+        except SQLAlchemyError as e:
+            logger.error(f"Error marking invoices as paid: {e}")
+            for outcome in outcomes.values():
+                outcome['success'] = False
+                outcome['error'] = "Database error"
+        
+        return outcomes
+    
+    @staticmethod
+    def expire_invoices(payment_hashes: List[str]) -> Dict[str, bool]:
+        """
+        Mark a batch of pending invoices as expired.
+        
+        Args:
+            payment_hashes: Lightning payment hashes to expire
+            
+        Returns:
+            Mapping of payment hash to True if expired, False otherwise
+        """
+        outcomes = {payment_hash: False for payment_hash in payment_hashes}
+        if not outcomes:
+            return outcomes
+        
+        try:
+            with db_manager.get_session() as session:
+                expired_hashes = [
+                    payment_hash for (payment_hash,) in session.query(Invoice.payment_hash).filter(
+                        Invoice.payment_hash.in_(sorted(outcomes)),
+                        Invoice.status == InvoiceStatus.PENDING.value
+                    ).order_by(Invoice.id).with_for_update()
+                ]
+                
+                if expired_hashes:
+                    session.query(Invoice).filter(
+                        Invoice.payment_hash.in_(expired_hashes)
+                    ).update({'status': InvoiceStatus.EXPIRED.value}, synchronize_session=False)
+                    
+                    session.query(Transaction).filter(
+                        Transaction.lightning_payment_hash.in_(expired_hashes),
+                        Transaction.transaction_type == TransactionType.INVOICE.value
+                    ).update({'status': TransactionStatus.EXPIRED.value}, synchronize_session=False)
+                
+                session.commit()
+                
+                for payment_hash in expired_hashes:
+                    outcomes[payment_hash] = True
+            
+            logger.info(f"Expired {len(expired_hashes)}/{len(outcomes)} invoices in batch")
+            
+        except SQLAlchemyError as e:
+            logger.error(f"Error expiring invoice batch: {e}")
+            return {payment_hash: False for payment_hash in payment_hashes}
+        
+        return outcomes
+    
     @staticmethod
     def expire_invoice(payment_hash: str) -> bool:
         """
@@ -271,6 +417,7 @@ class InvoiceManager:
             return False
     
     @staticmethod
+    @replica_read()
     def get_user_invoices(phone_number: str, status: str = None, limit: int = 20) -> List[Invoice]:
         """
         Get user's invoice history.
@@ -374,6 +521,7 @@ class InvoiceManager:
             return 0
     
     @staticmethod
+    @replica_read()
     def get_invoice_stats(phone_number: str = None) -> dict:
         """
         Get invoice statistics.
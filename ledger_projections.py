@@ -0,0 +1,125 @@
+"""
+Projections of the event journal
+MeTTa facts and in-memory ledger indexes rebuilt from journal events
+
+Handlers never add-atom ledger facts directly: they append an event, and
+these projections turn it into MeTTa atoms (Transaction, Invoice,
+PendingMpesa, Balance) and indexes such as pending top-ups by invoice id.
+"""
+import logging
+import threading
+from typing import Any, Dict, List, Optional
+
+from event_journal import (Event, Projection, TRANSACTION_RECORDED, INVOICE_CREATED, MPESA_PENDING,
+                           MPESA_SETTLED, MPESA_FAILED, BALANCE_SET)
+from metta_queries import MettaQueries, BALANCE, TRANSACTION, INVOICE, PENDING_MPESA
+
+logger = logging.getLogger(__name__)
+
+def transaction_fact(data: Dict[str, Any]) -> Dict[str, Any]:
+    return {'sender': data['from'], 'recipient': data['to'], 'amount': data['amount'],
+            'kind': data['kind'], 'timestamp': data['timestamp']}
+
+def invoice_fact(data: Dict[str, Any]) -> Dict[str, Any]:
+    return {'phone': data['phone'], 'invoice_id': data['invoice_id'], 'amount': data['amount'],
+            'timestamp': data['timestamp']}
+
+def pending_fact(data: Dict[str, Any]) -> Dict[str, Any]:
+    return {'phone': data['phone'], 'invoice_id': data['invoice_id'], 'kes_amount': data['kes_amount'],
+            'sats_amount': data['sats_amount'], 'timestamp': data['timestamp']}
+
+class MettaProjection(Projection):
+    """
+    Ledger facts in a MeTTa space.
+
+    Keeps a plain-data mirror of the facts it added, so exact atoms can be
+    removed (remove_atom does not match variables) and the state can be
+    snapshotted without querying the space.
+    """
+    name = 'metta'
+
+    def __init__(self, queries: MettaQueries):
+        self.queries = queries
+        self.transactions: List[Dict[str, Any]] = []
+        self.invoices: List[Dict[str, Any]] = []
+        self.pending: Dict[str, Dict[str, Any]] = {}
+        self.balances: Dict[str, int] = {}
+
+    def apply(self, event: Event):
+        data = event.data
+        if event.type == TRANSACTION_RECORDED:
+            self.transactions.append(data)
+            self.queries.add(TRANSACTION, **transaction_fact(data))
+        elif event.type == INVOICE_CREATED:
+            self.invoices.append(data)
+            self.queries.add(INVOICE, **invoice_fact(data))
+        elif event.type == MPESA_PENDING:
+            self.pending[data['invoice_id']] = data
+            self.queries.add(PENDING_MPESA, **pending_fact(data))
+        elif event.type in (MPESA_SETTLED, MPESA_FAILED):
+            pending = self.pending.pop(data['invoice_id'], None)
+            if pending is not None:
+                self.queries.remove(PENDING_MPESA, **pending_fact(pending))
+            if event.type == MPESA_SETTLED:
+                self.apply(Event(event.seq, event.ts, TRANSACTION_RECORDED, {
+                    'from': 'M-Pesa', 'to': data['phone'], 'amount': data['sats_amount'],
+                    'kind': 'TopUp', 'timestamp': data['settled_at']
+                }))
+        elif event.type == BALANCE_SET:
+            self._set_balance(data['phone'], int(data['balance']))
+
+    def _set_balance(self, phone: str, balance: int):
+        # Removes every Balance fact for the phone, including ones loaded from the knowledge base file
+        self.queries.replace(BALANCE, {'phone': phone}, balance=balance)
+        self.balances[phone] = balance
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            'transactions': list(self.transactions),
+            'invoices': list(self.invoices),
+            'pending': dict(self.pending),
+            'balances': dict(self.balances),
+        }
+
+    def restore(self, state: Dict[str, Any]):
+        for data in state.get('transactions', []):
+            self.apply(Event(0, 0, TRANSACTION_RECORDED, data))
+        for data in state.get('invoices', []):
+            self.apply(Event(0, 0, INVOICE_CREATED, data))
+        for data in state.get('pending', {}).values():
+            self.apply(Event(0, 0, MPESA_PENDING, data))
+        for phone, balance in state.get('balances', {}).items():
+            self._set_balance(phone, balance)
+
+class PendingTopupsProjection(Projection):
+    """M-Pesa top-ups awaiting payment, by invoice id"""
+    name = 'pending_topups'
+
+    def __init__(self):
+        self._pending: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def apply(self, event: Event):
+        if event.type == MPESA_PENDING:
+            with self._lock:
+                self._pending[event.data['invoice_id']] = event.data
+        elif event.type in (MPESA_SETTLED, MPESA_FAILED):
+            with self._lock:
+                self._pending.pop(event.data['invoice_id'], None)
+
+    def get(self, invoice_id: str) -> Optional[Dict[str, Any]]:
+        return self._pending.get(invoice_id)
+
+    def __contains__(self, invoice_id: str) -> bool:
+        return invoice_id in self._pending
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self._pending)
+
+    def restore(self, state: Dict[str, Any]):
+        with self._lock:
+            self._pending = dict(state)
@@ -1,18 +1,24 @@
 """
 Lightning Network API wrapper supporting LND REST/gRPC and LNbits
 """
-import requests
 import json
 import logging
 from typing import Dict, Any, Optional, Tuple
 import base64
 import time
+from sqlalchemy.exc import IntegrityError
+from circuit_breaker import dependencies
+from config import Config
 from database import get_session
-from models import User
+from models import User, Transaction, TransactionType, TransactionStatus
+from tracing import TracedHTTP
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Outbound calls to the Lightning backend, traced per request
+http = TracedHTTP('lightning')
+
 class LightningAPI:
     def __init__(self, api_type: str = "mock", **config):
         self.api_type = api_type
@@ -35,6 +41,22 @@ class LightningAPI:
             return self._btcpay_get_balance(user_id)
         return 0
     
+    def health_check(self) -> Optional[bool]:
+        """Whether the backend answers; None for the mock backend (nothing to reach)"""
+        timeout = Config.DEPENDENCY_HEALTH_TIMEOUT
+        if self.api_type == "lnbits":
+            response = http.get(f"{self.config['lnbits_url']}/api/v1/wallet",
+                                headers={"X-Api-Key": self.config.get("lnbits_admin_key", "")}, timeout=timeout)
+        elif self.api_type == "lnd":
+            response = http.get(f"{self.config['lnd_url']}/v1/getinfo",
+                                headers={"Grpc-Metadata-macaroon": self.config.get("lnd_macaroon", "")},
+                                verify=False if self.config.get("lnd_skip_verify") else True, timeout=timeout)
+        elif self.api_type == "btcpay":
+            response = http.get(f"{self.config.get('btcpay_url', '')}/api/v1/health", timeout=timeout)
+        else:
+            return None
+        return response.status_code == 200
+    
     def create_invoice(self, user_id: str, amount: int, memo: str = "") -> Tuple[bool, Dict[str, Any]]:
         """Create Lightning invoice"""
         if self.api_type == "mock":
@@ -146,6 +168,7 @@ class LightningAPI:
                 session.commit()
         except Exception as e:
             logger.error(f"Database balance update error: {e}")
+            raise
 
     def _update_balance(self, user_id: str, amount_change: int):
         """Update user balance (database-backed)"""
@@ -170,6 +193,44 @@ class LightningAPI:
                 session.commit()
         except Exception as e:
             logger.error(f"Database balance set error: {e}")
+            raise
+
+    def credit_topup(self, user_id: str, amount: int, reference: str) -> Optional[int]:
+        """
+        Credit a top-up to the database balance at most once per payment reference.
+
+        The credit commits together with a completed topup transaction whose
+        mpesa_transaction_id (unique) is the reference, so a retried or concurrent
+        settlement of the same payment finds that row and adds nothing.
+
+        Returns:
+            The new balance, or None if this reference was already credited
+
+        Raises:
+            SQLAlchemyError: If the database write fails
+        """
+        with get_session() as session:
+            if session.query(Transaction.id).filter_by(mpesa_transaction_id=reference).first():
+                return None
+            user = session.query(User).filter_by(phone_number=user_id).first()
+            if user is None:
+                user = User(phone_number=user_id, balance_sats=0)
+                session.add(user)
+            user.balance_sats += amount
+            new_balance = user.balance_sats
+            session.add(Transaction(user=user, transaction_type=TransactionType.TOPUP.value, amount_sats=amount,
+                                    status=TransactionStatus.COMPLETED.value, mpesa_transaction_id=reference,
+                                    description="M-Pesa top-up"))
+            try:
+                session.commit()
+            except IntegrityError:
+                # Another worker committed the same reference first
+                session.rollback()
+                if session.query(Transaction.id).filter_by(mpesa_transaction_id=reference).first():
+                    return None
+                raise
+            logger.info(f"Credited top-up {reference}: {amount} sats to {user_id}")
+            return new_balance
     
     # LNbits API methods
     def _lnbits_get_balance(self, user_id: str) -> int:
@@ -183,7 +244,7 @@ class LightningAPI:
             if not wallet_id:
                 return 0
                 
-            response = requests.get(
+            response = http.get(
                 f"{self.config['lnbits_url']}/api/v1/wallet",
                 headers={**headers, "X-Api-Key": wallet_id}
             )
@@ -207,7 +268,7 @@ class LightningAPI:
                 "amount": amount,
                 "memo": memo
             }
-            response = requests.post(
+            response = http.post(
                 f"{self.config['lnbits_url']}/api/v1/payments",
                 headers=headers,
                 json=data
@@ -230,7 +291,7 @@ class LightningAPI:
                 "out": True,
                 "bolt11": payment_request
             }
-            response = requests.post(
+            response = http.post(
                 f"{self.config['lnbits_url']}/api/v1/payments",
                 headers=headers,
                 json=data
@@ -249,7 +310,7 @@ class LightningAPI:
                 "X-Api-Key": self.config.get("lnbits_admin_key", ""),
                 "Content-Type": "application/json"
             }
-            response = requests.get(
+            response = http.get(
                 f"{self.config['lnbits_url']}/api/v1/payments/{invoice_id}",
                 headers=headers
             )
@@ -267,7 +328,7 @@ class LightningAPI:
             headers = {
                 "Grpc-Metadata-macaroon": self.config.get("lnd_macaroon", "")
             }
-            response = requests.get(
+            response = http.get(
                 f"{self.config['lnd_url']}/v1/balance/channels",
                 headers=headers,
                 verify=False if self.config.get("lnd_skip_verify") else True
@@ -292,7 +353,7 @@ class LightningAPI:
                 "memo": memo,
                 "expiry": "3600"
             }
-            response = requests.post(
+            response = http.post(
                 f"{self.config['lnd_url']}/v1/invoices",
                 headers=headers,
                 json=data,
@@ -315,7 +376,7 @@ class LightningAPI:
             data = {
                 "payment_request": payment_request
             }
-            response = requests.post(
+            response = http.post(
                 f"{self.config['lnd_url']}/v1/channels/transactions",
                 headers=headers,
                 json=data,
@@ -334,7 +395,7 @@ class LightningAPI:
             headers = {
                 "Grpc-Metadata-macaroon": self.config.get("lnd_macaroon", "")
             }
-            response = requests.get(
+            response = http.get(
                 f"{self.config['lnd_url']}/v1/invoice/{invoice_id}",
                 headers=headers,
                 verify=False if self.config.get("lnd_skip_verify") else True
@@ -393,7 +454,7 @@ class LightningAPI:
                 }
             }
             
-            response = requests.post(
+            response = http.post(
                 f"{btcpay_url}/api/v1/stores/{store_id}/invoices",
                 headers=headers,
                 json=data
@@ -440,7 +501,7 @@ class LightningAPI:
             store_id = self.config.get("btcpay_store_id", "")
             btcpay_url = self.config.get("btcpay_url", "")
             
-            response = requests.get(
+            response = http.get(
                 f"{btcpay_url}/api/v1/stores/{store_id}/invoices/{invoice_id}",
                 headers=headers
             )
@@ -466,4 +527,10 @@ class LightningAPI:
             return False, {"error": str(e)}
 
 # Initialize default Lightning API instance
-lightning_api = LightningAPI("mock")
\ No newline at end of file
+lightning_api = LightningAPI("mock")
+
+def _lightning_health() -> Optional[bool]:
+    """Background health probe of the configured backend"""
+    return lightning_api.health_check()
+
+dependencies.register('lightning', health_check=_lightning_health)
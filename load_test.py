@@ -0,0 +1,541 @@
+#!/usr/bin/env python3
+"""
+USSD load generator
+Replays concurrent Africa's Talking USSD sessions against /ussd and reports latency per state
+
+By default the Flask app is driven in-process against a throwaway SQLite database with
+mock Lightning, Intersend and OpenAI stand-ins, so runs are repeatable and free.
+Use --url to drive a deployed server instead (its real dependencies are used).
+
+Usage:
+    python load_test.py                                   # 20 sessions/s for 30 s, default mix
+    python load_test.py --rate 50 --duration 60           # Higher arrival rate
+    python load_test.py --mix balance=5,topup=3,ai=1      # Custom flow mix
+    python load_test.py --trace at_callbacks.jsonl        # Replay captured AT callbacks
+    python load_test.py --url http://localhost:5000/ussd  # Against a running server
+    python load_test.py --json > baseline.json            # Machine-readable report
+"""
+import argparse
+import contextlib
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from typing import Dict, Any, List, Tuple
+
+SERVICE_CODE = "*384*123#"
+
+# Each flow is the sequence of cumulative AT `text` values a handset sends, paired with
+# the session state that serves the hop. {recipient} is filled with another test user.
+FLOWS = OrderedDict([
+    ('balance', [
+        ('main_menu', ""),
+        ('main_menu', "0"),
+    ]),
+    ('send_btc', [
+        ('main_menu', ""),
+        ('main_menu', "1"),
+        ('send_btc_phone', "1*{recipient}"),
+        ('send_btc_amount', "1*{recipient}*100"),
+    ]),
+    ('receive_btc', [
+        ('main_menu', ""),
+        ('main_menu', "2"),
+        ('receive_btc_amount', "2*500"),
+    ]),
+    ('send_invoice', [
+        ('main_menu', ""),
+        ('main_menu', "3"),
+        ('send_invoice_phone', "3*{recipient}"),
+        ('send_invoice_amount', "3*{recipient}*500"),
+    ]),
+    ('topup', [
+        ('main_menu', ""),
+        ('main_menu', "4"),
+        ('topup_amount', "4*500"),
+    ]),
+    ('withdraw', [
+        ('main_menu', ""),
+        ('main_menu', "5"),
+        ('withdraw_amount', "5*200"),
+        ('withdraw_phone', "5*200*{recipient}"),
+    ]),
+    ('airtime', [
+        ('main_menu', ""),
+        ('main_menu', "6"),
+        ('airtime_amount', "6*50"),
+        ('airtime_phone', "6*50*1"),
+    ]),
+    ('ai', [
+        ('main_menu', ""),
+        ('ai', "what is my balance"),
+    ]),
+])
+
+DEFAULT_MIX = "balance=4,topup=3,send_btc=2,receive_btc=1,airtime=1,withdraw=1,send_invoice=1,ai=1"
+
+# Responses the app returns when a hop fails internally (as opposed to business rejections)
+ERROR_MARKERS = (
+    "Internal error",
+    "Error processing request",
+    "Payment service error",
+    "temporarily unavailable",
+    "DEBUG ERROR",
+)
+
+def parse_mix(mix: str) -> List[Tuple[str, float]]:
+    """Parse 'flow=weight,flow=weight' into a weighted flow list"""
+    weights = []
+    for item in mix.split(','):
+        name, _, weight = item.partition('=')
+        name = name.strip()
+        if name not in FLOWS:
+            raise ValueError(f"Unknown flow '{name}' (choose from {', '.join(FLOWS)})")
+        weights.append((name, float(weight or 1)))
+    return weights
+
+def load_trace(path: str) -> List[Dict[str, Any]]:
+    """
+    Load captured AT callbacks and group them into sessions.
+
+    Each line is a JSON object with sessionId, phoneNumber and text (as posted by
+    Africa's Talking), plus an optional state label. Hops keep file order.
+
+    Returns:
+        List of session scripts ({'flow', 'phone_number', 'hops'})
+    """
+    sessions = OrderedDict()
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            script = sessions.setdefault(record['sessionId'], {
+                'flow': record.get('flow', 'trace'),
+                'phone_number': record['phoneNumber'],
+                'hops': []
+            })
+            state = record.get('state') or f"hop{len(script['hops'])}"
+            script['hops'].append((state, record.get('text', "")))
+    return list(sessions.values())
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(fraction * len(sorted_values) + 0.5)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+class LoadReport:
+    """Thread-safe collector for hop latencies, errors and session outcomes"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.state_errors: Dict[str, int] = defaultdict(int)
+        self.error_kinds: Dict[str, int] = defaultdict(int)
+        self.error_samples: List[str] = []
+        self.flows: Dict[str, Dict[str, int]] = defaultdict(lambda: {'started': 0, 'completed': 0, 'failed': 0})
+        self.end_responses = 0
+        self.con_responses = 0
+        self.started_at = None
+        self.finished_at = None
+
+    def record_hop(self, state: str, elapsed_ms: float, error_kind: str = None, detail: str = ""):
+        with self._lock:
+            self.latencies[state].append(elapsed_ms)
+            if error_kind:
+                self.state_errors[state] += 1
+                self.error_kinds[error_kind] += 1
+                if len(self.error_samples) < 20:
+                    self.error_samples.append(f"{state}: {error_kind}: {detail[:120]}")
+
+    def record_response(self, body: str):
+        with self._lock:
+            if body.startswith("END"):
+                self.end_responses += 1
+            elif body.startswith("CON"):
+                self.con_responses += 1
+
+    def record_session(self, flow: str, ok: bool = None):
+        with self._lock:
+            if ok is None:
+                self.flows[flow]['started'] += 1
+            elif ok:
+                self.flows[flow]['completed'] += 1
+            else:
+                self.flows[flow]['failed'] += 1
+
+    def summary(self) -> Dict[str, Any]:
+        """Aggregate everything recorded into a report dictionary"""
+        with self._lock:
+            elapsed = max((self.finished_at or time.time()) - (self.started_at or time.time()), 1e-9)
+            states = {}
+            all_latencies = []
+            for state, values in sorted(self.latencies.items()):
+                ordered = sorted(values)
+                all_latencies.extend(ordered)
+                states[state] = {
+                    'requests': len(ordered),
+                    'errors': self.state_errors.get(state, 0),
+                    'p50_ms': round(percentile(ordered, 0.50), 2),
+                    'p95_ms': round(percentile(ordered, 0.95), 2),
+                    'p99_ms': round(percentile(ordered, 0.99), 2),
+                    'max_ms': round(ordered[-1], 2) if ordered else 0.0
+                }
+            all_latencies.sort()
+            total_requests = len(all_latencies)
+            total_sessions = sum(flow['started'] for flow in self.flows.values())
+            return {
+                'duration_s': round(elapsed, 2),
+                'requests': total_requests,
+                'sessions': total_sessions,
+                'throughput_rps': round(total_requests / elapsed, 2),
+                'sessions_per_s': round(total_sessions / elapsed, 2),
+                'errors': sum(self.error_kinds.values()),
+                'error_kinds': dict(self.error_kinds),
+                'error_samples': list(self.error_samples),
+                'responses': {'CON': self.con_responses, 'END': self.end_responses},
+                'latency': {
+                    'p50_ms': round(percentile(all_latencies, 0.50), 2),
+                    'p95_ms': round(percentile(all_latencies, 0.95), 2),
+                    'p99_ms': round(percentile(all_latencies, 0.99), 2),
+                    'max_ms': round(all_latencies[-1], 2) if all_latencies else 0.0
+                },
+                'states': states,
+                'flows': {name: dict(counts) for name, counts in sorted(self.flows.items())}
+            }
+
+class InProcessTransport:
+    """Posts USSD callbacks through Flask's test client (one client per worker thread)"""
+
+    def __init__(self, app):
+        self.app = app
+        self._local = threading.local()
+
+    def post(self, form: Dict[str, str]) -> Tuple[int, str]:
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        response = client.post('/ussd', data=form)
+        return response.status_code, response.get_data(as_text=True)
+
+class HttpTransport:
+    """Posts USSD callbacks to a running server (one requests.Session per worker thread)"""
+
+    def __init__(self, url: str, timeout: float = 30):
+        import requests
+        self._requests = requests
+        self.url = url
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def post(self, form: Dict[str, str]) -> Tuple[int, str]:
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = self._requests.Session()
+        response = session.post(self.url, data=form, timeout=self.timeout)
+        return response.status_code, response.text
+
+class FakeSMSClient:
+    """Stand-in for the Africa's Talking client that accepts every recipient"""
+
+    def send_bulk_sms(self, phone_numbers: List[str], message: str) -> Dict[str, Any]:
+        return {'SMSMessageData': {'Recipients': [
+            {'number': phone_number, 'statusCode': 101, 'status': 'Success', 'messageId': f"LOAD-{uuid.uuid4().hex[:10]}"}
+            for phone_number in phone_numbers]}}
+
+class FakeOpenAIClient:
+    """Stand-in for openai.OpenAI that answers every prompt with a check_balance call"""
+
+    def __init__(self, latency_ms: float):
+        self.latency_ms = latency_ms
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def _create(self, **kwargs):
+        time.sleep(self.latency_ms / 1000)
+        if kwargs.get('tools'):
+            tool_call = SimpleNamespace(function=SimpleNamespace(name='check_balance', arguments='{}'))
+            message = SimpleNamespace(content=None, tool_calls=[tool_call])
+        else:
+            message = SimpleNamespace(content="Your balance is shown above.", tool_calls=None)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+def _delayed(func, latency_ms: float):
+    """Wrap a callable so it sleeps for latency_ms before running"""
+    def wrapper(*args, **kwargs):
+        time.sleep(latency_ms / 1000)
+        return func(*args, **kwargs)
+    return wrapper
+
+def install_stand_ins(args, phone_numbers: List[str]):
+    """
+    Point the in-process app at a scratch database, event journal and SMS
+    outbox, and mock external services.
+
+    Args:
+        args: Parsed command-line arguments (latencies, database URL, seed balance)
+        phone_numbers: Test users to create with a starting balance
+
+    Returns:
+        The Flask app object
+    """
+    from database import DatabaseManager, set_db_manager, init_database
+
+    from event_journal import journal
+    from sms_queue import sms_queue
+
+    scratch_dir = tempfile.mkdtemp(prefix="ussd_load_")
+    database_url = args.database_url or f"sqlite:///{os.path.join(scratch_dir, 'load_test.db')}"
+    set_db_manager(DatabaseManager(database_url, workers=args.concurrency))
+    init_database()
+
+    # Ledger events and queued SMS stay out of the real journal and outbox
+    journal.directory = os.path.join(scratch_dir, 'journal')
+    sms_queue.path = os.path.join(scratch_dir, 'sms_queue.db')
+    sms_queue._client = FakeSMSClient()
+
+    import handlers
+    import app as ussd_app
+    from lightning import lightning_api
+
+    # Lightning: the mock backend is already database-only; add network-like latency
+    for name in ('create_invoice', 'pay_invoice', 'check_invoice'):
+        setattr(lightning_api, name, _delayed(getattr(lightning_api, name), args.lightning_ms))
+
+    # Intersend: STK push is accepted immediately and the first status poll completes it
+    def fake_stk_push(phone_number: str, amount: float, reference: str = None):
+        time.sleep(args.intersend_ms / 1000)
+        return True, {'invoice': {'invoice_id': f"LOAD-{uuid.uuid4().hex[:10]}", 'state': 'PENDING',
+                                  'value': amount, 'account': phone_number, 'api_ref': reference}}
+
+    def fake_check_status(invoice_id: str):
+        time.sleep(args.intersend_ms / 1000)
+        return {'invoice': {'invoice_id': invoice_id, 'state': 'COMPLETE', 'currency': 'KES'}}
+
+    handlers.initiate_mpesa_stk_push = fake_stk_push
+    handlers.check_mpesa_status = fake_check_status
+
+    # OpenAI: canned tool call with configurable latency
+    ussd_app.ai_enhanced_handler.ai_processor._client = FakeOpenAIClient(args.openai_ms)
+
+    for phone_number in phone_numbers:
+        lightning_api.set_balance(phone_number, args.seed_balance)
+
+    return ussd_app.app
+
+class LoadGenerator:
+    """Open-loop session generator: sessions arrive at a Poisson rate regardless of latency"""
+
+    def __init__(self, transport, report: LoadReport, phone_numbers: List[str],
+                 think_ms: float = 0, seed: int = None):
+        self.transport = transport
+        self.report = report
+        self.phone_numbers = phone_numbers
+        self.think_ms = think_ms
+        self.random = random.Random(seed)
+        self._random_lock = threading.Lock()
+
+    def _pick_recipient(self, phone_number: str) -> str:
+        with self._random_lock:
+            recipient = self.random.choice(self.phone_numbers)
+        if recipient == phone_number and len(self.phone_numbers) > 1:
+            recipient = self.phone_numbers[(self.phone_numbers.index(recipient) + 1) % len(self.phone_numbers)]
+        # Handsets type local format; the app normalizes it
+        return "0" + recipient[-9:]
+
+    def run_session(self, script: Dict[str, Any]):
+        """Send every hop of one session in order, stopping at END or on error"""
+        flow = script['flow']
+        phone_number = script['phone_number']
+        session_id = script.get('session_id') or f"ATUid_load_{uuid.uuid4().hex}"
+        recipient = self._pick_recipient(phone_number) if self.phone_numbers else ""
+        self.report.record_session(flow)
+
+        for index, (state, text) in enumerate(script['hops']):
+            if index and self.think_ms:
+                time.sleep(self.think_ms / 1000)
+            form = {
+                'sessionId': session_id,
+                'serviceCode': SERVICE_CODE,
+                'phoneNumber': phone_number,
+                'text': text.replace('{recipient}', recipient)
+            }
+            start = time.perf_counter()
+            try:
+                status_code, body = self.transport.post(form)
+            except Exception as e:
+                self.report.record_hop(state, (time.perf_counter() - start) * 1000, 'exception', str(e))
+                self.report.record_session(flow, ok=False)
+                return
+            elapsed_ms = (time.perf_counter() - start) * 1000
+
+            error_kind = None
+            if status_code != 200:
+                error_kind = f"http_{status_code}"
+            elif not body.startswith(("CON", "END")):
+                error_kind = 'bad_response'
+            elif any(marker in body for marker in ERROR_MARKERS):
+                error_kind = 'app_error'
+            self.report.record_hop(state, elapsed_ms, error_kind, body)
+            self.report.record_response(body)
+
+            if error_kind:
+                self.report.record_session(flow, ok=False)
+                return
+            if body.startswith("END"):
+                break
+
+        self.report.record_session(flow, ok=True)
+
+    def generate(self, mix: List[Tuple[str, float]], rate: float, duration: float,
+                 concurrency: int, max_sessions: int = None):
+        """
+        Start sessions at `rate` per second for `duration` seconds.
+
+        Args:
+            mix: Weighted flow list from parse_mix
+            rate: Mean session arrival rate (sessions/second)
+            duration: How long to keep starting sessions
+            concurrency: Worker threads (caps in-flight sessions)
+            max_sessions: Optional cap on the number of sessions started
+        """
+        names = [name for name, _ in mix]
+        weights = [weight for _, weight in mix]
+        self.report.started_at = time.time()
+        deadline = time.perf_counter() + duration
+        next_arrival = time.perf_counter()
+        started = 0
+
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="ussd-load") as pool:
+            while time.perf_counter() < deadline and (max_sessions is None or started < max_sessions):
+                delay = next_arrival - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                with self._random_lock:
+                    flow = self.random.choices(names, weights)[0]
+                    phone_number = self.random.choice(self.phone_numbers)
+                    next_arrival += self.random.expovariate(rate)
+                pool.submit(self.run_session, {'flow': flow, 'phone_number': phone_number, 'hops': FLOWS[flow]})
+                started += 1
+        self.report.finished_at = time.time()
+
+    def replay(self, scripts: List[Dict[str, Any]], rate: float, concurrency: int):
+        """Replay recorded session scripts at `rate` sessions per second"""
+        self.report.started_at = time.time()
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="ussd-load") as pool:
+            next_arrival = time.perf_counter()
+            for script in scripts:
+                delay = next_arrival - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                pool.submit(self.run_session, script)
+                with self._random_lock:
+                    next_arrival += self.random.expovariate(rate)
+        self.report.finished_at = time.time()
+
+def print_report(summary: Dict[str, Any]):
+    """Print a human-readable load test report"""
+    print("=" * 78)
+    print("USSD load test")
+    print("=" * 78)
+    print(f"Duration:    {summary['duration_s']} s")
+    print(f"Sessions:    {summary['sessions']} ({summary['sessions_per_s']}/s)")
+    print(f"Requests:    {summary['requests']} ({summary['throughput_rps']} req/s)")
+    print(f"Responses:   CON {summary['responses']['CON']}, END {summary['responses']['END']}")
+    print(f"Errors:      {summary['errors']} {summary['error_kinds'] or ''}")
+    latency = summary['latency']
+    print(f"Latency:     p50 {latency['p50_ms']} ms, p95 {latency['p95_ms']} ms, "
+          f"p99 {latency['p99_ms']} ms, max {latency['max_ms']} ms")
+    print()
+    print(f"{'state':<22}{'requests':>10}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    print("-" * 78)
+    for state, stats in summary['states'].items():
+        print(f"{state:<22}{stats['requests']:>10}{stats['errors']:>8}{stats['p50_ms']:>10.1f}"
+              f"{stats['p95_ms']:>10.1f}{stats['p99_ms']:>10.1f}{stats['max_ms']:>10.1f}")
+    print()
+    print(f"{'flow':<22}{'started':>10}{'completed':>12}{'failed':>8}")
+    print("-" * 52)
+    for flow, counts in summary['flows'].items():
+        print(f"{flow:<22}{counts['started']:>10}{counts['completed']:>12}{counts['failed']:>8}")
+    if summary['error_samples']:
+        print()
+        print("Sample errors:")
+        for sample in summary['error_samples']:
+            print(f"  ✗ {sample}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay concurrent USSD sessions against /ussd")
+    parser.add_argument('--url', help="Target a running server instead of the in-process app")
+    parser.add_argument('--rate', type=float, default=20, help="Session arrival rate per second")
+    parser.add_argument('--duration', type=float, default=30, help="Seconds to keep starting sessions")
+    parser.add_argument('--sessions', type=int, help="Stop after this many sessions")
+    parser.add_argument('--concurrency', type=int, default=32, help="Maximum in-flight sessions")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help="Flow weights, e.g. balance=4,topup=3")
+    parser.add_argument('--trace', help="JSON-lines file of captured AT callbacks to replay")
+    parser.add_argument('--users', type=int, default=200, help="Number of distinct test phone numbers")
+    parser.add_argument('--think-ms', type=float, default=0, help="Pause between hops of a session")
+    parser.add_argument('--seed', type=int, help="Random seed for repeatable runs")
+    parser.add_argument('--database-url', help="In-process only: database to use (default scratch SQLite)")
+    parser.add_argument('--seed-balance', type=int, default=100000, help="In-process only: starting sats per user")
+    parser.add_argument('--lightning-ms', type=float, default=5, help="Mock Lightning latency")
+    parser.add_argument('--intersend-ms', type=float, default=150, help="Mock Intersend latency")
+    parser.add_argument('--openai-ms', type=float, default=400, help="Mock OpenAI latency")
+    parser.add_argument('--verbose', action='store_true', help="Keep application logging and output")
+    parser.add_argument('--json', action='store_true', help="Print JSON instead of a table")
+    args = parser.parse_args()
+
+    phone_numbers = [f"+2547{10000000 + i:08d}" for i in range(args.users)]
+    mix = parse_mix(args.mix)
+    scripts = load_trace(args.trace) if args.trace else None
+
+    if args.url:
+        transport = HttpTransport(args.url)
+    else:
+        if scripts:
+            phone_numbers = sorted(set(phone_numbers) | {script['phone_number'] for script in scripts})
+        transport = InProcessTransport(install_stand_ins(args, phone_numbers))
+
+    report = LoadReport()
+    generator = LoadGenerator(transport, report, phone_numbers, args.think_ms, args.seed)
+
+    # The app logs every hop at DEBUG to stdout; keep that out of the measurement
+    quiet = not args.verbose and not args.url
+    if quiet:
+        import logging
+        logging.disable(logging.CRITICAL)
+    with open(os.devnull, 'w') as devnull, \
+            (contextlib.redirect_stdout(devnull) if quiet else contextlib.nullcontext()):
+        if scripts:
+            generator.replay(scripts, args.rate, args.concurrency)
+        else:
+            generator.generate(mix, args.rate, args.duration, args.concurrency, args.sessions)
+
+    summary = report.summary()
+    summary['config'] = {
+        'target': args.url or 'in-process',
+        'rate': args.rate,
+        'concurrency': args.concurrency,
+        'mix': args.trace or args.mix,
+        'mock_latency_ms': None if args.url else {
+            'lightning': args.lightning_ms, 'intersend': args.intersend_ms, 'openai': args.openai_ms
+        }
+    }
+
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print_report(summary)
+
+    sys.exit(1 if summary['errors'] else 0)
+
+if __name__ == "__main__":
+    main()
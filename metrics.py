@@ -0,0 +1,461 @@
+"""
+Prometheus metrics for USSD throughput, flows and dependency latency
+Recorded into per-thread shards without locks and exposed in text format on /metrics
+
+Each thread increments its own dictionaries, so the hot path never contends on a lock;
+shards are merged when /metrics is scraped. Under gunicorn, set METRICS_MULTIPROC_DIR
+and every worker periodically writes its merged totals to metrics_<pid>.json there;
+whichever worker serves the scrape sums the files of all workers.
+"""
+import atexit
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, Any, List, Tuple, Callable, Optional
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# USSD states grouped into the menu flow they belong to
+STATE_FLOWS = {
+    'send_btc_phone': 'send_btc',
+    'send_btc_amount': 'send_btc',
+    'receive_btc_amount': 'receive_btc',
+    'send_invoice_phone': 'send_invoice',
+    'send_invoice_amount': 'send_invoice',
+    'topup_amount': 'topup',
+    'withdraw_amount': 'withdraw',
+    'withdraw_phone': 'withdraw',
+    'airtime_amount': 'airtime',
+    'airtime_phone': 'airtime',
+}
+
+def flow_for_state(state: str) -> Optional[str]:
+    """Menu flow a USSD state belongs to (None for the main menu)"""
+    return STATE_FLOWS.get(state)
+
+class _Shard:
+    """One thread's private counters; only its owner thread writes to it"""
+
+    __slots__ = ('thread', 'values', 'histograms')
+
+    def __init__(self, thread: threading.Thread):
+        self.thread = thread
+        self.values: Dict[Tuple[str, Tuple], float] = {}
+        self.histograms: Dict[Tuple[str, Tuple], List[float]] = {}
+
+class MetricsRegistry:
+    """
+    Metric definitions plus per-thread shards and multi-process export.
+
+    Usage:
+        HOPS = registry.counter('ussd_hops_total', 'USSD hops by state', ('state',))
+        HOPS.inc('main_menu')
+    """
+
+    def __init__(self, multiproc_dir: str = None, flush_interval: float = 5.0):
+        self.multiproc_dir = multiproc_dir
+        self.flush_interval = flush_interval
+        self.definitions: Dict[str, Dict[str, Any]] = {}
+        self.collectors: List[Callable[[], List[Tuple[str, Tuple, float]]]] = []
+
+        self._local = threading.local()
+        self._shards: List[_Shard] = []
+        self._retired = _Shard(None)
+        self._lock = threading.Lock()
+        self._flusher = None
+        self._pid = os.getpid()
+
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    # -- definitions --------------------------------------------------------
+
+    def _define(self, kind: str, name: str, help_text: str, labelnames: Tuple[str, ...], **extra):
+        self.definitions[name] = {'type': kind, 'help': help_text, 'labelnames': tuple(labelnames), **extra}
+
+    def counter(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()) -> 'Counter':
+        self._define('counter', name, help_text, labelnames)
+        return Counter(self, name)
+
+    def gauge(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()) -> 'Gauge':
+        self._define('gauge', name, help_text, labelnames)
+        return Gauge(self, name)
+
+    def histogram(self, name: str, help_text: str, labelnames: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> 'Histogram':
+        self._define('histogram', name, help_text, labelnames, buckets=tuple(buckets))
+        return Histogram(self, name, tuple(buckets))
+
+    def register_collector(self, collector: Callable[[], List[Tuple[str, Tuple, float]]]):
+        """Register a callback returning (name, labels, value) samples computed at scrape time"""
+        self.collectors.append(collector)
+
+    # -- shards ---------------------------------------------------------------
+
+    def shard(self) -> _Shard:
+        """This thread's shard (created and registered on first use)"""
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = _Shard(threading.current_thread())
+            with self._lock:
+                # Fold finished threads here too, so short-lived threads cannot pile up between scrapes
+                self._retire_dead_shards()
+                self._shards.append(shard)
+            self._local.shard = shard
+            if self.multiproc_dir:
+                self._ensure_flusher()
+            return shard
+
+    def _after_fork(self):
+        """Children start empty so pre-fork samples are not counted once per worker"""
+        self._local = threading.local()
+        self._shards = []
+        self._retired = _Shard(None)
+        self._lock = threading.Lock()
+        self._flusher = None
+        self._pid = os.getpid()
+
+    def _merge_shards(self) -> Tuple[Dict, Dict]:
+        """Sum every shard; shards of finished threads are folded into a retired shard"""
+        values: Dict[Tuple[str, Tuple], float] = {}
+        histograms: Dict[Tuple[str, Tuple], List[float]] = {}
+
+        with self._lock:
+            self._retire_dead_shards()
+            # The retired shard is only written under the lock
+            _add_into(values, histograms, self._retired.values, self._retired.histograms)
+            live = list(self._shards)
+
+        for shard in live:
+            # dict.copy() is atomic under the GIL, so owners can keep writing
+            _add_into(values, histograms, shard.values.copy(),
+                      {key: list(counts) for key, counts in shard.histograms.copy().items()})
+        return values, histograms
+
+    def _retire_dead_shards(self):
+        """Fold shards of finished threads into the retired shard (caller holds the lock)"""
+        live = []
+        for shard in self._shards:
+            if shard.thread.is_alive():
+                live.append(shard)
+            else:
+                _add_into(self._retired.values, self._retired.histograms, shard.values.copy(),
+                          shard.histograms.copy())
+        self._shards = live
+
+    def _local_samples(self) -> Dict[str, Any]:
+        """This process's samples, including collector callbacks"""
+        values, histograms = self._merge_shards()
+        gauges = {}
+        for collector in self.collectors:
+            try:
+                for name, labels, value in collector():
+                    kind = self.definitions.get(name, {}).get('type')
+                    if kind == 'gauge':
+                        gauges[(name, labels)] = value
+                    else:
+                        values[(name, labels)] = value
+            except Exception as e:
+                logger.warning(f"Metrics collector failed: {e}")
+        # Gauges that are inc/dec'd live in the sharded values
+        for key in list(values):
+            if self.definitions.get(key[0], {}).get('type') == 'gauge':
+                gauges[key] = gauges.get(key, 0) + values.pop(key)
+        return {'pid': self._pid, 'written_at': time.time(), 'values': values,
+                'histograms': histograms, 'gauges': gauges}
+
+    # -- multi-process --------------------------------------------------------
+
+    def _process_file(self, pid: int) -> str:
+        return os.path.join(self.multiproc_dir, f"metrics_{pid}.json")
+
+    def write_process_file(self, samples: Dict[str, Any] = None):
+        """Atomically write this process's totals for other workers to aggregate"""
+        if not self.multiproc_dir:
+            return
+        samples = samples or self._local_samples()
+        payload = {
+            'pid': samples['pid'],
+            'written_at': samples['written_at'],
+            'values': [[name, list(labels), value] for (name, labels), value in samples['values'].items()],
+            'histograms': [[name, list(labels), counts] for (name, labels), counts in samples['histograms'].items()],
+            'gauges': [[name, list(labels), value] for (name, labels), value in samples['gauges'].items()],
+        }
+        try:
+            os.makedirs(self.multiproc_dir, exist_ok=True)
+            path = self._process_file(samples['pid'])
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(payload, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Could not write metrics file: {e}")
+
+    def _read_other_processes(self) -> List[Dict[str, Any]]:
+        samples = []
+        try:
+            filenames = os.listdir(self.multiproc_dir)
+        except OSError:
+            return samples
+        for filename in filenames:
+            if not (filename.startswith('metrics_') and filename.endswith('.json')):
+                continue
+            try:
+                with open(os.path.join(self.multiproc_dir, filename)) as f:
+                    payload = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if payload.get('pid') == self._pid:
+                continue
+            samples.append({
+                'pid': payload['pid'],
+                'alive': _pid_alive(payload['pid']),
+                'values': {(name, tuple(labels)): value for name, labels, value in payload['values']},
+                'histograms': {(name, tuple(labels)): counts for name, labels, counts in payload['histograms']},
+                'gauges': {(name, tuple(labels)): value for name, labels, value in payload['gauges']},
+            })
+        return samples
+
+    def _ensure_flusher(self):
+        if self._flusher is not None:
+            return
+        with self._lock:
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._run_flusher, name="metrics-flusher", daemon=True)
+                self._flusher.start()
+
+    def _run_flusher(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.write_process_file()
+
+    # -- exposition -----------------------------------------------------------
+
+    def collect(self) -> Dict[str, Any]:
+        """Merged samples for this process and, in multi-process mode, all other workers"""
+        local = self._local_samples()
+        values, histograms, gauges = dict(local['values']), dict(local['histograms']), dict(local['gauges'])
+
+        if self.multiproc_dir:
+            self.write_process_file(local)
+            for other in self._read_other_processes():
+                _add_into(values, histograms, other['values'], other['histograms'])
+                # Counters of exited workers still count; their gauges do not
+                if other['alive']:
+                    for key, value in other['gauges'].items():
+                        gauges[key] = gauges.get(key, 0) + value
+
+        return {'values': values, 'histograms': histograms, 'gauges': gauges}
+
+    def render(self) -> str:
+        """Prometheus text exposition format (version 0.0.4)"""
+        collected = self.collect()
+        by_name: Dict[str, List] = {}
+        for (name, labels), value in collected['values'].items():
+            by_name.setdefault(name, []).append((labels, value))
+        for (name, labels), value in collected['gauges'].items():
+            by_name.setdefault(name, []).append((labels, value))
+        for (name, labels), counts in collected['histograms'].items():
+            by_name.setdefault(name, []).append((labels, counts))
+
+        lines = []
+        for name, definition in self.definitions.items():
+            lines.append(f"# HELP {name} {definition['help']}")
+            lines.append(f"# TYPE {name} {definition['type']}")
+            labelnames = definition['labelnames']
+            for labels, sample in sorted(by_name.get(name, []), key=lambda item: item[0]):
+                if definition['type'] == 'histogram':
+                    buckets = definition['buckets']
+                    cumulative = 0
+                    for bound, count in zip(buckets + (float('inf'),), sample):
+                        cumulative += count
+                        le = '+Inf' if bound == float('inf') else _format_value(bound)
+                        lines.append(f"{name}_bucket{_format_labels(labelnames, labels, ('le', le))} {_format_value(cumulative)}")
+                    lines.append(f"{name}_sum{_format_labels(labelnames, labels)} {_format_value(sample[-2])}")
+                    lines.append(f"{name}_count{_format_labels(labelnames, labels)} {_format_value(sample[-1])}")
+                else:
+                    lines.append(f"{name}{_format_labels(labelnames, labels)} {_format_value(sample)}")
+        return "\n".join(lines) + "\n"
+
+class Counter:
+    __slots__ = ('registry', 'name')
+
+    def __init__(self, registry: MetricsRegistry, name: str):
+        self.registry = registry
+        self.name = name
+
+    def inc(self, *labels, amount: float = 1):
+        values = self.registry.shard().values
+        key = (self.name, labels)
+        values[key] = values.get(key, 0) + amount
+
+class Gauge(Counter):
+    """Up/down gauge whose per-thread deltas are summed at scrape time"""
+
+    __slots__ = ()
+
+    def dec(self, *labels, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+class Histogram:
+    __slots__ = ('registry', 'name', 'buckets')
+
+    def __init__(self, registry: MetricsRegistry, name: str, buckets: Tuple[float, ...]):
+        self.registry = registry
+        self.name = name
+        self.buckets = buckets
+
+    def observe(self, value: float, *labels):
+        histograms = self.registry.shard().histograms
+        key = (self.name, labels)
+        counts = histograms.get(key)
+        if counts is None:
+            # One slot per bucket plus +Inf, then sum and count
+            counts = histograms[key] = [0] * (len(self.buckets) + 3)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-2] += value
+        counts[-1] += 1
+
+def _add_into(values: Dict, histograms: Dict, other_values: Dict, other_histograms: Dict):
+    for key, value in other_values.items():
+        values[key] = values.get(key, 0) + value
+    for key, counts in other_histograms.items():
+        existing = histograms.get(key)
+        if existing is None:
+            histograms[key] = list(counts)
+        else:
+            for index, count in enumerate(counts):
+                existing[index] += count
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_labels(labelnames: Tuple[str, ...], labels: Tuple, extra: Tuple[str, str] = None) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, labels)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value: float) -> str:
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+# Global registry
+registry = MetricsRegistry(
+    multiproc_dir=Config.METRICS_MULTIPROC_DIR,
+    flush_interval=Config.METRICS_FLUSH_INTERVAL
+)
+if registry.multiproc_dir:
+    atexit.register(registry.write_process_file)
+
+# USSD traffic
+HOPS = registry.counter('ussd_hops_total', 'USSD hops handled, by session state at the start of the hop', ('state',))
+HOP_DURATION = registry.histogram('ussd_hop_duration_seconds', 'Time to answer a USSD hop, by session state', ('state',))
+RESPONSES = registry.counter('ussd_responses_total', 'USSD responses by type (CON continues, END closes)', ('type',))
+FLOWS_STARTED = registry.counter('ussd_flows_started_total', 'Menu flows entered from the main menu', ('flow',))
+FLOWS_COMPLETED = registry.counter('ussd_flows_completed_total', 'Menu flows that reached an END response', ('flow',))
+FLOWS_ABANDONED = registry.counter('ussd_flows_abandoned_total', 'Menu flows left by going back or timing out', ('flow',))
+COALESCED_HOPS = registry.counter('ussd_coalesced_hops_total',
+                                 'Gateway retries answered from an in-flight or recent execution', ('outcome',))
+
+# Dependencies
+OUTBOUND_DURATION = registry.histogram('ussd_outbound_request_duration_seconds',
+                                       'Latency of outbound calls, by dependency', ('dependency',))
+OUTBOUND_ERRORS = registry.counter('ussd_outbound_request_errors_total',
+                                   'Outbound calls that raised or returned 5xx, by dependency', ('dependency',))
+AI_REQUESTS = registry.counter('ussd_ai_requests_total',
+                               'Natural-language inputs by how they were answered '
+                               '(session_context avoids a model call)', ('source',))
+
+# Background work and resources
+PENDING_TOPUPS = registry.gauge('ussd_pending_topups', 'M-Pesa top-ups still being polled')
+ACTIVE_SESSIONS = registry.gauge('ussd_active_sessions', 'USSD sessions held in memory')
+DB_POOL_IN_USE = registry.gauge('ussd_db_pool_connections_in_use', 'Checked-out database connections', ('pool',))
+DB_POOL_CHECKOUTS = registry.counter('ussd_db_pool_checkouts_total', 'Database connection checkouts', ('pool',))
+DB_POOL_TIMEOUTS = registry.counter('ussd_db_pool_timeouts_total', 'Checkouts that timed out on an exhausted pool', ('pool',))
+CIRCUIT_OPEN = registry.gauge('ussd_circuit_open', 'Workers with an open circuit, by dependency', ('dependency',))
+CIRCUIT_TRANSITIONS = registry.counter('ussd_circuit_transitions_total', 'Circuit breaker state changes, by new state',
+                                       ('dependency', 'state'))
+CIRCUIT_REJECTIONS = registry.counter('ussd_circuit_rejections_total',
+                                      'Calls failed fast because the circuit was open', ('dependency',))
+METTA_LOCK_CONTENDED = registry.counter('ussd_metta_lock_contended_total',
+                                       'MeTTa space lock acquisitions that had to wait, by mode', ('mode',))
+METTA_LOCK_WAIT = registry.histogram('ussd_metta_lock_wait_seconds', 'Time spent waiting for a MeTTa space lock',
+                                     ('mode',), buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0))
+METTA_WRITE_BATCH = registry.histogram('ussd_metta_write_batch_size', 'Queued add/remove writes applied per lock',
+                                       buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+BALANCE_DRIFT = registry.counter('ussd_balance_drift_total',
+                                'Accounts whose MeTTa and database balances disagreed, by repair direction', ('direction',))
+BALANCE_DRIFT_SATS = registry.histogram('ussd_balance_drift_sats', 'Size of balance disagreements found by the reconciler',
+                                        buckets=(1, 10, 100, 1000, 10000, 100000, 1000000))
+BALANCE_RECONCILE_ROWS = registry.counter('ussd_balance_reconcile_rows_total',
+                                          'Accounts compared by the balance reconciler, by source', ('source',))
+STATIC_RESPONSES = registry.counter('ussd_static_responses_total',
+                                    'Landing page asset responses by coding and status (304 = revalidated)',
+                                    ('asset', 'encoding', 'status'))
+
+def record_hop(state_before: str, state_after: str, response: str, elapsed: float):
+    """Record one /ussd hop: counts, latency, response type and flow transitions"""
+    HOPS.inc(state_before)
+    HOP_DURATION.observe(elapsed, state_before)
+    response_type = response[:3]
+    RESPONSES.inc(response_type)
+
+    flow_before = STATE_FLOWS.get(state_before)
+    flow_after = STATE_FLOWS.get(state_after)
+    if flow_before is None and flow_after is not None:
+        FLOWS_STARTED.inc(flow_after)
+    if flow_after is not None and response_type == "END":
+        FLOWS_COMPLETED.inc(flow_after)
+    elif flow_before is not None and flow_after is None and response_type == "CON":
+        FLOWS_ABANDONED.inc(flow_before)
+
+def record_dependency(dependency: str, elapsed: float, error: bool = False):
+    """Record one outbound call"""
+    OUTBOUND_DURATION.observe(elapsed, dependency)
+    if error:
+        OUTBOUND_ERRORS.inc(dependency)
+
+def _collect_sessions() -> List[Tuple[str, Tuple, float]]:
+    from session_store import session_store
+    return [('ussd_active_sessions', (), len(session_store))]
+
+def _collect_db_pool() -> List[Tuple[str, Tuple, float]]:
+    from database import get_pool_metrics
+    snapshot = get_pool_metrics(top=0)
+    if not snapshot.get('pool'):
+        return []
+    pools = {'primary': snapshot['pool']}
+    for name, replica in snapshot.get('replicas', {}).items():
+        pools[name] = replica['pool']
+    samples = []
+    for name, pool in pools.items():
+        samples.append(('ussd_db_pool_connections_in_use', (name,), pool.get('in_use', 0)))
+        samples.append(('ussd_db_pool_checkouts_total', (name,), pool.get('checkouts', 0)))
+        samples.append(('ussd_db_pool_timeouts_total', (name,), pool.get('timeouts', 0)))
+    return samples
+
+registry.register_collector(_collect_sessions)
+registry.register_collector(_collect_db_pool)
+
+def render_metrics() -> str:
+    """Prometheus text for the /metrics endpoint"""
+    return registry.render()
@@ -0,0 +1,196 @@
+"""
+Thread-safe access to MeTTa spaces
+Reader/writer locks per space, with add/remove writes queued and applied in batches
+
+Request threads, the M-Pesa pollers, webhook handlers and journal catch-up all
+touch the knowledge base. A hyperon space must not be mutated while another
+thread matches against it, so every space is wrapped in a SpaceGateway:
+
+- any number of threads may query a space at once (shared lock);
+- add_atom/remove_atom calls are queued per space and applied together under
+  one exclusive lock acquisition, either when the queue reaches batch_size or
+  when a reader arrives (so a thread always sees its own earlier writes);
+- waiting writers block new readers, so a stream of balance lookups cannot
+  starve the journal projection.
+
+Lock waits and batch sizes are exported as Prometheus metrics and per-space
+counters (see MettaQueries.stats and /metrics/metta).
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, List, Tuple
+
+from config import Config
+from metrics import METTA_LOCK_CONTENDED, METTA_LOCK_WAIT, METTA_WRITE_BATCH
+
+logger = logging.getLogger(__name__)
+
+ADD = 'add'
+REMOVE = 'remove'
+
+class RWLock:
+    """
+    Writer-preferring reader/writer lock.
+
+    Re-entrant for the writer (which may also read) and for readers. A reader
+    cannot upgrade to writing: take the write lock up front instead.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None
+        self._write_depth = 0
+        self._writers_waiting = 0
+        self._local = threading.local()
+        self.stats = {'reads': 0, 'writes': 0, 'read_waits': 0, 'write_waits': 0, 'wait_seconds': 0.0}
+
+    def _waited(self, mode: str, start: float):
+        waited = time.perf_counter() - start
+        self.stats[f'{mode}_waits'] += 1
+        self.stats['wait_seconds'] += waited
+        METTA_LOCK_CONTENDED.inc(mode)
+        METTA_LOCK_WAIT.observe(waited, mode)
+
+    @contextmanager
+    def read(self):
+        """Shared lock"""
+        depth = getattr(self._local, 'reads', 0)
+        if depth or self._writer == threading.get_ident():
+            self._local.reads = depth + 1
+            try:
+                yield
+            finally:
+                self._local.reads = depth
+            return
+
+        start = None
+        with self._cond:
+            if self._writer is not None or self._writers_waiting:
+                start = time.perf_counter()
+                while self._writer is not None or self._writers_waiting:
+                    self._cond.wait()
+            self._readers += 1
+            self.stats['reads'] += 1
+        if start is not None:
+            self._waited('read', start)
+        self._local.reads = 1
+        try:
+            yield
+        finally:
+            self._local.reads = 0
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        """Exclusive lock"""
+        me = threading.get_ident()
+        if self._writer == me:
+            self._write_depth += 1
+            try:
+                yield
+            finally:
+                self._write_depth -= 1
+            return
+        if getattr(self._local, 'reads', 0):
+            raise RuntimeError(f"Cannot upgrade a read lock on {self.name} to a write lock")
+
+        start = None
+        with self._cond:
+            if self._writer is not None or self._readers:
+                start = time.perf_counter()
+                self._writers_waiting += 1
+                try:
+                    while self._writer is not None or self._readers:
+                        self._cond.wait()
+                finally:
+                    self._writers_waiting -= 1
+            self._writer = me
+            self._write_depth = 1
+            self.stats['writes'] += 1
+        if start is not None:
+            self._waited('write', start)
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = None
+                self._write_depth = 0
+                self._cond.notify_all()
+
+class SpaceGateway:
+    """One MeTTa space behind an RWLock, with a queue of pending writes"""
+
+    def __init__(self, name: str, space, batch_size: int = None):
+        self.name = name
+        self.space = space
+        self.batch_size = batch_size if batch_size is not None else Config.METTA_WRITE_BATCH_SIZE
+        self.lock = RWLock(name)
+        self._pending: List[Tuple[str, Any]] = []
+        self._pending_lock = threading.Lock()
+        self.stats = {'batches': 0, 'writes_applied': 0, 'missing_removes': 0}
+
+    def _enqueue(self, op: str, atom):
+        with self._pending_lock:
+            self._pending.append((op, atom))
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self.flush()
+
+    def add(self, atom):
+        """Queue an add_atom"""
+        self._enqueue(ADD, atom)
+
+    def remove(self, atom):
+        """Queue a remove_atom"""
+        self._enqueue(REMOVE, atom)
+
+    def flush(self) -> int:
+        """
+        Apply queued writes in order under one exclusive lock.
+
+        Returns:
+            Number of writes applied
+        """
+        if not self._pending:
+            return 0
+        with self.lock.write():
+            with self._pending_lock:
+                batch, self._pending = self._pending, []
+            for op, atom in batch:
+                if op == ADD:
+                    self.space.add_atom(atom)
+                elif not self.space.remove_atom(atom):
+                    self.stats['missing_removes'] += 1
+        if batch:
+            self.stats['batches'] += 1
+            self.stats['writes_applied'] += len(batch)
+            METTA_WRITE_BATCH.observe(len(batch))
+        return len(batch)
+
+    def query(self, pattern) -> list:
+        """Match a pattern, after applying any queued writes"""
+        self.flush()
+        with self.lock.read():
+            return list(self.space.query(pattern))
+
+    @contextmanager
+    def exclusive(self):
+        """Hold the write lock across several operations (queued writes are applied on exit)"""
+        with self.lock.write():
+            try:
+                yield self
+            finally:
+                self.flush()
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._pending_lock:
+            pending = len(self._pending)
+        return dict(self.lock.stats, **self.stats, pending=pending,
+                    wait_seconds=round(self.lock.stats['wait_seconds'], 6))
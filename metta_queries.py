@@ -0,0 +1,355 @@
+"""
+Parameterized MeTTa queries
+Ledger facts read and written as atoms built with hyperon's Python API, with typed results
+
+Every fact kind the handlers use (Balance, Transaction, Invoice, PendingMpesa,
+Preference, ExchangeRate) is declared once as a FactTemplate. A template knows
+its head symbol and the type of each field, and keeps its constant atoms and
+its all-variables pattern after first use. Patterns are assembled with E/S/V
+and run with space.query/add_atom/remove_atom, so no MeTTa program text is
+built or parsed per call, and results come back as Python ints and strs
+instead of printed atoms that have to be split apart.
+
+Field values become the same native Number/String atoms the parser makes for
+atoms.metta (so facts loaded from the file can be matched and removed). They
+are parsed from an escaped literal once and then cached, which also means a
+value containing quotes or parentheses can never change the shape of a fact.
+
+Usage:
+    from metta_queries import MettaQueries, BALANCE
+
+    queries = MettaQueries(metta)   # METTA_SHARDS per-user spaces
+    balance = queries.value(BALANCE, 'balance', phone='+254712345678')
+    queries.add(BALANCE, phone='+254712345678', balance=5000)
+"""
+import logging
+import threading
+import zlib
+from contextlib import ExitStack, contextmanager
+from functools import lru_cache
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+from config import Config
+from metta_gateway import SpaceGateway
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+# Field types
+STRING = 'string'   # "..." literal, a grounded str
+NUMBER = 'number'   # grounded int
+SYMBOL = 'symbol'   # bare symbol such as Lightning
+
+# Parsed value atoms kept per interpreter (phone numbers, amounts, invoice ids)
+LITERAL_CACHE_SIZE = 65536
+
+Literal = Callable[[str, Any], Any]  # (field type, value) -> atom
+
+_hyperon = None
+
+def _api():
+    """hyperon's atom constructors, imported on first use to keep hyperon out of import time"""
+    global _hyperon
+    if _hyperon is None:
+        import hyperon
+        _hyperon = hyperon
+    return _hyperon
+
+def to_python(atom) -> Any:
+    """Plain Python value of an atom: grounded values unwrapped, symbols as names, expressions as tuples"""
+    hyperon = _api()
+    kind = atom.get_metatype()
+    if kind == hyperon.AtomKind.GROUNDED:
+        obj = atom.get_object()
+        return getattr(obj, 'value', obj)
+    if kind == hyperon.AtomKind.SYMBOL:
+        return atom.get_name()
+    if kind == hyperon.AtomKind.EXPR:
+        return tuple(to_python(child) for child in atom.get_children())
+    return str(atom)
+
+class FactTemplate:
+    """
+    Shape of one kind of fact, e.g. (Balance "<phone>" <balance>).
+
+    Args:
+        head: Head symbol
+        fields: In order, either a bare symbol that is always present
+            (e.g. 'Language') or a (name, type) pair
+        shard_keys: Phone-number fields that decide which shard(s) hold the
+            fact; none means the fact lives in the shared space
+    """
+
+    def __init__(self, head: str, fields: Iterable[Union[str, Tuple[str, str]]], shard_keys: Tuple[str, ...] = ()):
+        self.head = head
+        self.shard_keys = tuple(shard_keys)
+        self.fields: List[Union[str, Tuple[str, str]]] = list(fields)
+        self.names = [field[0] for field in self.fields if isinstance(field, tuple)]
+        self._types = {field[0]: field[1] for field in self.fields if isinstance(field, tuple)}
+        self._constants = None  # head/bare-symbol atoms, built on first use
+        self._variables = None  # one V per field
+        self._open_pattern = None
+
+    def _compile(self):
+        if self._constants is not None:
+            return
+        hyperon = _api()
+        self._variables = {name: hyperon.V(name) for name in self.names}
+        self._constants = [hyperon.S(self.head)] + [
+            None if isinstance(field, tuple) else hyperon.S(field) for field in self.fields
+        ]
+        self._open_pattern = self._build({})
+
+    def value_atom(self, name: str, value, literal: Literal):
+        """Atom for a field value"""
+        kind = self._types[name]
+        if kind == SYMBOL:
+            return _api().S(str(value))
+        return literal(kind, value)
+
+    def _build(self, bound: Dict[str, Any], literal: Literal = None):
+        children = [self._constants[0]]
+        for i, field in enumerate(self.fields, start=1):
+            if not isinstance(field, tuple):
+                children.append(self._constants[i])
+            elif field[0] in bound:
+                children.append(self.value_atom(field[0], bound[field[0]], literal))
+            else:
+                children.append(self._variables[field[0]])
+        return _api().E(*children)
+
+    def pattern(self, literal: Literal, **bound):
+        """Pattern with the given fields bound and the rest as variables"""
+        self._compile()
+        unknown = set(bound) - set(self._types)
+        if unknown:
+            raise ValueError(f"{self.head} has no field(s) {', '.join(sorted(unknown))}")
+        if not bound:
+            return self._open_pattern
+        return self._build(bound, literal)
+
+    def atom(self, literal: Literal, **values):
+        """The ground fact; every field must be given"""
+        missing = [name for name in self.names if name not in values]
+        if missing:
+            raise ValueError(f"{self.head} needs {', '.join(missing)}")
+        return self.pattern(literal, **values)
+
+    def row(self, bindings: Dict[str, Any], bound: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Typed field values of one match, or None if the match is not a ground fact"""
+        variable = _api().AtomKind.VARIABLE
+        row = {}
+        for name in self.names:
+            if name in bound:
+                value = bound[name]
+            else:
+                atom = bindings.get(name)
+                # Rule bodies such as (Balance $user $new_balance) match too
+                if atom is None or atom.get_metatype() == variable:
+                    return None
+                value = to_python(atom)
+            kind = self._types[name]
+            if kind == NUMBER:
+                value = int(value)
+            elif kind == STRING:
+                value = str(value)
+            row[name] = value
+        return row
+
+# Ledger and profile facts (see atoms.metta); per-user facts are routed to a shard by phone
+BALANCE = FactTemplate('Balance', [('phone', STRING), ('balance', NUMBER)], shard_keys=('phone',))
+TRANSACTION = FactTemplate('Transaction', [('sender', STRING), ('recipient', STRING), ('amount', NUMBER),
+                                           ('kind', SYMBOL), ('timestamp', STRING)],
+                           shard_keys=('sender', 'recipient'))
+INVOICE = FactTemplate('Invoice', [('phone', STRING), ('invoice_id', STRING), ('amount', NUMBER),
+                                   ('timestamp', STRING)], shard_keys=('phone',))
+PENDING_MPESA = FactTemplate('PendingMpesa', [('phone', STRING), ('invoice_id', STRING), ('kes_amount', NUMBER),
+                                              ('sats_amount', NUMBER), ('timestamp', STRING)], shard_keys=('phone',))
+PREFERENCE_LANGUAGE = FactTemplate('Preference', [('phone', STRING), 'Language', ('language', STRING)],
+                                   shard_keys=('phone',))
+EXCHANGE_RATE = FactTemplate('ExchangeRate', ['KES', ('kes_units', NUMBER), ('sats_units', NUMBER)])
+
+SHARDED_FACTS = (BALANCE, TRANSACTION, INVOICE, PENDING_MPESA, PREFERENCE_LANGUAGE)
+
+def is_account(value) -> bool:
+    """User phone numbers (E.164) own shards; counterparties such as 'M-Pesa' or 'Airtime-Safaricom' do not"""
+    return str(value).startswith('+')
+
+class MettaQueries:
+    """
+    Typed reads and writes of template facts.
+
+    Rules and static facts stay in the interpreter's own space (&self), which
+    is treated as read-only shared state. Facts of templates with shard keys
+    live in `shards` separate spaces, chosen by a stable hash of the phone
+    number, so a user's lookups match against one shard instead of every
+    user's atoms, and each shard has its own reader/writer lock and write
+    queue (metta_gateway.SpaceGateway). A transaction between two users is
+    stored in both users' shards.
+
+    Shards are also registered as &shard0..&shardN-1 for ad-hoc metta.run
+    queries.
+    """
+
+    def __init__(self, metta, shards: int = None, cache_size: int = LITERAL_CACHE_SIZE):
+        self.metta = metta
+        self.shared = SpaceGateway('&self', metta.space())
+        count = shards if shards is not None else Config.METTA_SHARDS
+        self.shards: List[SpaceGateway] = []
+        if count > 0:
+            from hyperon import G
+            from hyperon.base import GroundingSpaceRef
+            for i in range(count):
+                shard = SpaceGateway(f'&shard{i}', GroundingSpaceRef())
+                metta.register_atom(shard.name, G(shard.space))
+                self.shards.append(shard)
+        self._parse_lock = threading.Lock()
+        self.literal: Literal = lru_cache(maxsize=cache_size)(self._parse_literal)
+
+    def _parse_literal(self, kind: str, value) -> Any:
+        """Native atom for a number or string, via the interpreter's own tokenizer"""
+        if kind == NUMBER:
+            text = str(int(value))
+        else:
+            text = '"' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+        with self._parse_lock:
+            return self.metta.parse_single(text)
+
+    def shard_for(self, key: str) -> SpaceGateway:
+        """Shard holding a phone number's facts (stable across processes)"""
+        return self.shards[zlib.crc32(str(key).encode('utf-8')) % len(self.shards)]
+
+    def _read_shards(self, template: FactTemplate, bound: Dict[str, Any]) -> List[SpaceGateway]:
+        if not template.shard_keys or not self.shards:
+            return [self.shared]
+        for key in template.shard_keys:
+            if key in bound and is_account(bound[key]):
+                return [self.shard_for(bound[key])]
+        # No user bound (e.g. every pending top-up): fan out
+        return self.shards
+
+    def _write_shards(self, template: FactTemplate, values: Dict[str, Any]) -> List[SpaceGateway]:
+        if not template.shard_keys or not self.shards:
+            return [self.shared]
+        keys = [values[key] for key in template.shard_keys if key in values]
+        accounts = [key for key in keys if is_account(key)] or keys[:1]
+        shards = {id(shard): shard for shard in (self.shard_for(key) for key in accounts)}
+        return list(shards.values())
+
+    @staticmethod
+    @contextmanager
+    def _exclusive(shards: List[SpaceGateway]):
+        """Write-lock several shards (in a fixed order, so writers cannot deadlock)"""
+        with ExitStack() as stack:
+            for shard in sorted(shards, key=lambda shard: shard.name):
+                stack.enter_context(shard.exclusive())
+            yield
+
+    def query(self, template: FactTemplate, **bound) -> List[Dict[str, Any]]:
+        """
+        Facts matching the bound fields.
+
+        Returns:
+            One dict per match with every field as a Python value (a fact
+            found in several shards is returned once)
+        """
+        pattern = template.pattern(self.literal, **bound)
+        shards = self._read_shards(template, bound)
+        rows = []
+        with span('metta.query', {'metta.fact': template.head, 'metta.bound': ','.join(sorted(bound)),
+                                  'metta.shards': len(shards)}):
+            for shard in shards:
+                rows.extend(template.row(bindings, bound) for bindings in shard.query(pattern))
+        rows = [row for row in rows if row is not None]
+        if len(shards) > 1 and len(template.shard_keys) > 1:
+            rows = list({tuple(row.values()): row for row in rows}.values())
+        return rows
+
+    def value(self, template: FactTemplate, field: str, default=None, **bound) -> Any:
+        """One field of the first matching fact, or default"""
+        rows = self.query(template, **bound)
+        return rows[0][field] if rows else default
+
+    def add(self, template: FactTemplate, **values):
+        """Add a ground fact (queued; visible to the next query of its shard)"""
+        atom = template.atom(self.literal, **values)
+        for shard in self._write_shards(template, values):
+            shard.add(atom)
+
+    def remove(self, template: FactTemplate, **values):
+        """Remove one exact fact (queued like add)"""
+        atom = template.atom(self.literal, **values)
+        for shard in self._write_shards(template, values):
+            shard.remove(atom)
+
+    def remove_matching(self, template: FactTemplate, **bound) -> int:
+        """
+        Remove every fact matching the bound fields (including facts loaded from atoms.metta).
+
+        Returns:
+            Number of facts removed
+        """
+        rows = self.query(template, **bound)
+        for row in rows:
+            self.remove(template, **row)
+        return len(rows)
+
+    def replace(self, template: FactTemplate, key: Dict[str, Any], **values) -> int:
+        """
+        Make the fact identified by key the only one: remove matches, then add
+        (under the shard lock, so concurrent replaces cannot leave two facts).
+
+        Returns:
+            Number of facts removed
+        """
+        with self._exclusive(self._write_shards(template, key)):
+            removed = self.remove_matching(template, **key)
+            self.add(template, **key, **values)
+        return removed
+
+    def first(self, template: FactTemplate, **bound) -> Optional[Dict[str, Any]]:
+        """First matching fact, or None"""
+        rows = self.query(template, **bound)
+        return rows[0] if rows else None
+
+    def adopt_shared_facts(self) -> int:
+        """
+        Move per-user facts loaded into &self (e.g. from atoms.metta) to their shards.
+
+        Returns:
+            Number of facts moved
+        """
+        if not self.shards:
+            return 0
+        moved = 0
+        for template in SHARDED_FACTS:
+            pattern = template.pattern(self.literal)
+            with self.shared.exclusive():
+                rows = [template.row(bindings, {}) for bindings in self.shared.query(pattern)]
+                for row in rows:
+                    if row is None:
+                        continue
+                    self.shared.remove(template.atom(self.literal, **row))
+                    self.add(template, **row)
+                    moved += 1
+        self.flush()
+        if moved:
+            logger.info(f"Moved {moved} per-user facts from &self into {len(self.shards)} shards")
+        return moved
+
+    def flush(self) -> int:
+        """Apply every space's queued writes now"""
+        return sum(shard.flush() for shard in [self.shared] + self.shards)
+
+    def shard_sizes(self) -> Dict[str, int]:
+        """Atom count per space"""
+        self.flush()
+        sizes = {}
+        for shard in [self.shared] + self.shards:
+            with shard.lock.read():
+                sizes[shard.name] = shard.space.atom_count()
+        return sizes
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Lock contention and write batching per space"""
+        return {shard.name: shard.snapshot() for shard in [self.shared] + self.shards}
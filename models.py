@@ -67,7 +67,9 @@ class Transaction(Base):
     __table_args__ = (
         Index('idx_user_type_status', 'user_id', 'transaction_type', 'status'),
         Index('idx_created_at', 'created_at'),
-        Index('idx_payment_hash', 'lightning_payment_hash'),
+        Index('idx_transactions_payment_hash', 'lightning_payment_hash'),
+        # One row per M-Pesa payment: the key that makes top-up credits idempotent
+        Index('idx_transactions_mpesa_id', 'mpesa_transaction_id', unique=True),
     )
     
     def __repr__(self):
@@ -125,7 +127,7 @@ class Invoice(Base):
     __table_args__ = (
         Index('idx_user_status', 'user_id', 'status'),
         Index('idx_expires_at', 'expires_at'),
-        Index('idx_payment_hash', 'payment_hash'),
+        Index('idx_invoices_payment_hash', 'payment_hash'),
     )
     
     def is_expired(self):
@@ -0,0 +1,152 @@
+"""
+Phone number normalization and carrier lookup
+One E.164 normalizer for every call site, plus array-indexed prefix→carrier tables per numbering plan
+
+Usage:
+    from phone_numbers import normalize, is_valid, detect_carrier
+
+    normalize("0712 345 678")        # '+254712345678'
+    detect_carrier("+254733123456")  # 'Airtel'
+"""
+import logging
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple, Iterable
+
+logger = logging.getLogger(__name__)
+
+UNKNOWN_CARRIER = "Unknown Carrier"
+
+# Characters users and gateways put inside numbers that carry no meaning
+_SEPARATORS = str.maketrans('', '', ' -().')
+
+class NumberingPlan:
+    """
+    A country's mobile numbering plan.
+
+    Carriers are compiled into a 1000-entry list indexed by the first three digits
+    of the national number, so a lookup is one slice, one int() and one index.
+    """
+
+    def __init__(self, country_code: str, national_length: int, trunk_prefix: str = '0',
+                 carriers: Dict[str, Iterable[str]] = None):
+        self.country_code = country_code
+        self.national_length = national_length
+        self.trunk_prefix = trunk_prefix
+        self.carrier_table: List[Optional[str]] = [None] * 1000
+        for carrier, prefixes in (carriers or {}).items():
+            self.add_carrier(carrier, prefixes)
+
+    def add_carrier(self, carrier: str, prefixes: Iterable[str]):
+        """Assign 3-digit national prefixes (e.g. '701') to a carrier"""
+        for prefix in prefixes:
+            if len(prefix) != 3 or not prefix.isdigit():
+                raise ValueError(f"Carrier prefixes must be 3 digits, got '{prefix}'")
+            self.carrier_table[int(prefix)] = carrier
+
+    def carrier_for(self, national_number: str) -> Optional[str]:
+        """Carrier owning a national significant number, if known"""
+        return self.carrier_table[int(national_number[:3])]
+
+def _prefix_range(start: int, end: int) -> List[str]:
+    """Inclusive range of 3-digit prefixes"""
+    return [str(prefix) for prefix in range(start, end + 1)]
+
+KENYA = NumberingPlan(
+    country_code='254',
+    national_length=9,
+    carriers={
+        'Safaricom': _prefix_range(701, 729),
+        'Airtel': _prefix_range(730, 739) + _prefix_range(750, 756),
+        'Telkom': _prefix_range(770, 777),
+    }
+)
+
+# Plans keyed by country calling code; numbers without one use the default plan
+NUMBERING_PLANS: Dict[str, NumberingPlan] = {KENYA.country_code: KENYA}
+DEFAULT_PLAN = KENYA
+
+def register_plan(plan: NumberingPlan, default: bool = False):
+    """Add or replace a numbering plan (clears cached results)"""
+    global DEFAULT_PLAN
+    NUMBERING_PLANS[plan.country_code] = plan
+    if default:
+        DEFAULT_PLAN = plan
+    _parse.cache_clear()
+
+@lru_cache(maxsize=65536)
+def _parse(phone_number: str) -> Optional[Tuple[str, str]]:
+    """Split a raw number into (country code, national number) or None if unparseable"""
+    cleaned = phone_number.strip().translate(_SEPARATORS)
+    if not cleaned:
+        return None
+
+    if cleaned.startswith('+'):
+        digits = cleaned[1:]
+        if not digits.isdigit():
+            return None
+        # Country calling codes are 1-3 digits
+        for length in (1, 2, 3):
+            plan = NUMBERING_PLANS.get(digits[:length])
+            if plan is not None:
+                national = digits[length:]
+                return (plan.country_code, national) if len(national) == plan.national_length else None
+        return None
+
+    if not cleaned.isdigit():
+        return None
+
+    plan = DEFAULT_PLAN
+    if cleaned.startswith(plan.country_code) and len(cleaned) == len(plan.country_code) + plan.national_length:
+        return plan.country_code, cleaned[len(plan.country_code):]
+    if plan.trunk_prefix and cleaned.startswith(plan.trunk_prefix) \
+            and len(cleaned) == len(plan.trunk_prefix) + plan.national_length:
+        return plan.country_code, cleaned[len(plan.trunk_prefix):]
+    return None
+
+def normalize(phone_number: str) -> Optional[str]:
+    """
+    Normalize a phone number to E.164.
+
+    Accepts '+254712345678', '254712345678' and '0712345678', also with spaces,
+    dashes, dots or brackets.
+
+    Returns:
+        E.164 string (e.g. '+254712345678') or None if the number is not valid
+    """
+    parsed = _parse(phone_number) if phone_number else None
+    return f"+{parsed[0]}{parsed[1]}" if parsed else None
+
+def normalize_or_original(phone_number: str) -> str:
+    """E.164 form when valid, otherwise the stripped input (for callers that validate later)"""
+    return normalize(phone_number) or (phone_number or "").strip()
+
+def is_valid(phone_number: str) -> bool:
+    """Whether the number parses under a registered numbering plan"""
+    return bool(phone_number) and _parse(phone_number) is not None
+
+def to_msisdn(phone_number: str) -> str:
+    """
+    Format for payment gateways that expect digits only (e.g. '254712345678').
+
+    A bare national number ('712345678') gets the default country code; other
+    unparseable input is returned as its digits so the gateway can reject it.
+    """
+    e164 = normalize(phone_number)
+    if e164:
+        return e164[1:]
+    digits = ''.join(filter(str.isdigit, phone_number or ""))
+    if len(digits) == DEFAULT_PLAN.national_length:
+        return DEFAULT_PLAN.country_code + digits
+    return digits
+
+def detect_carrier(phone_number: str) -> str:
+    """Mobile network carrier for a number, or 'Unknown Carrier'"""
+    parsed = _parse(phone_number) if phone_number else None
+    if parsed is None:
+        return UNKNOWN_CARRIER
+    country_code, national = parsed
+    return NUMBERING_PLANS[country_code].carrier_for(national) or UNKNOWN_CARRIER
+
+def cache_info():
+    """Hit/miss statistics of the normalization cache"""
+    return _parse.cache_info()
@@ -0,0 +1,329 @@
+"""
+Business rules compiled from the MeTTa knowledge base
+Reads the `(Rule Name (If condition (Error "message")))` atoms from atoms.metta and compiles them into Python closures
+
+Amount limits, phone number checks and per-flow minimums are written once, as
+Rule atoms, and evaluated here without a MeTTa interpreter round trip: each
+rule becomes a closure over its compiled condition, so a check is a dict
+lookup and one call. The file is re-read when its mtime changes (checked at
+most every reload_interval seconds); if the new version does not parse, the
+previous rules stay in force.
+
+Conditions support comparisons (< > <= >= = == !=), arithmetic (+ - * /),
+not/and/or, (StartsWith $text "prefix") and calls to registered functions
+such as (Balance $user).
+
+Usage:
+    from rule_engine import rules
+
+    rules.check('MaximumAmount', amount=2000000)   # 'Maximum amount is 1,000,000 sats'
+    rules.check('MinimumAmount', amount=500)       # None: the rule holds
+    rules.limit('MinimumWithdrawal')               # 100, for screens that show the threshold
+
+    python rule_engine.py list
+    python rule_engine.py check MinimumWithdrawal kes_amount=50
+"""
+import logging
+import operator
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+class RuleError(Exception):
+    """Raised for rule files that do not compile and for checks of unknown rules"""
+
+class Symbol(str):
+    """A bare MeTTa symbol (strings in the source are plain str)"""
+
+class Variable(str):
+    """A $variable, named without the $"""
+
+def parse(source: str) -> List[Any]:
+    """
+    Parse MeTTa source into nested lists of Symbol, Variable, str, int and float.
+
+    Raises:
+        RuleError: On unbalanced brackets or an unterminated string
+    """
+    stack: List[List[Any]] = [[]]
+    i, length = 0, len(source)
+    while i < length:
+        char = source[i]
+        if char.isspace():
+            i += 1
+        elif char == ';':
+            end = source.find('\n', i)
+            i = length if end < 0 else end
+        elif char == '(':
+            stack.append([])
+            i += 1
+        elif char == ')':
+            if len(stack) == 1:
+                raise RuleError(f"Unexpected ')' at offset {i}")
+            expression = stack.pop()
+            stack[-1].append(expression)
+            i += 1
+        elif char == '"':
+            chars = []
+            i += 1
+            while i < length and source[i] != '"':
+                if source[i] == '\\' and i + 1 < length:
+                    i += 1
+                    chars.append({'n': '\n', 't': '\t'}.get(source[i], source[i]))
+                else:
+                    chars.append(source[i])
+                i += 1
+            if i >= length:
+                raise RuleError("Unterminated string")
+            stack[-1].append(''.join(chars))
+            i += 1
+        else:
+            start = i
+            while i < length and not source[i].isspace() and source[i] not in '();"':
+                i += 1
+            stack[-1].append(_token(source[start:i]))
+    if len(stack) != 1:
+        raise RuleError("Unbalanced '(' at end of file")
+    return stack[0]
+
+def _token(text: str) -> Any:
+    if text.startswith('$'):
+        return Variable(text[1:])
+    for number in (int, float):
+        try:
+            return number(text)
+        except ValueError:
+            pass
+    return Symbol(text)
+
+COMPARISONS = {'<': operator.lt, '>': operator.gt, '<=': operator.le, '>=': operator.ge,
+               '=': operator.eq, '==': operator.eq, '!=': operator.ne}
+ARITHMETIC = {'+': operator.add, '-': operator.sub, '*': operator.mul, '/': operator.truediv}
+
+# Compiled expressions take (bindings, functions) and return a value
+Compiled = Callable[[Dict[str, Any], Dict[str, Callable]], Any]
+
+def compile_expression(expression: Any) -> Compiled:
+    """Compile one condition expression into a closure"""
+    if isinstance(expression, Variable):
+        name = str(expression)
+
+        def variable(bindings, functions):
+            try:
+                return bindings[name]
+            except KeyError:
+                raise RuleError(f"No value for ${name}") from None
+        return variable
+    if isinstance(expression, Symbol):
+        value = {'True': True, 'False': False}.get(expression, str(expression))
+        return lambda bindings, functions: value
+    if not isinstance(expression, list):
+        return lambda bindings, functions: expression
+    if not expression or not isinstance(expression[0], Symbol):
+        raise RuleError(f"Cannot compile {expression!r}")
+
+    head, args = str(expression[0]), [compile_expression(arg) for arg in expression[1:]]
+    if head in COMPARISONS or head in ARITHMETIC:
+        if len(args) != 2:
+            raise RuleError(f"({head} ...) takes two arguments")
+        op, (left, right) = COMPARISONS.get(head) or ARITHMETIC[head], args
+        return lambda bindings, functions: op(left(bindings, functions), right(bindings, functions))
+    if head in ('not', 'Not'):
+        (inner,) = args
+        return lambda bindings, functions: not inner(bindings, functions)
+    if head in ('and', 'And'):
+        return lambda bindings, functions: all(arg(bindings, functions) for arg in args)
+    if head in ('or', 'Or'):
+        return lambda bindings, functions: any(arg(bindings, functions) for arg in args)
+    if head == 'StartsWith':
+        text, prefix = args
+        return lambda bindings, functions: str(text(bindings, functions)).startswith(prefix(bindings, functions))
+
+    # Anything else is a function call, e.g. (Balance $user)
+    def call(bindings, functions):
+        function = bindings.get(head) or functions.get(head)
+        if function is None:
+            raise RuleError(f"No function registered for ({head} ...)")
+        return function(*(arg(bindings, functions) for arg in args))
+    return call
+
+def compile_rule(name: str, body: Any) -> Callable[[Dict[str, Any], Dict[str, Callable]], Optional[str]]:
+    """
+    Compile a rule body of the form (If condition (Error "message")).
+
+    Returns:
+        A closure returning the error message when the condition holds, else None
+    """
+    if not (isinstance(body, list) and len(body) == 3 and body[0] == 'If'):
+        raise RuleError(f"Rule {name}: expected (If condition (Error \"message\"))")
+    _, condition, error = body
+    if not (isinstance(error, list) and len(error) == 2 and error[0] == 'Error'):
+        raise RuleError(f"Rule {name}: expected (Error \"message\")")
+    test, message = compile_expression(condition), str(error[1])
+
+    def rule(bindings, functions):
+        return message if test(bindings, functions) else None
+    rule.limit = _limit(condition)
+    return rule
+
+def _limit(condition: Any) -> Optional[Any]:
+    """The number a condition like (< $kes_amount 10) compares its variable with, else None"""
+    if not (isinstance(condition, list) and len(condition) == 3 and condition[0] in COMPARISONS):
+        return None
+    left, right = condition[1], condition[2]
+    for variable, constant in ((left, right), (right, left)):
+        if isinstance(variable, Variable) and isinstance(constant, (int, float)):
+            return constant
+    return None
+
+def compile_rules(source: str) -> Dict[str, Callable]:
+    """Compile every top-level (Rule Name body) atom in MeTTa source"""
+    compiled = {}
+    for expression in parse(source):
+        if isinstance(expression, list) and len(expression) == 3 and expression[0] == 'Rule':
+            name = str(expression[1])
+            compiled[name] = compile_rule(name, expression[2])
+    return compiled
+
+class RuleEngine:
+    """
+    Compiled Rule atoms of one .metta file, reloaded when the file changes.
+
+    Functions used in conditions are registered by name; a callable passed to
+    check() under the same name is used instead (e.g. a balance already read).
+    """
+
+    def __init__(self, path: str = None, reload_interval: float = None):
+        self.path = path or Config.RULES_FILE
+        self.reload_interval = reload_interval if reload_interval is not None else Config.RULES_RELOAD_INTERVAL
+        self.functions: Dict[str, Callable] = {}
+        self._rules: Dict[str, Callable] = {}
+        self._mtime = None
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+        self.stats = {'loads': 0, 'load_errors': 0, 'checks': 0, 'violations': 0}
+
+    def register(self, name: str, function: Callable):
+        """Make a function available to conditions as (name args...)"""
+        self.functions[name] = function
+
+    def _current(self) -> Dict[str, Callable]:
+        now = time.monotonic()
+        if now >= self._next_check:
+            with self._lock:
+                if now >= self._next_check:
+                    self._next_check = now + self.reload_interval
+                    self._reload_if_changed()
+        return self._rules
+
+    def _reload_if_changed(self):
+        """Recompile if the file's mtime moved (caller holds the lock)"""
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError as e:
+            if self._mtime != -1:
+                logger.error(f"Rules file {self.path} unavailable, keeping {len(self._rules)} rules: {e}")
+                self._mtime = -1
+            return
+        if mtime == self._mtime:
+            return
+        self._mtime = mtime
+        try:
+            with open(self.path) as f:
+                rules = compile_rules(f.read())
+        except (OSError, RuleError) as e:
+            self.stats['load_errors'] += 1
+            logger.error(f"Rules in {self.path} did not compile, keeping the previous {len(self._rules)}: {e}")
+            return
+        self._rules = rules
+        self.stats['loads'] += 1
+        logger.info(f"Loaded {len(rules)} rules from {self.path}: {', '.join(sorted(rules))}")
+
+    def reload(self):
+        """Re-read the file now"""
+        with self._lock:
+            self._mtime = None
+            self._next_check = time.monotonic() + self.reload_interval
+            self._reload_if_changed()
+
+    def check(self, name: str, **bindings) -> Optional[str]:
+        """
+        Evaluate one rule.
+
+        Args:
+            name: Rule name, e.g. 'MinimumAmount'
+            **bindings: Values for the rule's $variables (and optional function overrides)
+
+        Returns:
+            The rule's error message if it is violated, else None
+
+        Raises:
+            RuleError: If the rule does not exist or a variable is not bound
+        """
+        rule = self._current().get(name)
+        if rule is None:
+            raise RuleError(f"No rule named {name} in {self.path}")
+        self.stats['checks'] += 1
+        error = rule(bindings, self.functions)
+        if error is not None:
+            self.stats['violations'] += 1
+        return error
+
+    def limit(self, name: str) -> Any:
+        """
+        The threshold of a rule whose condition compares a variable with a number.
+
+        Raises:
+            RuleError: If the rule does not exist or has no such threshold
+        """
+        rule = self._current().get(name)
+        if rule is None:
+            raise RuleError(f"No rule named {name} in {self.path}")
+        if rule.limit is None:
+            raise RuleError(f"Rule {name} does not compare a variable with a number")
+        return rule.limit
+
+    def first_violation(self, names: Tuple[str, ...], **bindings) -> Optional[str]:
+        """The error of the first violated rule among names, or None"""
+        for name in names:
+            error = self.check(name, **bindings)
+            if error is not None:
+                return error
+        return None
+
+    def names(self) -> List[str]:
+        return sorted(self._current())
+
+# Global instance
+rules = RuleEngine()
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description='Compiled business rules')
+    parser.add_argument('--file', default=None, help='Rules file (default RULES_FILE)')
+    subcommands = parser.add_subparsers(dest='command', required=True)
+    subcommands.add_parser('list', help='Rule names')
+    check_parser = subcommands.add_parser('check', help='Evaluate a rule')
+    check_parser.add_argument('rule')
+    check_parser.add_argument('bindings', nargs='*', help='name=value (numbers are parsed)')
+    args = parser.parse_args()
+
+    engine = RuleEngine(args.file) if args.file else rules
+    if args.command == 'list':
+        print('\n'.join(engine.names()))
+    else:
+        values = {}
+        for binding in args.bindings:
+            key, value = binding.split('=', 1)
+            try:
+                values[key] = json.loads(value)
+            except ValueError:
+                values[key] = value
+        print(json.dumps({'rule': args.rule, 'error': engine.check(args.rule, **values)}))
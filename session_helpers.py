@@ -1,12 +1,12 @@
 from sqlalchemy.orm import Session
 from sqlalchemy.exc import SQLAlchemyError
 from models import UssdSession, User
-from database import db_manager
+from database import db_manager, replica_read
 from user_helpers import UserManager
 import logging
 import json
 from datetime import datetime, timedelta
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
 
 logger = logging.getLogger(__name__)
 
@@ -287,6 +287,7 @@ class UssdSessionManager:
             return []
     
     @staticmethod
+    @replica_read()
     def get_session_history(phone_number: str, limit: int = 10) -> list:
         """
         Get recent USSD session history for a user.
@@ -308,6 +309,105 @@ class UssdSessionManager:
             logger.error(f"Error fetching session history for {phone_number}: {e}")
             return []
 
+    @staticmethod
+    def load_session_state(session_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Load an active session's state as plain values.
+        
+        Args:
+            session_id: USSD session identifier
+            
+        Returns:
+            Dict with phone_number, current_state and input_buffer, or None
+        """
+        try:
+            with db_manager.get_session() as session:
+                ussd_session = session.query(UssdSession).filter_by(
+                    session_id=session_id,
+                    is_active=True
+                ).first()
+                if not ussd_session:
+                    return None
+                
+                try:
+                    input_buffer = json.loads(ussd_session.input_buffer or '{}')
+                except json.JSONDecodeError:
+                    logger.warning(f"Invalid JSON in session buffer: {session_id}")
+                    input_buffer = {}
+                
+                return {
+                    'phone_number': ussd_session.phone_number,
+                    'current_state': ussd_session.current_state,
+                    'input_buffer': input_buffer,
+                    'last_activity': ussd_session.last_activity
+                }
+        except SQLAlchemyError as e:
+            logger.error(f"Error loading USSD session {session_id}: {e}")
+            return None
+    
+    @staticmethod
+    def save_sessions(records: List[Dict[str, Any]]) -> int:
+        """
+        Upsert a batch of USSD sessions in one database session and commit.
+        
+        Used by the write-behind session store to flush coalesced hops. The
+        input buffer is expected to be serialized already.
+        
+        Args:
+            records: List of dicts with session_id, phone_number, current_state,
+                     input_buffer (JSON string), last_activity and is_active
+            
+        Returns:
+            Number of sessions written
+        """
+        if not records:
+            return 0
+        
+        try:
+            with db_manager.get_session() as session:
+                # Resolve user IDs for all phone numbers at once, creating missing users
+                phones = sorted({record['phone_number'] for record in records})
+                user_ids = dict(session.query(User.phone_number, User.id).filter(
+                    User.phone_number.in_(phones)
+                ))
+                missing = [phone for phone in phones if phone not in user_ids]
+                if missing:
+                    new_users = [User(phone_number=phone, balance_sats=0) for phone in missing]
+                    session.add_all(new_users)
+                    session.flush()
+                    user_ids.update({user.phone_number: user.id for user in new_users})
+                
+                existing = {
+                    ussd_session.session_id: ussd_session
+                    for ussd_session in session.query(UssdSession).filter(
+                        UssdSession.session_id.in_([record['session_id'] for record in records])
+                    )
+                }
+                
+                for record in records:
+                    ussd_session = existing.get(record['session_id'])
+                    if ussd_session is None:
+                        ussd_session = UssdSession(
+                            session_id=record['session_id'],
+                            user_id=user_ids[record['phone_number']],
+                            phone_number=record['phone_number']
+                        )
+                        session.add(ussd_session)
+                        existing[record['session_id']] = ussd_session
+                    
+                    ussd_session.current_state = record['current_state']
+                    ussd_session.input_buffer = record['input_buffer']
+                    ussd_session.last_activity = record['last_activity']
+                    ussd_session.is_active = record['is_active']
+                
+                session.commit()
+                logger.debug(f"Saved {len(records)} USSD sessions in batch")
+                return len(records)
+                
+        except SQLAlchemyError as e:
+            logger.error(f"Error saving USSD session batch: {e}")
+            raise
+    
 # Convenience functions for backward compatibility
 def create_or_update_session(session_id: str, phone_number: str, 
                            current_state: str = "main_menu", 
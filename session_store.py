@@ -0,0 +1,299 @@
+"""
+Write-behind USSD session store backed by the ussd_sessions table
+Hops mutate an in-memory copy; dirty sessions are flushed to the database in batches
+"""
+import atexit
+import json
+import logging
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+from enum import IntEnum
+from typing import Dict, Any, Optional
+
+from config import Config
+from metrics import FLOWS_ABANDONED, flow_for_state
+
+logger = logging.getLogger(__name__)
+
+class SessionState(IntEnum):
+    """USSD menu states; member names are the state names used in handlers and the database"""
+    main_menu = 0
+    send_btc_phone = 1
+    send_btc_amount = 2
+    receive_btc_amount = 3
+    send_invoice_phone = 4
+    send_invoice_amount = 5
+    topup_amount = 6
+    withdraw_amount = 7
+    withdraw_phone = 8
+    airtime_amount = 9
+    airtime_phone = 10
+
+# Legacy input_buffer keys -> typed session fields
+_DATA_FIELDS = {
+    'language': 'language',
+    'recipient': 'recipient',
+    'recipient_phone': 'recipient',
+    'invoice_recipient': 'recipient',
+    'kes_amount': 'kes_amount',
+    'withdraw_kes': 'kes_amount',
+    'airtime_kes': 'kes_amount',
+}
+
+@dataclass(slots=True, eq=False)
+class USSDSession:
+    """
+    One live USSD session.
+
+    Slotted, with the state held as a SessionState and the flow inputs as typed
+    fields, so tens of thousands of concurrent sessions do not each carry an
+    instance __dict__ and a data dict. Only one flow runs per session at a
+    time, so the send and invoice flows share `recipient` and the withdraw
+    and airtime flows share `kes_amount`. Keys without a field go to `extra`,
+    which is only allocated when used.
+    """
+    session_id: str
+    phone_number: str
+    state_id: SessionState = SessionState.main_menu
+    language: Optional[str] = None
+    recipient: Optional[str] = None
+    kes_amount: Optional[int] = None
+    extra: Optional[Dict[str, Any]] = None
+    last_activity: float = field(default_factory=time.time)
+
+    @property
+    def state(self) -> str:
+        return self.state_id.name
+
+    @state.setter
+    def state(self, state: str):
+        try:
+            self.state_id = SessionState[state]
+        except KeyError:
+            raise ValueError(f"Unknown USSD state: {state}") from None
+
+    def set_state(self, state: str):
+        self.state = state
+
+    def set_data(self, key: str, value):
+        name = _DATA_FIELDS.get(key)
+        if name is not None:
+            setattr(self, name, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def get_data(self, key: str, default=None):
+        name = _DATA_FIELDS.get(key)
+        if name is not None:
+            value = getattr(self, name)
+            return default if value is None else value
+        return self.extra.get(key, default) if self.extra else default
+
+    @property
+    def data(self) -> Dict[str, Any]:
+        """Flow inputs as a plain dict (the persisted input_buffer)"""
+        data = dict(self.extra) if self.extra else {}
+        for name in ('language', 'recipient', 'kes_amount'):
+            value = getattr(self, name)
+            if value is not None:
+                data[name] = value
+        return data
+
+    @data.setter
+    def data(self, data: Dict[str, Any]):
+        self.language = self.recipient = self.kes_amount = self.extra = None
+        for key, value in (data or {}).items():
+            self.set_data(key, value)
+
+class SessionStore:
+    """
+    In-memory USSD session store with batched persistence.
+
+    Every hop reads and mutates the in-memory session and marks it dirty. A
+    background thread flushes dirty sessions every flush_interval seconds, so
+    a user tapping through five screens costs one database write instead of
+    five. Ending a session flushes immediately. On a cache miss (e.g. after
+    a worker restart) the session is reloaded from the database.
+
+    Sessions for the same sessionId served by different workers can lag by
+    up to one flush interval.
+    """
+
+    def __init__(self, flush_interval: float = None, session_timeout: float = None,
+                 persist: bool = None):
+        self.flush_interval = flush_interval if flush_interval is not None else Config.SESSION_FLUSH_INTERVAL_MS / 1000
+        self.session_timeout = session_timeout if session_timeout is not None else Config.SESSION_TIMEOUT_MINUTES * 60
+        self.persist = Config.SESSION_PERSISTENCE if persist is None else persist
+
+        self._sessions: Dict[str, USSDSession] = {}
+        self._dirty: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._flush_requested = threading.Event()
+        self._stopped = threading.Event()
+        self._flusher = None
+        self._last_sweep = time.time()
+
+        self.stats = {'flushes': 0, 'sessions_written': 0, 'flush_errors': 0, 'db_loads': 0}
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def __contains__(self, session_id: str) -> bool:
+        return session_id in self._sessions
+
+    def get_or_create(self, session_id: str, phone_number: str) -> USSDSession:
+        """Get a live session, reload it from the database, or create a new one"""
+        session = self._sessions.get(session_id)
+        if session is not None:
+            session.last_activity = time.time()
+            return session
+
+        session = self._load(session_id) or USSDSession(session_id, phone_number)
+
+        with self._lock:
+            # Another thread may have created it while we were loading
+            session = self._sessions.setdefault(session_id, session)
+        # The same thread evicts idle sessions, so it runs even without persistence
+        self._ensure_flusher()
+        return session
+
+    def _load(self, session_id: str) -> Optional[USSDSession]:
+        """Restore a session persisted by this or another worker"""
+        if not self.persist:
+            return None
+        try:
+            from session_helpers import UssdSessionManager
+            state = UssdSessionManager.load_session_state(session_id)
+        except Exception as e:
+            logger.error(f"Error loading session {session_id}: {e}")
+            return None
+        if not state:
+            return None
+
+        self.stats['db_loads'] += 1
+        session = USSDSession(session_id, state['phone_number'])
+        try:
+            session.state = state['current_state']
+        except ValueError:
+            logger.warning(f"Session {session_id} has unknown state {state['current_state']!r}, using main_menu")
+        session.data = state['input_buffer']
+        return session
+
+    def mark_dirty(self, session: USSDSession):
+        """Queue a live session for the next batched flush"""
+        if not self.persist:
+            return
+        with self._lock:
+            # Sessions ended during this hop must not be resurrected
+            if self._sessions.get(session.session_id) is not session:
+                return
+            self._dirty[session.session_id] = self._snapshot(session, is_active=True)
+        self._ensure_flusher()
+
+    def end(self, session_id: str):
+        """End a session: drop it from memory and persist it as inactive now"""
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+            if session is not None and self.persist:
+                self._dirty[session_id] = self._snapshot(session, is_active=False)
+        if session is not None and self.persist:
+            self._ensure_flusher()
+            self._flush_requested.set()
+
+    def _snapshot(self, session: USSDSession, is_active: bool) -> Dict[str, Any]:
+        """Copy a session into a database record (callers hold the lock)"""
+        return {
+            'session_id': session.session_id,
+            'phone_number': session.phone_number,
+            'current_state': session.state,
+            'input_buffer': session.data,
+            'last_activity': datetime.fromtimestamp(session.last_activity),
+            'is_active': is_active
+        }
+
+    def _ensure_flusher(self):
+        """Start the background flusher/sweeper on first use (never at import time)"""
+        if self._flusher is not None and self._flusher.is_alive():
+            return
+        with self._lock:
+            if self._flusher is not None and self._flusher.is_alive():
+                return
+            self._stopped.clear()
+            self._flusher = threading.Thread(target=self._run, name="ussd-session-flusher", daemon=True)
+            self._flusher.start()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._flush_requested.wait(self.flush_interval)
+            self._flush_requested.clear()
+            self.flush()
+            self._sweep_expired()
+
+    def flush(self) -> int:
+        """
+        Write all dirty sessions to the database in one batch.
+
+        Returns:
+            Number of sessions written
+        """
+        with self._lock:
+            if not self._dirty:
+                return 0
+            batch, self._dirty = self._dirty, {}
+
+        records = []
+        for record in batch.values():
+            # Serialize once per flush rather than once per hop
+            records.append({**record, 'input_buffer': json.dumps(record['input_buffer'], default=str)})
+
+        try:
+            from session_helpers import UssdSessionManager
+            written = UssdSessionManager.save_sessions(records)
+        except Exception as e:
+            logger.error(f"Session flush failed, will retry {len(batch)} sessions: {e}")
+            self.stats['flush_errors'] += 1
+            with self._lock:
+                # Keep anything written by a newer hop in the meantime
+                for session_id, record in batch.items():
+                    self._dirty.setdefault(session_id, record)
+            return 0
+
+        self.stats['flushes'] += 1
+        self.stats['sessions_written'] += written
+        return written
+
+    def _sweep_expired(self):
+        """Evict sessions idle longer than the timeout (at most once a minute)"""
+        now = time.time()
+        if now - self._last_sweep < 60:
+            return
+        self._last_sweep = now
+
+        cutoff = now - self.session_timeout
+        with self._lock:
+            expired = [sid for sid, session in self._sessions.items() if session.last_activity < cutoff]
+            for session_id in expired:
+                session = self._sessions.pop(session_id)
+                flow = flow_for_state(session.state)
+                if flow:
+                    FLOWS_ABANDONED.inc(flow)
+                if self.persist:
+                    self._dirty[session_id] = self._snapshot(session, is_active=False)
+        if expired:
+            logger.info(f"Evicted {len(expired)} idle USSD sessions")
+
+    def close(self):
+        """Stop the flusher and write any pending sessions"""
+        self._stopped.set()
+        self._flush_requested.set()
+        if self._flusher is not None:
+            self._flusher.join(timeout=5)
+        self.flush()
+
+# Global session store
+session_store = SessionStore()
+atexit.register(session_store.close)
@@ -0,0 +1,175 @@
+"""
+Request coalescing for retried USSD hops
+Single-flight execution keyed by (sessionId, text) and per-phone locks around balance changes
+
+Africa's Talking resends a hop when we answer slowly. USSD text is cumulative
+("4*500"), so an identical (sessionId, text) pair within a session is always a
+retry: the retry waits for the first execution and gets the same response, and
+retries arriving shortly after it finished get the cached response. Neither
+re-runs the handler, so a retry cannot send a second STK push or payment.
+
+Both guards are per process. Retries routed to another worker are still
+serialized on the balance by the phone locks only within that worker.
+
+Usage:
+    from single_flight import ussd_flight, phone_locks
+
+    response, outcome = ussd_flight.do((session_id, text), handle_hop)
+    with phone_locks.hold(from_phone, to_phone):
+        ...check and debit balance...
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Hashable, List, Tuple
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+EXECUTED = 'executed'
+WAITED = 'waited'
+CACHED = 'cached'
+
+class _Call:
+    __slots__ = ('done', 'result', 'error', 'expires')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.expires = None
+
+class SingleFlight:
+    """
+    Run one execution per key at a time and share its result.
+
+    Callers with a key that is already running block until it finishes and
+    receive its result (or its exception). Successful results stay cached for
+    ttl seconds; failures are not cached, so a later retry runs again.
+    """
+
+    def __init__(self, ttl: float = None, max_entries: int = 4096):
+        self.ttl = ttl if ttl is not None else Config.USSD_RETRY_CACHE_SECONDS
+        self.max_entries = max_entries
+        self._calls: 'OrderedDict[Hashable, _Call]' = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.stats = {EXECUTED: 0, WAITED: 0, CACHED: 0}
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Tuple[Any, str]:
+        """
+        Execute fn once for concurrent and recent callers with the same key.
+
+        Returns:
+            (result, outcome) where outcome is 'executed', 'waited' or 'cached'
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None and call.done.is_set() and call.expires <= time.monotonic():
+                del self._calls[key]
+                call = None
+            if call is None:
+                call = _Call()
+                self._calls[key] = call
+                owner = True
+                self._prune()
+            else:
+                owner = False
+
+        if not owner:
+            outcome = CACHED if call.done.is_set() else WAITED
+            call.done.wait()
+            self.stats[outcome] += 1
+            if call.error is not None:
+                raise call.error
+            logger.info(f"Coalesced duplicate request {key!r} ({outcome})")
+            return call.result, outcome
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            with self._lock:
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+            raise
+        finally:
+            call.expires = time.monotonic() + self.ttl
+            call.done.set()
+        self.stats[EXECUTED] += 1
+        return call.result, EXECUTED
+
+    def _prune(self):
+        """Drop expired results once the table is over max_entries (caller holds the lock)"""
+        if len(self._calls) <= self.max_entries:
+            return
+        now = time.monotonic()
+        expired = [key for key, call in self._calls.items() if call.done.is_set() and call.expires <= now]
+        for key in expired:
+            del self._calls[key]
+        # Still full of live entries: drop the oldest finished ones
+        while len(self._calls) > self.max_entries:
+            key, call = next(iter(self._calls.items()))
+            if not call.done.is_set():
+                break
+            del self._calls[key]
+
+    def forget(self, key: Hashable):
+        """Remove a cached result"""
+        with self._lock:
+            self._calls.pop(key, None)
+
+class KeyedLocks:
+    """
+    Re-entrant locks per key (e.g. phone number), created on demand and
+    dropped when no thread holds or waits for them.
+    """
+
+    def __init__(self):
+        self._locks: Dict[Hashable, List] = {}  # key -> [RLock, users]
+        self._lock = threading.Lock()
+
+    def _acquire_entry(self, key: Hashable) -> threading.RLock:
+        with self._lock:
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = self._locks[key] = [threading.RLock(), 0]
+            entry[1] += 1
+        return entry[0]
+
+    def _release_entry(self, key: Hashable):
+        with self._lock:
+            entry = self._locks[key]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    @contextmanager
+    def hold(self, *keys: Hashable):
+        """Hold the locks for all keys, acquired in sorted order so two holders cannot deadlock"""
+        ordered = sorted({key for key in keys if key})
+        held = []
+        try:
+            for key in ordered:
+                lock = self._acquire_entry(key)
+                try:
+                    lock.acquire()
+                except BaseException:
+                    self._release_entry(key)
+                    raise
+                held.append((key, lock))
+            yield
+        finally:
+            for key, lock in reversed(held):
+                lock.release()
+                self._release_entry(key)
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+# Global instances
+ussd_flight = SingleFlight()
+phone_locks = KeyedLocks()
@@ -0,0 +1,435 @@
+"""
+Outbound SMS queue
+Persistent SQLite outbox drained by a background sender with batching, rate limiting, retries and delivery tracking
+
+Handlers enqueue and return immediately; a sender thread in each worker claims
+due messages, groups recipients of identical text into one Africa's Talking
+request (the `to` field takes a comma-separated list), and records the
+per-recipient result. Failed sends are retried with exponential backoff, and
+delivery reports posted to /webhook/sms_delivery update the final status.
+
+Usage:
+    from sms_queue import send_sms
+
+    send_sms("+254712345678", "Invoice: lnbc...", kind="invoice")
+
+    python sms_queue.py stats
+    python sms_queue.py fake --port 8089   # local fake AT messaging endpoint
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+from urllib.parse import parse_qs
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# Outbox states
+QUEUED = 'queued'
+SENDING = 'sending'
+SENT = 'sent'
+DELIVERED = 'delivered'
+FAILED = 'failed'
+
+# Africa's Talking per-recipient status codes
+AT_ACCEPTED = {100, 101, 102}         # Processed, Sent, Queued
+AT_RETRYABLE = {405, 407, 500, 501, 502}  # InsufficientBalance, CouldNotRoute, server/gateway errors
+
+# Delivery report statuses that end a message's life
+DELIVERY_FINAL = {'Success': DELIVERED, 'Failed': FAILED, 'Rejected': FAILED, 'AbsentSubscriber': FAILED}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sms_outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    phone TEXT NOT NULL,
+    message TEXT NOT NULL,
+    kind TEXT NOT NULL DEFAULT 'notification',
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    claimed_by INTEGER,
+    message_id TEXT,
+    cost TEXT,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sms_outbox_due ON sms_outbox (status, next_attempt_at);
+CREATE INDEX IF NOT EXISTS sms_outbox_message_id ON sms_outbox (message_id);
+"""
+
+class TokenBucket:
+    """Blocking token bucket: rate tokens per second, up to burst"""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self, stop: threading.Event = None) -> bool:
+        """Wait for a token; returns False if stop was set while waiting"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self.rate
+            if stop is not None:
+                if stop.wait(wait):
+                    return False
+            else:
+                time.sleep(wait)
+
+class SMSQueue:
+    """
+    SQLite-backed SMS outbox with a background sender.
+
+    Claims are made in an IMMEDIATE transaction, so several workers can share
+    one outbox file without sending a message twice. Messages left in
+    'sending' by a crashed worker are re-queued after claim_timeout seconds.
+    """
+
+    def __init__(self, path: str = None, client=None, batch_size: int = None, rate_per_second: float = None,
+                 max_attempts: int = None, retry_base: float = None, poll_interval: float = None,
+                 claim_timeout: float = 300.0):
+        self.path = path or Config.SMS_QUEUE_PATH
+        self._client = client
+        self.batch_size = batch_size or Config.SMS_BATCH_SIZE
+        self.bucket = TokenBucket(rate_per_second or Config.SMS_RATE_PER_SECOND,
+                                  burst=max(1, int(rate_per_second or Config.SMS_RATE_PER_SECOND)))
+        self.max_attempts = max_attempts or Config.SMS_MAX_ATTEMPTS
+        self.retry_base = retry_base if retry_base is not None else Config.SMS_RETRY_BASE_SECONDS
+        self.poll_interval = poll_interval if poll_interval is not None else Config.SMS_POLL_INTERVAL
+        self.claim_timeout = claim_timeout
+
+        self._local = threading.local()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._sender = None
+        self._sender_pid = None
+        self._lock = threading.Lock()
+        self._initialized = False
+
+        self.stats = {'requests': 0, 'sent': 0, 'retried': 0, 'failed': 0}
+
+    @property
+    def client(self):
+        """Africa's Talking client, imported on first send"""
+        if self._client is None:
+            from at_sandbox_client import at_client
+            self._client = at_client
+        return self._client
+
+    def _connection(self) -> sqlite3.Connection:
+        """One connection per thread (and per process: connections do not survive fork)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            if not self._initialized:
+                conn.executescript(SCHEMA)
+                self._initialized = True
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def enqueue(self, phone: str, message: str, kind: str = 'notification') -> int:
+        """Queue one message; returns its outbox id"""
+        return self.enqueue_many([phone], message, kind)[0]
+
+    def enqueue_many(self, phones: List[str], message: str, kind: str = 'notification') -> List[int]:
+        """Queue the same message for several recipients (sent as one batched request when due together)"""
+        now = time.time()
+        conn = self._connection()
+        ids = []
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for phone in phones:
+                cursor = conn.execute(
+                    'INSERT INTO sms_outbox (phone, message, kind, next_attempt_at, created_at, updated_at) '
+                    'VALUES (?, ?, ?, ?, ?, ?)', (phone, message, kind, now, now, now))
+                ids.append(cursor.lastrowid)
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        logger.info(f"Queued {kind} SMS for {len(phones)} recipient(s): {ids}")
+        self._ensure_sender()
+        self._wake.set()
+        return ids
+
+    def _claim(self) -> List[sqlite3.Row]:
+        """Claim due messages for this process"""
+        now = time.time()
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Recover claims abandoned by a worker that died mid-send
+            conn.execute("UPDATE sms_outbox SET status = ?, claimed_by = NULL WHERE status = ? AND updated_at < ?",
+                         (QUEUED, SENDING, now - self.claim_timeout))
+            rows = conn.execute("SELECT * FROM sms_outbox WHERE status = ? AND next_attempt_at <= ? "
+                                "ORDER BY next_attempt_at, id LIMIT ?",
+                                (QUEUED, now, self.batch_size * 10)).fetchall()
+            if rows:
+                conn.executemany("UPDATE sms_outbox SET status = ?, claimed_by = ?, updated_at = ? WHERE id = ?",
+                                 [(SENDING, os.getpid(), now, row['id']) for row in rows])
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return rows
+
+    @staticmethod
+    def _batches(rows: List[sqlite3.Row], batch_size: int) -> List[List[sqlite3.Row]]:
+        """Group rows with identical text into batches of at most batch_size recipients"""
+        groups: 'OrderedDict[str, List[sqlite3.Row]]' = OrderedDict()
+        for row in rows:
+            groups.setdefault(row['message'], []).append(row)
+        batches = []
+        for group in groups.values():
+            for start in range(0, len(group), batch_size):
+                batches.append(group[start:start + batch_size])
+        return batches
+
+    def _send_batch(self, batch: List[sqlite3.Row]):
+        phones = [row['phone'] for row in batch]
+        self.stats['requests'] += 1
+        try:
+            response = self.client.send_bulk_sms(phones, batch[0]['message'])
+        except Exception as e:
+            response = {'status': 'error', 'message': str(e)}
+
+        recipients = {}
+        if isinstance(response, dict):
+            for recipient in response.get('SMSMessageData', {}).get('Recipients', []) or []:
+                recipients[recipient.get('number')] = recipient
+        error = None if recipients else (response.get('message') if isinstance(response, dict) else str(response))
+
+        updates = []
+        now = time.time()
+        for row in batch:
+            recipient = recipients.get(row['phone'])
+            attempts = row['attempts'] + 1
+            if recipient is not None and int(recipient.get('statusCode', 0)) in AT_ACCEPTED:
+                self.stats['sent'] += 1
+                updates.append((SENT, attempts, now, recipient.get('messageId'), recipient.get('cost'), None, now,
+                                row['id']))
+                continue
+            if recipient is not None:
+                code = int(recipient.get('statusCode', 0))
+                reason = f"{code} {recipient.get('status', '')}".strip()
+                retryable = code in AT_RETRYABLE
+            else:
+                reason = error or 'no result for recipient'
+                retryable = True
+            if retryable and attempts < self.max_attempts:
+                self.stats['retried'] += 1
+                delay = self.retry_base * (2 ** (attempts - 1))
+                updates.append((QUEUED, attempts, now + delay, None, None, reason, now, row['id']))
+                logger.warning(f"SMS {row['id']} to {row['phone']} failed ({reason}); retry in {delay:.1f}s")
+            else:
+                self.stats['failed'] += 1
+                updates.append((FAILED, attempts, now, None, None, reason, now, row['id']))
+                logger.error(f"SMS {row['id']} to {row['phone']} failed permanently: {reason}")
+
+        conn = self._connection()
+        conn.executemany("UPDATE sms_outbox SET status = ?, attempts = ?, next_attempt_at = ?, message_id = ?, "
+                         "cost = ?, last_error = ?, claimed_by = NULL, updated_at = ? WHERE id = ?",
+                         updates)
+
+    def drain(self) -> int:
+        """Send everything due now; returns the number of messages attempted"""
+        attempted = 0
+        while not self._stopped.is_set():
+            rows = self._claim()
+            if not rows:
+                break
+            claimed_at = time.time()
+            for batch in self._batches(rows, self.batch_size):
+                if not self.bucket.take(self._stopped):
+                    # Shutting down: hand unsent claims back to the queue
+                    self._release([row['id'] for row in batch])
+                    continue
+                if time.time() - claimed_at >= self.claim_timeout / 2:
+                    self._refresh_claims()
+                    claimed_at = time.time()
+                self._send_batch(batch)
+                attempted += len(batch)
+        return attempted
+
+    def _refresh_claims(self):
+        """Touch this process's claimed rows so other workers do not recover them mid-drain"""
+        self._connection().execute("UPDATE sms_outbox SET updated_at = ? WHERE status = ? AND claimed_by = ?",
+                                   (time.time(), SENDING, os.getpid()))
+
+    def _release(self, ids: List[int]):
+        conn = self._connection()
+        conn.executemany("UPDATE sms_outbox SET status = ?, claimed_by = NULL WHERE id = ? AND status = ?",
+                         [(QUEUED, message_id, SENDING) for message_id in ids])
+
+    def _ensure_sender(self):
+        if self._sender_pid == os.getpid():
+            return
+        with self._lock:
+            if self._sender_pid == os.getpid():
+                return
+            self._sender_pid = os.getpid()
+            self._sender = threading.Thread(target=self._run, name='sms-sender', daemon=True)
+            self._sender.start()
+
+    def start(self):
+        """Start the sender (it also starts on the first enqueue)"""
+        self._ensure_sender()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self.drain()
+            except Exception as e:
+                logger.error(f"SMS sender error: {e}")
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+
+    def record_delivery(self, message_id: str, status: str, failure_reason: str = '') -> bool:
+        """Apply an Africa's Talking delivery report; returns False for unknown message ids"""
+        new_status = DELIVERY_FINAL.get(status)
+        conn = self._connection()
+        if new_status is None:
+            # Intermediate report (Sent, Submitted, Buffered): just note it
+            cursor = conn.execute("UPDATE sms_outbox SET last_error = ?, updated_at = ? WHERE message_id = ?",
+                                  (f"delivery: {status}", time.time(), message_id))
+        else:
+            cursor = conn.execute("UPDATE sms_outbox SET status = ?, last_error = ?, updated_at = ? WHERE message_id = ?",
+                                  (new_status, failure_reason or None, time.time(), message_id))
+        return cursor.rowcount > 0
+
+    def status(self, outbox_id: int) -> Optional[Dict[str, Any]]:
+        """One message's outbox row"""
+        row = self._connection().execute("SELECT * FROM sms_outbox WHERE id = ?", (outbox_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def counts(self) -> Dict[str, int]:
+        """Messages per status"""
+        rows = self._connection().execute("SELECT status, COUNT(*) FROM sms_outbox GROUP BY status").fetchall()
+        return {status: count for status, count in rows}
+
+    def close(self):
+        self._stopped.set()
+        self._wake.set()
+
+# Global instance
+sms_queue = SMSQueue()
+
+def send_sms(phone_number: str, message: str, kind: str = 'notification') -> Optional[int]:
+    """Queue an SMS without blocking; returns the outbox id, or None when SMS is disabled or queuing failed"""
+    if not Config.SMS_ENABLED:
+        logger.info(f"SMS disabled, not sending {kind} to {phone_number}")
+        return None
+    try:
+        return sms_queue.enqueue(phone_number, message, kind)
+    except Exception as e:
+        logger.error(f"Could not queue {kind} SMS to {phone_number}: {e}")
+        return None
+
+class FakeAfricasTalking:
+    """
+    Local stand-in for the Africa's Talking messaging endpoint.
+
+    Point AFRICASTALKING_API_URL at fake.url. Numbers listed in fail_numbers
+    get status 403 (InvalidPhoneNumber); with busy=True every request gets 500.
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, fail_numbers=(), busy: bool = False):
+        self.fail_numbers = set(fail_numbers)
+        self.busy = busy
+        self.requests: List[Dict[str, Any]] = []
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+                form = {key: values[0] for key, values in parse_qs(body).items()}
+                fake.requests.append(form)
+                if fake.busy:
+                    return self._send(500, {'error': 'busy'})
+                if not self.path.rstrip('/').endswith('/messaging'):
+                    return self._send(404, {'error': 'not found'})
+                recipients = []
+                for number in form.get('to', '').split(','):
+                    number = number.strip()
+                    if number in fake.fail_numbers:
+                        recipients.append({'statusCode': 403, 'number': number, 'status': 'InvalidPhoneNumber',
+                                           'cost': '0', 'messageId': 'None'})
+                    else:
+                        recipients.append({'statusCode': 101, 'number': number, 'status': 'Success',
+                                           'cost': 'KES 0.8000', 'messageId': f'ATXid_{len(fake.requests)}_{number}'})
+                sent = sum(1 for r in recipients if r['statusCode'] == 101)
+                self._send(201, {'SMSMessageData': {'Message': f'Sent to {sent}/{len(recipients)}',
+                                                    'Recipients': recipients}})
+
+            def _send(self, status: int, payload: Dict[str, Any]):
+                data = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://{host}:{self.server.server_address[1]}/version1"
+        self._thread = None
+
+    def start(self) -> 'FakeAfricasTalking':
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True, name='fake-africastalking')
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self) -> 'FakeAfricasTalking':
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Outbound SMS queue')
+    subcommands = parser.add_subparsers(dest='command', required=True)
+    subcommands.add_parser('stats', help='Messages per status')
+    fake_parser = subcommands.add_parser('fake', help='Run a fake Africa\'s Talking messaging endpoint')
+    fake_parser.add_argument('--port', type=int, default=8089)
+    args = parser.parse_args()
+
+    if args.command == 'stats':
+        print(json.dumps(sms_queue.counts(), indent=2))
+    else:
+        fake = FakeAfricasTalking(port=args.port)
+        print(f"Fake Africa's Talking on {fake.url} (AFRICASTALKING_API_URL={fake.url})")
+        try:
+            fake.server.serve_forever()
+        except KeyboardInterrupt:
+            fake.stop()
@@ -0,0 +1,316 @@
+"""
+Static assets for the landing page
+Loads, minifies, hashes and pre-compresses index.html, styles.css and script.js once, and serves them from memory
+
+Each asset is kept as ready-to-send byte strings (identity, gzip and, when the
+brotli package is installed, br) with a content-hash ETag. The page links
+styles.css and script.js with ?v=<hash>, and versioned requests are cached by
+browsers and proxies as immutable; unversioned requests revalidate and get a
+304 when the ETag still matches. Files are re-read when their mtime changes.
+
+Usage:
+    from static_assets import static_assets
+
+    body, status, headers = static_assets.respond('styles.css', request.headers, request.args.get('v'))
+"""
+import gzip
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+from typing import Dict, Mapping, Optional, Tuple
+
+from config import Config
+from metrics import STATIC_RESPONSES
+
+try:
+    import brotli
+except ImportError:  # Optional: gzip only
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+PAGE_CACHE_CONTROL = 'no-cache'
+
+# Content codings in server preference order
+ENCODINGS = ('br', 'gzip', 'identity')
+
+class StaticMinifier:
+    """Conservative whitespace/comment minifiers that leave strings and line structure intact"""
+
+    _CSS_TOKENS = re.compile(r'("(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\')|/\*.*?\*/|\s+', re.S)
+    _CSS_PUNCTUATION = re.compile(r' ?([{};,]) ?')
+    _HTML_RAW_BLOCKS = re.compile(r'(<(pre|textarea|script|style)\b.*?</\2\s*>)', re.S | re.I)
+    _HTML_COMMENT = re.compile(r'<!--(?!\[if).*?-->', re.S)
+
+    @staticmethod
+    def css(source: str) -> str:
+        """Drop comments and collapse whitespace outside strings"""
+        out = []
+        pending = []  # CSS text since the last string literal
+        pos = 0
+        for match in StaticMinifier._CSS_TOKENS.finditer(source):
+            pending.append(source[pos:match.start()])
+            if match.group(1):
+                out.append(StaticMinifier._css_text(''.join(pending)))
+                out.append(match.group(1))
+                pending = []
+            else:
+                pending.append(' ')
+            pos = match.end()
+        pending.append(source[pos:])
+        out.append(StaticMinifier._css_text(''.join(pending)))
+        return ''.join(out).strip()
+
+    @staticmethod
+    def _css_text(text: str) -> str:
+        text = StaticMinifier._CSS_PUNCTUATION.sub(r'\1', re.sub(r' {2,}', ' ', text))
+        return text.replace(';}', '}')
+
+    @staticmethod
+    def js(source: str) -> str:
+        """
+        Strip indentation, blank lines and whole-line // comments.
+
+        Newlines are kept so automatic semicolon insertion is unchanged. Files
+        with template literals (which may span lines) are returned as-is.
+        """
+        if '`' in source:
+            return source
+        lines = []
+        for line in source.splitlines():
+            stripped = line.strip()
+            if not stripped or stripped.startswith('//'):
+                continue
+            lines.append(stripped)
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def html(source: str) -> str:
+        """Drop comments, indentation and blank lines outside pre/textarea/script/style"""
+        parts = []
+        pos = 0
+        for match in StaticMinifier._HTML_RAW_BLOCKS.finditer(source):
+            parts.append(StaticMinifier._html_text(source[pos:match.start()]))
+            parts.append(match.group(1))
+            pos = match.end()
+        parts.append(StaticMinifier._html_text(source[pos:]))
+        return ''.join(parts)
+
+    @staticmethod
+    def _html_text(text: str) -> str:
+        text = StaticMinifier._HTML_COMMENT.sub('', text)
+        return re.sub(r'\n\s*', '\n', text)
+
+MINIFIERS = {
+    'text/css': StaticMinifier.css,
+    'application/javascript': StaticMinifier.js,
+    'text/html': StaticMinifier.html,
+}
+
+class Asset:
+    """One file held in memory as pre-encoded variants"""
+    __slots__ = ('name', 'path', 'mimetype', 'mtime', 'version', 'variants', 'etags')
+
+    def __init__(self, name: str, path: str, mimetype: str, mtime: float, content: bytes):
+        self.name = name
+        self.path = path
+        self.mimetype = mimetype
+        self.mtime = mtime
+        self.version = hashlib.sha256(content).hexdigest()[:16]
+        self.variants: Dict[str, bytes] = {'identity': content}
+        self.variants['gzip'] = gzip.compress(content, compresslevel=9, mtime=0)
+        if brotli is not None:
+            self.variants['br'] = brotli.compress(content, quality=11)
+        # Different bytes per coding, so each variant gets its own strong ETag
+        self.etags = {encoding: f'"{self.version}-{encoding}"' for encoding in self.variants}
+
+class StaticAssets:
+    """In-memory asset registry with conditional GET, content negotiation and mtime reload"""
+
+    def __init__(self, directory: str = None, check_interval: float = None, minify: bool = None,
+                 max_age: int = None):
+        self.directory = directory or Config.STATIC_ASSET_DIR
+        self.check_interval = check_interval if check_interval is not None else Config.STATIC_ASSET_CHECK_SECONDS
+        self.minify = minify if minify is not None else Config.STATIC_ASSET_MINIFY
+        self.max_age = max_age if max_age is not None else Config.STATIC_ASSET_MAX_AGE
+        self._files: Dict[str, str] = {}  # name -> mimetype
+        self._page: Optional[str] = None
+        self._assets: Dict[str, Asset] = {}
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def register(self, name: str, mimetype: str, page: bool = False):
+        """Add a file served by name; the page has its links to other assets versioned"""
+        self._files[name] = mimetype
+        if page:
+            self._page = name
+        self._checked_at = 0.0
+
+    def _load(self, name: str, mtime: float) -> Asset:
+        path = os.path.join(self.directory, name)
+        mimetype = self._files[name]
+        with open(path, 'rb') as f:
+            content = f.read()
+        kind = mimetype.split(';')[0]
+        if self.minify and kind in MINIFIERS:
+            content = MINIFIERS[kind](content.decode('utf-8')).encode('utf-8')
+        if name == self._page:
+            content = self._version_links(content.decode('utf-8')).encode('utf-8')
+        return Asset(name, path, mimetype, mtime, content)
+
+    def _version_links(self, html: str) -> str:
+        """Point href/src attributes at ?v=<hash> URLs of the other assets"""
+        for name, asset in self._assets.items():
+            if name == self._page:
+                continue
+            html = re.sub(rf'((?:href|src)=["\']){re.escape(name)}(["\'])',
+                          rf'\g<1>{name}?v={asset.version}\g<2>', html)
+        return html
+
+    def refresh(self, force: bool = False):
+        """Reload files whose mtime changed (at most once per check_interval unless forced)"""
+        now = time.monotonic()
+        if not force and now - self._checked_at < self.check_interval:
+            return
+        with self._lock:
+            if not force and now - self._checked_at < self.check_interval:
+                return
+            self._checked_at = now
+            changed = False
+            # The page goes last: its links embed the other assets' hashes
+            names = sorted(self._files, key=lambda name: name == self._page)
+            for name in names:
+                try:
+                    mtime = os.stat(os.path.join(self.directory, name)).st_mtime
+                except FileNotFoundError:
+                    if self._assets.pop(name, None) is not None:
+                        logger.warning(f"Static asset {name} removed")
+                        changed = True
+                    continue
+                current = self._assets.get(name)
+                if current is not None and current.mtime == mtime and not (name == self._page and changed):
+                    continue
+                try:
+                    self._assets[name] = self._load(name, mtime)
+                except OSError as e:
+                    logger.error(f"Could not load static asset {name}: {e}")
+                    continue
+                changed = True
+                asset = self._assets[name]
+                logger.info(f"Loaded static asset {name} ({len(asset.variants['identity'])} bytes, "
+                            f"version {asset.version})")
+
+    def get(self, name: str) -> Optional[Asset]:
+        """Current version of an asset, or None if its file does not exist"""
+        self.refresh()
+        return self._assets.get(name)
+
+    @staticmethod
+    def choose_encoding(accept_encoding: str, available) -> str:
+        """Preferred coding allowed by an Accept-Encoding header (q=0 excludes a coding)"""
+        weights = {}
+        for part in (accept_encoding or '').split(','):
+            token, _, params = part.partition(';')
+            token = token.strip().lower()
+            if not token:
+                continue
+            q = 1.0
+            key, _, value = params.strip().partition('=')
+            if key.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+            weights[token] = q
+        for encoding in ENCODINGS:
+            if encoding in available and weights.get(encoding, weights.get('*', 0.0)) > 0:
+                return encoding
+        return 'identity'
+
+    @staticmethod
+    def etag_matches(if_none_match: str, etag: str) -> bool:
+        """Weak comparison against an If-None-Match header"""
+        if not if_none_match:
+            return False
+        if if_none_match.strip() == '*':
+            return True
+        for tag in if_none_match.split(','):
+            tag = tag.strip()
+            if tag.startswith('W/'):
+                tag = tag[2:]
+            if tag == etag:
+                return True
+        return False
+
+    def respond(self, name: str, headers: Mapping[str, str], version: str = None) -> Tuple[bytes, int, Dict[str, str]]:
+        """
+        Build a response for an asset request.
+
+        Args:
+            name: Registered asset name
+            headers: Request headers (Accept-Encoding, If-None-Match)
+            version: The ?v= query value, if any
+
+        Returns:
+            (body, status, headers); raises FileNotFoundError if the asset is missing
+        """
+        asset = self.get(name)
+        if asset is None:
+            raise FileNotFoundError(os.path.join(self.directory, name))
+
+        encoding = self.choose_encoding(headers.get('Accept-Encoding', ''), asset.variants)
+        etag = asset.etags[encoding]
+        if name == self._page:
+            cache_control = PAGE_CACHE_CONTROL
+        elif version == asset.version:
+            cache_control = IMMUTABLE_CACHE_CONTROL
+        else:
+            cache_control = f'public, max-age={self.max_age}'
+
+        response_headers = {
+            'ETag': etag,
+            'Cache-Control': cache_control,
+            'Vary': 'Accept-Encoding',
+        }
+        if self.etag_matches(headers.get('If-None-Match', ''), etag):
+            STATIC_RESPONSES.inc(name, encoding, '304')
+            return b'', 304, response_headers
+
+        body = asset.variants[encoding]
+        response_headers['Content-Type'] = asset.mimetype
+        response_headers['Content-Length'] = str(len(body))
+        if encoding != 'identity':
+            response_headers['Content-Encoding'] = encoding
+        STATIC_RESPONSES.inc(name, encoding, '200')
+        return body, 200, response_headers
+
+def landing_assets(directory: str = None) -> StaticAssets:
+    """Registry of the landing page, its stylesheet and its script"""
+    assets = StaticAssets(directory=directory)
+    assets.register('styles.css', 'text/css; charset=utf-8')
+    assets.register('script.js', 'application/javascript; charset=utf-8')
+    assets.register('index.html', 'text/html; charset=utf-8', page=True)
+    return assets
+
+# Global instance
+static_assets = landing_assets()
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Show the landing page assets as they are served')
+    parser.add_argument('--dir', default=Config.STATIC_ASSET_DIR, help='Asset directory')
+    args = parser.parse_args()
+
+    assets = landing_assets(args.dir)
+    for name in ('index.html', 'styles.css', 'script.js'):
+        asset = assets.get(name)
+        if asset is None:
+            print(f"{name}: missing")
+            continue
+        sizes = ', '.join(f"{encoding} {len(body)}" for encoding, body in asset.variants.items())
+        print(f"{name}: version {asset.version}, source {os.path.getsize(asset.path)} bytes -> {sizes}")
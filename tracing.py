@@ -0,0 +1,392 @@
+"""
+Lightweight request tracing for the USSD hot path
+Context-local spans exported as OpenTelemetry (OTLP/JSON) to a file or a local collector
+
+Spans nest automatically through a ContextVar, so a /ussd hop produces a tree of
+MeTTa, database, Lightning, Intersend and OpenAI spans. When tracing is disabled
+every entry point returns a shared no-op span and costs one attribute check.
+"""
+import json
+import logging
+import queue
+import random
+import threading
+import time
+from contextvars import ContextVar
+from functools import wraps
+from typing import Dict, Any, List, Optional
+
+from config import Config
+from metrics import record_dependency
+from circuit_breaker import dependencies
+
+logger = logging.getLogger(__name__)
+
+# OTLP span kinds and status codes
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+SPAN_KIND_CLIENT = 3
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+_current_span: ContextVar[Optional['Span']] = ContextVar('current_span', default=None)
+
+class _NoopSpan:
+    """Shared stand-in returned while tracing is disabled"""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def set_attribute(self, key: str, value):
+        pass
+
+    def set_error(self, message: str):
+        pass
+
+NOOP_SPAN = _NoopSpan()
+
+class Span:
+    """One timed operation; finished spans are exported with the rest of their trace"""
+
+    __slots__ = ('tracer', 'name', 'kind', 'trace_id', 'span_id', 'parent_id', 'root',
+                 'attributes', 'start_ns', 'end_ns', 'status', 'status_message',
+                 'finished', '_token')
+
+    def __init__(self, tracer: 'Tracer', name: str, kind: int, parent: Optional['Span'],
+                 attributes: Optional[Dict[str, Any]]):
+        self.tracer = tracer
+        self.name = name
+        self.kind = kind
+        self.span_id = f"{random.getrandbits(64):016x}"
+        if parent is None:
+            self.trace_id = f"{random.getrandbits(128):032x}"
+            self.parent_id = None
+            self.root = self
+            self.finished: Optional[List['Span']] = []
+        else:
+            self.trace_id = parent.trace_id
+            self.parent_id = parent.span_id
+            self.root = parent.root
+            self.finished = None
+        self.attributes = dict(attributes) if attributes else {}
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.status = STATUS_OK
+        self.status_message = ""
+        self._token = None
+
+    def __enter__(self):
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc is not None:
+            self.set_error(f"{exc_type.__name__}: {exc}")
+        self.end()
+        if self._token is not None:
+            _current_span.reset(self._token)
+            self._token = None
+        return False
+
+    @property
+    def duration_ms(self) -> float:
+        end_ns = self.end_ns if self.end_ns is not None else time.time_ns()
+        return (end_ns - self.start_ns) / 1e6
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def set_error(self, message: str):
+        self.status = STATUS_ERROR
+        self.status_message = message[:500]
+
+    def end(self):
+        """Finish the span; the root hands the whole trace to the exporter"""
+        if self.end_ns is not None:
+            return
+        self.end_ns = time.time_ns()
+        root = self.root
+        if root is self:
+            self.finished.append(self)
+            self.tracer._finish_trace(self.finished)
+        elif root.end_ns is None:
+            root.finished.append(self)
+        else:
+            # Outlived its root (e.g. work handed to another thread)
+            self.tracer._finish_trace([self])
+
+    def to_otlp(self) -> Dict[str, Any]:
+        """Serialize in OTLP/JSON span form"""
+        span = {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'kind': self.kind,
+            'startTimeUnixNano': str(self.start_ns),
+            'endTimeUnixNano': str(self.end_ns),
+            'attributes': [_otlp_attribute(key, value) for key, value in self.attributes.items()],
+            'status': {'code': self.status}
+        }
+        if self.parent_id:
+            span['parentSpanId'] = self.parent_id
+        if self.status_message:
+            span['status']['message'] = self.status_message
+        return span
+
+def _otlp_attribute(key: str, value) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {'key': key, 'value': {'boolValue': value}}
+    if isinstance(value, int):
+        return {'key': key, 'value': {'intValue': str(value)}}
+    if isinstance(value, float):
+        return {'key': key, 'value': {'doubleValue': value}}
+    return {'key': key, 'value': {'stringValue': str(value)}}
+
+def format_tree(spans: List[Span]) -> str:
+    """Render a finished trace as an indented duration breakdown"""
+    children: Dict[Optional[str], List[Span]] = {}
+    span_ids = {span.span_id for span in spans}
+    for span in spans:
+        parent = span.parent_id if span.parent_id in span_ids else None
+        children.setdefault(parent, []).append(span)
+
+    lines = []
+    def walk(parent_id: Optional[str], depth: int):
+        for span in sorted(children.get(parent_id, []), key=lambda s: s.start_ns):
+            marker = " ✗" if span.status == STATUS_ERROR else ""
+            lines.append(f"{'  ' * depth}{span.name} {span.duration_ms:.1f} ms{marker}")
+            walk(span.span_id, depth + 1)
+    walk(None, 0)
+    return "\n".join(lines)
+
+class Tracer:
+    """
+    Span factory and batching exporter.
+
+    Usage:
+        with tracer.span('metta.run', {'metta.query': query}):
+            ...
+    """
+
+    def __init__(self, enabled: bool = False, exporter: str = 'file', file_path: str = 'traces.jsonl',
+                 endpoint: str = None, service_name: str = 'ussd-lightning', slow_trace_ms: float = 1000,
+                 export_interval: float = 1.0, max_queue: int = 10000):
+        self.enabled = enabled
+        self.exporter = exporter
+        self.file_path = file_path
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self.slow_trace_ms = slow_trace_ms
+        self.export_interval = export_interval
+
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self._worker = None
+        self._worker_lock = threading.Lock()
+        self._http_session = None
+        self.stats = {'traces': 0, 'spans_exported': 0, 'dropped': 0, 'export_errors': 0}
+
+    def span(self, name: str, attributes: Optional[Dict[str, Any]] = None, kind: int = SPAN_KIND_INTERNAL):
+        """Open a span as a child of the current one (use as a context manager)"""
+        if not self.enabled:
+            return NOOP_SPAN
+        return Span(self, name, kind, _current_span.get(), attributes)
+
+    def _finish_trace(self, spans: List[Span]):
+        root = spans[-1]
+        if root.parent_id is None and self.slow_trace_ms is not None and root.duration_ms >= self.slow_trace_ms:
+            logger.warning(f"Slow trace {root.trace_id} ({root.duration_ms:.1f} ms):\n{format_tree(spans)}")
+        try:
+            self._queue.put_nowait(spans)
+        except queue.Full:
+            self.stats['dropped'] += len(spans)
+            return
+        self.stats['traces'] += 1
+        self._ensure_worker()
+
+    def _ensure_worker(self):
+        if self._worker is not None and self._worker.is_alive():
+            return
+        with self._worker_lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+                self._worker.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.export_interval
+            while len(batch) < 512:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self.export([span for trace in batch for span in trace])
+
+    def export(self, spans: List[Span]):
+        """Write one batch of spans as an OTLP/JSON ExportTraceServiceRequest"""
+        if not spans:
+            return
+        payload = {
+            'resourceSpans': [{
+                'resource': {'attributes': [_otlp_attribute('service.name', self.service_name)]},
+                'scopeSpans': [{
+                    'scope': {'name': __name__},
+                    'spans': [span.to_otlp() for span in spans]
+                }]
+            }]
+        }
+        try:
+            if self.exporter == 'otlp':
+                if self._http_session is None:
+                    import requests
+                    self._http_session = requests.Session()
+                response = self._http_session.post(self.endpoint, json=payload, timeout=5)
+                response.raise_for_status()
+            else:
+                with open(self.file_path, 'a') as f:
+                    f.write(json.dumps(payload) + "\n")
+            self.stats['spans_exported'] += len(spans)
+        except Exception as e:
+            self.stats['export_errors'] += 1
+            logger.warning(f"Trace export failed ({len(spans)} spans): {e}")
+
+# Global tracer configured from the environment
+tracer = Tracer(
+    enabled=Config.TRACING_ENABLED,
+    exporter=Config.TRACING_EXPORTER,
+    file_path=Config.TRACING_FILE,
+    endpoint=Config.TRACING_OTLP_ENDPOINT,
+    service_name=Config.TRACING_SERVICE_NAME,
+    slow_trace_ms=Config.TRACING_SLOW_TRACE_MS
+)
+
+def span(name: str, attributes: Optional[Dict[str, Any]] = None, kind: int = SPAN_KIND_INTERNAL):
+    """Open a span on the global tracer"""
+    if not tracer.enabled:
+        return NOOP_SPAN
+    return Span(tracer, name, kind, _current_span.get(), attributes)
+
+def current_span():
+    """The active span, or a no-op span outside any trace"""
+    return _current_span.get() or NOOP_SPAN
+
+def traced(name: str = None, kind: int = SPAN_KIND_INTERNAL):
+    """Decorator that wraps every call in a span"""
+    def decorator(func):
+        span_name = name or func.__qualname__
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return func(*args, **kwargs)
+            with Span(tracer, span_name, kind, _current_span.get(), None):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def instrument_metta(metta):
+    """Trace every metta.run call on this interpreter instance"""
+    run = metta.run
+
+    @wraps(run)
+    def traced_run(program, *args, **kwargs):
+        if not tracer.enabled:
+            return run(program, *args, **kwargs)
+        with Span(tracer, 'metta.run', SPAN_KIND_INTERNAL, _current_span.get(),
+                  {'metta.program': program[:200] if isinstance(program, str) else str(program)[:200]}):
+            return run(program, *args, **kwargs)
+
+    metta.run = traced_run
+    return metta
+
+def instrument_openai(client):
+    """Trace chat.completions.create on an OpenAI client instance"""
+    completions = client.chat.completions
+    create = completions.create
+
+    breaker = dependencies.breaker('openai')
+
+    @wraps(create)
+    def traced_create(*args, **kwargs):
+        breaker.acquire()
+        start = time.perf_counter()
+        failed = True
+        try:
+            if not tracer.enabled:
+                response = create(*args, **kwargs)
+                failed = False
+                return response
+            with Span(tracer, 'openai.chat.completions.create', SPAN_KIND_CLIENT, _current_span.get(),
+                      {'peer.service': 'openai', 'gen_ai.request.model': kwargs.get('model', '')}) as active:
+                response = create(*args, **kwargs)
+                usage = getattr(response, 'usage', None)
+                if usage is not None:
+                    active.set_attribute('gen_ai.usage.input_tokens', getattr(usage, 'prompt_tokens', 0) or 0)
+                    active.set_attribute('gen_ai.usage.output_tokens', getattr(usage, 'completion_tokens', 0) or 0)
+                failed = False
+                return response
+        finally:
+            elapsed = time.perf_counter() - start
+            record_dependency('openai', elapsed, failed)
+            breaker.record(elapsed, failed)
+
+    completions.create = traced_create
+    return client
+
+class TracedHTTP:
+    """
+    Drop-in for requests.get/post that opens a client span per call.
+
+    Calls go through the peer service's circuit breaker and raise
+    CircuitOpenError without touching the network while it is open.
+
+    Usage:
+        http = TracedHTTP('lightning')
+        response = http.post(url, json=payload, timeout=10)
+
+    Pass a requests.Session to reuse its connection pool across calls.
+    """
+
+    def __init__(self, peer_service: str, session=None):
+        self.peer_service = peer_service
+        self.session = session
+
+    def request(self, method: str, url: str, **kwargs):
+        import requests
+        send = self.session.request if self.session is not None else requests.request
+        breaker = dependencies.breaker(self.peer_service)
+        breaker.acquire()
+        start = time.perf_counter()
+        failed = True
+        try:
+            if not tracer.enabled:
+                response = send(method, url, **kwargs)
+                failed = response.status_code >= 500
+                return response
+            with Span(tracer, f"HTTP {method} {self.peer_service}", SPAN_KIND_CLIENT, _current_span.get(),
+                      {'peer.service': self.peer_service, 'http.request.method': method,
+                       'url.full': url.split('?', 1)[0]}) as active:
+                response = send(method, url, **kwargs)
+                active.set_attribute('http.response.status_code', response.status_code)
+                failed = response.status_code >= 500
+                if failed:
+                    active.set_error(f"HTTP {response.status_code}")
+                return response
+        finally:
+            elapsed = time.perf_counter() - start
+            record_dependency(self.peer_service, elapsed, failed)
+            breaker.record(elapsed, failed)
+
+    def get(self, url: str, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url: str, **kwargs):
+        return self.request('POST', url, **kwargs)
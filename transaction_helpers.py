@@ -1,8 +1,8 @@
 from sqlalchemy.orm import Session
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy import and_
+from sqlalchemy import and_, insert
 from models import Transaction, User, TransactionType, TransactionStatus
-from database import db_manager
+from database import db_manager, replica_read
 from user_helpers import UserManager
 import logging
 from datetime import datetime
@@ -326,6 +326,7 @@ class TransactionManager:
             return False
     
     @staticmethod
+    @replica_read()
     def get_user_transactions(phone_number: str, limit: int = 20, 
                             transaction_type: str = None) -> List[Transaction]:
         """
@@ -438,6 +439,249 @@ class TransactionManager:
             logger.error(f"Error reversing transaction: {e}")
             return False
 
+    # Batch operations
+    #
+    # Reconciliation, bulk payout and settlement jobs call these instead of
+    # looping over the single-row helpers above, so a whole batch shares one
+    # connection checkout and one COMMIT. Row locks are always taken in
+    # ascending primary key order so two concurrent batches touching the same
+    # users cannot deadlock each other. Every item gets an outcome dict in
+    # input order instead of the whole batch failing on one bad row.
+
+    @staticmethod
+    def _outcome(success: bool, error: str = None, **extra) -> Dict[str, Any]:
+        """Build a per-item batch outcome"""
+        return {'success': success, 'error': error, **extra}
+
+    @staticmethod
+    def _lock_users_by_phone(session, phone_numbers: List[str],
+                             create_missing: bool = False) -> Dict[str, User]:
+        """
+        Lock the users for a set of phone numbers in a deterministic order.
+
+        Args:
+            session: Active database session
+            phone_numbers: Phone numbers to lock (duplicates allowed)
+            create_missing: Create users that do not exist yet
+
+        Returns:
+            Dictionary of phone number to locked User
+        """
+        unique_phones = sorted(set(phone_numbers))
+        if not unique_phones:
+            return {}
+
+        if create_missing:
+            existing = {
+                phone for (phone,) in session.query(User.phone_number).filter(
+                    User.phone_number.in_(unique_phones)
+                )
+            }
+            missing = [phone for phone in unique_phones if phone not in existing]
+            if missing:
+                session.add_all([User(phone_number=phone, balance_sats=0) for phone in missing])
+                session.flush()
+                logger.info(f"Created {len(missing)} users for batch operation")
+
+        users = session.query(User).filter(
+            User.phone_number.in_(unique_phones)
+        ).order_by(User.id).with_for_update().all()
+
+        return {user.phone_number: user for user in users}
+
+    @staticmethod
+    def log_topup_transactions(topups: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Log a batch of M-Pesa topups with atomic balance additions.
+
+        Args:
+            topups: List of dicts with phone_number, amount_sats,
+                    mpesa_transaction_id and an optional description
+
+        Returns:
+            List of outcome dicts in input order, each with success, error,
+            phone_number and mpesa_transaction_id
+        """
+        outcomes = []
+        accepted = []
+        seen_mpesa_ids = set()
+
+        for topup in topups:
+            phone_number = topup.get('phone_number')
+            amount_sats = topup.get('amount_sats')
+            mpesa_transaction_id = topup.get('mpesa_transaction_id')
+            outcome = TransactionManager._outcome(
+                False, phone_number=phone_number, mpesa_transaction_id=mpesa_transaction_id
+            )
+
+            if not phone_number or not isinstance(amount_sats, int) or amount_sats <= 0:
+                outcome['error'] = "Invalid phone number or amount"
+            elif mpesa_transaction_id in seen_mpesa_ids:
+                outcome['error'] = "Duplicate M-Pesa transaction ID in batch"
+            else:
+                seen_mpesa_ids.add(mpesa_transaction_id)
+                accepted.append((outcome, topup))
+
+            outcomes.append(outcome)
+
+        if not accepted:
+            return outcomes
+
+        try:
+            with db_manager.get_session() as session:
+                users = TransactionManager._lock_users_by_phone(
+                    session, [topup['phone_number'] for _, topup in accepted], create_missing=True
+                )
+
+                rows = []
+                for outcome, topup in accepted:
+                    user = users.get(topup['phone_number'])
+                    if not user:
+                        outcome['error'] = "User not found"
+                        continue
+
+                    user.balance_sats += topup['amount_sats']
+                    rows.append({
+                        'user_id': user.id,
+                        'transaction_type': TransactionType.TOPUP.value,
+                        'amount_sats': topup['amount_sats'],
+                        'status': TransactionStatus.COMPLETED.value,
+                        'mpesa_transaction_id': topup['mpesa_transaction_id'],
+                        'description': topup.get('description') or f"M-Pesa topup: {topup['amount_sats']} sats"
+                    })
+                    outcome['success'] = True
+
+                if rows:
+                    session.execute(insert(Transaction), rows)
+
+                session.commit()
+
+            logger.info(f"Logged {len(rows)}/{len(topups)} topup transactions in batch")
+
+        except SQLAlchemyError as e:
+            logger.error(f"Error logging topup batch: {e}")
+            for outcome, _ in accepted:
+                outcome['success'] = False
+                outcome['error'] = "Database error"
+
+        return outcomes
+
+    @staticmethod
+    def update_transaction_statuses(statuses: Dict[int, str],
+                                    mpesa_transaction_ids: Dict[int, str] = None) -> Dict[int, bool]:
+        """
+        Update the status of many transactions with one IN-list update per status.
+
+        Args:
+            statuses: Mapping of transaction ID to new status
+            mpesa_transaction_ids: Optional mapping of transaction ID to M-Pesa ID
+
+        Returns:
+            Mapping of transaction ID to True if updated, False otherwise
+        """
+        outcomes = {transaction_id: False for transaction_id in statuses}
+        if not statuses:
+            return outcomes
+
+        mpesa_transaction_ids = mpesa_transaction_ids or {}
+
+        try:
+            with db_manager.get_session() as session:
+                found_ids = [
+                    transaction_id for (transaction_id,) in session.query(Transaction.id).filter(
+                        Transaction.id.in_(sorted(statuses))
+                    ).order_by(Transaction.id).with_for_update()
+                ]
+
+                by_status = {}
+                for transaction_id in found_ids:
+                    by_status.setdefault(statuses[transaction_id], []).append(transaction_id)
+
+                for new_status, transaction_ids in by_status.items():
+                    session.query(Transaction).filter(
+                        Transaction.id.in_(transaction_ids)
+                    ).update({'status': new_status}, synchronize_session=False)
+
+                for transaction_id in found_ids:
+                    mpesa_id = mpesa_transaction_ids.get(transaction_id)
+                    if mpesa_id:
+                        session.query(Transaction).filter_by(id=transaction_id).update(
+                            {'mpesa_transaction_id': mpesa_id}, synchronize_session=False
+                        )
+
+                session.commit()
+
+                for transaction_id in found_ids:
+                    outcomes[transaction_id] = True
+
+            missing = len(statuses) - len(found_ids)
+            if missing:
+                logger.error(f"{missing} transactions not found for batch status update")
+            logger.info(f"Updated status of {len(found_ids)} transactions in batch")
+
+        except SQLAlchemyError as e:
+            logger.error(f"Error updating transaction statuses: {e}")
+            return {transaction_id: False for transaction_id in statuses}
+
+        return outcomes
+
+    @staticmethod
+    def reverse_failed_transactions(transaction_ids: List[int],
+                                    reason: str = "Transaction failed") -> Dict[int, bool]:
+        """
+        Reverse a batch of failed send/withdraw transactions.
+
+        Args:
+            transaction_ids: Transaction IDs to reverse
+            reason: Reason for reversal
+
+        Returns:
+            Mapping of transaction ID to True if reversed, False otherwise
+        """
+        outcomes = {transaction_id: False for transaction_id in transaction_ids}
+        if not transaction_ids:
+            return outcomes
+
+        try:
+            with db_manager.get_session() as session:
+                transactions = session.query(Transaction).filter(
+                    Transaction.id.in_(sorted(set(transaction_ids))),
+                    Transaction.transaction_type.in_([TransactionType.SEND.value, TransactionType.WITHDRAW.value]),
+                    Transaction.status != TransactionStatus.FAILED.value
+                ).order_by(Transaction.id).with_for_update().all()
+
+                user_ids = sorted({transaction.user_id for transaction in transactions})
+                users = {
+                    user.id: user for user in session.query(User).filter(
+                        User.id.in_(user_ids)
+                    ).order_by(User.id).with_for_update().all()
+                } if user_ids else {}
+
+                reversed_ids = []
+                for transaction in transactions:
+                    user = users.get(transaction.user_id)
+                    if not user:
+                        logger.error(f"User not found for transaction reversal: {transaction.user_id}")
+                        continue
+
+                    user.balance_sats += transaction.amount_sats
+                    transaction.status = TransactionStatus.FAILED.value
+                    transaction.description = f"{transaction.description or ''} - REVERSED: {reason}"
+                    reversed_ids.append(transaction.id)
+
+                session.commit()
+
+                for transaction_id in reversed_ids:
+                    outcomes[transaction_id] = True
+
+            logger.info(f"Reversed {len(reversed_ids)}/{len(outcomes)} transactions in batch")
+
+        except SQLAlchemyError as e:
+            logger.error(f"Error reversing transaction batch: {e}")
+            return {transaction_id: False for transaction_id in transaction_ids}
+
+        return outcomes
+
 # Wrapper functions for existing USSD operations
 def send_btc_with_logging(sender_phone: str, recipient_phone: str, amount_sats: int,
                          lightning_payment_hash: str = None, invoice_string: str = None) -> Optional[Transaction]:
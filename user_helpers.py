@@ -1,7 +1,7 @@
 from sqlalchemy.orm import Session
 from sqlalchemy.exc import SQLAlchemyError, IntegrityError
 from models import User
-from database import db_manager
+from database import db_manager, replica_read
 import logging
 from typing import Optional, Tuple
 
@@ -197,6 +197,7 @@ class UserManager:
             return False
     
     @staticmethod
+    @replica_read()
     def get_all_users_with_balance() -> list:
         """
         Get all users who have a positive balance.
@@ -0,0 +1,407 @@
+"""
+USSD screen templates
+Per-language screen registry with pre-rendered static screens, length checks and "98. More" pagination
+
+Static screens are rendered once when they are registered; screens with slots
+are compiled into literal/slot parts so a render is one join. Every screen's
+worst-case length is checked against the gateway budget at import time, and
+any response that still comes out too long is split into pages instead of
+being cut off by the gateway.
+
+Usage:
+    from ussd_screens import render, screens
+
+    render('main_menu', 'sw', balance=15000)
+    screens.respond(session_id, response)   # paginates when over budget
+"""
+import logging
+import threading
+from collections import OrderedDict
+from string import Formatter
+from typing import Dict, List, Optional, Tuple
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+MORE_OPTION = "98"
+MORE_FOOTER = f"\n{MORE_OPTION}. More"
+
+# Worst-case rendered width of common slots, used for build-time length checks
+DEFAULT_SLOT_WIDTHS = {
+    'balance': 13,   # 1,000,000,000
+    'sats': 13,
+    'kes': 9,        # 1,000,000
+    'phone': 13,     # +254712345678
+    'rate': 40,
+    'minimum': 9,    # Rule thresholds in KES
+    'maximum': 9,
+}
+
+class ScreenTooLongError(ValueError):
+    """Raised when a screen can exceed the gateway budget and may not be paginated"""
+
+class Screen:
+    """A compiled screen template for one language"""
+    __slots__ = ('name', 'language', 'static', 'parts', 'max_length')
+
+    def __init__(self, name: str, language: str, template: str, widths: Dict[str, int]):
+        self.name = name
+        self.language = language
+        self.parts: List[Tuple[str, Optional[str], str]] = []
+
+        max_length = 0
+        for literal, field, spec, _ in Formatter().parse(template):
+            max_length += len(literal)
+            if field is not None:
+                if field not in widths:
+                    raise ValueError(f"Screen '{name}' ({language}): no width declared for slot '{field}'")
+                max_length += widths[field]
+            self.parts.append((literal, field, spec or ''))
+        self.max_length = max_length
+
+        # Screens without slots are rendered once, here
+        self.static = template if all(field is None for _, field, _ in self.parts) else None
+
+    def render(self, slots: Dict) -> str:
+        if self.static is not None:
+            return self.static
+        return ''.join(literal + (format(slots[field], spec) if field is not None else '')
+                       for literal, field, spec in self.parts)
+
+class ScreenRegistry:
+    """
+    Screens by name and language, plus pending pages of paginated responses.
+
+    A response longer than the budget is split on line boundaries into pages
+    that end with "98. More"; the remaining pages are kept per session and
+    served when the user answers 98. Every page but the last is a CON screen.
+    """
+
+    def __init__(self, budget: int = None, default_language: str = None, max_pending: int = 1024):
+        self.budget = budget if budget is not None else Config.USSD_MAX_CHARS
+        self.default_language = default_language or Config.USSD_DEFAULT_LANGUAGE
+        self.max_pending = max_pending
+        self._screens: Dict[Tuple[str, str], Screen] = {}
+        self._pending: 'OrderedDict[str, List[str]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def register(self, name: str, templates: Dict[str, str], widths: Dict[str, int] = None,
+                 paginate: bool = False):
+        """
+        Compile a screen for each language.
+
+        Args:
+            name: Screen name used with render()
+            templates: Template per language code, with str.format slots
+            widths: Worst-case widths for slots not in DEFAULT_SLOT_WIDTHS
+            paginate: Allow the screen to exceed the budget (it will be paged)
+
+        Raises:
+            ScreenTooLongError: If a template can exceed the budget and paginate is False
+        """
+        slot_widths = dict(DEFAULT_SLOT_WIDTHS, **(widths or {}))
+        for language, template in templates.items():
+            screen = Screen(name, language, template, slot_widths)
+            if screen.max_length > self.budget and not paginate:
+                raise ScreenTooLongError(f"Screen '{name}' ({language}) can reach {screen.max_length} "
+                                         f"characters, budget is {self.budget}")
+            self._screens[(name, language)] = screen
+
+    def render(self, name: str, language: str = None, **slots) -> str:
+        """Render a screen, falling back to the default language"""
+        screen = self._screens.get((name, language or self.default_language)) \
+            or self._screens[(name, self.default_language)]
+        return screen.render(slots)
+
+    def paginate(self, response: str) -> List[str]:
+        """Split a response into pages that fit the budget (a single page if it already fits)"""
+        if len(response) <= self.budget:
+            return [response]
+
+        kind, body = (response[:3], response[4:]) if response[:4] in ("CON ", "END ") else ("END", response)
+        room = self.budget - len("CON ") - len(MORE_FOOTER)
+
+        # Lines longer than a page are wrapped on spaces (or hard-split as a last resort)
+        lines = []
+        for line in body.split('\n'):
+            while len(line) > room:
+                cut = line.rfind(' ', 0, room + 1)
+                cut = cut if cut > 0 else room
+                lines.append(line[:cut])
+                line = line[cut:].lstrip(' ')
+            lines.append(line)
+
+        pages, current = [], None
+        for line in lines:
+            candidate = line if current is None else f"{current}\n{line}"
+            if len(candidate) > room:
+                pages.append(current)
+                current = line
+            else:
+                current = candidate
+        pages.append(current)
+
+        # The last page may use the footer's room
+        if len(pages) > 1 and len(f"{pages[-2]}\n{pages[-1]}") <= self.budget - len("CON "):
+            pages[-2:] = [f"{pages[-2]}\n{pages[-1]}"]
+
+        rendered = [f"CON {page}{MORE_FOOTER}" for page in pages[:-1]]
+        rendered.append(f"{kind} {pages[-1]}")
+        return rendered
+
+    def respond(self, session_id: str, response: str) -> str:
+        """First page of a response, keeping any further pages for the session"""
+        if len(response) <= self.budget:
+            if session_id in self._pending:
+                self.discard(session_id)
+            return response
+
+        pages = self.paginate(response)
+        logger.info(f"USSD screen of {len(response)} characters split into {len(pages)} pages")
+        with self._lock:
+            self._pending[session_id] = pages[1:]
+            self._pending.move_to_end(session_id)
+            while len(self._pending) > self.max_pending:
+                self._pending.popitem(last=False)
+        return pages[0]
+
+    def has_more(self, session_id: str) -> bool:
+        return session_id in self._pending
+
+    def next_page(self, session_id: str) -> Optional[str]:
+        """Next pending page for a session, or None"""
+        with self._lock:
+            pages = self._pending.get(session_id)
+            if not pages:
+                return None
+            page = pages.pop(0)
+            if not pages:
+                del self._pending[session_id]
+        return page
+
+    def discard(self, session_id: str):
+        """Drop pending pages for a session"""
+        with self._lock:
+            self._pending.pop(session_id, None)
+
+# Global instance
+screens = ScreenRegistry()
+
+def render(name: str, language: str = None, **slots) -> str:
+    """Render a registered screen"""
+    return screens.render(name, language, **slots)
+
+def session_language(session) -> str:
+    """Language for a USSD session ('language' session data, else the default)"""
+    return session.get_data('language') or screens.default_language
+
+def render_for(session, name: str, **slots) -> str:
+    """Render a registered screen in the session's language"""
+    return screens.render(name, session_language(session), **slots)
+
+# The welcome line already names the service, so the menu skips the
+# "Bitcoin Lightning" header to stay within budget for 7-digit balances
+screens.register('main_menu', {
+    'en': ("CON Welcome to Bitcoin Lightning!\n"
+           "₿ Balance: {balance:,} sats\n\n"
+           "1. Send BTC\n"
+           "2. Receive BTC\n"
+           "3. Send Invoice\n"
+           "4. Buy BTC (M-Pesa)\n"
+           "5. Withdraw M-Pesa\n"
+           "6. Buy Airtime\n"
+           "0. Exit"),
+    'sw': ("CON Karibu Bitcoin Lightning!\n"
+           "₿ Salio: {balance:,} sats\n\n"
+           "1. Tuma BTC\n"
+           "2. Pokea BTC\n"
+           "3. Tuma Ankara\n"
+           "4. Nunua BTC (M-Pesa)\n"
+           "5. Toa M-Pesa\n"
+           "6. Nunua Airtime\n"
+           "0. Ondoka"),
+})
+
+# Menu body without the CON prefix (USSDHandlers.get_menu_text)
+screens.register('menu', {
+    'en': ("Bitcoin Lightning\n"
+           "1. Send BTC\n"
+           "2. Receive BTC\n"
+           "3. Send Invoice\n"
+           "4. Buy BTC (M-Pesa)\n"
+           "5. Withdraw M-Pesa\n"
+           "6. Buy Airtime\n"
+           "7. History\n"
+           "0. Exit"),
+    'sw': ("Bitcoin Lightning\n"
+           "1. Tuma BTC\n"
+           "2. Pokea BTC\n"
+           "3. Tuma Ankara\n"
+           "4. Nunua BTC (M-Pesa)\n"
+           "5. Toa M-Pesa\n"
+           "6. Nunua Airtime\n"
+           "7. Historia\n"
+           "0. Ondoka"),
+})
+
+screens.register('help', {
+    'en': ("END USSD Commands:\n"
+           "• Send: '1*phone*amount'\n"
+           "• Buy BTC: '4*amount_kes'\n"
+           "• Rates: 'rates?'\n"
+           "• Help: 'help'"),
+    'sw': ("END Amri za USSD:\n"
+           "• Tuma: '1*simu*kiasi'\n"
+           "• Nunua BTC: '4*kiasi_kes'\n"
+           "• Viwango: 'rates?'\n"
+           "• Msaada: 'help'"),
+})
+
+screens.register('rates', {
+    'en': "END Current rate: {rate}",
+    'sw': "END Kiwango cha sasa: {rate}",
+})
+
+screens.register('exit', {
+    'en': "END Thank you for using Bitcoin Lightning!",
+    'sw': "END Asante kwa kutumia Bitcoin Lightning!",
+})
+
+screens.register('send_btc_phone', {
+    'en': "CON Send BTC\nEnter recipient phone number:",
+    'sw': "CON Tuma BTC\nWeka nambari ya simu ya mpokeaji:",
+})
+
+screens.register('send_btc_amount', {
+    'en': "CON Send BTC to {phone}\nEnter amount in sats:",
+    'sw': "CON Tuma BTC kwa {phone}\nWeka kiasi kwa sats:",
+})
+
+screens.register('receive_btc_amount', {
+    'en': "CON Receive BTC\nEnter amount in sats:",
+    'sw': "CON Pokea BTC\nWeka kiasi kwa sats:",
+})
+
+screens.register('send_invoice_phone', {
+    'en': "CON Send Invoice\nEnter recipient phone number:",
+    'sw': "CON Tuma Ankara\nWeka nambari ya simu ya mpokeaji:",
+})
+
+screens.register('send_invoice_amount', {
+    'en': "CON Send invoice to {phone}\nEnter amount in sats:",
+    'sw': "CON Tuma ankara kwa {phone}\nWeka kiasi kwa sats:",
+})
+
+screens.register('topup_amount', {
+    'en': ("CON Buy BTC with M-Pesa\n"
+           "Enter KES amount (Min: {minimum:,} KES):\n\n"
+           "(Ask 'rates?' or say 'back')"),
+    'sw': ("CON Nunua BTC kwa M-Pesa\n"
+           "Weka kiasi cha KES (Chini: {minimum:,} KES):\n\n"
+           "(Uliza 'rates?' au sema 'back')"),
+})
+
+screens.register('topup_invalid_amount', {
+    'en': ("CON Invalid amount. Please enter a valid number.\n"
+           "Enter KES amount (Min: {minimum:,} KES):\n\n"
+           "(Ask 'rates?' or say 'back')"),
+    'sw': ("CON Kiasi si sahihi. Tafadhali weka nambari sahihi.\n"
+           "Weka kiasi cha KES (Chini: {minimum:,} KES):\n\n"
+           "(Uliza 'rates?' au sema 'back')"),
+})
+
+screens.register('topup_minimum', {
+    'en': ("CON Minimum top-up is {minimum:,} KES.\n"
+           "Enter KES amount (Min: {minimum:,} KES):\n\n"
+           "(Ask 'rates?' or say 'back')"),
+    'sw': ("CON Kiwango cha chini ni {minimum:,} KES.\n"
+           "Weka kiasi cha KES (Chini: {minimum:,} KES):\n\n"
+           "(Uliza 'rates?' au sema 'back')"),
+})
+
+screens.register('withdraw_minimum', {
+    'en': "CON Minimum withdrawal is {minimum:,} KES.\nEnter amount in KES:",
+    'sw': "CON Kiwango cha chini cha kutoa ni {minimum:,} KES.\nWeka kiasi kwa KES:",
+})
+
+screens.register('withdraw_insufficient', {
+    'en': "CON Insufficient balance.\nNeed {sats} sats, have {balance} sats.\nEnter amount in KES:",
+    'sw': "CON Salio halitoshi.\nUnahitaji {sats} sats, una {balance} sats.\nWeka kiasi kwa KES:",
+})
+
+screens.register('withdraw_amount', {
+    'en': "CON Withdraw to M-Pesa\nEnter amount in KES:",
+    'sw': "CON Toa kwa M-Pesa\nWeka kiasi kwa KES:",
+})
+
+screens.register('withdraw_phone', {
+    'en': "CON Withdraw {kes} KES ({sats} sats)\nEnter M-Pesa phone number:",
+    'sw': "CON Toa {kes} KES ({sats} sats)\nWeka nambari ya simu ya M-Pesa:",
+})
+
+screens.register('airtime_amount', {
+    'en': "CON Buy Airtime\nEnter amount in KES ({minimum}-{maximum}):",
+    'sw': "CON Nunua Airtime\nWeka kiasi kwa KES ({minimum}-{maximum}):",
+})
+
+screens.register('airtime_minimum', {
+    'en': "CON Minimum airtime purchase is {minimum:,} KES.\nEnter amount in KES:",
+    'sw': "CON Kiwango cha chini cha airtime ni {minimum:,} KES.\nWeka kiasi kwa KES:",
+})
+
+screens.register('airtime_maximum', {
+    'en': "CON Maximum airtime purchase is {maximum:,} KES.\nEnter amount in KES:",
+    'sw': "CON Kiwango cha juu cha airtime ni {maximum:,} KES.\nWeka kiasi kwa KES:",
+})
+
+screens.register('airtime_recipient', {
+    'en': "CON Buy {kes} KES airtime\n\n1. For my number ({phone})\n2. For another number",
+    'sw': "CON Nunua airtime ya {kes} KES\n\n1. Kwa nambari yangu ({phone})\n2. Kwa nambari nyingine",
+})
+
+screens.register('airtime_phone', {
+    'en': "CON Enter phone number for airtime:",
+    'sw': "CON Weka nambari ya simu ya airtime:",
+})
+
+screens.register('invalid_phone', {
+    'en': "CON Invalid phone number format.\nEnter recipient phone number:",
+    'sw': "CON Nambari ya simu si sahihi.\nWeka nambari ya simu ya mpokeaji:",
+})
+
+screens.register('invalid_mpesa_phone', {
+    'en': "CON Invalid phone number format.\nEnter M-Pesa phone number:",
+    'sw': "CON Nambari ya simu si sahihi.\nWeka nambari ya simu ya M-Pesa:",
+})
+
+screens.register('invalid_airtime_phone', {
+    'en': "CON Invalid phone number format.\nEnter phone number for airtime:",
+    'sw': "CON Nambari ya simu si sahihi.\nWeka nambari ya simu ya airtime:",
+})
+
+screens.register('invalid_amount_sats', {
+    'en': "CON Invalid amount. Enter amount in sats:",
+    'sw': "CON Kiasi si sahihi. Weka kiasi kwa sats:",
+})
+
+screens.register('invalid_amount_kes', {
+    'en': "CON Invalid amount. Enter amount in KES:",
+    'sw': "CON Kiasi si sahihi. Weka kiasi kwa KES:",
+})
+
+screens.register('service_unavailable', {
+    'en': "END Service temporarily unavailable.\nPlease try again later.",
+    'sw': "END Huduma haipatikani kwa sasa.\nTafadhali jaribu tena baadaye.",
+})
+
+screens.register('processing_error', {
+    'en': "END Error processing request. Please try again.",
+    'sw': "END Hitilafu katika ombi. Tafadhali jaribu tena.",
+})
+
+if __name__ == "__main__":
+    # Print every screen with its worst-case length against the budget
+    for (name, language), screen in sorted(screens._screens.items()):
+        print(f"{name:24} {language}  {screen.max_length:4}/{screens.budget}"
+              f"{'  static' if screen.static is not None else ''}")